@@ -19,6 +19,10 @@
 
 #include <Python.h>
 #include <stdint.h>
+#include <limits.h>
+#include <zlib.h>
+
+static PyObject *zlib_error;
 
 static int py_is_sha(PyObject *sha)
 {
@@ -181,6 +185,185 @@ static PyObject *py_apply_delta(PyObject *self, PyObject *args)
 	return ret_list;
 }
 
+#define DELTA_BLOCK_SIZE 16
+#define DELTA_MAX_COPY 0x10000
+#define DELTA_HASH_MULT 0x01000193U
+
+static uint32_t delta_block_hash(const uint8_t *data)
+{
+	uint32_t h = 0;
+	int i;
+	for (i = 0; i < DELTA_BLOCK_SIZE; i++)
+		h = h * DELTA_HASH_MULT + data[i];
+	return h;
+}
+
+static uint8_t *delta_encode_size(uint8_t *out, size_t size)
+{
+	uint8_t c = size & 0x7f;
+	size >>= 7;
+	while (size) {
+		*out++ = c | 0x80;
+		c = size & 0x7f;
+		size >>= 7;
+	}
+	*out++ = c;
+	return out;
+}
+
+static uint8_t *delta_encode_insert(uint8_t *out, const uint8_t *data,
+				    size_t len)
+{
+	while (len > 0) {
+		size_t n = len > 127 ? 127 : len;
+		*out++ = n;
+		memcpy(out, data, n);
+		out += n;
+		data += n;
+		len -= n;
+	}
+	return out;
+}
+
+static uint8_t *delta_encode_copy(uint8_t *out, size_t offset, size_t size)
+{
+	uint8_t *op = out++;
+	int i;
+	*op = 0x80;
+	for (i = 0; i < 4; i++) {
+		if (offset & (0xffUL << (i * 8))) {
+			*out++ = (offset >> (i * 8)) & 0xff;
+			*op |= 1 << i;
+		}
+	}
+	for (i = 0; i < 2; i++) {
+		if (size & (0xffUL << (i * 8))) {
+			*out++ = (size >> (i * 8)) & 0xff;
+			*op |= 1 << (4 + i);
+		}
+	}
+	return out;
+}
+
+/*
+ * Create a delta from src_buf to trg_buf, producing the same output as the
+ * pure Python create_delta in pack.py: the source is indexed in blocks of
+ * DELTA_BLOCK_SIZE bytes, and the target is scanned with a rolling hash for
+ * matching blocks, which are then extended in both directions.
+ */
+static PyObject *py_create_delta(PyObject *self, PyObject *args)
+{
+	const uint8_t *src, *trg;
+	int src_len, trg_len;
+	size_t nblocks, hash_size, hash_mask, i, insert_start, out_max;
+	Py_ssize_t *heads, *next;
+	uint32_t h = 0, mult_pow;
+	uint8_t *out, *pos;
+	PyObject *ret;
+
+	if (!PyArg_ParseTuple(args, "s#s#", &src, &src_len, &trg, &trg_len))
+		return NULL;
+
+	nblocks = src_len / DELTA_BLOCK_SIZE;
+	hash_size = 1;
+	while (hash_size < nblocks * 2)
+		hash_size <<= 1;
+	hash_mask = hash_size - 1;
+
+	heads = PyMem_New(Py_ssize_t, hash_size);
+	next = PyMem_New(Py_ssize_t, nblocks + 1);
+	if (heads == NULL || next == NULL) {
+		PyMem_Free(heads);
+		PyMem_Free(next);
+		return PyErr_NoMemory();
+	}
+	for (i = 0; i < hash_size; i++)
+		heads[i] = -1;
+	/*
+	 * Insert blocks back to front, so each bucket is ordered by ascending
+	 * offset and the first match is the earliest block in the source.
+	 */
+	for (i = nblocks; i > 0; i--) {
+		size_t b = i - 1;
+		h = delta_block_hash(src + b * DELTA_BLOCK_SIZE) & hash_mask;
+		next[b] = heads[h];
+		heads[h] = b;
+	}
+
+	/* Worst case: all inserts, plus a few header bytes. */
+	out_max = 2 * (size_t)trg_len + 64;
+	ret = PyString_FromStringAndSize(NULL, out_max);
+	if (ret == NULL) {
+		PyMem_Free(heads);
+		PyMem_Free(next);
+		return NULL;
+	}
+	out = (uint8_t *)PyString_AS_STRING(ret);
+	pos = delta_encode_size(out, src_len);
+	pos = delta_encode_size(pos, trg_len);
+
+	mult_pow = 1;
+	for (i = 0; i < DELTA_BLOCK_SIZE - 1; i++)
+		mult_pow *= DELTA_HASH_MULT;
+
+	insert_start = 0;
+	i = 0;
+	if (nblocks > 0 && trg_len >= DELTA_BLOCK_SIZE)
+		h = delta_block_hash(trg);
+	while (nblocks > 0 && i + DELTA_BLOCK_SIZE <= (size_t)trg_len) {
+		Py_ssize_t b;
+		size_t src_off, len, max_len;
+
+		for (b = heads[h & hash_mask]; b >= 0; b = next[b]) {
+			if (!memcmp(src + b * DELTA_BLOCK_SIZE, trg + i,
+				    DELTA_BLOCK_SIZE))
+				break;
+		}
+		if (b < 0) {
+			if (i + DELTA_BLOCK_SIZE < (size_t)trg_len)
+				h = (h - trg[i] * mult_pow) * DELTA_HASH_MULT +
+					trg[i + DELTA_BLOCK_SIZE];
+			i++;
+			continue;
+		}
+
+		src_off = b * DELTA_BLOCK_SIZE;
+		while (i > insert_start && src_off > 0 &&
+		       trg[i - 1] == src[src_off - 1]) {
+			i--;
+			src_off--;
+		}
+		len = DELTA_BLOCK_SIZE;
+		max_len = src_len - src_off;
+		if (trg_len - i < max_len)
+			max_len = trg_len - i;
+		while (len < max_len && src[src_off + len] == trg[i + len])
+			len++;
+
+		pos = delta_encode_insert(pos, trg + insert_start,
+					  i - insert_start);
+		i += len;
+		insert_start = i;
+		while (len > 0) {
+			size_t n = len > DELTA_MAX_COPY ? DELTA_MAX_COPY : len;
+			pos = delta_encode_copy(pos, src_off, n);
+			src_off += n;
+			len -= n;
+		}
+		if (i + DELTA_BLOCK_SIZE <= (size_t)trg_len)
+			h = delta_block_hash(trg + i);
+	}
+	pos = delta_encode_insert(pos, trg + insert_start,
+				  trg_len - insert_start);
+
+	PyMem_Free(heads);
+	PyMem_Free(next);
+
+	if (_PyString_Resize(&ret, pos - out) < 0)
+		return NULL;
+	return ret;
+}
+
 static PyObject *py_bisect_find_sha(PyObject *self, PyObject *args)
 {
 	PyObject *unpack_name;
@@ -227,15 +410,182 @@ static PyObject *py_bisect_find_sha(PyObject *self, PyObject *args)
 }
 
 
+/*
+ * The largest ratio between the uncompressed and compressed sizes of a zlib
+ * stream; buffers that are too small to hold an object of the given size are
+ * rejected before allocating its contents.
+ */
+#define ZLIB_MAX_RATIO 1032
+
+/*
+ * Unpack an object that is contained in a buffer, like the pure Python
+ * unpack_object_buffer in pack.py: returns None if the buffer does not
+ * contain the whole object followed by at least one byte.
+ */
+static PyObject *py_unpack_object_buffer(PyObject *self, PyObject *args)
+{
+	const uint8_t *data;
+	int len, pos = 0, shift = 4, ret;
+	int compute_crc32 = 0, include_comp = 0;
+	int type_num;
+	uint8_t c, extra;
+	unsigned long long size, base_offset;
+	z_stream zs;
+	PyObject *py_delta_base, *py_decomp, *py_comp, *py_crc32;
+
+	if (!PyArg_ParseTuple(args, "s#|ii", &data, &len, &compute_crc32,
+						  &include_comp))
+		return NULL;
+
+	if (len == 0)
+		Py_RETURN_NONE;
+	c = data[pos++];
+	type_num = (c >> 4) & 0x07;
+	size = c & 0x0f;
+	while (c & 0x80) {
+		if (pos >= len)
+			Py_RETURN_NONE;
+		c = data[pos++];
+		if (shift < 64)
+			size += (unsigned long long)(c & 0x7f) << shift;
+		shift += 7;
+	}
+
+	if (type_num == 6) { /* OFS_DELTA */
+		if (pos >= len)
+			Py_RETURN_NONE;
+		c = data[pos++];
+		base_offset = c & 0x7f;
+		while (c & 0x80) {
+			if (pos >= len)
+				Py_RETURN_NONE;
+			c = data[pos++];
+			base_offset = ((base_offset + 1) << 7) + (c & 0x7f);
+		}
+		py_delta_base = PyLong_FromUnsignedLongLong(base_offset);
+	} else if (type_num == 7) { /* REF_DELTA */
+		if (pos + 20 > len)
+			Py_RETURN_NONE;
+		py_delta_base = PyString_FromStringAndSize((const char *)data + pos,
+												   20);
+		pos += 20;
+	} else {
+		Py_INCREF(Py_None);
+		py_delta_base = Py_None;
+	}
+	if (py_delta_base == NULL)
+		return NULL;
+
+	if (size > (unsigned long long)(len - pos) * ZLIB_MAX_RATIO + 64 ||
+		size > PY_SSIZE_T_MAX || size > UINT_MAX) {
+		Py_DECREF(py_delta_base);
+		Py_RETURN_NONE;
+	}
+
+	py_decomp = PyString_FromStringAndSize(NULL, (Py_ssize_t)size);
+	if (py_decomp == NULL) {
+		Py_DECREF(py_delta_base);
+		return NULL;
+	}
+
+	memset(&zs, 0, sizeof(zs));
+	if (inflateInit(&zs) != Z_OK) {
+		Py_DECREF(py_delta_base);
+		Py_DECREF(py_decomp);
+		PyErr_SetString(zlib_error, "unable to initialize decompression");
+		return NULL;
+	}
+	zs.next_in = (Bytef *)data + pos;
+	zs.avail_in = len - pos;
+	zs.next_out = (Bytef *)PyString_AS_STRING(py_decomp);
+	zs.avail_out = (uInt)size;
+
+	Py_BEGIN_ALLOW_THREADS
+	for (;;) {
+		ret = inflate(&zs, Z_SYNC_FLUSH);
+		if (ret != Z_OK && ret != Z_BUF_ERROR)
+			break;
+		if (zs.avail_in == 0)
+			break;
+		if (zs.avail_out == 0) {
+			if (zs.total_out > size)
+				break;
+			/* Room for one more byte, to find the end of the stream or
+			 * notice that the object is larger than its header says. */
+			zs.next_out = &extra;
+			zs.avail_out = 1;
+		}
+	}
+	Py_END_ALLOW_THREADS
+	inflateEnd(&zs);
+
+	if (ret != Z_STREAM_END && ret != Z_OK && ret != Z_BUF_ERROR) {
+		Py_DECREF(py_delta_base);
+		Py_DECREF(py_decomp);
+		PyErr_Format(zlib_error, "Error %d while decompressing data", ret);
+		return NULL;
+	}
+	if (zs.avail_in == 0) {
+		/* The end of the stream may not have been reached. */
+		Py_DECREF(py_delta_base);
+		Py_DECREF(py_decomp);
+		Py_RETURN_NONE;
+	}
+	if (ret != Z_STREAM_END || zs.total_out != size) {
+		Py_DECREF(py_delta_base);
+		Py_DECREF(py_decomp);
+		PyErr_SetString(zlib_error,
+			"decompressed data does not match expected size");
+		return NULL;
+	}
+
+	len -= zs.avail_in;
+	if (compute_crc32) {
+		py_crc32 = PyLong_FromUnsignedLong(crc32(0, data, len));
+	} else {
+		Py_INCREF(Py_None);
+		py_crc32 = Py_None;
+	}
+	if (include_comp) {
+		py_comp = PyString_FromStringAndSize((const char *)data + pos,
+											 len - pos);
+	} else {
+		Py_INCREF(Py_None);
+		py_comp = Py_None;
+	}
+	if (py_crc32 == NULL || py_comp == NULL) {
+		Py_DECREF(py_delta_base);
+		Py_DECREF(py_decomp);
+		Py_XDECREF(py_crc32);
+		Py_XDECREF(py_comp);
+		return NULL;
+	}
+
+	return Py_BuildValue("(iNKNNNi)", type_num, py_delta_base, size,
+						 py_decomp, py_comp, py_crc32, len);
+}
+
+
 static PyMethodDef py_pack_methods[] = {
 	{ "apply_delta", (PyCFunction)py_apply_delta, METH_VARARGS, NULL },
+	{ "create_delta", (PyCFunction)py_create_delta, METH_VARARGS, NULL },
 	{ "bisect_find_sha", (PyCFunction)py_bisect_find_sha, METH_VARARGS, NULL },
+	{ "unpack_object_buffer", (PyCFunction)py_unpack_object_buffer,
+		METH_VARARGS, NULL },
 	{ NULL, NULL, 0, NULL }
 };
 
 void init_pack(void)
 {
-	PyObject *m;
+	PyObject *m, *zlib_mod;
+
+	zlib_mod = PyImport_ImportModule("zlib");
+	if (zlib_mod == NULL)
+		return;
+	zlib_error = PyObject_GetAttrString(zlib_mod, "error");
+	Py_DECREF(zlib_mod);
+	if (zlib_error == NULL)
+		return;
 
 	m = Py_InitModule3("_pack", py_pack_methods, NULL);
 	if (m == NULL)
@@ -29,6 +29,9 @@ The Dulwich client supports the following capabilities:
  * report-status
  * delete-refs
 
+Protocol version 2 can be used for fetching, over git://, HTTP and local
+subprocesses, by passing protocol_version=2 to the client.
+
 Known capabilities that are not supported:
 
  * shallow
@@ -39,11 +42,18 @@ Known capabilities that are not supported:
 __docformat__ = 'restructuredText'
 
 from cStringIO import StringIO
+import asyncore
+import httplib
+import os
 import select
 import socket
 import subprocess
+import sys
+import threading
+import time
 import urllib2
 import urlparse
+import zlib
 
 from dulwich.errors import (
     GitProtocolError,
@@ -53,11 +63,14 @@ from dulwich.errors import (
     )
 from dulwich.protocol import (
     _RBUFSIZE,
+    AGENT,
+    DELIM_PKT,
     PktLineParser,
     Protocol,
     TCP_GIT_PORT,
     ZERO_SHA,
     extract_capabilities,
+    pkt_line,
     )
 from dulwich.pack import (
     write_pack_objects,
@@ -78,6 +91,180 @@ COMMON_CAPABILITIES = ['ofs-delta', 'side-band-64k']
 FETCH_CAPABILITIES = ['thin-pack', 'multi_ack', 'multi_ack_detailed'] + COMMON_CAPABILITIES
 SEND_CAPABILITIES = ['report-status'] + COMMON_CAPABILITIES
 
+# Number of haves sent in the first round of a stateless negotiation; each
+# later round sends twice as many, up to MAX_HAVES_PER_ROUND
+HAVES_PER_ROUND = 32
+MAX_HAVES_PER_ROUND = 1024
+
+# Give up negotiating once this many haves have been sent since the last new
+# common commit, like git's MAX_IN_VAIN
+MAX_IN_VAIN = 256
+
+# Largest HTTP request body sent with a Content-Length, like git's
+# http.postBuffer; larger bodies are streamed in chunks of this size
+HTTP_POST_BUFFER = 1024 * 1024
+
+
+def _parse_refs(pkts):
+    """Parse a ref advertisement.
+
+    :param pkts: Iterable over the pkt-lines of the advertisement, up to but
+        not including the flush-pkt
+    :return: Tuple with a dictionary of refs and the set of server
+        capabilities
+    :raise GitProtocolError: if the server sent an error
+    """
+    server_capabilities = None
+    refs = {}
+    for pkt in pkts:
+        (sha, ref) = pkt.rstrip('\n').split(' ', 1)
+        if sha == 'ERR':
+            raise GitProtocolError(ref)
+        if server_capabilities is None:
+            (ref, server_capabilities) = extract_capabilities(ref)
+        refs[ref] = sha
+    return refs, set(server_capabilities or [])
+
+
+def _parse_v2_capabilities(pkts):
+    """Parse a protocol version 2 capability advertisement.
+
+    :param pkts: Iterable over the pkt-lines following "version 2", up to but
+        not including the flush-pkt
+    :return: Dictionary mapping capability names to their values, or None
+        for capabilities without a value
+    """
+    capabilities = {}
+    for pkt in pkts:
+        pkt = pkt.rstrip('\n')
+        if '=' in pkt:
+            name, value = pkt.split('=', 1)
+        else:
+            name, value = pkt, None
+        capabilities[name] = value
+    return capabilities
+
+
+def _v2_request(command, server_capabilities, args):
+    """Serialize a protocol version 2 command request.
+
+    :param command: Name of the command
+    :param server_capabilities: Capabilities advertised by the server
+    :param args: Arguments of the command, without trailing newlines
+    :return: The request as a string of pkt-lines
+    """
+    if command not in server_capabilities:
+        raise GitProtocolError('server does not support %s' % command)
+    ret = [pkt_line('command=%s\n' % command)]
+    if 'agent' in server_capabilities:
+        ret.append(pkt_line('agent=%s\n' % AGENT))
+    ret.append(pkt_line(DELIM_PKT))
+    ret.extend(pkt_line('%s\n' % arg) for arg in args)
+    ret.append(pkt_line(None))
+    return ''.join(ret)
+
+
+def _get_shallow(graph_walker, depth):
+    """Determine the shallow commits to announce to the server.
+
+    :param graph_walker: Graph walker of the local repository
+    :param depth: Requested depth, or None
+    :return: Sorted list of the local shallow commits, or None if the fetch
+        involves neither shallow commits nor a depth
+    """
+    shallow = sorted(getattr(graph_walker, 'shallow', None) or [])
+    if not shallow and depth is None:
+        return None
+    return shallow
+
+
+def _shallow_capabilities(server_capabilities):
+    """Return the capabilities to request for a shallow fetch.
+
+    :param server_capabilities: Capabilities advertised by the server
+    :raise GitProtocolError: If the server does not support shallow fetches
+    """
+    if 'shallow' not in server_capabilities:
+        raise GitProtocolError('server does not support shallow fetches')
+    return set(['shallow'])
+
+
+def _parse_shallow_update(pkts):
+    """Parse the shallow and unshallow lines sent by the server.
+
+    :param pkts: Iterable over the pkt-lines of the update
+    :return: Tuple with the sets of new shallow and unshallow commits
+    """
+    new_shallow = set()
+    new_unshallow = set()
+    for pkt in pkts:
+        fields = pkt.rstrip('\n').split(' ')
+        if len(fields) == 2 and fields[0] == 'shallow':
+            new_shallow.add(fields[1])
+        elif len(fields) == 2 and fields[0] == 'unshallow':
+            new_unshallow.add(fields[1])
+        else:
+            raise GitProtocolError('unexpected shallow update %r' % pkt)
+    return new_shallow, new_unshallow
+
+
+class _StatelessNegotiator(object):
+    """Keeps track of the haves of a stateless negotiation.
+
+    Each round is a separate request, which repeats the commits the server
+    acknowledged so far and sends a batch of new haves. The negotiation is
+    done when the server is ready, the graph walker runs out of haves, or
+    too many haves were sent in vain.
+
+    :ivar common: Commits acknowledged by the server, in order
+    :ivar done: Whether the last round returned by next_round() should end
+        the negotiation
+    """
+
+    def __init__(self, graph_walker, batch_size=HAVES_PER_ROUND):
+        """Create a new instance.
+
+        :param graph_walker: Object with next() and ack().
+        :param batch_size: Number of new haves in the first round, or None
+            to send all haves in a single round
+        """
+        self.graph_walker = graph_walker
+        self.common = []
+        self.done = False
+        self._batch_size = batch_size
+        self._in_vain = 0
+        self._ready = False
+        self._have = graph_walker.next()
+
+    def next_round(self):
+        """Return the new haves to send in the next round."""
+        haves = []
+        if self._ready or (self.common and self._in_vain > MAX_IN_VAIN):
+            self.done = True
+            return haves
+        while self._have and (self._batch_size is None or
+                              len(haves) < self._batch_size):
+            haves.append(self._have)
+            self._have = self.graph_walker.next()
+        self.done = not self._have
+        self._in_vain += len(haves)
+        if self._batch_size is not None:
+            self._batch_size = min(self._batch_size * 2, MAX_HAVES_PER_ROUND)
+        return haves
+
+    def ack(self, sha, ready=False):
+        """Handle an acknowledgment from the server.
+
+        :param sha: Commit the server has in common with us
+        :param ready: Whether the server is ready to send a pack
+        """
+        if ready:
+            self._ready = True
+        if sha is not None and sha not in self.common:
+            self.graph_walker.ack(sha)
+            self.common.append(sha)
+            self._in_vain = 0
+
 
 class ReportStatusParser(object):
     """Handle status as reported by servers with the 'report-status' capability.
@@ -145,13 +332,21 @@ class GitClient(object):
 
     """
 
-    def __init__(self, thin_packs=True, report_activity=None):
+    def __init__(self, thin_packs=True, report_activity=None,
+                 protocol_version=0):
         """Create a new GitClient instance.
 
         :param thin_packs: Whether or not thin packs should be retrieved
         :param report_activity: Optional callback for reporting transport
             activity.
+        :param protocol_version: Version of the git protocol to request when
+            fetching, 0 or 2. Servers that do not support version 2 are
+            talked to in version 0.
         """
+        if protocol_version not in (0, 2):
+            raise ValueError('unsupported protocol version %r' %
+                             protocol_version)
+        self._protocol_version = protocol_version
         self._report_activity = report_activity
         self._fetch_capabilities = set(FETCH_CAPABILITIES)
         self._send_capabilities = set(SEND_CAPABILITIES)
@@ -159,17 +354,7 @@ class GitClient(object):
             self._fetch_capabilities.remove('thin-pack')
 
     def _read_refs(self, proto):
-        server_capabilities = None
-        refs = {}
-        # Receive refs from server
-        for pkt in proto.read_pkt_seq():
-            (sha, ref) = pkt.rstrip('\n').split(' ', 1)
-            if sha == 'ERR':
-                raise GitProtocolError(ref)
-            if server_capabilities is None:
-                (ref, server_capabilities) = extract_capabilities(ref)
-            refs[ref] = sha
-        return refs, set(server_capabilities)
+        return _parse_refs(proto.read_pkt_seq())
 
     def send_pack(self, path, determine_wants, generate_pack_contents,
                   progress=None):
@@ -186,7 +371,8 @@ class GitClient(object):
         """
         raise NotImplementedError(self.send_pack)
 
-    def fetch(self, path, target, determine_wants=None, progress=None):
+    def fetch(self, path, target, determine_wants=None, progress=None,
+              ref_prefix=None, depth=None):
         """Fetch into a target repository.
 
         :param path: Path to fetch from
@@ -194,28 +380,142 @@ class GitClient(object):
         :param determine_wants: Optional function to determine what refs
             to fetch
         :param progress: Optional progress function
+        :param ref_prefix: Optional list of prefixes of the names of the refs
+            to retrieve; only honored in protocol version 2
+        :param depth: Optional number of commits to fetch from the tip of
+            each wanted ref; the target repository becomes shallow
         :return: remote refs as dictionary
         """
         if determine_wants is None:
             determine_wants = target.object_store.determine_wants_all
+        graph_walker = target.get_graph_walker()
         f, commit = target.object_store.add_pack()
         try:
-            return self.fetch_pack(path, determine_wants,
-                target.get_graph_walker(), f.write, progress)
+            refs = self.fetch_pack(path, determine_wants, graph_walker,
+                f.write, progress, ref_prefix=ref_prefix, depth=depth)
         finally:
             commit()
+        target.update_shallow(graph_walker.new_shallow,
+                              graph_walker.new_unshallow)
+        return refs
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
+                   progress=None, ref_prefix=None, depth=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param ref_prefix: Optional list of prefixes of the names of the refs
+            to retrieve; only honored in protocol version 2
+        :param depth: Optional number of commits to fetch from the tip of
+            each wanted ref
         """
         raise NotImplementedError(self.fetch_pack)
 
+    def _ls_refs_v2(self, request, server_capabilities, ref_prefix=None):
+        """Retrieve refs with the protocol version 2 ls-refs command.
+
+        :param request: Function that sends a request and returns a Protocol
+            to read the response from
+        :param server_capabilities: Capabilities advertised by the server
+        :param ref_prefix: Optional list of prefixes of the names of the refs
+            to retrieve
+        :return: Dictionary of refs, including peeled tags as "name^{}"
+        """
+        args = ['symrefs', 'peel']
+        for prefix in ref_prefix or []:
+            args.append('ref-prefix %s' % prefix)
+        proto = request(_v2_request('ls-refs', server_capabilities, args))
+        refs = {}
+        for pkt in proto.read_pkt_seq():
+            if pkt.startswith('ERR '):
+                raise GitProtocolError(pkt[4:].rstrip('\n'))
+            fields = pkt.rstrip('\n').split(' ')
+            sha, name = fields[:2]
+            refs[name] = sha
+            for attribute in fields[2:]:
+                if attribute.startswith('peeled:'):
+                    refs[name + '^{}'] = attribute[len('peeled:'):]
+        return refs
+
+    def _fetch_pack_v2(self, request, server_capabilities, wants,
+                       graph_walker, pack_data, progress=None, depth=None):
+        """Retrieve a pack with the protocol version 2 fetch command.
+
+        Each round of negotiation is a separate request, which repeats the
+        wants and the haves the server has acknowledged so far.
+
+        :param request: Function that sends a request and returns a Protocol
+            to read the response from
+        :param server_capabilities: Capabilities advertised by the server
+        :param wants: List of commits to fetch
+        :param graph_walker: Object with next() and ack().
+        :param pack_data: Callback called for each bit of data in the pack
+        :param progress: Callback for progress reports (strings)
+        :param depth: Optional number of commits to fetch from the tip of
+            each wanted ref
+        """
+        features = [cap for cap in ('thin-pack', 'ofs-delta')
+                    if cap in self._fetch_capabilities]
+        if progress is None:
+            features.append('no-progress')
+            progress = lambda x: None
+        shallow = _get_shallow(graph_walker, depth)
+        if shallow is not None:
+            fetch_features = (server_capabilities.get('fetch') or '').split()
+            if 'shallow' not in fetch_features:
+                raise GitProtocolError(
+                    'server does not support shallow fetches')
+            features.extend('shallow %s' % sha for sha in shallow)
+            if depth is not None:
+                features.append('deepen %d' % depth)
+        negotiator = _StatelessNegotiator(graph_walker)
+        while True:
+            haves = negotiator.next_round()
+            done = negotiator.done
+            args = list(features)
+            args.extend('want %s' % want for want in wants)
+            args.extend('have %s' % sha for sha in negotiator.common + haves)
+            if done:
+                args.append('done')
+            proto = request(_v2_request('fetch', server_capabilities, args))
+            pkt = proto.read_pkt_line()
+            if pkt == 'acknowledgments\n':
+                pkt = proto.read_pkt_line()
+                while pkt is not None and pkt is not DELIM_PKT:
+                    line = pkt.rstrip('\n')
+                    if line.startswith('ACK '):
+                        negotiator.ack(line[4:])
+                    elif line == 'ready':
+                        negotiator.ack(None, ready=True)
+                    elif line != 'NAK':
+                        raise GitProtocolError(
+                            'unexpected acknowledgment %r' % line)
+                    pkt = proto.read_pkt_line()
+                if pkt is None:
+                    if done:
+                        raise GitProtocolError(
+                            'server did not send a pack after done')
+                    continue
+                pkt = proto.read_pkt_line()
+            if pkt == 'shallow-info\n':
+                lines = []
+                pkt = proto.read_pkt_line()
+                while pkt is not None and pkt is not DELIM_PKT:
+                    lines.append(pkt)
+                    pkt = proto.read_pkt_line()
+                graph_walker.update_shallow(*_parse_shallow_update(lines))
+                pkt = proto.read_pkt_line()
+            if pkt != 'packfile\n':
+                raise GitProtocolError('expected packfile, got %r' % pkt)
+            def error(data):
+                raise GitProtocolError(data.rstrip('\n'))
+            self._read_side_band64k_data(proto,
+                {1: pack_data, 2: progress, 3: error})
+            return
+
     def _parse_status_report(self, proto):
         unpack = proto.read_pkt_line().strip()
         if unpack != 'unpack ok':
@@ -333,23 +633,48 @@ class GitClient(object):
         if data:
             raise SendPackError('Unexpected response %r' % data)
 
-    def _handle_upload_pack_head(self, proto, capabilities, graph_walker,
-                                 wants, can_read):
-        """Handle the head of a 'git-upload-pack' request.
+    def _write_upload_pack_wants(self, proto, capabilities, graph_walker,
+                                 wants, depth=None):
+        """Write the wants of a 'git-upload-pack' request.
 
-        :param proto: Protocol object to read from
+        :param proto: Protocol object to write to
         :param capabilities: List of negotiated capabilities
-        :param graph_walker: GraphWalker instance to call .ack() on
+        :param graph_walker: GraphWalker of the local repository
         :param wants: List of commits to fetch
-        :param can_read: function that returns a boolean that indicates
-            whether there is extra graph data to read on proto
+        :param depth: Optional number of commits to fetch from the tip of
+            each wanted ref
         """
         assert isinstance(wants, list) and type(wants[0]) == str
         proto.write_pkt_line('want %s %s\n' % (
             wants[0], ' '.join(capabilities)))
         for want in wants[1:]:
             proto.write_pkt_line('want %s\n' % want)
+        shallow = _get_shallow(graph_walker, depth)
+        if shallow is not None:
+            for sha in shallow:
+                proto.write_pkt_line('shallow %s\n' % sha)
+            if depth is not None:
+                proto.write_pkt_line('deepen %d\n' % depth)
         proto.write_pkt_line(None)
+
+    def _handle_upload_pack_head(self, proto, capabilities, graph_walker,
+                                 wants, can_read, depth=None):
+        """Handle the head of a 'git-upload-pack' request.
+
+        :param proto: Protocol object to read from
+        :param capabilities: List of negotiated capabilities
+        :param graph_walker: GraphWalker instance to call .ack() on
+        :param wants: List of commits to fetch
+        :param can_read: function that returns a boolean that indicates
+            whether there is extra graph data to read on proto
+        :param depth: Optional number of commits to fetch from the tip of
+            each wanted ref
+        """
+        self._write_upload_pack_wants(proto, capabilities, graph_walker,
+                                      wants, depth)
+        if depth is not None:
+            graph_walker.update_shallow(
+                *_parse_shallow_update(proto.read_pkt_seq()))
         have = graph_walker.next()
         while have:
             proto.write_pkt_line('have %s\n' % have)
@@ -459,17 +784,29 @@ class TraditionalGitClient(GitClient):
         return new_refs
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
+                   progress=None, ref_prefix=None, depth=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param ref_prefix: Optional list of prefixes of the names of the refs
+            to retrieve; only honored in protocol version 2
+        :param depth: Optional number of commits to fetch from the tip of
+            each wanted ref
         """
         proto, can_read = self._connect('upload-pack', path)
+        pkt = proto.read_pkt_line()
+        if pkt == 'version 2\n':
+            return self._fetch_pack_over_v2(proto, determine_wants,
+                graph_walker, pack_data, progress, ref_prefix, depth)
+        proto.unread_pkt_line(pkt)
         refs, server_capabilities = self._read_refs(proto)
         negotiated_capabilities = self._fetch_capabilities & server_capabilities
+        if _get_shallow(graph_walker, depth) is not None:
+            negotiated_capabilities = (negotiated_capabilities |
+                _shallow_capabilities(server_capabilities))
         try:
             wants = determine_wants(refs)
         except:
@@ -481,11 +818,32 @@ class TraditionalGitClient(GitClient):
             proto.write_pkt_line(None)
             return refs
         self._handle_upload_pack_head(proto, negotiated_capabilities,
-            graph_walker, wants, can_read)
+            graph_walker, wants, can_read, depth)
         self._handle_upload_pack_tail(proto, negotiated_capabilities,
             graph_walker, pack_data, progress)
         return refs
 
+    def _fetch_pack_over_v2(self, proto, determine_wants, graph_walker,
+                            pack_data, progress, ref_prefix, depth=None):
+        server_capabilities = _parse_v2_capabilities(proto.read_pkt_seq())
+        def request(data):
+            proto.write(data)
+            return proto
+        refs = self._ls_refs_v2(request, server_capabilities, ref_prefix)
+        try:
+            wants = determine_wants(refs)
+        except:
+            proto.write_pkt_line(None)
+            raise
+        if wants is not None:
+            wants = [cid for cid in wants if cid != ZERO_SHA]
+        if wants:
+            self._fetch_pack_v2(request, server_capabilities, wants,
+                                graph_walker, pack_data, progress, depth)
+        # End the session
+        proto.write_pkt_line(None)
+        return refs
+
     def archive(self, path, committish, write_data, progress=None):
         proto, can_read = self._connect('upload-archive', path)
         proto.write_pkt_line("argument %s" % committish)
@@ -540,10 +898,128 @@ class TCPGitClient(TraditionalGitClient):
                          report_activity=self._report_activity)
         if path.startswith("/~"):
             path = path[1:]
-        proto.send_cmd('git-%s' % cmd, path, 'host=%s' % self._host)
+        args = [path, 'host=%s' % self._host]
+        if self._protocol_version == 2 and cmd == 'upload-pack':
+            # Extra parameters follow the host after an empty field.
+            args.extend(['', 'version=2'])
+        proto.send_cmd('git-%s' % cmd, *args)
         return proto, lambda: _fileno_can_read(s)
 
 
+class _AsyncRefsReader(asyncore.dispatcher):
+    """Retrieves the refs of a repository over git:// without blocking."""
+
+    def __init__(self, host, port, path, callback, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self._callback = callback
+        self._pkts = []
+        self._parser = PktLineParser(self._handle_pkt)
+        self._done = False
+        if path.startswith("/~"):
+            path = path[1:]
+        self._outbuf = pkt_line("git-upload-pack %s\0host=%s\0" % (path, host))
+        (family, socktype, proto, canonname, sockaddr) = socket.getaddrinfo(
+            host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+        self.create_socket(family, socktype)
+        self.connect(sockaddr)
+
+    def _finish(self, result):
+        if self._callback is not None:
+            self._callback(result)
+            self._callback = None
+
+    def _handle_pkt(self, pkt):
+        if self._done:
+            return
+        if pkt is not None:
+            self._pkts.append(pkt)
+            return
+        self._done = True
+        try:
+            refs, server_capabilities = _parse_refs(self._pkts)
+        except GitProtocolError, e:
+            self._finish(e)
+        else:
+            self._finish(refs)
+        # Tell the server we do not want anything.
+        self._outbuf += pkt_line(None)
+
+    def handle_connect(self):
+        pass
+
+    def readable(self):
+        return not self._done
+
+    def writable(self):
+        return not self.connected or bool(self._outbuf)
+
+    def handle_read(self):
+        data = self.recv(_RBUFSIZE)
+        if data:
+            self._parser.parse(data)
+
+    def handle_write(self):
+        sent = self.send(self._outbuf)
+        self._outbuf = self._outbuf[sent:]
+        if self._done and not self._outbuf:
+            self.close()
+
+    def handle_close(self):
+        self._finish(GitProtocolError(
+            'Connection closed before the refs were received'))
+        self.close()
+
+    def handle_error(self):
+        self._finish(sys.exc_info()[1])
+        self.close()
+
+
+def get_refs_many(locations, timeout=None):
+    """Retrieve the refs of many repositories over git:// at the same time.
+
+    All connections are made from a single asyncore event loop, so polling a
+    large number of repositories does not need a thread per repository.
+    Repositories whose refs have changed can then be fetched with a
+    TCPGitClient.
+
+    :param locations: Iterable of (host, port, path) tuples; port may be None
+        to use the default port.
+    :param timeout: Maximum number of seconds to wait, or None to wait until
+        all servers have responded
+    :return: Dictionary mapping each location to a dictionary with its refs,
+        or to the exception that prevented retrieving them.
+    """
+    results = {}
+    socket_map = {}
+    for location in locations:
+        host, port, path = location
+        if port is None:
+            port = TCP_GIT_PORT
+        try:
+            _AsyncRefsReader(host, port, path,
+                lambda result, location=location:
+                    results.__setitem__(location, result),
+                socket_map)
+        except socket.error, e:
+            results[location] = e
+    if timeout is not None:
+        deadline = time.time() + timeout
+    use_poll = getattr(select, 'poll', None) is not None
+    while socket_map:
+        if timeout is None:
+            wait = 30.0
+        else:
+            wait = deadline - time.time()
+            if wait <= 0:
+                break
+        asyncore.loop(timeout=wait, use_poll=use_poll, map=socket_map,
+                      count=1)
+    for reader in socket_map.values():
+        reader._finish(socket.timeout('timed out'))
+        reader.close()
+    return results
+
+
 class SubprocessWrapper(object):
     """A socket-like object that talks to a subprocess via pipes."""
 
@@ -581,10 +1057,14 @@ class SubprocessGitClient(TraditionalGitClient):
     def _connect(self, service, path):
         import subprocess
         argv = ['git', service, path]
+        env = None
+        if self._protocol_version == 2 and service == 'upload-pack':
+            env = dict(os.environ)
+            env['GIT_PROTOCOL'] = 'version=2'
         p = SubprocessWrapper(
             subprocess.Popen(argv, bufsize=0, stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE,
-                             stderr=self._stderr))
+                             stderr=self._stderr, env=env))
         return Protocol(p.read, p.write,
                         report_activity=self._report_activity), p.can_read
 
@@ -629,11 +1109,334 @@ class SSHGitClient(TraditionalGitClient):
                 con.can_read)
 
 
+class HTTPConnectionPool(object):
+    """Pool of persistent HTTP and HTTPS connections.
+
+    Idle connections are kept per server, so that later requests to the same
+    server skip the TCP and TLS handshakes. A pool can be shared by any number
+    of HttpGitClient instances, also from several threads.
+    """
+
+    def __init__(self, max_idle=8):
+        """Create a new pool.
+
+        :param max_idle: Maximum number of idle connections kept per server
+        """
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, connect):
+        """Obtain a connection.
+
+        :param key: Hashable identifying the server
+        :param connect: Function that creates a new connection to the server
+        :return: An idle connection to the server, or a new one
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                # A server that closed the connection in the meantime makes
+                # its socket readable; it has nothing else to say.
+                if conn.sock is not None and not _fileno_can_read(conn.sock):
+                    return conn
+                conn.close()
+        finally:
+            self._lock.release()
+        return connect()
+
+    def put(self, key, conn):
+        """Return a connection to the pool.
+
+        :param key: Hashable identifying the server
+        :param conn: Connection whose last response has been read completely
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+
+# What httplib reports as the status line when the server closed the
+# connection without responding, depending on the Python version.
+_NO_STATUS_LINE_ERRORS = (
+    "''",
+    "No status line received - the server has closed the connection",
+    )
+
+
+def _nothing_received(err):
+    """Check whether a request failed before any response was received.
+
+    :param err: Exception raised while sending the request or reading the
+        response headers
+    """
+    if isinstance(err, socket.timeout):
+        # The server may still be handling the request.
+        return False
+    if isinstance(err, httplib.BadStatusLine):
+        return err.line in _NO_STATUS_LINE_ERRORS
+    return isinstance(err, socket.error)
+
+
+class _PooledResponse(object):
+    """Response to a request sent on a pooled connection.
+
+    The connection goes back to the pool once the response has been read
+    completely.
+    """
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+    def recv(self, size):
+        data = self._response.read(size)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        """Read the rest of the response and release the connection."""
+        if self._conn is not None:
+            self._response.read()
+            self._release()
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._response.will_close:
+            conn.close()
+        else:
+            self._pool.put(self._key, conn)
+
+
+class _RequestBodyWriter(object):
+    """Send the body of a HTTP request while it is being written.
+
+    Bodies that fit in the post buffer are sent with a Content-Length. Larger
+    ones are sent with chunked transfer encoding, in chunks of the size of the
+    post buffer, so that they never have to be kept in memory completely.
+    """
+
+    def __init__(self, conn, method, selector, headers, post_buffer):
+        self._conn = conn
+        self._method = method
+        self._selector = selector
+        self._headers = headers
+        self._post_buffer = post_buffer
+        self._buf = []
+        self._buflen = 0
+        self._chunked = False
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buflen += len(data)
+        if self._buflen >= self._post_buffer:
+            if not self._chunked:
+                self._conn.putrequest(self._method, self._selector,
+                    skip_host='Host' in self._headers,
+                    skip_accept_encoding='Accept-Encoding' in self._headers)
+                for name, value in self._headers.iteritems():
+                    self._conn.putheader(name, value)
+                self._conn.putheader('Transfer-Encoding', 'chunked')
+                self._conn.endheaders()
+                self._chunked = True
+            self._send_chunk()
+
+    def _send_chunk(self):
+        chunk = ''.join(self._buf)
+        self._buf = []
+        self._buflen = 0
+        self._conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+
+    def close(self):
+        """Finish the request."""
+        if not self._chunked:
+            self._conn.request(self._method, self._selector,
+                               ''.join(self._buf), self._headers)
+            return
+        if self._buf:
+            self._send_chunk()
+        self._conn.send('0\r\n\r\n')
+
+
+class _PooledHandlerMixin(object):
+    """Mixin for urllib2 handlers that keeps connections in a
+    HTTPConnectionPool.
+
+    Besides strings, requests can have a function as data, which is called
+    with a write function to stream the body of the request. The function
+    is called again if the request is retried on a new connection.
+    """
+
+    def __init__(self, pool, post_buffer):
+        self.pool = pool
+        self.post_buffer = post_buffer
+
+    def do_request_(self, request):
+        data = request.data
+        if not callable(data):
+            return urllib2.AbstractHTTPHandler.do_request_(self, request)
+        # The length of a streamed body is not known in advance
+        request.data = None
+        try:
+            return urllib2.AbstractHTTPHandler.do_request_(self, request)
+        finally:
+            request.data = data
+
+    def do_pooled_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+        tunnel_headers = {}
+        if req._tunnel_host and "Proxy-Authorization" in headers:
+            # Proxy-Authorization should not be sent to origin server.
+            tunnel_headers["Proxy-Authorization"] = headers.pop(
+                "Proxy-Authorization")
+
+        new_conns = []
+        def connect():
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            if req._tunnel_host:
+                conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            new_conns.append(conn)
+            return conn
+        key = (http_class, host, req._tunnel_host)
+        conn = self.pool.get(key, connect)
+        while True:
+            try:
+                r = self._send_request(conn, req, headers)
+            except (socket.error, httplib.HTTPException), err:
+                conn.close()
+                if conn in new_conns or not _nothing_received(err):
+                    raise urllib2.URLError(err)
+                # The server closed the idle connection just as it was
+                # reused, so it has not seen the request.
+                conn = connect()
+            except:
+                conn.close()
+                raise
+            else:
+                break
+        fp = socket._fileobject(_PooledResponse(self.pool, key, conn, r),
+                                close=True)
+        resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    def _send_request(self, conn, req, headers):
+        """Send a request and read the headers of its response."""
+        if callable(req.data):
+            writer = _RequestBodyWriter(conn, req.get_method(),
+                req.get_selector(), headers, self.post_buffer)
+            req.data(writer.write)
+            writer.close()
+        else:
+            conn.request(req.get_method(), req.get_selector(), req.data,
+                         headers)
+        return conn.getresponse(buffering=True)
+
+
+class _PooledHTTPHandler(_PooledHandlerMixin, urllib2.HTTPHandler):
+
+    def __init__(self, pool, post_buffer):
+        urllib2.HTTPHandler.__init__(self)
+        _PooledHandlerMixin.__init__(self, pool, post_buffer)
+
+    def http_open(self, req):
+        return self.do_pooled_open(httplib.HTTPConnection, req)
+
+    http_request = _PooledHandlerMixin.do_request_
+
+
+if hasattr(httplib, 'HTTPSConnection'):
+    class _PooledHTTPSHandler(_PooledHandlerMixin, urllib2.HTTPSHandler):
+
+        def __init__(self, pool, post_buffer):
+            urllib2.HTTPSHandler.__init__(self)
+            _PooledHandlerMixin.__init__(self, pool, post_buffer)
+
+        def https_open(self, req):
+            return self.do_pooled_open(httplib.HTTPSConnection, req,
+                                       context=self._context)
+
+        https_request = _PooledHandlerMixin.do_request_
+
+
+def _gzip_body(write_body):
+    """Compress a streamed request body with gzip.
+
+    :param write_body: Function that writes the body with the write function
+        it is passed
+    :return: Function that writes the compressed body
+    """
+    def write_compressed(write):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        def compress(data):
+            data = compressor.compress(data)
+            if data:
+                write(data)
+        write_body(compress)
+        write(compressor.flush())
+    return write_compressed
+
+
 class HttpGitClient(GitClient):
 
-    def __init__(self, base_url, dumb=None, *args, **kwargs):
+    def __init__(self, base_url, dumb=None, pool=None,
+                 post_buffer=HTTP_POST_BUFFER, gzip_requests=False,
+                 *args, **kwargs):
+        """Create a new HttpGitClient instance.
+
+        :param base_url: URL of the server
+        :param dumb: Whether the server only supports the dumb protocol, or
+            None to find out
+        :param pool: Optional HTTPConnectionPool to keep connections in, so
+            that they can be shared with other clients
+        :param post_buffer: Largest request body to send at once; larger
+            bodies are streamed with chunked transfer encoding
+        :param gzip_requests: Whether to compress request bodies with gzip
+        """
         self.base_url = base_url.rstrip("/") + "/"
         self.dumb = dumb
+        if pool is None:
+            pool = HTTPConnectionPool()
+        self.pool = pool
+        self._gzip_requests = gzip_requests
+        handlers = [_PooledHTTPHandler(pool, post_buffer)]
+        if hasattr(httplib, 'HTTPSConnection'):
+            handlers.append(_PooledHTTPSHandler(pool, post_buffer))
+        self._opener = urllib2.build_opener(*handlers)
         GitClient.__init__(self, *args, **kwargs)
 
     def _get_url(self, path):
@@ -644,15 +1447,26 @@ class HttpGitClient(GitClient):
 
         This is provided so subclasses can provide their own version.
 
-        :param req: urllib2.Request instance
+        :param req: urllib2.Request instance, whose data may be a function
+            that writes the body with the write function it is passed
         :return: matching response
         """
-        return urllib2.urlopen(req)
+        return self._opener.open(req)
 
-    def _discover_references(self, service, url):
+    def _git_protocol_headers(self, service):
+        if self._protocol_version == 2 and service == "git-upload-pack":
+            return {"Git-Protocol": "version=2"}
+        return {}
+
+    def _get_info_refs(self, service, url):
+        """Retrieve the ref advertisement of a repository.
+
+        :return: Tuple with a Protocol positioned after the service line and
+            a boolean indicating whether the server speaks protocol version 2
+        """
         assert url[-1] == "/"
         url = urlparse.urljoin(url, "info/refs")
-        headers = {}
+        headers = self._git_protocol_headers(service)
         if self.dumb != False:
             url += "?service=%s" % service
             headers["Content-Type"] = "application/x-%s-request" % service
@@ -664,21 +1478,55 @@ class HttpGitClient(GitClient):
             raise GitProtocolError("unexpected http response %d" %
                 resp.getcode())
         self.dumb = (not resp.info().gettype().startswith("application/x-git-"))
-        proto = Protocol(resp.read, None)
-        if not self.dumb:
-            # The first line should mention the service
-            pkts = list(proto.read_pkt_seq())
-            if pkts != [('# service=%s\n' % service)]:
+        # Reading the advertisement completely releases the connection
+        proto = Protocol(StringIO(resp.read()).read, None)
+        if self.dumb:
+            return proto, False
+        pkt = proto.read_pkt_line()
+        if pkt == ('# service=%s\n' % service):
+            # The service line is followed by a flush-pkt
+            pkt = proto.read_pkt_line()
+            if pkt is not None:
                 raise GitProtocolError(
-                    "unexpected first line %r from smart server" % pkts)
+                    "unexpected line %r from smart server" % pkt)
+            pkt = proto.read_pkt_line()
+        elif pkt != 'version 2\n':
+            # Only servers speaking protocol version 2 may omit the
+            # service line.
+            raise GitProtocolError(
+                "unexpected first line %r from smart server" % pkt)
+        if pkt == 'version 2\n':
+            return proto, True
+        proto.unread_pkt_line(pkt)
+        return proto, False
+
+    def _discover_references(self, service, url):
+        proto, v2 = self._get_info_refs(service, url)
+        if v2:
+            raise GitProtocolError(
+                "unexpected protocol version 2 response for %s" % service)
         return self._read_refs(proto)
 
     def _smart_request(self, service, url, data):
+        """Send a request to a smart server.
+
+        :param service: Name of the service
+        :param url: URL of the repository
+        :param data: Body of the request, or a function that writes it with
+            the write function it is passed
+        :return: The response
+        """
         assert url[-1] == "/"
         url = urlparse.urljoin(url, service)
-        req = urllib2.Request(url,
-            headers={"Content-Type": "application/x-%s-request" % service},
-            data=data)
+        headers = self._git_protocol_headers(service)
+        headers["Content-Type"] = "application/x-%s-request" % service
+        if self._gzip_requests:
+            if not callable(data):
+                body = data
+                data = lambda write: write(body)
+            data = _gzip_body(data)
+            headers["Content-Encoding"] = "gzip"
+        req = urllib2.Request(url, headers=headers, data=data)
         resp = self._perform(req)
         if resp.getcode() == 404:
             raise NotGitRepository()
@@ -719,29 +1567,56 @@ class HttpGitClient(GitClient):
         if not want and old_refs == new_refs:
             return new_refs
         objects = generate_pack_contents(have, want)
-        if len(objects) > 0:
-            entries, sha = write_pack_objects(req_proto.write_file(), objects)
-        resp = self._smart_request("git-receive-pack", url,
-            data=req_data.getvalue())
+        def write_body(write):
+            # The pack is sent while it is being generated
+            write(req_data.getvalue())
+            if len(objects) > 0:
+                write_pack_objects(Protocol(None, write).write_file(),
+                                   objects)
+        resp = self._smart_request("git-receive-pack", url, data=write_body)
         resp_proto = Protocol(resp.read, None)
         self._handle_receive_pack_tail(resp_proto, negotiated_capabilities,
             progress)
         return new_refs
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
+                   progress=None, ref_prefix=None, depth=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param ref_prefix: Optional list of prefixes of the names of the refs
+            to retrieve; only honored in protocol version 2
+        :param depth: Optional number of commits to fetch from the tip of
+            each wanted ref
         :return: Dictionary with the refs of the remote repository
         """
         url = self._get_url(path)
-        refs, server_capabilities = self._discover_references(
-            "git-upload-pack", url)
-        negotiated_capabilities = server_capabilities
+        proto, v2 = self._get_info_refs("git-upload-pack", url)
+        if v2:
+            server_capabilities = _parse_v2_capabilities(proto.read_pkt_seq())
+            responses = []
+            def request(data):
+                # Each response is complete once the next request is sent
+                while responses:
+                    responses.pop().close()
+                resp = self._smart_request("git-upload-pack", url, data=data)
+                responses.append(resp)
+                return Protocol(resp.read, None)
+            refs = self._ls_refs_v2(request, server_capabilities, ref_prefix)
+            wants = determine_wants(refs)
+            if wants is not None:
+                wants = [cid for cid in wants if cid != ZERO_SHA]
+            if wants:
+                self._fetch_pack_v2(request, server_capabilities, wants,
+                                    graph_walker, pack_data, progress, depth)
+            while responses:
+                responses.pop().close()
+            return refs
+        refs, server_capabilities = self._read_refs(proto)
+        negotiated_capabilities = self._fetch_capabilities & server_capabilities
         wants = determine_wants(refs)
         if wants is not None:
             wants = [cid for cid in wants if cid != ZERO_SHA]
@@ -749,17 +1624,57 @@ class HttpGitClient(GitClient):
             return refs
         if self.dumb:
             raise NotImplementedError(self.send_pack)
-        req_data = StringIO()
-        req_proto = Protocol(None, req_data.write)
-        self._handle_upload_pack_head(req_proto,
-            negotiated_capabilities, graph_walker, wants,
-            lambda: False)
-        resp = self._smart_request("git-upload-pack", url,
-            data=req_data.getvalue())
-        resp_proto = Protocol(resp.read, None)
-        self._handle_upload_pack_tail(resp_proto, negotiated_capabilities,
-            graph_walker, pack_data, progress)
-        return refs
+        if _get_shallow(graph_walker, depth) is not None:
+            negotiated_capabilities = (negotiated_capabilities |
+                _shallow_capabilities(server_capabilities))
+        if negotiated_capabilities & set(['multi_ack', 'multi_ack_detailed']):
+            negotiator = _StatelessNegotiator(graph_walker)
+        else:
+            # Without multi_ack the server does not report the common commits
+            # at the end of a round.
+            negotiator = _StatelessNegotiator(graph_walker, batch_size=None)
+        while True:
+            haves = negotiator.next_round()
+            req_data = StringIO()
+            req_proto = Protocol(None, req_data.write)
+            self._write_upload_pack_wants(req_proto, negotiated_capabilities,
+                                          graph_walker, wants, depth)
+            for have in negotiator.common + haves:
+                req_proto.write_pkt_line('have %s\n' % have)
+            if negotiator.done:
+                req_proto.write_pkt_line('done\n')
+            else:
+                req_proto.write_pkt_line(None)
+            resp = self._smart_request("git-upload-pack", url,
+                data=req_data.getvalue())
+            try:
+                resp_proto = Protocol(resp.read, None)
+                if depth is not None:
+                    graph_walker.update_shallow(
+                        *_parse_shallow_update(resp_proto.read_pkt_seq()))
+                if negotiator.done:
+                    self._handle_upload_pack_tail(resp_proto,
+                        negotiated_capabilities, graph_walker, pack_data,
+                        progress)
+                    return refs
+                self._read_stateless_acks(resp_proto, negotiator)
+            finally:
+                resp.close()
+
+    def _read_stateless_acks(self, proto, negotiator):
+        """Read the acknowledgments for a round of stateless negotiation.
+
+        :param proto: Protocol object to read the response from
+        :param negotiator: _StatelessNegotiator to pass the acks on to
+        """
+        pkt = proto.read_pkt_line()
+        while pkt != 'NAK\n':
+            parts = pkt and pkt.rstrip('\n').split(' ')
+            if not parts or parts[0] != 'ACK' or len(parts) != 3 or (
+                    parts[2] not in ('continue', 'common', 'ready')):
+                raise GitProtocolError('unexpected acknowledgment %r' % pkt)
+            negotiator.ack(parts[1], ready=(parts[2] == 'ready'))
+            pkt = proto.read_pkt_line()
 
 
 def get_transport_and_path(uri, **kwargs):
@@ -0,0 +1,357 @@
+# commit_graph.py -- Reading and writing git commit-graph files
+# Copyright (C) 2013 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing git commit-graph files.
+
+A commit-graph file (objects/info/commit-graph) stores the parents, root
+tree, commit time and generation number of a set of commits, so that
+history can be walked without reading and parsing the commit objects.
+
+The generation number of a commit without parents is 1; that of any other
+commit is one more than the largest generation number of its parents. A
+commit can therefore only be an ancestor of commits with a larger
+generation number.
+"""
+
+import struct
+try:
+    from struct import unpack_from
+except ImportError:
+    from dulwich._compat import unpack_from
+
+from dulwich._compat import (
+    make_sha,
+    namedtuple,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import (
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    SHA1Writer,
+    _load_file_contents,
+    bisect_find_sha,
+    )
+
+
+COMMIT_GRAPH_SIGNATURE = 'CGPH'
+
+CHUNK_OID_FANOUT = 'OIDF'
+CHUNK_OID_LOOKUP = 'OIDL'
+CHUNK_COMMIT_DATA = 'CDAT'
+CHUNK_EXTRA_EDGE_LIST = 'EDGE'
+
+# Parent position for commits with fewer than two parents
+GRAPH_PARENT_NONE = 0x70000000
+# Set on the second parent position of octopus merges, and on the last entry
+# for each such merge in the extra edge list.
+GRAPH_EXTRA_EDGES_NEEDED = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+GENERATION_NUMBER_MAX = 0x3fffffff
+
+_COMMIT_DATA_SIZE = 36
+
+
+class CommitGraphEntry(namedtuple('CommitGraphEntry',
+        ['commit_id', 'tree', 'parents', 'generation', 'commit_time'])):
+    """The information about a single commit in a commit-graph."""
+
+
+def load_commit_graph(path):
+    """Load a commit-graph file by path.
+
+    :param path: Path to the commit-graph file
+    :return: A CommitGraph loaded from the given path
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return CommitGraph(path, file=f)
+    except:
+        f.close()
+        raise
+
+
+class CommitGraph(object):
+    """A commit-graph file, as written by git commit-graph write.
+
+    The file is memory-mapped where possible, and entries are only unpacked
+    when they are looked up.
+    """
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            self._contents, self._size = (contents, size)
+        if self._contents[:4] != COMMIT_GRAPH_SIGNATURE:
+            raise AssertionError('Not a commit-graph file')
+        (self.version, hash_version, num_chunks, num_base_graphs) = unpack_from(
+            '>BBBB', self._contents, 4)
+        if self.version != 1:
+            raise AssertionError('Version was %d' % self.version)
+        if hash_version != 1:
+            raise AssertionError('Unsupported hash version %d' % hash_version)
+        if num_base_graphs != 0:
+            raise AssertionError('Split commit-graphs are not supported')
+        chunks = {}
+        for i in range(num_chunks):
+            chunk_id, offset = unpack_from('>4sQ', self._contents, 8 + i * 12)
+            chunks[chunk_id] = offset
+        for chunk_id in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP,
+                         CHUNK_COMMIT_DATA):
+            if chunk_id not in chunks:
+                raise AssertionError('Missing %s chunk' % chunk_id)
+        fan_out_offset = chunks[CHUNK_OID_FANOUT]
+        self._fan_out_table = list(unpack_from(
+            '>256L', self._contents, fan_out_offset))
+        self._name_table_offset = chunks[CHUNK_OID_LOOKUP]
+        self._commit_data_offset = chunks[CHUNK_COMMIT_DATA]
+        self._edge_offset = chunks.get(CHUNK_EXTRA_EDGE_LIST)
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, "close", None) is not None:
+            self._contents.close()
+
+    def __len__(self):
+        """Return the number of commits in this commit-graph."""
+        return self._fan_out_table[-1]
+
+    def __iter__(self):
+        """Iterate over the SHAs of the commits in this commit-graph."""
+        for i in xrange(len(self)):
+            yield sha_to_hex(self._unpack_name(i))
+
+    def __contains__(self, sha):
+        try:
+            self._position(sha)
+        except KeyError:
+            return False
+        return True
+
+    def _unpack_name(self, i):
+        offset = self._name_table_offset + i * 20
+        return self._contents[offset:offset+20]
+
+    def _position(self, sha):
+        """Return the position of a commit in the commit-graph.
+
+        :param sha: Hex or binary SHA of the commit
+        :raise KeyError: if the commit is not in the commit-graph
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        idx = ord(sha[0])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        i = bisect_find_sha(start, end, sha, self._unpack_name)
+        if i is None:
+            raise KeyError(sha)
+        return i
+
+    def _unpack_parents(self, i):
+        parent1, parent2 = unpack_from('>LL', self._contents,
+            self._commit_data_offset + i * _COMMIT_DATA_SIZE + 20)
+        if parent1 == GRAPH_PARENT_NONE:
+            return []
+        parents = [sha_to_hex(self._unpack_name(parent1))]
+        if parent2 == GRAPH_PARENT_NONE:
+            return parents
+        if not parent2 & GRAPH_EXTRA_EDGES_NEEDED:
+            parents.append(sha_to_hex(self._unpack_name(parent2)))
+            return parents
+        offset = self._edge_offset + (parent2 & ~GRAPH_EXTRA_EDGES_NEEDED) * 4
+        while True:
+            (edge,) = unpack_from('>L', self._contents, offset)
+            parents.append(sha_to_hex(
+                self._unpack_name(edge & ~GRAPH_LAST_EDGE)))
+            if edge & GRAPH_LAST_EDGE:
+                return parents
+            offset += 4
+
+    def _unpack_generation_and_time(self, i):
+        high, low = unpack_from('>LL', self._contents,
+            self._commit_data_offset + i * _COMMIT_DATA_SIZE + 28)
+        return high >> 2, ((high & 3) << 32) | low
+
+    def _unpack_entry(self, i):
+        offset = self._commit_data_offset + i * _COMMIT_DATA_SIZE
+        generation, commit_time = self._unpack_generation_and_time(i)
+        return CommitGraphEntry(sha_to_hex(self._unpack_name(i)),
+            sha_to_hex(self._contents[offset:offset+20]),
+            self._unpack_parents(i), generation, commit_time)
+
+    def get_entry(self, sha):
+        """Return the information stored about a commit.
+
+        :param sha: Hex or binary SHA of the commit
+        :return: A CommitGraphEntry
+        :raise KeyError: if the commit is not in the commit-graph
+        """
+        return self._unpack_entry(self._position(sha))
+
+    def get_parents(self, sha):
+        """Return the hex SHAs of the parents of a commit.
+
+        :raise KeyError: if the commit is not in the commit-graph
+        """
+        return self._unpack_parents(self._position(sha))
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        :raise KeyError: if the commit is not in the commit-graph
+        """
+        return self._unpack_generation_and_time(self._position(sha))[1]
+
+    def get_generation(self, sha):
+        """Return the generation number of a commit.
+
+        :raise KeyError: if the commit is not in the commit-graph
+        """
+        return self._unpack_generation_and_time(self._position(sha))[0]
+
+    def iterentries(self):
+        """Iterate over the commits in this commit-graph.
+
+        :return: Iterator over CommitGraphEntry objects, sorted by SHA
+        """
+        for i in xrange(len(self)):
+            yield self._unpack_entry(i)
+
+    def check(self):
+        """Check that the stored checksum matches the actual checksum."""
+        actual = self.calculate_checksum()
+        stored = self.get_stored_checksum()
+        if actual != stored:
+            raise ChecksumMismatch(stored, actual)
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over this commit-graph.
+
+        :return: This is a 20-byte binary digest
+        """
+        return make_sha(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored for this commit-graph.
+
+        :return: 20-byte binary digest
+        """
+        return str(self._contents[-20:])
+
+
+def _compute_generations(parent_positions):
+    """Compute the generation numbers of a set of commits.
+
+    :param parent_positions: List with the positions of the parents of each
+        commit
+    :return: List with the generation number of each commit
+    """
+    generations = [0] * len(parent_positions)
+    for i in xrange(len(parent_positions)):
+        todo = [i]
+        while todo:
+            j = todo[-1]
+            if generations[j]:
+                todo.pop()
+                continue
+            pending = [p for p in parent_positions[j] if not generations[p]]
+            if pending:
+                todo.extend(pending)
+                continue
+            todo.pop()
+            generations[j] = min(GENERATION_NUMBER_MAX, 1 + max(
+                [generations[p] for p in parent_positions[j]] or [0]))
+    return generations
+
+
+def write_commit_graph(f, commits):
+    """Write a commit-graph file.
+
+    :param f: File-like object to write to
+    :param commits: Iterable over tuples with the SHA of a commit, the SHA of
+        its tree, the SHAs of its parents and its commit time. The parents of
+        all commits have to be included as well.
+    :return: The SHA of the commit-graph written
+    :raise ValueError: if the parent of a commit is not included
+    """
+    entries = sorted((hex_to_sha(sha), tree, parents, commit_time)
+                     for (sha, tree, parents, commit_time) in commits)
+    positions = dict((entry[0], i) for (i, entry) in enumerate(entries))
+    parent_positions = []
+    for sha, tree, parents, commit_time in entries:
+        try:
+            parent_positions.append([positions[hex_to_sha(p)]
+                                     for p in parents])
+        except KeyError:
+            raise ValueError('Not all parents of %s are included' %
+                             sha_to_hex(sha))
+    generations = _compute_generations(parent_positions)
+
+    fan_out_table = [0] * 0x100
+    for entry in entries:
+        fan_out_table[ord(entry[0][0])] += 1
+    for i in range(1, 0x100):
+        fan_out_table[i] += fan_out_table[i-1]
+
+    commit_data = []
+    edges = []
+    for i, (sha, tree, parents, commit_time) in enumerate(entries):
+        ps = parent_positions[i] + [GRAPH_PARENT_NONE] * 2
+        if len(parents) > 2:
+            ps[1] = GRAPH_EXTRA_EDGES_NEEDED | len(edges)
+            edges.extend(parent_positions[i][1:-1])
+            edges.append(GRAPH_LAST_EDGE | parent_positions[i][-1])
+        commit_data.append(hex_to_sha(tree))
+        commit_data.append(struct.pack('>LLLL', ps[0], ps[1],
+            (generations[i] << 2) | (commit_time >> 32),
+            commit_time & 0xffffffff))
+    chunks = [
+        (CHUNK_OID_FANOUT, struct.pack('>256L', *fan_out_table)),
+        (CHUNK_OID_LOOKUP, ''.join(entry[0] for entry in entries)),
+        (CHUNK_COMMIT_DATA, ''.join(commit_data)),
+        ]
+    if edges:
+        chunks.append((CHUNK_EXTRA_EDGE_LIST,
+                       struct.pack('>%dL' % len(edges), *edges)))
+
+    f = SHA1Writer(f)
+    f.write(COMMIT_GRAPH_SIGNATURE)
+    f.write(struct.pack('>BBBB', 1, 1, len(chunks), 0))
+    offset = 8 + (len(chunks) + 1) * 12
+    for chunk_id, data in chunks:
+        f.write(struct.pack('>4sQ', chunk_id, offset))
+        offset += len(data)
+    f.write(struct.pack('>4sQ', '\0' * 4, offset))
+    for chunk_id, data in chunks:
+        f.write(data)
+    return f.write_sha()
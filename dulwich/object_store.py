@@ -21,17 +21,25 @@
 """Git object store interfaces and implementation."""
 
 
+import collections
 import errno
+import heapq
 import itertools
 import os
 import stat
 import tempfile
+import time
 
+from dulwich.commit_graph import (
+    load_commit_graph,
+    write_commit_graph,
+    )
 from dulwich.diff_tree import (
     tree_changes,
     walk_trees,
     )
 from dulwich.errors import (
+    ChecksumMismatch,
     NotTreeError,
     )
 from dulwich.file import GitFile
@@ -46,31 +54,67 @@ from dulwich.objects import (
     hex_to_filename,
     S_ISGITLINK,
     object_class,
+    parse_loose_object,
+    read_loose_object_header,
     )
 from dulwich.pack import (
+    DEFAULT_COMPRESSION_LEVEL,
+    DELTA_TYPES,
     Pack,
     PackData,
     iter_sha1,
     write_pack_header,
     write_pack_index_v2,
+    write_pack_data,
     write_pack_object,
     write_pack_objects,
     compute_file_sha,
+    BitmapIndex,
     PackIndexer,
     PackStreamCopier,
+    bitmap_from_positions,
+    deltify_sorted_objects,
+    iter_bitmap_positions,
+    load_multi_pack_index,
+    write_multi_pack_index,
+    write_pack_bitmap,
     )
 
 INFODIR = 'info'
 PACKDIR = 'pack'
+MULTI_PACK_INDEX_FILENAME = 'multi-pack-index'
+COMMIT_GRAPH_FILENAME = 'commit-graph'
+
+# Besides the commits that are explicitly asked for, bitmaps are written for
+# every n-th commit in a pack.
+DEFAULT_BITMAP_COMMIT_INTERVAL = 100
+
+# Minimum number of seconds between progress reports while counting objects
+PROGRESS_INTERVAL = 0.2
+
+# Maximum number of object locations, and of objects known not to be in any
+# pack, that a PackBasedObjectStore remembers; a cache is emptied when it is
+# full.
+OBJECT_LOCATION_CACHE_SIZE = 100000
+MISSING_OBJECT_CACHE_SIZE = 10000
+
+# Location of objects that are stored as loose objects
+_LOOSE = 'loose'
 
 
 class BaseObjectStore(object):
     """Object store interface."""
 
+    # zlib compression level and number of compression threads used when
+    # writing packs for this store
+    pack_compression_level = DEFAULT_COMPRESSION_LEVEL
+    pack_threads = 1
+
     def determine_wants_all(self, refs):
-        return [sha for (ref, sha) in refs.iteritems()
-                if not sha in self and not ref.endswith("^{}") and
-                   not sha == ZERO_SHA]
+        candidates = [sha for (ref, sha) in refs.iteritems()
+                      if not ref.endswith("^{}") and not sha == ZERO_SHA]
+        present = self.contains_many(candidates)
+        return [sha for sha in candidates if not sha in present]
 
     def iter_shas(self, shas):
         """Iterate over the objects for the specified shas.
@@ -95,6 +139,14 @@ class BaseObjectStore(object):
         """
         return self.contains_packed(sha) or self.contains_loose(sha)
 
+    def contains_many(self, shas):
+        """Check which of a set of objects are present.
+
+        :param shas: Iterable over SHA1s
+        :return: Set of the given SHA1s that are present in this store
+        """
+        return set(sha for sha in shas if sha in self)
+
     @property
     def packs(self):
         """Iterable of pack objects."""
@@ -108,6 +160,18 @@ class BaseObjectStore(object):
         """
         raise NotImplementedError(self.get_raw)
 
+    def get_object_header(self, name):
+        """Obtain the type and size of an object.
+
+        Stores that can find the size of an object without inflating it
+        override this.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and object size.
+        """
+        type_num, raw = self.get_raw(name)
+        return type_num, len(raw)
+
     def __getitem__(self, sha):
         """Obtain an object by SHA1."""
         type_num, uncomp = self.get_raw(sha)
@@ -160,7 +224,8 @@ class BaseObjectStore(object):
                 yield entry
 
     def find_missing_objects(self, haves, wants, progress=None,
-                             get_tagged=None):
+                             get_tagged=None, object_filter=None,
+                             shallow=None, client_shallow=None):
         """Find the missing objects required for a set of revisions.
 
         :param haves: Iterable over SHAs already in common.
@@ -169,9 +234,20 @@ class BaseObjectStore(object):
             updated progress strings.
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
+        :param object_filter: Optional ObjectFilter deciding which of the
+            trees and blobs reachable from the wants to leave out
+        :param shallow: Optional set of commits whose parents are not sent
+        :param client_shallow: Optional set of shallow commits of the
+            receiving side, which does not have their parents
         :return: Iterator over (sha, path) pairs.
         """
-        finder = MissingObjectFinder(self, haves, wants, progress, get_tagged)
+        if object_filter is None:
+            finder = MissingObjectFinder(self, haves, wants, progress,
+                get_tagged, shallow=shallow, client_shallow=client_shallow)
+        else:
+            finder = FilteredMissingObjectFinder(self, haves, wants,
+                object_filter, progress, get_tagged, shallow=shallow,
+                client_shallow=client_shallow)
         return iter(finder.next, None)
 
     def find_common_revisions(self, graphwalker):
@@ -189,13 +265,67 @@ class BaseObjectStore(object):
             sha = graphwalker.next()
         return haves
 
-    def get_graph_walker(self, heads):
+    def get_graph_walker(self, heads, shallow=None, skipping=False):
         """Obtain a graph walker for this object store.
 
         :param heads: Local heads to start search with
+        :param shallow: Optional set of shallow commits, whose parents are
+            not present
+        :param skipping: Whether to skip over commits when negotiating; see
+            SkippingGraphWalker
         :return: GraphWalker object
         """
-        return ObjectStoreGraphWalker(heads, lambda sha: self[sha].parents)
+        if skipping:
+            return SkippingGraphWalker(heads, self.get_parents,
+                                       self.get_commit_time, shallow)
+        return ObjectStoreGraphWalker(heads, self.get_parents, shallow)
+
+    def get_commit_graph(self):
+        """Return the commit-graph for this object store, if any.
+
+        :return: A CommitGraph, or None if there is no commit-graph
+        """
+        return None
+
+    def get_parents(self, sha):
+        """Return the parents of a commit.
+
+        The commit-graph is used if it contains the commit, avoiding the
+        need to read the commit itself.
+
+        :param sha: SHA of the commit
+        :return: List of parent SHAs
+        """
+        graph = self.get_commit_graph()
+        if graph is not None:
+            try:
+                return graph.get_parents(sha)
+            except KeyError:
+                pass
+        return self[sha].parents
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        :param sha: SHA of the commit
+        :return: Commit time, in seconds since the epoch
+        """
+        graph = self.get_commit_graph()
+        if graph is not None:
+            try:
+                return graph.get_commit_time(sha)
+            except KeyError:
+                pass
+        return self[sha].commit_time
+
+    def generate_pack_data(self, objects):
+        """Generate the records for a pack containing a set of objects.
+
+        :param objects: Iterable over (sha, path) tuples of the objects to
+            include
+        :return: Iterator over records, as accepted by write_pack_data
+        """
+        return _deltify_store_objects(self, objects)
 
     def generate_pack_contents(self, have, want, progress=None):
         """Iterate over the contents of a pack file.
@@ -221,28 +351,28 @@ class BaseObjectStore(object):
             obj = self[sha]
         return obj
 
-    def _collect_ancestors(self, heads, common=set()):
+    def _collect_ancestors(self, heads, common=set(), shallow=frozenset()):
         """Collect all ancestors of heads up to (excluding) those in common.
 
         :param heads: commits to start from
         :param common: commits to end at, or empty set to walk repository
             completely
+        :param shallow: commits whose parents are not walked
         :return: a tuple (A, B) where A - all commits reachable
             from heads but not present in common, B - common (shared) elements
             that are directly reachable from heads
         """
         bases = set()
         commits = set()
-        queue = []
-        queue.extend(heads)
+        queue = collections.deque(heads)
         while queue:
-            e = queue.pop(0)
+            e = queue.popleft()
             if e in common:
                 bases.add(e)
             elif e not in commits:
                 commits.add(e)
-                cmt = self[e]
-                queue.extend(cmt.parents)
+                if e not in shallow:
+                    queue.extend(self.get_parents(e))
         return (commits, bases)
 
 
@@ -250,19 +380,67 @@ class PackBasedObjectStore(BaseObjectStore):
 
     def __init__(self):
         self._pack_cache = None
+        self._multi_pack_index = None
+        self._multi_pack_index_packs = []
+        self._unindexed_packs = []
+        # Binary SHA -> (pack, offset), _LOOSE or alternate store
+        self._object_locations = {}
+        # Binary SHAs of objects that are not in any of the packs
+        self._missing_objects = {}
+
+    def _remember_location(self, sha, location):
+        if len(self._object_locations) >= OBJECT_LOCATION_CACHE_SIZE:
+            self._object_locations.clear()
+        self._object_locations[sha] = location
+
+    def _remember_missing(self, sha):
+        if len(self._missing_objects) >= MISSING_OBJECT_CACHE_SIZE:
+            self._missing_objects.clear()
+        self._missing_objects[sha] = True
 
     @property
     def alternates(self):
         return []
 
+    def _with_current_packs(self, func, *args):
+        """Call a function that looks at the packs of this store.
+
+        Packs can be removed by a repack after they have been listed. If
+        that happens, the packs are listed again and func is retried; the
+        objects of removed packs are in the packs that replaced them.
+        """
+        try:
+            return func(*args)
+        except (OSError, IOError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._reload_packs()
+            return func(*args)
+
     def contains_packed(self, sha):
         """Check if a particular object is present by SHA1 and is packed.
 
         This does not check alternates.
         """
-        for pack in self.packs:
+        return self._with_current_packs(self._contains_packed, sha)
+
+    def _contains_packed(self, sha):
+        midx, packs = self._lookup_packs()
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        if sha in self._missing_objects:
+            return False
+        if midx is not None:
+            try:
+                midx.object_index(sha)
+            except KeyError:
+                pass
+            else:
+                return True
+        for pack in packs:
             if sha in pack:
                 return True
+        self._remember_missing(sha)
         return False
 
     def __contains__(self, sha):
@@ -270,6 +448,13 @@ class PackBasedObjectStore(BaseObjectStore):
 
         This method makes no distinction between loose and packed objects.
         """
+        # Check for changed packs first, which forgets stale locations.
+        # Loose objects can be pruned without the packs changing, so only
+        # packed locations are trusted.
+        self.packs
+        if isinstance(self._object_locations.get(
+                len(sha) == 40 and hex_to_sha(sha) or sha), tuple):
+            return True
         if self.contains_packed(sha) or self.contains_loose(sha):
             return True
         for alternate in self.alternates:
@@ -277,6 +462,40 @@ class PackBasedObjectStore(BaseObjectStore):
                 return True
         return False
 
+    def contains_many(self, shas):
+        """Check which of a set of objects are present.
+
+        Each pack index is asked about all remaining SHA1s at once, which is
+        considerably cheaper than looking them up one at a time.
+
+        :param shas: Iterable over SHA1s
+        :return: Set of the given SHA1s that are present in this store
+        """
+        remaining = set(shas)
+        present = set()
+        midx, packs = self._lookup_packs()
+        if midx is not None:
+            found = midx.object_index_many(remaining)
+            present.update(found)
+            remaining.difference_update(found)
+        for pack in packs:
+            if not remaining:
+                return present
+            found = pack.index.object_index_many(remaining)
+            present.update(found)
+            remaining.difference_update(found)
+        if remaining:
+            found = self._contains_loose_many(remaining)
+            present.update(found)
+            remaining.difference_update(found)
+        for alternate in self.alternates:
+            if not remaining:
+                break
+            found = alternate.contains_many(remaining)
+            present.update(found)
+            remaining.difference_update(found)
+        return present
+
     def _load_packs(self):
         raise NotImplementedError(self._load_packs)
 
@@ -284,20 +503,165 @@ class PackBasedObjectStore(BaseObjectStore):
         """Check whether the pack cache is stale."""
         raise NotImplementedError(self._pack_cache_stale)
 
+    def _load_multi_pack_index(self):
+        """Load the multi-pack-index for this store, if there is one.
+
+        :return: A MultiPackIndex, or None
+        """
+        return None
+
     def _add_known_pack(self, pack):
         """Add a newly appeared pack to the cache by path.
 
         """
         if self._pack_cache is not None:
             self._pack_cache.append(pack)
+            self._unindexed_packs.append(pack)
+        self._missing_objects.clear()
+
+    def _update_multi_pack_index(self):
+        """Match the multi-pack-index against the currently known packs.
+
+        A multi-pack-index that refers to packs that no longer exist is
+        ignored.
+        """
+        if self._multi_pack_index is not None:
+            self._multi_pack_index.close()
+        midx = self._load_multi_pack_index()
+        packs = self._pack_cache
+        by_name = dict((os.path.basename(p._basename) + ".idx", p)
+                       for p in packs)
+        if midx is not None and not all(
+                name in by_name for name in midx.pack_names):
+            midx.close()
+            midx = None
+        if midx is None:
+            self._multi_pack_index = None
+            self._multi_pack_index_packs = []
+            self._unindexed_packs = list(packs)
+            return
+        self._multi_pack_index = midx
+        self._multi_pack_index_packs = [by_name[name]
+                                        for name in midx.pack_names]
+        covered = set(midx.pack_names)
+        self._unindexed_packs = [
+            p for p in packs
+            if os.path.basename(p._basename) + ".idx" not in covered]
 
     @property
     def packs(self):
         """List with pack objects."""
         if self._pack_cache is None or self._pack_cache_stale():
-            self._pack_cache = self._load_packs()
+            self._reload_packs()
         return self._pack_cache
 
+    def _reload_packs(self):
+        """List the packs of this store again.
+
+        Packs that are still present are kept open; the packs that have
+        disappeared are closed.
+        """
+        known = dict((p._basename, p) for p in self._pack_cache or [])
+        self._pack_cache = [known.pop(p._basename, p)
+                            for p in self._load_packs()]
+        for pack in known.itervalues():
+            pack.close()
+        self._update_multi_pack_index()
+        self._object_locations.clear()
+        self._missing_objects.clear()
+
+    def _lookup_packs(self):
+        """Return what to consult when looking for a packed object.
+
+        :return: Tuple with the multi-pack-index (or None) and the list of
+            packs that are not covered by it.
+        """
+        self.packs
+        return self._multi_pack_index, self._unindexed_packs
+
+    def find_missing_objects(self, haves, wants, progress=None,
+                             get_tagged=None, object_filter=None,
+                             shallow=None, client_shallow=None):
+        """Find the missing objects required for a set of revisions.
+
+        If there is a pack with reachability bitmaps that contains all
+        wanted objects, and neither a filter nor shallow commits are given,
+        the objects to send are computed from its bitmaps rather than by
+        walking the history.
+
+        :param haves: Iterable over SHAs already in common.
+        :param wants: Iterable over SHAs of objects to fetch.
+        :param progress: Simple progress function that will be called with
+            updated progress strings.
+        :param get_tagged: Function that returns a dict of pointed-to sha -> tag
+            sha for including tags.
+        :param object_filter: Optional ObjectFilter deciding which of the
+            trees and blobs reachable from the wants to leave out
+        :param shallow: Optional set of commits whose parents are not sent
+        :param client_shallow: Optional set of shallow commits of the
+            receiving side, which does not have their parents
+        :return: Iterator over (sha, path) pairs.
+        """
+        # Bitmaps describe complete histories, and do not record the depths
+        # of objects, which filters need.
+        use_bitmaps = (object_filter is None and not shallow
+                       and not client_shallow)
+        for pack in (use_bitmaps and self.packs or []):
+            bitmap = pack.bitmap
+            if bitmap is None:
+                continue
+            missing = _find_missing_objects_bitmap(
+                self, bitmap, haves, wants, progress, get_tagged)
+            if missing is not None:
+                return iter(missing)
+            break
+        return super(PackBasedObjectStore, self).find_missing_objects(
+            haves, wants, progress, get_tagged, object_filter, shallow,
+            client_shallow)
+
+    def generate_pack_data(self, objects):
+        """Generate the records for a pack containing a set of objects.
+
+        Objects that are stored in one of the packs of this store are copied
+        from it without decompressing and recompressing them. This includes
+        deltas, as long as their base is included from the same pack.
+
+        :param objects: Iterable over (sha, path) tuples of the objects to
+            include
+        :return: Iterator over records, as accepted by write_pack_data
+        """
+        paths = dict(objects)
+        packs = self.packs
+        remaining = set(paths)
+        located = {}
+        for i, pack in enumerate(packs):
+            if not remaining:
+                break
+            found = pack.index.object_index_many(remaining)
+            for sha, offset in found.iteritems():
+                located[sha] = (i, offset)
+            remaining.difference_update(found)
+        return self._iter_pack_data(packs, paths, located)
+
+    def _iter_pack_data(self, packs, paths, located):
+        rest = [sha for sha in paths if sha not in located]
+        for i, offset, sha in sorted(
+                (i, offset, sha) for (sha, (i, offset)) in located.iteritems()):
+            try:
+                unpacked = packs[i].get_compressed_entry(offset)
+            except ChecksumMismatch:
+                rest.append(sha)
+                continue
+            if unpacked.pack_type_num in DELTA_TYPES:
+                base = located.get(sha_to_hex(unpacked.delta_base))
+                if base is None or base[0] != i:
+                    rest.append(sha)
+                    continue
+            yield unpacked
+        for record in _deltify_store_objects(
+                self, [(sha, paths[sha]) for sha in rest]):
+            yield record
+
     def _iter_alternate_objects(self):
         """Iterate over the SHAs of all the objects in alternate stores."""
         for alternate in self.alternates:
@@ -319,13 +683,11 @@ class PackBasedObjectStore(BaseObjectStore):
 
         :return: Number of objects packed
         """
-        objects = set()
-        for sha in self._iter_loose_objects():
-            objects.add((self._get_loose_object(sha), None))
-        self.add_objects(list(objects))
-        for obj, path in objects:
-            self._remove_loose_object(obj.id)
-        return len(objects)
+        shas = list(self._iter_loose_objects())
+        self._pack_store_objects([(sha, None) for sha in shas])
+        for sha in shas:
+            self._remove_loose_object(sha)
+        return len(shas)
 
     def __iter__(self):
         """Iterate over the SHAs that are present in this store."""
@@ -339,12 +701,71 @@ class PackBasedObjectStore(BaseObjectStore):
         """
         return self._get_loose_object(sha) is not None
 
+    def _contains_loose_many(self, shas):
+        """Check which of a set of objects are present as loose objects.
+
+        :param shas: Iterable over hex SHAs
+        :return: Set of the given SHAs that are loose objects in this store
+        """
+        return set(sha for sha in shas if self.contains_loose(sha))
+
+    def _get_loose_raw(self, sha):
+        """Obtain the raw text for a loose object.
+
+        :param sha: Hex SHA of the object
+        :return: Tuple with numeric type and object contents, or None if
+            there is no such loose object
+        """
+        obj = self._get_loose_object(sha)
+        if obj is None:
+            return None
+        return obj.type_num, obj.as_raw_string()
+
+    def _get_loose_header(self, sha):
+        """Obtain the type and size of a loose object.
+
+        :param sha: Hex SHA of the object
+        :return: Tuple with numeric type and object size, or None if there is
+            no such loose object
+        """
+        ret = self._get_loose_raw(sha)
+        if ret is None:
+            return None
+        type_num, raw = ret
+        return type_num, len(raw)
+
     def get_raw(self, name):
         """Obtain the raw text for an object.
 
         :param name: sha for the object.
         :return: tuple with numeric type and object contents.
         """
+        return self._read_object(name, 'get_raw_at', self._get_loose_raw,
+                                 'get_raw')
+
+    def get_object_header(self, name):
+        """Obtain the type and size of an object.
+
+        Packed objects are not inflated, and only the header of loose objects
+        is read.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and object size.
+        """
+        return self._read_object(name, 'get_object_header_at',
+                                 self._get_loose_header, 'get_object_header')
+
+    def _read_object(self, name, packed_method, read_loose, alternate_method):
+        """Look up an object and read it from wherever it is stored.
+
+        :param name: sha for the object.
+        :param packed_method: Name of the Pack method to call with the offset
+            of a packed object
+        :param read_loose: Function to call with the hex SHA of a loose object
+        :param alternate_method: Name of the method to call on alternate
+            object stores
+        :return: Result of the method or function that read the object
+        """
         if len(name) == 40:
             sha = hex_to_sha(name)
             hexsha = name
@@ -353,23 +774,113 @@ class PackBasedObjectStore(BaseObjectStore):
             hexsha = None
         else:
             raise AssertionError("Invalid object name %r" % name)
-        for pack in self.packs:
-            try:
-                return pack.get_raw(sha)
-            except KeyError:
-                pass
+        # Locations and misses are remembered until the packs change.
+        self.packs
+        location = self._object_locations.get(sha)
+        if location is not None:
+            ret = self._read_at_location(sha, location, packed_method,
+                                         read_loose, alternate_method)
+            if ret is not None:
+                return ret
+            # The object has moved.
+            self._object_locations[sha] = None
+        if sha not in self._missing_objects:
+            ret = self._with_current_packs(self._read_packed, sha,
+                                           packed_method)
+            if ret is not None:
+                return ret
+            self._remember_missing(sha)
         if hexsha is None:
             hexsha = sha_to_hex(name)
-        ret = self._get_loose_object(hexsha)
+        ret = read_loose(hexsha)
         if ret is not None:
-            return ret.type_num, ret.as_raw_string()
+            self._remember_location(sha, _LOOSE)
+            return ret
         for alternate in self.alternates:
             try:
-                return alternate.get_raw(hexsha)
+                ret = getattr(alternate, alternate_method)(hexsha)
             except KeyError:
                 pass
+            else:
+                self._remember_location(sha, alternate)
+                return ret
         raise KeyError(hexsha)
 
+    def _read_at_location(self, sha, location, packed_method, read_loose,
+                          alternate_method):
+        """Read an object from where it was found before.
+
+        :param sha: Binary SHA of the object
+        :param location: Location from the object location cache
+        :param packed_method: See _read_object
+        :param read_loose: See _read_object
+        :param alternate_method: See _read_object
+        :return: Result of reading the object, or None if the object is no
+            longer there
+        """
+        try:
+            if location is _LOOSE:
+                return read_loose(sha_to_hex(sha))
+            elif isinstance(location, tuple):
+                pack, offset = location
+                return getattr(pack, packed_method)(offset)
+            else:
+                return getattr(location, alternate_method)(sha)
+        except KeyError:
+            return None
+        except (OSError, IOError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _read_packed(self, sha, packed_method):
+        """Read an object from the packs of this store.
+
+        :param sha: Binary SHA of the object
+        :param packed_method: See _read_object
+        :return: Result of reading the object, or None if the object is not
+            packed.
+        """
+        midx, packs = self._lookup_packs()
+        location = None
+        if midx is not None:
+            try:
+                pack_id, offset = midx.object_index(sha)
+            except KeyError:
+                pass
+            else:
+                location = (self._multi_pack_index_packs[pack_id], offset)
+        if location is None:
+            for pack in packs:
+                try:
+                    location = (pack, pack.index.object_index(sha))
+                except KeyError:
+                    continue
+                break
+            else:
+                return None
+        pack, offset = location
+        ret = getattr(pack, packed_method)(offset)
+        self._remember_location(sha, location)
+        return ret
+
+    def _pack_store_objects(self, objects):
+        """Write objects that are already in this store to a new pack.
+
+        The objects are read as they are written rather than all kept in
+        memory, and compressed entries of existing packs are reused.
+
+        :param objects: List of (sha, path) tuples
+        :return: The new Pack, or None if there were no objects
+        """
+        if not objects:
+            return None
+        f, commit = self.add_pack()
+        write_pack_data(f, len(objects), self.generate_pack_data(objects),
+                        compression_level=self.pack_compression_level,
+                        threads=self.pack_threads)
+        return commit()
+
     def add_objects(self, objects):
         """Add a set of objects to this object store.
 
@@ -380,23 +891,37 @@ class PackBasedObjectStore(BaseObjectStore):
             # Don't bother writing an empty pack file
             return
         f, commit = self.add_pack()
-        write_pack_objects(f, objects)
+        write_pack_objects(f, objects,
+                           compression_level=self.pack_compression_level,
+                           threads=self.pack_threads)
         return commit()
 
 
 class DiskObjectStore(PackBasedObjectStore):
     """Git-style object store that exists on disk."""
 
-    def __init__(self, path):
+    def __init__(self, path, index_processes=1,
+                 pack_compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 pack_threads=1):
         """Open an object store.
 
         :param path: Path of the object store.
+        :param index_processes: Number of processes to use for indexing
+            received packs; None for the number of CPUs.
+        :param pack_compression_level: zlib compression level for packs
+            written to the store.
+        :param pack_threads: Number of threads to compress objects with when
+            writing packs; None for the number of CPUs.
         """
         super(DiskObjectStore, self).__init__()
         self.path = path
+        self.index_processes = index_processes
+        self.pack_compression_level = pack_compression_level
+        self.pack_threads = pack_threads
         self.pack_dir = os.path.join(self.path, PACKDIR)
         self._pack_cache_time = 0
         self._alternates = None
+        self._commit_graph = None
 
     @property
     def alternates(self):
@@ -454,6 +979,66 @@ class DiskObjectStore(PackBasedObjectStore):
             f.close()
         self.alternates.append(DiskObjectStore(path))
 
+    def _commit_graph_path(self):
+        return os.path.join(self.path, INFODIR, COMMIT_GRAPH_FILENAME)
+
+    def get_commit_graph(self):
+        if self._commit_graph is None:
+            try:
+                self._commit_graph = load_commit_graph(
+                    self._commit_graph_path())
+            except (OSError, IOError), e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._commit_graph = False
+        return self._commit_graph or None
+
+    def write_commit_graph(self, heads):
+        """Write a commit-graph for the history of a set of commits.
+
+        :param heads: SHAs of the commits to include, along with all their
+            ancestors.
+        :return: The CommitGraph that was written
+        """
+        graph = self.get_commit_graph()
+        commits = []
+        seen = set()
+        todo = list(heads)
+        while todo:
+            sha = todo.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+            entry = None
+            if graph is not None:
+                try:
+                    entry = graph.get_entry(sha)
+                except KeyError:
+                    pass
+            if entry is not None:
+                commits.append((sha, entry.tree, entry.parents,
+                                entry.commit_time))
+                todo.extend(entry.parents)
+            else:
+                commit = self[sha]
+                commits.append((sha, commit.tree, commit.parents,
+                                commit.commit_time))
+                todo.extend(commit.parents)
+        if graph is not None:
+            graph.close()
+        self._commit_graph = None
+        try:
+            os.mkdir(os.path.join(self.path, INFODIR))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        f = GitFile(self._commit_graph_path(), 'wb')
+        try:
+            write_commit_graph(f, commits)
+        finally:
+            f.close()
+        return self.get_commit_graph()
+
     def _load_packs(self):
         pack_files = []
         try:
@@ -472,6 +1057,168 @@ class DiskObjectStore(PackBasedObjectStore):
         suffix_len = len(".pack")
         return [Pack(f[:-suffix_len]) for _, f in pack_files]
 
+    def _load_multi_pack_index(self):
+        try:
+            return load_multi_pack_index(
+                os.path.join(self.pack_dir, MULTI_PACK_INDEX_FILENAME))
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def write_multi_pack_index(self):
+        """Write a multi-pack-index covering all packs in this store.
+
+        Objects that are present in more than one pack are looked up in the
+        most recently modified of those packs, like they would be without a
+        multi-pack-index.
+
+        :return: The MultiPackIndex that was written, or None if there are
+            no packs.
+        """
+        path = os.path.join(self.pack_dir, MULTI_PACK_INDEX_FILENAME)
+        packs = self.packs
+        if not packs:
+            if os.path.exists(path):
+                os.remove(path)
+            self._update_multi_pack_index()
+            return None
+        f = GitFile(path, 'wb')
+        try:
+            write_multi_pack_index(f, [
+                (os.path.basename(p._basename) + ".idx", p.index)
+                for p in packs])
+        finally:
+            f.close()
+        self._update_multi_pack_index()
+        return self._multi_pack_index
+
+    def write_pack_bitmap(self, pack, commits,
+                          interval=DEFAULT_BITMAP_COMMIT_INTERVAL):
+        """Write reachability bitmaps for a pack in this store.
+
+        Bitmaps can only be stored for commits whose history is entirely
+        contained in the pack; other commits are skipped.
+
+        :param pack: The Pack to write bitmaps for
+        :param commits: SHAs of commits to store bitmaps for, typically the
+            heads of the repository.
+        :param interval: Also store bitmaps for every interval-th commit in
+            the pack, to speed up fetches from older commits.
+        :return: The BitmapIndex that was written
+        """
+        bitmap = BitmapIndex(pack.index)
+        type_positions = ([], [], [], [])
+        parents = {}
+        for obj in pack.iterobjects():
+            pos = bitmap.position(obj.sha().digest())
+            type_positions[obj.type_num - 1].append(pos)
+            if isinstance(obj, Commit):
+                parents[obj.id] = obj.parents
+        selected = set(commits)
+        for i, sha in enumerate(_topo_sort_commits(parents)):
+            if sha not in selected and (i + 1) % interval:
+                continue
+            bits = _bitmap_reachable(self, bitmap, [sha])
+            if bits is not None:
+                bitmap.commit_bitmaps[hex_to_sha(sha)] = bits
+        entries = sorted((bitmap.index_position(sha), bits)
+                         for (sha, bits) in bitmap.commit_bitmaps.iteritems())
+        f = GitFile(pack._bitmap_path, 'wb')
+        try:
+            write_pack_bitmap(f, pack.index.get_pack_checksum(),
+                [bitmap_from_positions(p) for p in type_positions], entries)
+        finally:
+            f.close()
+        pack._bitmap = None
+        return pack.bitmap
+
+    def repack(self, heads=None, geometric=None, write_bitmap=True):
+        """Consolidate the packs and loose objects of this store.
+
+        By default all packs and loose objects are combined into a single
+        new pack, like git repack -a -d. If heads is given, only the objects
+        reachable from them are written, so unreachable packed objects are
+        dropped; unreachable loose objects are left alone, as they may be
+        part of an update that has not been referenced yet.
+
+        With geometric, only the smallest packs are combined, so that the
+        object counts of the remaining packs form a geometric progression
+        with the given factor, like git repack --geometric. This keeps the
+        number of packs logarithmic in the number of objects while big packs
+        are rarely rewritten.
+
+        Packs with a .keep file are never repacked, and objects that are in
+        such a pack are not written again. Old packs are only removed once
+        the new pack is in place; readers that have them open can continue
+        to use them, and lookups in packs that have disappeared are retried
+        against the current packs. A multi-pack-index is rewritten if there
+        was one.
+
+        :param heads: SHAs of the objects to keep along with everything
+            reachable from them, typically the values of all refs; None to
+            keep all objects. Can not be combined with geometric.
+        :param geometric: Factor for geometric repacking, or None
+        :param write_bitmap: Whether to write a bitmap for the new pack; only
+            done if heads is given.
+        :return: The new Pack, or None if no pack was written
+        """
+        if heads is not None and geometric is not None:
+            raise ValueError("heads can not be combined with geometric")
+        all_packs = self.packs
+        packs = [p for p in all_packs
+                 if not os.path.exists(p._basename + ".keep")]
+        loose = list(self._iter_loose_objects())
+        if geometric is not None:
+            packs = _geometric_rollup(packs, geometric, len(loose))
+            if len(packs) + bool(loose) < 2:
+                return None
+        elif heads is None and len(packs) + bool(loose) < 2:
+            return None
+        repacked = set(p._basename for p in packs)
+        kept = [p for p in all_packs if p._basename not in repacked]
+
+        if heads is None:
+            objects = dict.fromkeys(loose)
+            for pack in packs:
+                objects.update(dict.fromkeys(pack))
+        else:
+            objects = dict(self.find_missing_objects([], heads))
+            # Objects that only exist in alternates are not copied.
+            present = set(sha for sha in loose if sha in objects)
+            for pack in packs:
+                present.update(pack.index.object_index_many(objects))
+            for sha in list(objects):
+                if sha not in present:
+                    del objects[sha]
+            loose = [sha for sha in loose if sha in objects]
+        for pack in kept:
+            for sha in pack.index.object_index_many(objects):
+                del objects[sha]
+
+        new_pack = self._pack_store_objects(objects.items())
+        for pack in packs:
+            if new_pack is not None and pack._basename == new_pack._basename:
+                # The same objects as before.
+                continue
+            # Remove the pack data first, so that the pack is no longer
+            # listed while its index is removed.
+            for ext in (".pack", ".idx", ".bitmap"):
+                try:
+                    os.remove(pack._basename + ext)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        for sha in loose:
+            self._remove_loose_object(sha)
+        self._reload_packs()
+        if os.path.exists(os.path.join(self.pack_dir,
+                                       MULTI_PACK_INDEX_FILENAME)):
+            self.write_multi_pack_index()
+        if new_pack is not None and heads is not None and write_bitmap:
+            self.write_pack_bitmap(new_pack, heads)
+        return new_pack
+
     def _pack_cache_stale(self):
         try:
             return os.stat(self.pack_dir).st_mtime > self._pack_cache_time
@@ -500,6 +1247,54 @@ class DiskObjectStore(PackBasedObjectStore):
                 return None
             raise
 
+    def contains_loose(self, sha):
+        return os.path.exists(self._get_shafile_path(sha))
+
+    def _contains_loose_many(self, shas):
+        by_dir = {}
+        for sha in shas:
+            by_dir.setdefault(sha[:2], []).append(sha)
+        present = set()
+        for dir, dir_shas in by_dir.iteritems():
+            if len(dir_shas) == 1:
+                present.update(filter(self.contains_loose, dir_shas))
+                continue
+            # A single listing is cheaper than a stat for each object.
+            try:
+                names = set(os.listdir(os.path.join(self.path, dir)))
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+            present.update(sha for sha in dir_shas if sha[2:] in names)
+        return present
+
+    def _get_loose_raw(self, sha):
+        path = self._get_shafile_path(sha)
+        try:
+            f = GitFile(path, 'rb')
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return parse_loose_object(f.read())
+        finally:
+            f.close()
+
+    def _get_loose_header(self, sha):
+        path = self._get_shafile_path(sha)
+        try:
+            f = GitFile(path, 'rb')
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return read_loose_object_header(f)
+        finally:
+            f.close()
+
     def _remove_loose_object(self, sha):
         os.remove(self._get_shafile_path(sha))
 
@@ -514,7 +1309,12 @@ class DiskObjectStore(PackBasedObjectStore):
         :param copier: A PackStreamCopier to use for writing pack data.
         :param indexer: A PackIndexer for indexing the pack.
         """
-        entries = list(indexer)
+        if self.index_processes == 1:
+            entries = list(indexer)
+        else:
+            # Must flush before reading (http://bugs.python.org/issue3207)
+            f.flush()
+            entries = list(indexer.iter_parallel(path, self.index_processes))
 
         # Update the header with the new number of objects.
         f.seek(0)
@@ -595,7 +1395,7 @@ class DiskObjectStore(PackBasedObjectStore):
         :param path: Path to the pack file.
         """
         p = PackData(path)
-        entries = p.sorted_entries()
+        entries = p.sorted_entries(processes=self.index_processes)
         basename = os.path.join(self.pack_dir,
             "pack-%s" % iter_sha1(entry[0] for entry in entries))
         f = GitFile(basename+".idx", "wb")
@@ -801,7 +1601,9 @@ class ObjectStoreIterator(ObjectIterator):
 
     def __len__(self):
         """Return the number of objects."""
-        return len(list(self.itershas()))
+        for sha in self.sha_iter:
+            self._shas.append(sha)
+        return len(self._shas)
 
 
 def tree_lookup_path(lookup_obj, root_sha, path):
@@ -833,7 +1635,8 @@ def _collect_filetree_revs(obj_store, tree_sha, kset):
                _collect_filetree_revs(obj_store, sha, kset)
 
 
-def _split_commits_and_tags(obj_store, lst, ignore_unknown=False):
+def _split_commits_and_tags(obj_store, lst, ignore_unknown=False,
+                            others=None):
     """Split object id list into two list with commit SHA1s and tag SHA1s.
 
     Commits referenced by tags are included into commits
@@ -845,10 +1648,14 @@ def _split_commits_and_tags(obj_store, lst, ignore_unknown=False):
     :param lst: Collection of commit and tag SHAs
     :param ignore_unknown: True to skip SHA1 missing in the repository
         silently.
+    :param others: Optional set to add the SHA1s of trees and blobs to;
+        if not given, KeyError is raised for them
     :return: A tuple of (commits, tags) SHA1s
     """
     commits = set()
     tags = set()
+    if ignore_unknown:
+        lst = obj_store.contains_many(lst)
     for e in lst:
         try:
             o = obj_store[e]
@@ -861,11 +1668,195 @@ def _split_commits_and_tags(obj_store, lst, ignore_unknown=False):
             elif isinstance(o, Tag):
                 tags.add(e)
                 commits.add(o.object[1])
+            elif others is not None:
+                others.add(e)
             else:
                 raise KeyError('Not a commit or a tag: %s' % e)
     return (commits, tags)
 
 
+def _deltify_store_objects(obj_store, objects):
+    """Generate deltas for objects in an object store.
+
+    Unlike deltify_pack_objects, this does not keep all objects in memory:
+    the order in which to search for deltas is determined from the object
+    headers, and each object is only inflated when its record is generated.
+
+    :param obj_store: Object store to read the objects from
+    :param objects: Iterable over (sha, path) tuples
+    :return: Iterator over records, as accepted by write_pack_data
+    """
+    # Order by the magic Linus heuristic, like deltify_pack_objects
+    magic = []
+    for sha, path in objects:
+        type_num, size = obj_store.get_object_header(sha)
+        magic.append((type_num, path, -size, sha))
+    magic.sort()
+    return deltify_sorted_objects(
+        (type_num, hex_to_sha(sha), obj_store.get_raw(sha)[1])
+        for (type_num, path, neg_length, sha) in magic)
+
+
+def _geometric_rollup(packs, factor, extra=0):
+    """Select the packs to combine for a geometric repack.
+
+    The smallest packs are combined until the object counts of the new pack
+    and the remaining packs form a geometric progression with the given
+    factor.
+
+    :param packs: Packs to choose from
+    :param factor: Minimum ratio between the object counts of subsequent
+        packs
+    :param extra: Number of objects that are added to the new pack besides
+        those of the selected packs, e.g. loose objects
+    :return: List of the packs to combine
+    """
+    packs = sorted(packs, key=len)
+    counts = [len(p) for p in packs]
+    # Everything below the largest pack that breaks the progression has
+    # to be combined.
+    split = 0
+    for i in range(len(counts) - 1, 0, -1):
+        if counts[i - 1] * factor > counts[i]:
+            split = i
+            break
+    total = extra + sum(counts[:split])
+    # The combined pack may in turn be too big for the packs above it.
+    while split < len(counts) and total * factor > counts[split]:
+        total += counts[split]
+        split += 1
+    return packs[:split]
+
+
+def _topo_sort_commits(parents):
+    """Sort commits so that parents come before their children.
+
+    :param parents: Dictionary mapping commit SHAs to their parents; parents
+        that are not in the dictionary are ignored.
+    :return: List of commit SHAs
+    """
+    ret = []
+    done = set()
+    for head in sorted(parents):
+        todo = [(head, False)]
+        while todo:
+            sha, expanded = todo.pop()
+            if expanded:
+                ret.append(sha)
+                continue
+            if sha in done:
+                continue
+            done.add(sha)
+            todo.append((sha, True))
+            todo.extend((p, False) for p in parents[sha]
+                        if p in parents and p not in done)
+    return ret
+
+
+def _bitmap_reachable(obj_store, bitmap, shas, ignore_external=False):
+    """Find the objects in a pack that are reachable from a set of objects.
+
+    Objects are walked until a commit is found that has a bitmap.
+
+    :param obj_store: Object store to get objects by SHA1 from
+    :param bitmap: BitmapIndex of the pack
+    :param shas: Iterable over SHA1s to start from
+    :param ignore_external: Whether to walk (and otherwise ignore) objects
+        that are not in the pack, or give up on finding any of them. Objects
+        that are not in the object store at all are ignored in the former case.
+    :return: Bitmap of reachable objects, or None if ignore_external is False
+        and an object outside the pack was found.
+    """
+    bits = 0L
+    added = set()
+    # Positions covered by bits, as testing bits of a long is linear in its
+    # size.
+    covered = bytearray(len(bitmap))
+    external = set()
+    todo = [(sha, False) for sha in shas]
+    while todo:
+        sha, leaf = todo.pop()
+        bin_sha = hex_to_sha(sha)
+        try:
+            pos = bitmap.position(bin_sha)
+        except KeyError:
+            if not ignore_external:
+                return None
+            if sha in external:
+                continue
+            external.add(sha)
+            pos = None
+        else:
+            if pos in added or covered[pos]:
+                continue
+            if bin_sha in bitmap.commit_bitmaps:
+                commit_bits = bitmap.commit_bitmaps[bin_sha]
+                bits |= commit_bits
+                for covered_pos in iter_bitmap_positions(commit_bits):
+                    covered[covered_pos] = 1
+                continue
+            added.add(pos)
+        if leaf:
+            continue
+        try:
+            o = obj_store[sha]
+        except KeyError:
+            if pos is not None:
+                raise
+            continue
+        if isinstance(o, Commit):
+            todo.append((o.tree, False))
+            todo.extend((p, False) for p in o.parents)
+        elif isinstance(o, Tree):
+            todo.extend((s, not stat.S_ISDIR(m))
+                        for n, m, s in o.iteritems() if not S_ISGITLINK(m))
+        elif isinstance(o, Tag):
+            todo.append((o.object[1], False))
+    return bits | bitmap_from_positions(added)
+
+
+def _find_missing_objects_bitmap(obj_store, bitmap, haves, wants,
+                                 progress=None, get_tagged=None):
+    """Find the missing objects required for a set of revisions using bitmaps.
+
+    :param obj_store: Object store to get objects by SHA1 from
+    :param bitmap: BitmapIndex of a pack in obj_store
+    :param haves: Iterable over SHAs already in common.
+    :param wants: Iterable over SHAs of objects to fetch.
+    :param progress: Simple progress function that will be called with
+        updated progress strings.
+    :param get_tagged: Function that returns a dict of pointed-to sha -> tag
+        sha for including tags.
+    :return: List of (sha, path) pairs, or None if not all objects
+        reachable from wants are in the pack.
+    """
+    want_bits = _bitmap_reachable(obj_store, bitmap, wants)
+    if want_bits is None:
+        return None
+    have_bits = _bitmap_reachable(obj_store, bitmap, haves, True)
+    ret = [(sha_to_hex(sha), None)
+           for sha in bitmap.iter_names(want_bits & ~have_bits)]
+    tagged = get_tagged and get_tagged() or {}
+    if tagged:
+        have_positions = set(iter_bitmap_positions(have_bits))
+        sending = set(sha for (sha, path) in ret)
+        for sha, tag in sorted(tagged.iteritems()):
+            if sha not in sending or tag in sending:
+                continue
+            try:
+                pos = bitmap.position(hex_to_sha(tag))
+            except KeyError:
+                pass
+            else:
+                if pos in have_positions:
+                    continue
+            ret.append((tag, None))
+            sending.add(tag)
+    if progress is not None:
+        progress("counting objects: %d, done.\n" % len(ret))
+    return ret
+
+
 class MissingObjectFinder(object):
     """Find the objects missing from another object store.
 
@@ -877,10 +1868,13 @@ class MissingObjectFinder(object):
     :param get_tagged: Function that returns a dict of pointed-to sha -> tag
         sha for including tags.
     :param tagged: dict of pointed-to sha -> tag sha for including tags
+    :param shallow: Optional set of commits whose parents are not sent
+    :param client_shallow: Optional set of shallow commits of the receiving
+        side, which does not have their parents
     """
 
     def __init__(self, object_store, haves, wants, progress=None,
-                 get_tagged=None):
+                 get_tagged=None, shallow=None, client_shallow=None):
         self.object_store = object_store
         # process Commits and Tags differently
         # Note, while haves may list commits/tags not available locally,
@@ -889,16 +1883,25 @@ class MissingObjectFinder(object):
         # _split_commits_and_tags fails with KeyError
         have_commits, have_tags = \
                 _split_commits_and_tags(object_store, haves, True)
+        want_others = set()
         want_commits, want_tags = \
-                _split_commits_and_tags(object_store, wants, False)
+                _split_commits_and_tags(object_store, wants, False,
+                                        want_others)
         # all_ancestors is a set of commits that shall not be sent
         # (complete repository up to 'haves')
-        all_ancestors = object_store._collect_ancestors(have_commits)[0]
+        all_ancestors = object_store._collect_ancestors(have_commits,
+            shallow=client_shallow or frozenset())[0]
+        # the receiving side lacks the parents of its shallow commits, so
+        # those that are being deepened are walked from their parents
+        for sha in set(client_shallow or ()).difference(shallow or ()):
+            if sha in all_ancestors:
+                want_commits.update(object_store.get_parents(sha))
         # all_missing - complete set of commits between haves and wants
         # common - commits from all_ancestors we hit into while
         # traversing parent hierarchy of wants
         missing_commits, common_commits = \
-            object_store._collect_ancestors(want_commits, all_ancestors)
+            object_store._collect_ancestors(want_commits, all_ancestors,
+                                            shallow or frozenset())
         self.sha_done = set()
         # Now, fill sha_done with commits and revisions of
         # files and directories known to be both locally
@@ -914,8 +1917,8 @@ class MissingObjectFinder(object):
 
         missing_tags = want_tags.difference(have_tags)
         # in fact, what we 'want' is commits and tags
-        # we've found missing
-        wants = missing_commits.union(missing_tags)
+        # we've found missing, plus any trees and blobs asked for directly
+        wants = missing_commits.union(missing_tags, want_others)
 
         self.objects_to_send = set([(w, None, False) for w in wants])
 
@@ -924,6 +1927,7 @@ class MissingObjectFinder(object):
         else:
             self.progress = progress
         self._tagged = get_tagged and get_tagged() or {}
+        self._last_progress = 0
 
     def add_todo(self, entries):
         self.objects_to_send.update([e for e in entries
@@ -949,26 +1953,205 @@ class MissingObjectFinder(object):
         if sha in self._tagged:
             self.add_todo([(self._tagged[sha], None, True)])
         self.sha_done.add(sha)
-        self.progress("counting objects: %d\r" % len(self.sha_done))
+        now = time.time()
+        if now - self._last_progress >= PROGRESS_INTERVAL:
+            self.progress("counting objects: %d\r" % len(self.sha_done))
+            self._last_progress = now
         return (sha, name)
 
 
+class FilteredMissingObjectFinder(MissingObjectFinder):
+    """Find the objects missing from another object store, leaving out the
+    trees and blobs rejected by a filter.
+
+    Objects are visited in order of their depth below the root trees of the
+    commits, so that the filter sees every tree and blob at the smallest
+    depth at which it can be reached. Objects that are asked for directly
+    are always included.
+
+    :param object_filter: ObjectFilter to apply
+    """
+
+    def __init__(self, object_store, haves, wants, object_filter,
+                 progress=None, get_tagged=None, shallow=None,
+                 client_shallow=None):
+        super(FilteredMissingObjectFinder, self).__init__(
+            object_store, haves, wants, progress, get_tagged, shallow,
+            client_shallow)
+        self.object_filter = object_filter
+        self.objects_to_send = [(-1, sha, name, leaf)
+                                for (sha, name, leaf) in self.objects_to_send]
+        heapq.heapify(self.objects_to_send)
+
+    def add_todo(self, entries, depth=-1):
+        for (sha, name, leaf) in entries:
+            if sha not in self.sha_done:
+                heapq.heappush(self.objects_to_send, (depth, sha, name, leaf))
+
+    def _include(self, sha, leaf, depth):
+        if depth < 0:
+            return True
+        if leaf:
+            return self.object_filter.include_blob(
+                self.object_store, sha, depth)
+        return self.object_filter.include_tree(self.object_store, sha, depth)
+
+    def next(self):
+        while True:
+            if not self.objects_to_send:
+                return None
+            (depth, sha, name, leaf) = heapq.heappop(self.objects_to_send)
+            if sha in self.sha_done:
+                continue
+            if self._include(sha, leaf, depth):
+                break
+            # Any other path to this object is at least as deep.
+            self.sha_done.add(sha)
+        if not leaf:
+            o = self.object_store[sha]
+            if isinstance(o, Commit):
+                self.add_todo([(o.tree, "", False)], 0)
+            elif isinstance(o, Tree):
+                self.add_todo([(s, n, not stat.S_ISDIR(m))
+                               for n, m, s in o.iteritems()
+                               if not S_ISGITLINK(m)], max(depth, 0) + 1)
+            elif isinstance(o, Tag):
+                self.add_todo([(o.object[1], None, False)])
+        if sha in self._tagged:
+            self.add_todo([(self._tagged[sha], None, True)])
+        self.sha_done.add(sha)
+        now = time.time()
+        if now - self._last_progress >= PROGRESS_INTERVAL:
+            self.progress("counting objects: %d\r" % len(self.sha_done))
+            self._last_progress = now
+        return (sha, name)
+
+
+class ObjectFilter(object):
+    """Decides which trees and blobs are sent in a partial fetch.
+
+    The depth of a root tree of a commit is 0, and the entries of a tree
+    are one level deeper than the tree itself. Commits and tags are always
+    sent.
+    """
+
+    def include_tree(self, object_store, sha, depth):
+        """Check whether a tree should be sent.
+
+        :param object_store: Object store containing the tree
+        :param sha: SHA1 of the tree
+        :param depth: Smallest depth at which the tree is reachable
+        :return: Boolean indicating whether to send the tree
+        """
+        return True
+
+    def include_blob(self, object_store, sha, depth):
+        """Check whether a blob should be sent.
+
+        :param object_store: Object store containing the blob
+        :param sha: SHA1 of the blob
+        :param depth: Smallest depth at which the blob is reachable
+        :return: Boolean indicating whether to send the blob
+        """
+        return True
+
+
+class BlobNoneFilter(ObjectFilter):
+    """Filter that leaves out all blobs ("blob:none")."""
+
+    def include_blob(self, object_store, sha, depth):
+        return False
+
+
+class BlobLimitFilter(ObjectFilter):
+    """Filter that leaves out blobs of a minimum size ("blob:limit=<n>")."""
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def include_blob(self, object_store, sha, depth):
+        type_num, size = object_store.get_object_header(sha)
+        return size < self.limit
+
+
+class TreeDepthFilter(ObjectFilter):
+    """Filter that leaves out trees and blobs at or below a depth
+    ("tree:<depth>")."""
+
+    def __init__(self, depth):
+        self.depth = depth
+
+    def include_tree(self, object_store, sha, depth):
+        return depth < self.depth
+
+    include_blob = include_tree
+
+
+# Suffixes allowed on the size in a "blob:limit=" filter
+_FILTER_SIZE_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_object_filter(spec):
+    """Parse a filter specification, as used by partial clones.
+
+    :param spec: Filter specification, e.g. "blob:none", "blob:limit=1m" or
+        "tree:0"
+    :return: An ObjectFilter
+    :raise ValueError: if the specification is invalid or not supported
+    """
+    if spec == 'blob:none':
+        return BlobNoneFilter()
+    try:
+        if spec.startswith('blob:limit='):
+            size = spec[len('blob:limit='):].lower()
+            factor = _FILTER_SIZE_UNITS.get(size[-1:], 1)
+            if factor != 1:
+                size = size[:-1]
+            limit = int(size) * factor
+            if limit >= 0:
+                return BlobLimitFilter(limit)
+        elif spec.startswith('tree:'):
+            depth = int(spec[len('tree:'):])
+            if depth >= 0:
+                return TreeDepthFilter(depth)
+    except ValueError:
+        pass
+    raise ValueError('unsupported object filter %r' % spec)
+
+
 class ObjectStoreGraphWalker(object):
     """Graph walker that finds what commits are missing from an object store.
 
     :ivar heads: Revisions without descendants in the local repo
     :ivar get_parents: Function to retrieve parents in the local repo
+    :ivar shallow: Shallow commits in the local repo, whose parents are not
+        present
+    :ivar new_shallow: Commits the remote side made shallow
+    :ivar new_unshallow: Commits the remote side sent the parents of
     """
 
-    def __init__(self, local_heads, get_parents):
+    def __init__(self, local_heads, get_parents, shallow=None):
         """Create a new instance.
 
         :param local_heads: Heads to start search with
         :param get_parents: Function for finding the parents of a SHA1.
+        :param shallow: Optional set of shallow commits in the local repo
         """
         self.heads = set(local_heads)
         self.get_parents = get_parents
         self.parents = {}
+        self.shallow = set(shallow or [])
+        self.new_shallow = set()
+        self.new_unshallow = set()
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        """Record the changes to the shallow commits sent by the remote side.
+
+        :param new_shallow: Commits that become shallow
+        :param new_unshallow: Shallow commits whose parents are sent
+        """
+        self.new_shallow.update(new_shallow)
+        self.new_unshallow.update(new_unshallow)
 
     def ack(self, sha):
         """Ack that a revision and its ancestors are present in the source."""
@@ -998,8 +2181,106 @@ class ObjectStoreGraphWalker(object):
         """Iterate over ancestors of heads in the target."""
         if self.heads:
             ret = self.heads.pop()
-            ps = self.get_parents(ret)
+            if ret in self.shallow:
+                ps = []
+            else:
+                ps = self.get_parents(ret)
             self.parents[ret] = ps
             self.heads.update([p for p in ps if not p in self.parents])
             return ret
         return None
+
+
+class SkippingGraphWalker(ObjectStoreGraphWalker):
+    """Graph walker that skips over commits, like git's skipping negotiator.
+
+    Commits are walked newest first. After each commit that is returned, an
+    exponentially growing number of its ancestors is skipped, so that far
+    fewer haves are needed to find the common commits of a repository that
+    is far behind. The price is that the server may send some objects that
+    are already present.
+    """
+
+    def __init__(self, local_heads, get_parents, get_commit_time,
+                 shallow=None):
+        """Create a new instance.
+
+        :param local_heads: Heads to start search with
+        :param get_parents: Function for finding the parents of a SHA1.
+        :param get_commit_time: Function for finding the commit time of a SHA1.
+        :param shallow: Optional set of shallow commits in the local repo
+        """
+        super(SkippingGraphWalker, self).__init__(local_heads, get_parents,
+                                                  shallow)
+        self.get_commit_time = get_commit_time
+        self._queue = []
+        # Maps queued commits to their [original_ttl, ttl]
+        self._entries = {}
+        self._popped = set()
+        self._common = set()
+        self._non_common = 0
+        for head in self.heads:
+            self._queue_commit(head)
+
+    def _queue_commit(self, sha):
+        entry = self._entries.get(sha)
+        if entry is None:
+            entry = self._entries[sha] = [0, 0]
+            heapq.heappush(self._queue, (-self.get_commit_time(sha), sha))
+            if sha not in self._common:
+                self._non_common += 1
+        return entry
+
+    def _push(self, sha, original_ttl, ttl):
+        if sha in self._popped:
+            # Popped already, because of clock skew
+            return False
+        entry = self._queue_commit(sha)
+        if ttl:
+            new_original_ttl, new_ttl = original_ttl, ttl - 1
+        else:
+            new_original_ttl = original_ttl * 3 // 2 + 1
+            new_ttl = new_original_ttl
+        if entry[0] < new_original_ttl:
+            entry[:] = [new_original_ttl, new_ttl]
+        return True
+
+    def _mark_common(self, sha):
+        pending = [sha]
+        while pending:
+            sha = pending.pop()
+            if sha in self._common:
+                continue
+            self._common.add(sha)
+            if sha in self._entries:
+                self._non_common -= 1
+            pending.extend(self.parents.get(sha) or [])
+
+    def ack(self, sha):
+        """Ack that a revision and its ancestors are present in the source."""
+        self._mark_common(sha)
+
+    def next(self):
+        """Return the next commit to send as have, or None."""
+        while self._queue and self._non_common:
+            sha = heapq.heappop(self._queue)[1]
+            original_ttl, ttl = self._entries.pop(sha)
+            self._popped.add(sha)
+            common = sha in self._common
+            if not common:
+                self._non_common -= 1
+            if sha in self.shallow:
+                ps = []
+            else:
+                ps = self.get_parents(sha)
+            self.parents[sha] = ps
+            parent_pushed = False
+            for p in ps:
+                if common:
+                    self._mark_common(p)
+                elif self._push(p, original_ttl, ttl):
+                    parent_pushed = True
+            # Commits without parents to fall back on are never skipped
+            if not common and (not ttl or not parent_pushed):
+                return sha
+        return None
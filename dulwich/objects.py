@@ -1201,6 +1201,91 @@ for cls in OBJECT_CLASSES:
     _TYPE_MAP[cls.type_num] = cls
 
 
+def parse_loose_object(contents):
+    """Parse the contents of a loose object file.
+
+    Unlike ShaFile.from_path, this does not create an object, which makes it
+    cheaper for callers that are only interested in the raw text.
+
+    :param contents: Contents of the file, in either the legacy format or the
+        experimental format that uses pack object headers
+    :return: Tuple with numeric type and raw object contents
+    :raise ObjectFormatException: if the contents are not a valid object
+    """
+    try:
+        if ShaFile._is_legacy_object(contents[:2]):
+            text = zlib.decompress(contents)
+            header_end = text.find("\0")
+            if header_end < 0:
+                raise ObjectFormatException("Invalid object header, no \\0")
+            type_name, size = text[:header_end].split(" ", 1)
+            obj_class = object_class(type_name)
+            raw = text[header_end+1:]
+        else:
+            obj_class = object_class((ord(contents[0]) >> 4) & 7)
+            used = 1
+            while ord(contents[used - 1]) & 0x80:
+                used += 1
+            raw = zlib.decompress(contents[used:])
+            size = len(raw)
+        if obj_class is None:
+            raise ObjectFormatException("Not a known type")
+        if int(size) != len(raw):
+            raise ObjectFormatException(
+                "Object size %s does not match its contents" % size)
+    except (IndexError, ValueError, zlib.error), e:
+        raise ObjectFormatException("invalid object: %s" % e)
+    return obj_class.type_num, raw
+
+
+# The header of a legacy loose object ("<type> <size>\0") is never longer.
+_MAX_LOOSE_HEADER_SIZE = 64
+
+
+def read_loose_object_header(f):
+    """Read the type and size of a loose object without inflating it.
+
+    Only as much of the file is read and decompressed as is needed for the
+    header.
+
+    :param f: File-like object with the contents of a loose object file, in
+        either the legacy format or the experimental format that uses pack
+        object headers
+    :return: Tuple with numeric type and size of the object
+    :raise ObjectFormatException: if the header is not valid
+    """
+    data = f.read(_MAX_LOOSE_HEADER_SIZE)
+    try:
+        if ShaFile._is_legacy_object(data[:2]):
+            decomp = zlib.decompressobj()
+            header = ''
+            while True:
+                header += decomp.decompress(
+                    data, _MAX_LOOSE_HEADER_SIZE - len(header))
+                header_end = header.find("\0")
+                if header_end >= 0:
+                    break
+                data = decomp.unconsumed_tail or f.read(_MAX_LOOSE_HEADER_SIZE)
+                if len(header) >= _MAX_LOOSE_HEADER_SIZE or not data:
+                    raise ObjectFormatException(
+                        "Invalid object header, no \\0")
+            type_name, size = header[:header_end].split(" ", 1)
+            obj_class = object_class(type_name)
+            size = int(size)
+        else:
+            obj_class = object_class((ord(data[0]) >> 4) & 7)
+            size = ord(data[0]) & 0x0f
+            used = 1
+            while ord(data[used - 1]) & 0x80:
+                size |= (ord(data[used]) & 0x7f) << (used * 7 - 3)
+                used += 1
+        if obj_class is None:
+            raise ObjectFormatException("Not a known type")
+    except (IndexError, ValueError, zlib.error), e:
+        raise ObjectFormatException("invalid object: %s" % e)
+    return obj_class.type_num, size
+
+
 
 # Hold on to the pure-python implementations for testing
 _parse_tree_py = parse_tree
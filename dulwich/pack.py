@@ -36,13 +36,15 @@ except ImportError:
     from dulwich._compat import defaultdict
 
 import binascii
+import bisect
+import errno
 from cStringIO import (
     StringIO,
     )
 from collections import (
     deque,
     )
-import difflib
+import heapq
 from itertools import (
     chain,
     imap,
@@ -55,12 +57,14 @@ except ImportError:
 else:
     has_mmap = True
 import os
+import Queue
 import struct
 try:
     from struct import unpack_from
 except ImportError:
     from dulwich._compat import unpack_from
 import sys
+import threading
 import warnings
 import zlib
 
@@ -225,7 +229,9 @@ def read_zlib_chunks(read_some, unpacked, include_comp=False,
         add = read_some(buffer_size)
         if not add:
             raise zlib.error('EOF before end of zlib stream')
-        comp_chunks.append(add)
+        if include_comp:
+            # read_some may return a buffer into a memory-mapped pack.
+            comp_chunks.append(str(add))
         decomp = decomp_obj.decompress(add)
         decomp_len += len(decomp)
         decomp_chunks.append(decomp)
@@ -276,26 +282,75 @@ def load_pack_index(path):
         f.close()
 
 
+def _mmap_file_contents(f, size=None):
+    """Memory-map a file, if possible.
+
+    :param f: File-like object to map
+    :param size: Optional size of the file
+    :return: Tuple with the map and its size, or None if the file could not
+        be mapped
+    """
+    if not has_mmap or getattr(f, 'fileno', None) is None:
+        return None
+    fd = f.fileno()
+    if size is None:
+        size = os.fstat(fd).st_size
+    try:
+        contents = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    except mmap.error:
+        # Perhaps a socket?
+        return None
+    return contents, size
+
+
 def _load_file_contents(f, size=None):
-    fileno = getattr(f, 'fileno', None)
     # Attempt to use mmap if possible
-    if fileno is not None:
-        fd = f.fileno()
-        if size is None:
-            size = os.fstat(fd).st_size
-        if has_mmap:
-            try:
-                contents = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
-            except mmap.error:
-                # Perhaps a socket?
-                pass
-            else:
-                return contents, size
+    mapped = _mmap_file_contents(f, size)
+    if mapped is not None:
+        return mapped
     contents = f.read()
     size = len(contents)
     return contents, size
 
 
+class _BufferReader(object):
+    """File-like reader over an in-memory or memory-mapped buffer.
+
+    read() returns string copies and is meant for small reads such as object
+    headers; read_some() returns zero-copy buffer slices that can be fed
+    straight to zlib.
+    """
+
+    def __init__(self, contents, size):
+        self._contents = contents
+        self._size = size
+        self._offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            end = self._size
+        else:
+            end = min(self._offset + size, self._size)
+        data = self._contents[self._offset:end]
+        self._offset = end
+        return data
+
+    def read_some(self, size):
+        data = buffer(self._contents, self._offset, size)
+        self._offset += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == SEEK_CUR:
+            offset += self._offset
+        elif whence == SEEK_END:
+            offset += self._size
+        self._offset = offset
+
+    def tell(self):
+        return self._offset
+
+
 def load_pack_index_file(path, f):
     """Load an index file from a file-like object.
 
@@ -315,6 +370,25 @@ def load_pack_index_file(path, f):
         return PackIndex1(path, file=f, contents=contents, size=size)
 
 
+# A batch lookup reads all names of a fan-out bucket when it has at least
+# one SHA to look up for this many names in the bucket, as reading a name is
+# much cheaper than a search that reads names one at a time.
+_NAME_TABLE_READ_FACTOR = 32
+
+
+def _split_names(contents, offset, start, end):
+    """Read a range of a table of object names.
+
+    :param contents: Buffer with the table
+    :param offset: Offset of the table in contents
+    :param start: Index of the first name to read
+    :param end: Index just past the last name to read
+    :return: List of binary SHAs
+    """
+    data = contents[offset + start * 20:offset + end * 20]
+    return [data[i:i+20] for i in xrange(0, len(data), 20)]
+
+
 def bisect_find_sha(start, end, sha, unpack_name):
     """Find a SHA in a data blob with sorted SHAs.
 
@@ -399,6 +473,21 @@ class PackIndex(object):
         """
         raise NotImplementedError(self._object_index)
 
+    def object_index_many(self, shas):
+        """Return the offsets in the corresponding packfile for many objects.
+
+        :param shas: Iterable over hex or binary SHAs
+        :return: Dictionary mapping those of the given SHAs that are present
+            in this index to their offsets in the packfile.
+        """
+        ret = {}
+        for sha in shas:
+            try:
+                ret[sha] = self.object_index(sha)
+            except KeyError:
+                pass
+        return ret
+
     def objects_sha1(self):
         """Return the hex SHA1 over all the shas of all objects in this pack.
 
@@ -500,6 +589,10 @@ class FilePackIndex(PackIndex):
         """Unpack the i-th name from the index file."""
         raise NotImplementedError(self._unpack_name)
 
+    def _unpack_names(self, start, end):
+        """Unpack the names of the entries start up to end."""
+        return [self._unpack_name(i) for i in xrange(start, end)]
+
     def _unpack_offset(self, i):
         """Unpack the i-th object offset from the index file."""
         raise NotImplementedError(self._unpack_offset)
@@ -573,6 +666,54 @@ class FilePackIndex(PackIndex):
             raise KeyError(sha)
         return self._unpack_offset(i)
 
+    def object_index_many(self, shas):
+        """Return the offsets in the corresponding packfile for many objects.
+
+        The SHAs are grouped by their fan-out bucket. The names of a bucket
+        that many SHAs are looked up in are read at once and searched
+        in memory; the SHAs in other buckets are looked up one at a time.
+
+        :param shas: Iterable over hex or binary SHAs
+        :return: Dictionary mapping those of the given SHAs that are present
+            in this index to their offsets in the packfile, keyed by the SHAs
+            exactly as they were given.
+        """
+        # Each SHA is looked up as given, so a SHA given both in hex and in
+        # binary form is found under both.
+        buckets = {}
+        for sha in shas:
+            if len(sha) == 40:
+                bin_sha = binascii.unhexlify(sha)
+            else:
+                bin_sha = sha
+            buckets.setdefault(bin_sha[0], []).append((bin_sha, sha))
+        fan_out_table = self._fan_out_table
+        unpack_offset = self._unpack_offset
+        ret = {}
+        for first, entries in buckets.iteritems():
+            idx = ord(first)
+            if idx == 0:
+                start = 0
+            else:
+                start = fan_out_table[idx-1]
+            end = fan_out_table[idx]
+            if start == end:
+                continue
+            if len(entries) * _NAME_TABLE_READ_FACTOR >= end - start:
+                names = self._unpack_names(start, end)
+                bisect_left = bisect.bisect_left
+                for bin_sha, sha in entries:
+                    i = bisect_left(names, bin_sha)
+                    if i < len(names) and names[i] == bin_sha:
+                        ret[sha] = unpack_offset(start + i)
+            else:
+                for bin_sha, sha in entries:
+                    i = bisect_find_sha(start, end - 1, bin_sha,
+                                        self._unpack_name)
+                    if i is not None:
+                        ret[sha] = unpack_offset(i)
+        return ret
+
 
 class PackIndex1(FilePackIndex):
     """Version 1 Pack Index file."""
@@ -626,6 +767,10 @@ class PackIndex2(FilePackIndex):
         offset = self._name_table_offset + i * 20
         return self._contents[offset:offset+20]
 
+    def _unpack_names(self, start, end):
+        return _split_names(self._contents, self._name_table_offset, start,
+                            end)
+
     def _unpack_offset(self, i):
         offset = self._pack_offset_table_offset + i * 4
         offset = unpack_from('>L', self._contents, offset)[0]
@@ -639,6 +784,481 @@ class PackIndex2(FilePackIndex):
                           self._crc32_table_offset + i * 4)[0]
 
 
+MULTI_PACK_INDEX_SIGNATURE = 'MIDX'
+
+MIDX_CHUNK_PACKNAMES = 'PNAM'
+MIDX_CHUNK_OIDFANOUT = 'OIDF'
+MIDX_CHUNK_OIDLOOKUP = 'OIDL'
+MIDX_CHUNK_OBJECTOFFSETS = 'OOFF'
+MIDX_CHUNK_LARGEOFFSETS = 'LOFF'
+
+
+def load_multi_pack_index(path):
+    """Load a multi-pack-index file by path.
+
+    :param path: Path to the multi-pack-index file
+    :return: A MultiPackIndex loaded from the given path
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return MultiPackIndex(path, file=f)
+    except:
+        f.close()
+        raise
+
+
+class MultiPackIndex(FilePackIndex):
+    """A multi-pack-index, as written by git multi-pack-index.
+
+    This maps objects in any of a number of packs to the pack they are in and
+    their offset in that pack, so that a lookup across all packs in a
+    repository only has to do a single search.
+
+    Rather than an offset, object_index returns a tuple with the position of
+    the pack in pack_names and the offset of the object in that pack;
+    iterentries yields tuples with object name, pack position and offset.
+    """
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        super(MultiPackIndex, self).__init__(filename, file, contents, size)
+        if self._contents[:4] != MULTI_PACK_INDEX_SIGNATURE:
+            raise AssertionError('Not a multi-pack-index file')
+        (self.version, oid_version, num_chunks, num_base_files,
+         num_packs) = unpack_from('>BBBBL', self._contents, 4)
+        if self.version != 1:
+            raise AssertionError('Version was %d' % self.version)
+        if oid_version != 1:
+            raise AssertionError('Unsupported object id version %d' %
+                                 oid_version)
+        self._chunks = {}
+        for i in range(num_chunks):
+            chunk_id, offset = unpack_from('>4sQ', self._contents, 12 + i * 12)
+            self._chunks[chunk_id] = offset
+        for chunk_id in (MIDX_CHUNK_PACKNAMES, MIDX_CHUNK_OIDFANOUT,
+                         MIDX_CHUNK_OIDLOOKUP, MIDX_CHUNK_OBJECTOFFSETS):
+            if chunk_id not in self._chunks:
+                raise AssertionError('Missing %s chunk' % chunk_id)
+        names_offset = self._chunks[MIDX_CHUNK_PACKNAMES]
+        self.pack_names = []
+        for i in range(num_packs):
+            end = self._contents.find('\0', names_offset)
+            self.pack_names.append(self._contents[names_offset:end])
+            names_offset = end + 1
+        self._fan_out_table = self._read_fan_out_table(
+            self._chunks[MIDX_CHUNK_OIDFANOUT])
+        self._name_table_offset = self._chunks[MIDX_CHUNK_OIDLOOKUP]
+        self._offset_table_offset = self._chunks[MIDX_CHUNK_OBJECTOFFSETS]
+        self._large_offset_table_offset = self._chunks.get(
+            MIDX_CHUNK_LARGEOFFSETS)
+
+    def _unpack_entry(self, i):
+        pack_id, offset = self._unpack_offset(i)
+        return (self._unpack_name(i), pack_id, offset)
+
+    def _unpack_name(self, i):
+        offset = self._name_table_offset + i * 20
+        return self._contents[offset:offset+20]
+
+    def _unpack_names(self, start, end):
+        return _split_names(self._contents, self._name_table_offset, start,
+                            end)
+
+    def _unpack_offset(self, i):
+        pack_id, offset = unpack_from('>LL', self._contents,
+                                      self._offset_table_offset + i * 8)
+        if offset & (2**31) and self._large_offset_table_offset is not None:
+            offset = unpack_from('>Q', self._contents,
+                self._large_offset_table_offset + (offset&(2**31-1)) * 8)[0]
+        return pack_id, offset
+
+    def _unpack_crc32_checksum(self, i):
+        # Not stored in multi-pack-index files
+        return None
+
+    def get_pack_checksum(self):
+        raise NotImplementedError(self.get_pack_checksum)
+
+
+def _iter_multi_pack_index_entries(index, preference, pack_id):
+    for sha, offset, crc32 in index.iterentries():
+        yield sha, preference, pack_id, offset
+
+
+def write_multi_pack_index(f, pack_indexes):
+    """Write a multi-pack-index file.
+
+    :param f: File-like object to write to
+    :param pack_indexes: List of tuples with the file name of a pack index
+        (e.g. pack-<sha>.idx) and the PackIndex itself. For objects that are
+        present in more than one pack, the first pack in this list is used.
+    :return: The SHA of the multi-pack-index written
+    """
+    pack_names = sorted(name for (name, index) in pack_indexes)
+    pack_ids = dict((name, i) for (i, name) in enumerate(pack_names))
+    entry_iters = [
+        _iter_multi_pack_index_entries(index, preference, pack_ids[name])
+        for (preference, (name, index)) in enumerate(pack_indexes)]
+
+    names = []
+    offsets = []
+    fan_out_table = defaultdict(lambda: 0)
+    for sha, preference, pack_id, offset in heapq.merge(*entry_iters):
+        if names and names[-1] == sha:
+            continue
+        names.append(sha)
+        offsets.append((pack_id, offset))
+        fan_out_table[ord(sha[0])] += 1
+
+    chunk_names = ''.join(name + '\0' for name in pack_names)
+    chunk_names += '\0' * (-len(chunk_names) % 4)
+    fan_out = []
+    for i in range(0x100):
+        fan_out.append(struct.pack('>L', fan_out_table[i]))
+        fan_out_table[i+1] += fan_out_table[i]
+    need_large_offsets = bool(offsets) and max(
+        offset for (pack_id, offset) in offsets) > 0xffffffff
+    offset_table = []
+    large_offsets = []
+    for pack_id, offset in offsets:
+        if need_large_offsets and offset >= 2**31:
+            offset_table.append(struct.pack('>LL', pack_id,
+                                            2**31 + len(large_offsets)))
+            large_offsets.append(struct.pack('>Q', offset))
+        else:
+            offset_table.append(struct.pack('>LL', pack_id, offset))
+    chunks = [
+        (MIDX_CHUNK_PACKNAMES, chunk_names),
+        (MIDX_CHUNK_OIDFANOUT, ''.join(fan_out)),
+        (MIDX_CHUNK_OIDLOOKUP, ''.join(names)),
+        (MIDX_CHUNK_OBJECTOFFSETS, ''.join(offset_table)),
+        ]
+    if large_offsets:
+        chunks.append((MIDX_CHUNK_LARGEOFFSETS, ''.join(large_offsets)))
+
+    f = SHA1Writer(f)
+    f.write(MULTI_PACK_INDEX_SIGNATURE)
+    f.write(struct.pack('>BBBBL', 1, 1, len(chunks), 0, len(pack_names)))
+    offset = 12 + (len(chunks) + 1) * 12
+    for chunk_id, data in chunks:
+        f.write(struct.pack('>4sQ', chunk_id, offset))
+        offset += len(data)
+    f.write(struct.pack('>4sQ', '\0' * 4, offset))
+    for chunk_id, data in chunks:
+        f.write(data)
+    return f.write_sha()
+
+
+BITMAP_SIGNATURE = 'BITM'
+
+# Bitmaps contain all objects reachable from a commit, not just the commit
+BITMAP_OPT_FULL_DAG = 1
+# The file contains a table of name hashes for the objects in the pack
+BITMAP_OPT_HASH_CACHE = 4
+
+_EWAH_CLEAN_WORDS = ('\0' * 8, '\xff' * 8)
+_EWAH_MAX_RUNNING_LENGTH = 2**32 - 1
+_EWAH_MAX_LITERAL_WORDS = 2**31 - 1
+
+
+def _reverse_words(data):
+    """Reverse the order of the 8-byte words in a string."""
+    return ''.join([data[i:i+8] for i in xrange(len(data) - 8, -1, -8)])
+
+
+def read_ewah(contents, offset=0):
+    """Read an EWAH compressed bitmap, as used in pack bitmap files.
+
+    :param contents: String (or mmap) to read from
+    :param offset: Offset in contents at which the bitmap starts
+    :return: Tuple with the bitmap as a long (bit i of the bitmap is bit i of
+        the long) and the offset just past the end of the bitmap.
+    """
+    bit_size, num_words = unpack_from('>LL', contents, offset)
+    offset += 8
+    end = offset + num_words * 8
+    # Collect the words lowest first; they are reversed into a single
+    # big-endian hex string at the end, which is much faster than building
+    # the long a word at a time.
+    pieces = []
+    while offset < end:
+        (rlw,) = unpack_from('>Q', contents, offset)
+        offset += 8
+        running_length = (rlw >> 1) & _EWAH_MAX_RUNNING_LENGTH
+        literal_words = rlw >> 33
+        if running_length:
+            pieces.append(_EWAH_CLEAN_WORDS[rlw & 1] * running_length)
+        if literal_words:
+            pieces.append(_reverse_words(
+                str(contents[offset:offset + literal_words * 8])))
+            offset += literal_words * 8
+    if offset != end:
+        raise AssertionError('Invalid EWAH bitmap')
+    pieces.reverse()
+    # Skip the position of the last marker word
+    return long(binascii.hexlify(''.join(pieces)) or '0', 16), end + 4
+
+
+def write_ewah(f, bits):
+    """Write an EWAH compressed bitmap.
+
+    :param f: File-like object to write to
+    :param bits: The bitmap, as a long; bit i of the bitmap is bit i of bits
+    """
+    bit_size = bits.bit_length()
+    num_words = (bit_size + 63) // 64
+    if bits:
+        data = binascii.unhexlify('%0*x' % (num_words * 16, bits))
+    else:
+        data = ''
+    words = [data[i:i+8] for i in xrange(len(data) - 8, -1, -8)]
+    ret = []
+    last_rlw = 0
+    i = 0
+    while True:
+        running_bit = 0
+        running_length = 0
+        if i < len(words) and words[i] in _EWAH_CLEAN_WORDS:
+            clean_word = words[i]
+            running_bit = int(clean_word == _EWAH_CLEAN_WORDS[1])
+            while (i < len(words) and words[i] == clean_word and
+                   running_length < _EWAH_MAX_RUNNING_LENGTH):
+                running_length += 1
+                i += 1
+        literal_start = i
+        while (i < len(words) and words[i] not in _EWAH_CLEAN_WORDS and
+               i - literal_start < _EWAH_MAX_LITERAL_WORDS):
+            i += 1
+        last_rlw = len(ret)
+        ret.append(struct.pack('>Q', running_bit | (running_length << 1) |
+                                     ((i - literal_start) << 33)))
+        ret.extend(words[literal_start:i])
+        if i >= len(words):
+            break
+    f.write(struct.pack('>LL', bit_size, len(ret)))
+    f.write(''.join(ret))
+    f.write(struct.pack('>L', last_rlw))
+
+
+def iter_bitmap_positions(bits):
+    """Iterate over the positions of the bits set in a bitmap, in order.
+
+    :param bits: Bitmap, as a long
+    """
+    digits = bin(bits)[:1:-1]
+    i = digits.find('1')
+    while i != -1:
+        yield i
+        i = digits.find('1', i + 1)
+
+
+def bitmap_from_positions(positions):
+    """Create a bitmap with a particular set of bits set.
+
+    :param positions: Iterable over bit positions
+    :return: Bitmap, as a long
+    """
+    positions = list(positions)
+    if not positions:
+        return 0L
+    data = bytearray((max(positions) >> 3) + 1)
+    for pos in positions:
+        data[pos >> 3] |= 1 << (pos & 7)
+    data.reverse()
+    return long(binascii.hexlify(data), 16)
+
+
+def load_pack_bitmap(path):
+    """Load a pack bitmap file by path.
+
+    :param path: Path to the .bitmap file
+    :return: A PackBitmap loaded from the given path
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return PackBitmap(path, file=f)
+    except:
+        f.close()
+        raise
+
+
+class PackBitmap(object):
+    """A pack bitmap file, as written by git repack -b.
+
+    This contains, for a selection of commits in a pack, a bitmap of all
+    objects in the pack reachable from that commit, as well as bitmaps with
+    the objects of each type. Bit i of these bitmaps refers to the i-th object
+    in the pack, ordered by offset.
+    """
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            self._contents, self._size = (contents, size)
+        if self._contents[:4] != BITMAP_SIGNATURE:
+            raise AssertionError('Not a pack bitmap file')
+        (self.version, self.flags, num_entries) = unpack_from(
+            '>HHL', self._contents, 4)
+        if self.version != 1:
+            raise AssertionError('Version was %d' % self.version)
+        if not self.flags & BITMAP_OPT_FULL_DAG:
+            raise AssertionError('Unsupported pack bitmap flags %d' %
+                                 self.flags)
+        self._pack_checksum = str(self._contents[12:32])
+        offset = 32
+        self.commits, offset = read_ewah(self._contents, offset)
+        self.trees, offset = read_ewah(self._contents, offset)
+        self.blobs, offset = read_ewah(self._contents, offset)
+        self.tags, offset = read_ewah(self._contents, offset)
+        self._entries = []
+        for i in range(num_entries):
+            index_position, xor_offset, flags = unpack_from(
+                '>LBB', self._contents, offset)
+            if xor_offset > i:
+                raise AssertionError('Invalid XOR offset in pack bitmap')
+            self._entries.append((index_position, xor_offset, offset + 6))
+            offset = read_ewah(self._contents, offset + 6)[1]
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, "close", None) is not None:
+            self._contents.close()
+
+    def __len__(self):
+        """Return the number of commits with a bitmap."""
+        return len(self._entries)
+
+    def iterentries(self):
+        """Iterate over the commit bitmaps in this file.
+
+        :return: iterator over tuples with the position of the commit in the
+            pack index (as opposed to the pack) and its bitmap.
+        """
+        resolved = []
+        for index_position, xor_offset, offset in self._entries:
+            bits = read_ewah(self._contents, offset)[0]
+            if xor_offset:
+                bits ^= resolved[-xor_offset]
+            resolved.append(bits)
+            yield index_position, bits
+
+    def get_pack_checksum(self):
+        """Return the SHA1 checksum stored for the corresponding packfile.
+
+        :return: 20-byte binary digest
+        """
+        return self._pack_checksum
+
+    def check(self):
+        """Check that the stored checksum matches the actual checksum."""
+        actual = self.calculate_checksum()
+        stored = self.get_stored_checksum()
+        if actual != stored:
+            raise ChecksumMismatch(stored, actual)
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over this bitmap file.
+
+        :return: This is a 20-byte binary digest
+        """
+        return make_sha(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored for this bitmap file.
+
+        :return: 20-byte binary digest
+        """
+        return str(self._contents[-20:])
+
+
+def write_pack_bitmap(f, pack_checksum, type_bitmaps, entries):
+    """Write a pack bitmap file.
+
+    :param f: File-like object to write to
+    :param pack_checksum: Checksum of the pack the bitmaps are for
+    :param type_bitmaps: Tuple with the bitmaps of commits, trees, blobs and
+        tags in the pack
+    :param entries: List of tuples with the position of a commit in the pack
+        index and the bitmap of the objects reachable from it
+    :return: The SHA of the bitmap file written
+    """
+    f = SHA1Writer(f)
+    f.write(BITMAP_SIGNATURE)
+    f.write(struct.pack('>HHL', 1, BITMAP_OPT_FULL_DAG, len(entries)))
+    f.write(pack_checksum)
+    for bits in type_bitmaps:
+        write_ewah(f, bits)
+    for index_position, bits in entries:
+        f.write(struct.pack('>LBB', index_position, 0, 0))
+        write_ewah(f, bits)
+    return f.write_sha()
+
+
+class BitmapIndex(object):
+    """Reachability bitmaps for the objects in a pack.
+
+    This maps between object names and the bit positions used in the
+    bitmaps of a pack, and provides the bitmaps of the commits in the pack
+    that have one.
+    """
+
+    def __init__(self, index, bitmap=None):
+        """Create a new BitmapIndex.
+
+        :param index: PackIndex of the pack
+        :param bitmap: Optional PackBitmap with the bitmaps for the pack
+        """
+        entries = sorted(index.iterentries())
+        self._index_order = [sha for (sha, offset, crc32) in entries]
+        self._names = [sha for (offset, sha) in
+                       sorted((offset, sha) for (sha, offset, crc32) in entries)]
+        self._positions = dict((sha, i) for (i, sha) in enumerate(self._names))
+        self.commit_bitmaps = {}
+        if bitmap is None:
+            self.type_bitmaps = (0L, 0L, 0L, 0L)
+            return
+        self.type_bitmaps = (bitmap.commits, bitmap.trees, bitmap.blobs,
+                             bitmap.tags)
+        for index_position, bits in bitmap.iterentries():
+            self.commit_bitmaps[self._index_order[index_position]] = bits
+
+    def __len__(self):
+        return len(self._names)
+
+    def position(self, sha):
+        """Return the bit position of an object.
+
+        :param sha: A *binary* SHA string
+        :raise KeyError: if the object is not in the pack
+        """
+        return self._positions[sha]
+
+    def index_position(self, sha):
+        """Return the position of an object in the pack index.
+
+        :param sha: A *binary* SHA string
+        :raise KeyError: if the object is not in the pack
+        """
+        i = bisect.bisect_left(self._index_order, sha)
+        if i == len(self._index_order) or self._index_order[i] != sha:
+            raise KeyError(sha)
+        return i
+
+    def iter_names(self, bits):
+        """Iterate over the objects in a bitmap.
+
+        :param bits: Bitmap, as a long
+        :return: Iterator over binary SHAs, in pack order
+        """
+        for pos in iter_bitmap_positions(bits):
+            yield self._names[pos]
+
+
 def read_pack_header(read):
     """Read the header of a pack file.
 
@@ -662,6 +1282,75 @@ def chunks_length(chunks):
     return sum(imap(len, chunks))
 
 
+def read_object_header(read_all, crc32=None):
+    """Read the header of an object in a pack.
+
+    :param read_all: Read function that blocks until the number of requested
+        bytes are read.
+    :param crc32: Optional CRC32 to update with the header bytes.
+    :return: Tuple with the type number in the pack, the delta base (relative
+        offset for OFS_DELTA, binary SHA for REF_DELTA, None otherwise), the
+        uncompressed size, the length of the header and the updated CRC32.
+    """
+    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+    type_num = (bytes[0] >> 4) & 0x07
+    size = bytes[0] & 0x0f
+    for i, byte in enumerate(bytes[1:]):
+        size += (byte & 0x7f) << ((i * 7) + 4)
+
+    raw_base = len(bytes)
+    if type_num == OFS_DELTA:
+        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+        raw_base += len(bytes)
+        if bytes[-1] & 0x80:
+            raise AssertionError
+        delta_base_offset = bytes[0] & 0x7f
+        for byte in bytes[1:]:
+            delta_base_offset += 1
+            delta_base_offset <<= 7
+            delta_base_offset += (byte & 0x7f)
+        delta_base = delta_base_offset
+    elif type_num == REF_DELTA:
+        delta_base = read_all(20)
+        if crc32 is not None:
+            crc32 = binascii.crc32(delta_base, crc32)
+        raw_base += 20
+    else:
+        delta_base = None
+    return type_num, delta_base, size, raw_base, crc32
+
+
+# Maximum length of the header of a delta: two sizes, each encoded in at most
+# ten bytes.
+_MAX_DELTA_HEADER_SIZE = 20
+
+
+def read_delta_target_size(read_all):
+    """Read the size of the result of applying a compressed delta.
+
+    Only the start of the delta is read and decompressed, as far as needed to
+    get the source and target sizes from its header.
+
+    :param read_all: Read function for the compressed delta data.
+    :return: The size of the object that results from applying the delta.
+    :raise ApplyDeltaError: if the delta header is truncated
+    """
+    decomp = zlib.decompressobj()
+    header = ''
+    while True:
+        ends = [i for i, c in enumerate(header) if not ord(c) & 0x80]
+        if len(ends) >= 2:
+            break
+        data = decomp.unconsumed_tail or read_all(_MAX_DELTA_HEADER_SIZE)
+        if not data or len(header) >= _MAX_DELTA_HEADER_SIZE:
+            raise ApplyDeltaError('Truncated delta header')
+        header += decomp.decompress(data, _MAX_DELTA_HEADER_SIZE - len(header))
+    size = 0
+    for i, c in enumerate(header[ends[0] + 1:ends[1] + 1]):
+        size |= (ord(c) & 0x7f) << (i * 7)
+    return size
+
+
 def unpack_object(read_all, read_some=None, compute_crc32=False,
                   include_comp=False, zlib_bufsize=_ZLIB_BUFSIZE):
     """Unpack a Git object.
@@ -693,36 +1382,103 @@ def unpack_object(read_all, read_some=None, compute_crc32=False,
     else:
         crc32 = None
 
-    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-    type_num = (bytes[0] >> 4) & 0x07
-    size = bytes[0] & 0x0f
-    for i, byte in enumerate(bytes[1:]):
-        size += (byte & 0x7f) << ((i * 7) + 4)
+    # Most objects fit in a single buffer, in which case they can be
+    # unpacked in one go.
+    data = read_some(zlib_bufsize)
+    result = unpack_object_buffer(data, compute_crc32, include_comp)
+    if result is not None:
+        type_num, delta_base, size, decomp, comp, crc32, end = result
+        unpacked = UnpackedObject(type_num, delta_base, size, crc32)
+        unpacked.decomp_chunks.append(decomp)
+        if include_comp:
+            unpacked.comp_chunks = [comp]
+        return unpacked, data[end:]
+
+    # Read the rest of the object after the data that was already read.
+    prefix = StringIO(data)
+    def prefixed_read_all(size):
+        ret = prefix.read(size)
+        if len(ret) < size:
+            ret += read_all(size - len(ret))
+        return ret
+    def prefixed_read_some(size):
+        return prefix.read() or read_some(size)
+    type_num, delta_base, size, raw_base, crc32 = read_object_header(
+        prefixed_read_all, crc32)
+    unpacked = UnpackedObject(type_num, delta_base, size, crc32)
+    unused = read_zlib_chunks(prefixed_read_some, unpacked,
+                              buffer_size=zlib_bufsize,
+                              include_comp=include_comp)
+    return unpacked, unused
 
-    raw_base = len(bytes)
+
+def unpack_object_buffer(data, compute_crc32=False, include_comp=False):
+    """Unpack an object that is contained in a buffer.
+
+    :param data: Buffer that starts with the object; for the object to be
+        unpacked, it must contain the whole object and at least one byte
+        after it.
+    :param compute_crc32: If True, compute the CRC32 of the object.
+    :param include_comp: If True, include the compressed data in the result.
+    :return: None if the buffer does not contain the whole object, otherwise
+        a tuple with the type number in the pack, the delta base, the
+        uncompressed size, the uncompressed data, the compressed data (or
+        None), the CRC32 (or None) and the length of the object in the
+        buffer.
+    :raise zlib.error: if a decompression error occurred.
+    """
+    n = len(data)
+    if n == 0:
+        return None
+    c = ord(data[0])
+    type_num = (c >> 4) & 0x07
+    size = c & 0x0f
+    shift = 4
+    pos = 1
+    while c & 0x80:
+        if pos >= n:
+            return None
+        c = ord(data[pos])
+        pos += 1
+        size += (c & 0x7f) << shift
+        shift += 7
     if type_num == OFS_DELTA:
-        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-        raw_base += len(bytes)
-        if bytes[-1] & 0x80:
-            raise AssertionError
-        delta_base_offset = bytes[0] & 0x7f
-        for byte in bytes[1:]:
-            delta_base_offset += 1
-            delta_base_offset <<= 7
-            delta_base_offset += (byte & 0x7f)
-        delta_base = delta_base_offset
+        if pos >= n:
+            return None
+        c = ord(data[pos])
+        pos += 1
+        delta_base = c & 0x7f
+        while c & 0x80:
+            if pos >= n:
+                return None
+            c = ord(data[pos])
+            pos += 1
+            delta_base = ((delta_base + 1) << 7) + (c & 0x7f)
     elif type_num == REF_DELTA:
-        delta_base = read_all(20)
-        if compute_crc32:
-            crc32 = binascii.crc32(delta_base, crc32)
-        raw_base += 20
+        if pos + 20 > n:
+            return None
+        delta_base = str(data[pos:pos+20])
+        pos += 20
     else:
         delta_base = None
-
-    unpacked = UnpackedObject(type_num, delta_base, size, crc32)
-    unused = read_zlib_chunks(read_some, unpacked, buffer_size=zlib_bufsize,
-                              include_comp=include_comp)
-    return unpacked, unused
+    decomp_obj = zlib.decompressobj()
+    decomp = decomp_obj.decompress(data[pos:])
+    unused = decomp_obj.unused_data
+    if not unused:
+        # The end of the stream may not have been reached.
+        return None
+    end = n - len(unused)
+    if len(decomp) != size:
+        raise zlib.error('decompressed data does not match expected size')
+    if compute_crc32:
+        crc32 = binascii.crc32(data[:end]) & 0xffffffff
+    else:
+        crc32 = None
+    if include_comp:
+        comp = str(data[pos:end])
+    else:
+        comp = None
+    return type_num, delta_base, size, decomp, comp, crc32, end
 
 
 def _compute_object_size((num, obj)):
@@ -732,6 +1488,46 @@ def _compute_object_size((num, obj)):
     return chunks_length(obj)
 
 
+# Default byte budget for DeltaBaseCache; the same as git's default for
+# core.deltaBaseCacheLimit.
+DEFAULT_DELTA_BASE_CACHE_SIZE = 96 * 1024 * 1024
+
+
+class DeltaBaseCache(LRUSizeCache):
+    """Cache of inflated delta bases in a pack, keyed by offset.
+
+    This serves the same purpose as git's core.deltaBaseCacheLimit: objects
+    that are used as delta bases are kept around (up to a byte budget), so
+    that resolving other deltas against the same base does not inflate it
+    again.
+
+    :ivar hits: Number of lookups that were served from the cache
+    :ivar misses: Number of lookups for offsets that were not in the cache
+    """
+
+    def __init__(self, max_size=DEFAULT_DELTA_BASE_CACHE_SIZE,
+                 after_cleanup_size=None):
+        """Create a new DeltaBaseCache.
+
+        :param max_size: Maximum number of bytes of inflated objects to keep
+        :param after_cleanup_size: After cleaning up, shrink to this size
+        """
+        super(DeltaBaseCache, self).__init__(max_size,
+            after_cleanup_size=after_cleanup_size,
+            compute_size=_compute_object_size)
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, offset):
+        try:
+            ret = super(DeltaBaseCache, self).__getitem__(offset)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return ret
+
+
 class PackStreamReader(object):
     """Class to read a pack stream.
 
@@ -956,23 +1752,28 @@ class PackData(object):
     For the complete objects the data is stored as zlib deflated data.
     The size in the header is the uncompressed object size, so to uncompress
     you need to just keep feeding data to zlib until you get an object back,
-    or it errors on bad data. This is done here by just giving the complete
-    buffer from the start of the deflated object on. This is bad, but until I
-    get mmap sorted out it will have to do.
+    or it errors on bad data. Where possible the pack file is memory-mapped,
+    in which case the decompressor reads directly from slices of the map
+    rather than from copies made through the file object.
 
     Currently there are no integrity checks done. Also no attempt is made to
     try and detect the delta case, or a request for an object at the wrong
     position.  It will all just throw a zlib or KeyError.
     """
 
-    def __init__(self, filename, file=None, size=None):
+    def __init__(self, filename, file=None, size=None, use_mmap=True,
+                 delta_base_cache_size=DEFAULT_DELTA_BASE_CACHE_SIZE):
         """Create a PackData object representing the pack in the given filename.
 
         The file must exist and stay readable until the object is disposed of. It
-        must also stay the same size. It will be mapped whenever needed.
-
-        Currently there is a restriction on the size of the pack as the python
-        mmap implementation is flawed.
+        must also stay the same size.
+
+        :param filename: Path to the pack file
+        :param file: Optional file-like object to read the pack from
+        :param size: Optional size of the pack file
+        :param use_mmap: Whether to memory-map the pack file, if possible
+        :param delta_base_cache_size: Maximum number of bytes of inflated delta
+            bases to cache
         """
         self._filename = filename
         self._size = size
@@ -982,8 +1783,14 @@ class PackData(object):
         else:
             self._file = file
         (version, self._num_objects) = read_pack_header(self._file.read)
-        self._offset_cache = LRUSizeCache(1024*1024*20,
-            compute_size=_compute_object_size)
+        self._contents = None
+        self._reader = self._file
+        # If the pack can not be mapped, objects are read through the file.
+        mapped = use_mmap and _mmap_file_contents(self._file, size) or None
+        if mapped is not None:
+            self._contents, self._size = mapped
+            self._reader = _BufferReader(self._contents, self._size)
+        self._offset_cache = DeltaBaseCache(delta_base_cache_size)
         self.pack = None
 
     @classmethod
@@ -994,8 +1801,15 @@ class PackData(object):
     def from_path(cls, path):
         return cls(filename=path)
 
+    @property
+    def delta_base_cache(self):
+        """The DeltaBaseCache shared by all lookups in this pack."""
+        return self._offset_cache
+
     def close(self):
         self._file.close()
+        if getattr(self._contents, 'close', None) is not None:
+            self._contents.close()
 
     def _get_size(self):
         if self._size is not None:
@@ -1016,6 +1830,8 @@ class PackData(object):
 
         :return: 20-byte binary SHA1 digest
         """
+        if self._contents is not None:
+            return make_sha(buffer(self._contents, 0, self._size - 20)).digest()
         return compute_file_sha(self._file, end_ofs=-20).digest()
 
     def get_ref(self, sha):
@@ -1032,6 +1848,10 @@ class PackData(object):
     def resolve_object(self, offset, type, obj, get_ref=None):
         """Resolve an object, possibly resolving deltas when necessary.
 
+        Every object that is used as a delta base along the way is stored in
+        the delta base cache, so later lookups of objects with the same bases
+        do not need to inflate them again.
+
         :return: Tuple with object type and contents.
         """
         if type not in DELTA_TYPES:
@@ -1039,74 +1859,105 @@ class PackData(object):
 
         if get_ref is None:
             get_ref = self.get_ref
-        if type == OFS_DELTA:
-            (delta_offset, delta) = obj
-            # TODO: clean up asserts and replace with nicer error messages
-            assert isinstance(offset, int) or isinstance(offset, long)
-            assert isinstance(delta_offset, int) or isinstance(offset, long)
-            base_offset = offset-delta_offset
-            type, base_obj = self.get_object_at(base_offset)
-            assert isinstance(type, int)
-        elif type == REF_DELTA:
-            (basename, delta) = obj
-            assert isinstance(basename, str) and len(basename) == 20
-            base_offset, type, base_obj = get_ref(basename)
-            assert isinstance(type, int)
-        type, base_chunks = self.resolve_object(base_offset, type, base_obj)
-        chunks = apply_delta(base_chunks, delta)
-        # TODO(dborowitz): This can result in poor performance if large base
-        # objects are separated from deltas in the pack. We should reorganize
-        # so that we apply deltas to all objects in a chain one after the other
-        # to optimize cache performance.
-        if offset is not None:
-            self._offset_cache[offset] = type, chunks
-        return type, chunks
+        # Walk down the chain until we hit a full object (or a cached one),
+        # remembering the deltas to apply on the way back up.
+        delta_stack = []
+        base_offset = offset
+        base_type = type
+        base_obj = obj
+        while base_type in DELTA_TYPES:
+            prev_offset = base_offset
+            if base_type == OFS_DELTA:
+                (delta_offset, delta) = base_obj
+                # TODO: clean up asserts and replace with nicer error messages
+                assert (isinstance(base_offset, int) or
+                        isinstance(base_offset, long))
+                assert (isinstance(delta_offset, int) or
+                        isinstance(delta_offset, long))
+                base_offset = base_offset - delta_offset
+                base_type, base_obj = self.get_object_at(base_offset)
+                assert isinstance(base_type, int)
+            elif base_type == REF_DELTA:
+                (basename, delta) = base_obj
+                assert isinstance(basename, str) and len(basename) == 20
+                base_offset, base_type, base_obj = get_ref(basename)
+                assert isinstance(base_type, int)
+            delta_stack.append((prev_offset, delta))
+
+        # Apply the deltas from the base up to the tip in one pass, dropping
+        # each delta and intermediate result as soon as it has been used.
+        chunks = base_obj
+        while delta_stack:
+            if base_offset is not None:
+                self._offset_cache[base_offset] = base_type, chunks
+            base_offset, delta = delta_stack.pop()
+            chunks = apply_delta(chunks, delta)
+        return base_type, chunks
+
+    def _read_funcs(self):
+        """Return the read_all and read_some functions for the pack contents.
+        """
+        return self._reader.read, getattr(self._reader, 'read_some', None)
 
     def iterobjects(self, progress=None, compute_crc32=True):
-        self._file.seek(self._header_size)
+        reader = self._reader
+        read_all, read_some = self._read_funcs()
+        reader.seek(self._header_size)
         for i in xrange(1, self._num_objects + 1):
-            offset = self._file.tell()
+            offset = reader.tell()
             unpacked, unused = unpack_object(
-              self._file.read, compute_crc32=compute_crc32)
+              read_all, read_some=read_some, compute_crc32=compute_crc32)
             if progress is not None:
                 progress(i, self._num_objects)
             yield (offset, unpacked.pack_type_num, unpacked._obj(),
                    unpacked.crc32)
-            self._file.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
+            reader.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
 
     def _iter_unpacked(self):
         # TODO(dborowitz): Merge this with iterobjects, if we can change its
         # return type.
-        self._file.seek(self._header_size)
+        reader = self._reader
+        read_all, read_some = self._read_funcs()
+        reader.seek(self._header_size)
         for _ in xrange(self._num_objects):
-            offset = self._file.tell()
+            offset = reader.tell()
             unpacked, unused = unpack_object(
-              self._file.read, compute_crc32=False)
+              read_all, read_some=read_some, compute_crc32=False)
             unpacked.offset = offset
             yield unpacked
-            self._file.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
+            reader.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
 
-    def iterentries(self, progress=None):
+    def iterentries(self, progress=None, processes=1):
         """Yield entries summarizing the contents of this pack.
 
         :param progress: Progress function, called with current and total
             object count.
+        :param processes: Number of processes to use for resolving deltas;
+            None for the number of CPUs. Using more than one process requires
+            the pack data to have been opened by path.
         :return: iterator of tuples with (sha, offset, crc32)
         """
         num_objects = self._num_objects
-        for i, result in enumerate(PackIndexer.for_pack_data(self)):
+        indexer = PackIndexer.for_pack_data(self)
+        if processes == 1:
+            results = iter(indexer)
+        else:
+            results = indexer.iter_parallel(self._filename, processes)
+        for i, result in enumerate(results):
             if progress is not None:
                 progress(i, num_objects)
             yield result
 
-    def sorted_entries(self, progress=None):
+    def sorted_entries(self, progress=None, processes=1):
         """Return entries in this pack, sorted by SHA.
 
         :param progress: Progress function, called with current and total
             object count
+        :param processes: Number of processes to use for resolving deltas;
+            see iterentries.
         :return: List of tuples with (sha, offset, crc32)
         """
-        ret = list(self.iterentries(progress=progress))
+        ret = list(self.iterentries(progress=progress, processes=processes))
         ret.sort()
         return ret
 
@@ -1155,8 +2006,8 @@ class PackData(object):
 
     def get_stored_checksum(self):
         """Return the expected checksum stored in this pack."""
-        self._file.seek(-20, SEEK_END)
-        return self._file.read(20)
+        self._reader.seek(-20, SEEK_END)
+        return self._reader.read(20)
 
     def check(self):
         """Check the consistency of this pack."""
@@ -1172,15 +2023,48 @@ class PackData(object):
         and then the packfile can be asked directly for that object using this
         function.
         """
-        if offset in self._offset_cache:
+        try:
             return self._offset_cache[offset]
+        except KeyError:
+            pass
         assert isinstance(offset, long) or isinstance(offset, int),\
                 'offset was %r' % offset
         assert offset >= self._header_size
-        self._file.seek(offset)
-        unpacked, _ = unpack_object(self._file.read)
+        read_all, read_some = self._read_funcs()
+        self._reader.seek(offset)
+        unpacked, _ = unpack_object(read_all, read_some=read_some)
         return (unpacked.pack_type_num, unpacked._obj())
 
+    def get_object_header_at(self, offset):
+        """Return the type and size of the object at an offset.
+
+        Nothing is inflated for full objects. For deltas only the start of the
+        delta is, to get the size of the resolved object; its type comes from
+        the headers along the delta chain.
+
+        :param offset: Offset of the object in the pack
+        :return: Tuple with the resolved numeric type and size of the object
+        """
+        size = None
+        while True:
+            self._reader.seek(offset)
+            type_num, delta_base, obj_size, _, _ = read_object_header(
+                self._reader.read)
+            if size is None:
+                if type_num in DELTA_TYPES:
+                    size = read_delta_target_size(self._reader.read)
+                else:
+                    size = obj_size
+            if type_num == OFS_DELTA:
+                offset -= delta_base
+            elif type_num == REF_DELTA:
+                if self.pack is not None:
+                    offset = self.pack.index.object_index(delta_base)
+                if self.pack is None or not offset:
+                    raise KeyError(delta_base)
+            else:
+                return type_num, size
+
 
 class DeltaChainIterator(object):
     """Abstract iterator over pack data based on delta chains.
@@ -1208,6 +2092,7 @@ class DeltaChainIterator(object):
 
     def __init__(self, file_obj, resolve_ext_ref=None):
         self._file = file_obj
+        self._read_some = None
         self._resolve_ext_ref = resolve_ext_ref
         self._pending_ofs = defaultdict(list)
         self._pending_ref = defaultdict(list)
@@ -1235,7 +2120,8 @@ class DeltaChainIterator(object):
             self._full_ofs.append((offset, type_num))
 
     def set_pack_data(self, pack_data):
-        self._file = pack_data._file
+        self._file = pack_data._reader
+        self._read_some = pack_data._read_funcs()[1]
 
     def _walk_all_chains(self):
         for offset, type_num in self._full_ofs:
@@ -1276,8 +2162,8 @@ class DeltaChainIterator(object):
     def _resolve_object(self, offset, obj_type_num, base_chunks):
         self._file.seek(offset)
         unpacked, _ = unpack_object(
-          self._file.read, include_comp=self._include_comp,
-          compute_crc32=self._compute_crc32)
+          self._file.read, read_some=self._read_some,
+          include_comp=self._include_comp, compute_crc32=self._compute_crc32)
         unpacked.offset = offset
         if base_chunks is None:
             assert unpacked.pack_type_num == obj_type_num
@@ -1291,15 +2177,19 @@ class DeltaChainIterator(object):
     def _follow_chain(self, offset, obj_type_num, base_chunks):
         # Unlike PackData.get_object_at, there is no need to cache offsets as
         # this approach by design inflates each object exactly once.
-        unpacked = self._resolve_object(offset, obj_type_num, base_chunks)
-        yield self._result(unpacked)
-
-        pending = chain(self._pending_ofs.pop(unpacked.offset, []),
-                        self._pending_ref.pop(unpacked.sha(), []))
-        for new_offset in pending:
-            for new_result in self._follow_chain(
-              new_offset, unpacked.obj_type_num, unpacked.obj_chunks):
-                yield new_result
+        todo = [(offset, obj_type_num, base_chunks)]
+        while todo:
+            (offset, obj_type_num, base_chunks) = todo.pop()
+            unpacked = self._resolve_object(offset, obj_type_num, base_chunks)
+            yield self._result(unpacked)
+
+            unblocked = list(chain(self._pending_ofs.pop(unpacked.offset, []),
+                                   self._pending_ref.pop(unpacked.sha(), [])))
+            # Push in reverse so that dependents are walked depth-first in the
+            # order they were recorded.
+            todo.extend(
+                (new_offset, unpacked.obj_type_num, unpacked.obj_chunks)
+                for new_offset in reversed(unblocked))
 
     def __iter__(self):
         return self._walk_all_chains()
@@ -1308,6 +2198,32 @@ class DeltaChainIterator(object):
         return self._ext_refs
 
 
+# Arguments for the PackIndexer of the current worker process of
+# PackIndexer.iter_parallel.
+_parallel_indexer_args = None
+
+
+def _init_parallel_indexer(cls, path, pending_ofs, pending_ref):
+    global _parallel_indexer_args
+    _parallel_indexer_args = (cls, path, pending_ofs, pending_ref)
+
+
+def _index_delta_trees(roots):
+    cls, path, pending_ofs, pending_ref = _parallel_indexer_args
+    data = PackData(path)
+    try:
+        indexer = cls(None)
+        indexer.set_pack_data(data)
+        indexer._pending_ofs = pending_ofs
+        indexer._pending_ref = pending_ref
+        results = []
+        for offset, type_num in roots:
+            results.extend(indexer._follow_chain(offset, type_num, None))
+        return results
+    finally:
+        data.close()
+
+
 class PackIndexer(DeltaChainIterator):
     """Delta chain iterator that yields index entries."""
 
@@ -1316,6 +2232,46 @@ class PackIndexer(DeltaChainIterator):
     def _result(self, unpacked):
         return unpacked.sha(), unpacked.offset, unpacked.crc32
 
+    def iter_parallel(self, path, processes=None):
+        """Iterate over the index entries, using a pool of worker processes.
+
+        This is similar to git index-pack --threads: every tree of deltas
+        rooted at a full object in the pack is resolved in its entirety by a
+        worker process, which reads the pack from path. Chains based on
+        external refs are resolved in this process afterwards.
+
+        :param path: Path of the pack file. All objects must have been
+            recorded, and the pack must be flushed to disk.
+        :param processes: Number of worker processes; defaults to the number
+            of CPUs.
+        :return: Iterator over (sha, offset, crc32) tuples, in no particular
+            order.
+        """
+        from multiprocessing import Pool, cpu_count
+        if processes is None:
+            processes = cpu_count()
+        pool = Pool(processes, _init_parallel_indexer,
+                    (self.__class__, path, self._pending_ofs,
+                     self._pending_ref))
+        try:
+            # Each task reads the pack for a chunk of delta trees.
+            chunksize = max(1, len(self._full_ofs) // (processes * 4))
+            chunks = [self._full_ofs[i:i + chunksize]
+                      for i in xrange(0, len(self._full_ofs), chunksize)]
+            for results in pool.imap_unordered(_index_delta_trees, chunks):
+                for result in results:
+                    sha, offset = result[:2]
+                    self._pending_ofs.pop(offset, None)
+                    self._pending_ref.pop(sha, None)
+                    yield result
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+        for result in self._walk_ref_chains():
+            yield result
+        assert not self._pending_ofs
+
 
 class PackInflater(DeltaChainIterator):
     """Delta chain iterator that yields ShaFile objects."""
@@ -1410,20 +2366,49 @@ def pack_object_header(type_num, delta_base, size):
     return header
 
 
-def write_pack_object(f, type, object, sha=None):
+# zlib compression level for pack entries; -1 is the zlib default, like git's
+# core.compression default.
+DEFAULT_COMPRESSION_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+
+# Objects smaller than this are compressed by the writer itself rather than
+# by a compression thread.
+PARALLEL_COMPRESS_MIN_SIZE = 4096
+
+# Number of records per compression thread that may be in flight ahead of
+# the pack writer.
+PARALLEL_COMPRESS_WINDOW = 16
+
+
+def write_pack_object(f, type, object, sha=None,
+                      compression_level=DEFAULT_COMPRESSION_LEVEL):
     """Write pack object to a file.
 
     :param f: File to write to
     :param type: Numeric type of the object
     :param object: Object to write
+    :param compression_level: zlib compression level to use
     :return: Tuple with offset at which the object was written, and crc32
     """
     if type in DELTA_TYPES:
         delta_base, object = object
     else:
         delta_base = None
-    header = pack_object_header(type, delta_base, len(object))
-    comp_data = zlib.compress(object)
+    return _write_pack_entry(f, type, delta_base, len(object),
+                             zlib.compress(object, compression_level), sha)
+
+
+def _write_pack_entry(f, type, delta_base, size, comp_data, sha=None):
+    """Write a pack entry whose data has already been compressed.
+
+    :param f: File to write to
+    :param type: Numeric type of the object
+    :param delta_base: Delta base offset or SHA, or None for full texts
+    :param size: Uncompressed size of the object
+    :param comp_data: Compressed object data
+    :param sha: Optional hash object to update with the written data
+    :return: crc32 of the entry
+    """
+    header = pack_object_header(type, delta_base, size)
     crc32 = 0
     for data in (header, comp_data):
         f.write(data)
@@ -1433,12 +2418,16 @@ def write_pack_object(f, type, object, sha=None):
     return crc32 & 0xffffffff
 
 
-def write_pack(filename, objects, num_objects=None):
+def write_pack(filename, objects, num_objects=None,
+               compression_level=DEFAULT_COMPRESSION_LEVEL, threads=1):
     """Write a new pack data file.
 
     :param filename: Path to the new pack file (without .pack extension)
     :param objects: Iterable of (object, path) tuples to write.
         Should provide __len__
+    :param compression_level: zlib compression level to use
+    :param threads: Number of threads to compress objects with; None for
+        the number of CPUs
     :return: Tuple with checksum of pack file and index file
     """
     if num_objects is not None:
@@ -1447,7 +2436,8 @@ def write_pack(filename, objects, num_objects=None):
     f = GitFile(filename + '.pack', 'wb')
     try:
         entries, data_sum = write_pack_objects(f, objects,
-            num_objects=num_objects)
+            num_objects=num_objects, compression_level=compression_level,
+            threads=threads)
     finally:
         f.close()
     entries = [(k, v[0], v[1]) for (k, v) in entries.iteritems()]
@@ -1466,11 +2456,19 @@ def write_pack_header(f, num_objects):
     f.write(struct.pack('>L', num_objects))  # Number of objects in pack
 
 
-def deltify_pack_objects(objects, window=10):
+# Default number of objects to consider as delta bases for each object, and
+# maximum length of delta chains; the same defaults as git.
+DEFAULT_PACK_DELTA_WINDOW_SIZE = 10
+DEFAULT_PACK_DELTA_DEPTH = 50
+
+
+def deltify_pack_objects(objects, window=DEFAULT_PACK_DELTA_WINDOW_SIZE,
+                         depth=DEFAULT_PACK_DELTA_DEPTH):
     """Generate deltas for pack objects.
 
     :param objects: Objects to deltify
     :param window: Window size
+    :param depth: Maximum length of delta chains
     :return: Iterator over type_num, object id, delta_base, content
         delta_base is None for full text entries
     """
@@ -1480,74 +2478,277 @@ def deltify_pack_objects(objects, window=10):
     for obj, path in objects:
         magic.append((obj.type_num, path, -obj.raw_length(), obj))
     magic.sort()
+    for record in deltify_sorted_objects(
+            ((o.type_num, o.sha().digest(), o.as_raw_string())
+             for (type_num, path, neg_length, o) in magic),
+            window, depth):
+        yield record
+
+
+def deltify_sorted_objects(objects, window=DEFAULT_PACK_DELTA_WINDOW_SIZE,
+                           depth=DEFAULT_PACK_DELTA_DEPTH):
+    """Generate deltas for objects that are already in delta search order.
 
+    Only the objects in the window are kept in memory, so objects can be
+    produced lazily.
+
+    :param objects: Iterable over type_num, binary object id, raw contents
+    :param window: Window size
+    :param depth: Maximum length of delta chains
+    :return: Iterator over type_num, object id, delta_base, content
+        delta_base is None for full text entries
+    """
+    # Tuples of (type_num, sha, raw, chain depth) for recent objects
     possible_bases = deque()
 
-    for type_num, path, neg_length, o in magic:
-        raw = o.as_raw_string()
+    for type_num, sha, raw in objects:
         winner = raw
         winner_base = None
-        for base in possible_bases:
-            if base.type_num != type_num:
+        winner_depth = 0
+        for base_type_num, base_sha, base_raw, base_depth in possible_bases:
+            if base_type_num != type_num or base_depth >= depth:
                 continue
-            delta = create_delta(base.as_raw_string(), raw)
+            delta = create_delta(base_raw, raw)
             if len(delta) < len(winner):
-                winner_base = base.sha().digest()
+                winner_base = base_sha
                 winner = delta
-        yield type_num, o.sha().digest(), winner_base, winner
-        possible_bases.appendleft(o)
+                winner_depth = base_depth + 1
+        yield type_num, sha, winner_base, winner
+        possible_bases.appendleft((type_num, sha, raw, winner_depth))
         while len(possible_bases) > window:
             possible_bases.pop()
 
 
-def write_pack_objects(f, objects, window=10, num_objects=None):
+def write_pack_objects(f, objects, window=DEFAULT_PACK_DELTA_WINDOW_SIZE,
+                       num_objects=None, depth=DEFAULT_PACK_DELTA_DEPTH,
+                       compression_level=DEFAULT_COMPRESSION_LEVEL, threads=1):
     """Write a new pack data file.
 
     :param f: File to write to
     :param objects: Iterable of (object, path) tuples to write.
         Should provide __len__
-    :param window: Sliding window size for searching for deltas; currently
-                   unimplemented
+    :param window: Sliding window size for searching for deltas; if 0 or
+        None, objects are written without deltas (and without reading all
+        of them into memory first)
     :param num_objects: Number of objects (do not use, deprecated)
+    :param depth: Maximum length of delta chains
+    :param compression_level: zlib compression level to use
+    :param threads: Number of threads to compress objects with; None for
+        the number of CPUs
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
     if num_objects is None:
         num_objects = len(objects)
-    # FIXME: pack_contents = deltify_pack_objects(objects, window)
-    pack_contents = (
-        (o.type_num, o.sha().digest(), None, o.as_raw_string())
-        for (o, path) in objects)
-    return write_pack_data(f, num_objects, pack_contents)
+    if window:
+        pack_contents = deltify_pack_objects(objects, window, depth)
+    else:
+        pack_contents = (
+            (o.type_num, o.sha().digest(), None, o.as_raw_string())
+            for (o, path) in objects)
+    return write_pack_data(f, num_objects, pack_contents,
+                           compression_level=compression_level,
+                           threads=threads)
+
 
+class _CompressTask(object):
+    """Compression of a single object, done by a _CompressorPool."""
 
-def write_pack_data(f, num_records, records):
+    __slots__ = ('data', 'level', 'result', 'error', 'done')
+
+    def __init__(self, data, level):
+        self.data = data
+        self.level = level
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = zlib.compress(self.data, self.level)
+        except Exception, e:
+            self.error = e
+        self.data = None
+        self.done.set()
+
+    def wait(self):
+        """Wait for the compressed data.
+
+        :return: The compressed data
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _CompressorPool(object):
+    """Pool of threads compressing objects.
+
+    zlib releases the GIL while compressing, so compression of large objects
+    scales with the number of threads.
+    """
+
+    def __init__(self, threads):
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            task.run()
+
+    def compress(self, data, level):
+        """Queue data for compression.
+
+        :return: A _CompressTask; its wait method returns the compressed data
+        """
+        task = _CompressTask(data, level)
+        self._tasks.put(task)
+        return task
+
+    def close(self):
+        for t in self._threads:
+            self._tasks.put(None)
+        for t in self._threads:
+            t.join()
+
+
+def _iter_compressed(records, compression_level, threads):
+    """Compress pack records, possibly in parallel.
+
+    :param records: Iterator over records, as accepted by write_pack_data
+    :param compression_level: zlib compression level to use
+    :param threads: Number of threads to compress with
+    :return: Iterator over (record, compressed data) tuples, in the same
+        order as records; the compressed data is None for UnpackedObjects.
+    """
+    if threads == 1:
+        for record in records:
+            if isinstance(record, UnpackedObject):
+                yield record, None
+            else:
+                yield record, zlib.compress(record[3], compression_level)
+        return
+    pool = _CompressorPool(threads)
+    try:
+        # Only a limited number of records is in flight, so memory use stays
+        # bounded however large the pack.
+        pending = deque()
+        for record in records:
+            if isinstance(record, UnpackedObject):
+                comp_data = None
+            elif len(record[3]) < PARALLEL_COMPRESS_MIN_SIZE:
+                # Not worth a round trip to another thread.
+                comp_data = zlib.compress(record[3], compression_level)
+            else:
+                comp_data = pool.compress(record[3], compression_level)
+            pending.append((record, comp_data))
+            while len(pending) > threads * PARALLEL_COMPRESS_WINDOW:
+                record, comp_data = pending.popleft()
+                if isinstance(comp_data, _CompressTask):
+                    comp_data = comp_data.wait()
+                yield record, comp_data
+        while pending:
+            record, comp_data = pending.popleft()
+            if isinstance(comp_data, _CompressTask):
+                comp_data = comp_data.wait()
+            yield record, comp_data
+    finally:
+        pool.close()
+
+
+def write_pack_data(f, num_records, records,
+                    compression_level=DEFAULT_COMPRESSION_LEVEL, threads=1):
     """Write a new pack data file.
 
+    Besides tuples, records can be UnpackedObjects as returned by
+    Pack.get_compressed_entry, whose compressed data is copied as is. The
+    delta base of such a record is written as an offset if the base has
+    already been written, and as a SHA otherwise.
+
+    With more than one thread, objects are compressed in parallel ahead of
+    the writer; they are still written in the order of records.
+
     :param f: File to write to
     :param num_records: Number of records
     :param records: Iterator over type_num, object_id, delta_base, raw
+    :param compression_level: zlib compression level to use
+    :param threads: Number of threads to compress objects with; None for
+        the number of CPUs
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
+    if threads is None:
+        threads = _cpu_count()
     # Write the pack
     entries = {}
     f = SHA1Writer(f)
     write_pack_header(f, num_records)
-    for type_num, object_id, delta_base, raw in records:
+    for record, comp_data in _iter_compressed(records, compression_level,
+                                              threads):
+        offset = f.offset()
+        if isinstance(record, UnpackedObject):
+            entries[record.sha()] = (offset,
+                                     _write_compressed_entry(f, record, entries))
+            continue
+        type_num, object_id, delta_base, raw = record
         if delta_base is not None:
             try:
                 base_offset, base_crc32 = entries[delta_base]
             except KeyError:
                 type_num = REF_DELTA
-                raw = (delta_base, raw)
             else:
                 type_num = OFS_DELTA
-                raw = (base_offset, raw)
-        offset = f.offset()
-        crc32 = write_pack_object(f, type_num, raw)
+                delta_base = offset - base_offset
+        crc32 = _write_pack_entry(f, type_num, delta_base, len(raw), comp_data)
         entries[object_id] = (offset, crc32)
     return entries, f.write_sha()
 
 
+def _cpu_count():
+    """Return the number of CPUs, or 1 if it can not be determined."""
+    try:
+        from multiprocessing import cpu_count
+        return cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def _write_compressed_entry(f, unpacked, entries):
+    """Write an already compressed pack entry.
+
+    :param f: SHA1Writer to write to
+    :param unpacked: UnpackedObject with comp_chunks set; the delta base of
+        deltas should be the binary SHA of the base.
+    :param entries: Dict mapping id -> (offset, crc32) of the objects written
+        so far
+    :return: The CRC32 of the entry written
+    """
+    type_num = unpacked.pack_type_num
+    delta_base = unpacked.delta_base
+    if type_num in DELTA_TYPES:
+        try:
+            base_offset, base_crc32 = entries[delta_base]
+        except KeyError:
+            type_num = REF_DELTA
+        else:
+            type_num = OFS_DELTA
+            delta_base = f.offset() - base_offset
+    header = pack_object_header(type_num, delta_base, unpacked.decomp_len)
+    f.write(header)
+    crc32 = binascii.crc32(header)
+    for chunk in unpacked.comp_chunks:
+        f.write(chunk)
+        crc32 = binascii.crc32(chunk, crc32)
+    return crc32 & 0xffffffff
+
+
 def write_pack_index_v1(f, entries, pack_checksum):
     """Write a new pack index file.
 
@@ -1574,64 +2775,117 @@ def write_pack_index_v1(f, entries, pack_checksum):
     return f.write_sha()
 
 
+# Size of the blocks of the delta base that are indexed by create_delta.
+_DELTA_BLOCK_SIZE = 16
+
+# Maximum number of bytes that a single copy instruction can cover.
+_DELTA_MAX_COPY = 0x10000
+
+
+def _delta_encode_size(size):
+    ret = ''
+    c = size & 0x7f
+    size >>= 7
+    while size:
+        ret += chr(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret += chr(c)
+    return ret
+
+
+def _delta_encode_copy(offset, size):
+    """Encode a copy instruction, as used in git's diff-delta.c.
+
+    A size of 0x10000 is encoded by leaving out all size bytes.
+    """
+    scratch = ''
+    op = 0x80
+    for i in range(4):
+        if offset & 0xff << i*8:
+            scratch += chr((offset >> i*8) & 0xff)
+            op |= 1 << i
+    for i in range(2):
+        if size & 0xff << i*8:
+            scratch += chr((size >> i*8) & 0xff)
+            op |= 1 << (4+i)
+    return chr(op) + scratch
+
+
+def _delta_encode_insert(data):
+    """Encode insert instructions for a string of literal data."""
+    ret = []
+    for i in xrange(0, len(data), 127):
+        chunk = data[i:i+127]
+        ret.append(chr(len(chunk)))
+        ret.append(chunk)
+    return ''.join(ret)
+
+
+def _common_prefix_length(a, a_start, b, b_start):
+    """Return the length of the common prefix of a[a_start:] and b[b_start:].
+    """
+    max_len = min(len(a) - a_start, len(b) - b_start)
+    n = 0
+    step = 256
+    while n < max_len:
+        step = min(step, max_len - n)
+        if (a[a_start+n:a_start+n+step] == b[b_start+n:b_start+n+step]):
+            n += step
+            continue
+        while a[a_start+n] == b[b_start+n]:
+            n += 1
+        break
+    return n
+
+
 def create_delta(base_buf, target_buf):
-    """Use python difflib to work out how to transform base_buf to target_buf.
+    """Work out how to transform base_buf to target_buf.
+
+    Like git's diff-delta.c, this indexes the base buffer in blocks of
+    _DELTA_BLOCK_SIZE bytes and then scans the target for matching blocks,
+    extending each match in both directions.
 
     :param base_buf: Base buffer
     :param target_buf: Target buffer
+    :return: Delta, as a string
     """
     assert isinstance(base_buf, str)
     assert isinstance(target_buf, str)
-    out_buf = ''
-    # write delta header
-    def encode_size(size):
-        ret = ''
-        c = size & 0x7f
-        size >>= 7
-        while size:
-            ret += chr(c | 0x80)
-            c = size & 0x7f
-            size >>= 7
-        ret += chr(c)
-        return ret
-    out_buf += encode_size(len(base_buf))
-    out_buf += encode_size(len(target_buf))
-    # write out delta opcodes
-    seq = difflib.SequenceMatcher(a=base_buf, b=target_buf)
-    for opcode, i1, i2, j1, j2 in seq.get_opcodes():
-        # Git patch opcodes don't care about deletes!
-        #if opcode == 'replace' or opcode == 'delete':
-        #    pass
-        if opcode == 'equal':
-            # If they are equal, unpacker will use data from base_buf
-            # Write out an opcode that says what range to use
-            scratch = ''
-            op = 0x80
-            o = i1
-            for i in range(4):
-                if o & 0xff << i*8:
-                    scratch += chr((o >> i*8) & 0xff)
-                    op |= 1 << i
-            s = i2 - i1
-            for i in range(2):
-                if s & 0xff << i*8:
-                    scratch += chr((s >> i*8) & 0xff)
-                    op |= 1 << (4+i)
-            out_buf += chr(op)
-            out_buf += scratch
-        if opcode == 'replace' or opcode == 'insert':
-            # If we are replacing a range or adding one, then we just
-            # output it to the stream (prefixed by its size)
-            s = j2 - j1
-            o = j1
-            while s > 127:
-                out_buf += chr(127)
-                out_buf += target_buf[o:o+127]
-                s -= 127
-                o += 127
-            out_buf += chr(s)
-            out_buf += target_buf[o:o+s]
-    return out_buf
+    block_size = _DELTA_BLOCK_SIZE
+    index = {}
+    for i in xrange(0, len(base_buf) - block_size + 1, block_size):
+        index.setdefault(base_buf[i:i+block_size], i)
+
+    out = [_delta_encode_size(len(base_buf)),
+           _delta_encode_size(len(target_buf))]
+    target_len = len(target_buf)
+    insert_start = 0
+    i = 0
+    while i <= target_len - block_size:
+        base_offset = index.get(target_buf[i:i+block_size])
+        if base_offset is None:
+            i += 1
+            continue
+        # Extend the match backwards over data we were about to insert.
+        while (i > insert_start and base_offset > 0 and
+               target_buf[i-1] == base_buf[base_offset-1]):
+            i -= 1
+            base_offset -= 1
+        length = block_size + _common_prefix_length(
+            base_buf, base_offset + block_size, target_buf, i + block_size)
+        if insert_start < i:
+            out.append(_delta_encode_insert(target_buf[insert_start:i]))
+        i += length
+        insert_start = i
+        while length > 0:
+            size = min(length, _DELTA_MAX_COPY)
+            out.append(_delta_encode_copy(base_offset, size))
+            base_offset += size
+            length -= size
+    if insert_start < target_len:
+        out.append(_delta_encode_insert(target_buf[insert_start:]))
+    return ''.join(out)
 
 
 def apply_delta(src_buf, delta):
@@ -1736,6 +2990,10 @@ def write_pack_index_v2(f, entries, pack_checksum):
     return f.write_sha()
 
 
+# Marker for a pack that has no (usable) bitmap file.
+_NO_BITMAP = object()
+
+
 class Pack(object):
     """A Git pack object."""
 
@@ -1745,8 +3003,12 @@ class Pack(object):
         self._idx = None
         self._idx_path = self._basename + '.idx'
         self._data_path = self._basename + '.pack'
+        self._bitmap_path = self._basename + '.bitmap'
+        self._bitmap = None
+        self._offset_table = None
         self._data_load = lambda: PackData(self._data_path)
         self._idx_load = lambda: load_pack_index(self._idx_path)
+        self._bitmap_load = lambda: load_pack_bitmap(self._bitmap_path)
 
     @classmethod
     def from_lazy_objects(self, data_fn, idx_fn):
@@ -1788,10 +3050,39 @@ class Pack(object):
             self._idx = self._idx_load()
         return self._idx
 
+    @property
+    def bitmap(self):
+        """The reachability bitmaps for this pack.
+
+        :return: A BitmapIndex, or None if there is no bitmap file for this
+            pack or it was written for a different version of the pack.
+        """
+        if self._bitmap is None:
+            self._bitmap = self._load_bitmap()
+        if self._bitmap is _NO_BITMAP:
+            return None
+        return self._bitmap
+
+    def _load_bitmap(self):
+        try:
+            bitmap = self._bitmap_load()
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                # Remember the miss, so the file is not looked up again.
+                return _NO_BITMAP
+            raise
+        try:
+            if bitmap.get_pack_checksum() != self.index.get_pack_checksum():
+                return _NO_BITMAP
+            return BitmapIndex(self.index, bitmap)
+        finally:
+            bitmap.close()
+
     def close(self):
         if self._data is not None:
             self._data.close()
-        self.index.close()
+        if self._idx is not None:
+            self._idx.close()
 
     def __eq__(self, other):
         return type(self) == type(other) and self.index == other.index
@@ -1839,11 +3130,85 @@ class Pack(object):
             return False
 
     def get_raw(self, sha1):
-        offset = self.index.object_index(sha1)
+        return self.get_raw_at(self.index.object_index(sha1))
+
+    def _get_offset_table(self):
+        """Return the offsets, SHAs and CRC32s of all entries, by offset."""
+        if self._offset_table is None:
+            entries = sorted((offset, sha, crc32)
+                             for (sha, offset, crc32) in self.index.iterentries())
+            self._offset_table = tuple(
+                [entry[i] for entry in entries] for i in range(3))
+        return self._offset_table
+
+    def get_compressed_entry(self, offset):
+        """Obtain the compressed pack entry for the object at an offset.
+
+        The entry is checked against the CRC32 stored in the pack index, or
+        if the index does not store those, by decompressing it.
+
+        :param offset: Offset of the object in the pack
+        :return: An UnpackedObject with offset, pack_type_num, delta_base,
+            decomp_len, crc32 and comp_chunks set and the SHA of the object
+            cached. The delta base of a delta is the binary SHA of its base,
+            for both OFS_DELTA and REF_DELTA.
+        :raise KeyError: if there is no object at offset
+        :raise ChecksumMismatch: if the entry is corrupt
+        """
+        offsets, shas, crc32s = self._get_offset_table()
+        i = bisect.bisect_left(offsets, offset)
+        if i == len(offsets) or offsets[i] != offset:
+            raise KeyError(offset)
+        if i + 1 < len(offsets):
+            end = offsets[i + 1]
+        else:
+            end = self.data._get_size() - 20
+        reader = self.data._reader
+        reader.seek(offset)
+        data = reader.read(end - offset)
+        type_num, delta_base, size, header_len, unused_crc32 = (
+            read_object_header(StringIO(data).read))
+        crc32 = binascii.crc32(data) & 0xffffffff
+        comp_data = data[header_len:]
+        if crc32s[i] is not None:
+            if crc32 != crc32s[i]:
+                raise ChecksumMismatch('%08x' % crc32s[i], '%08x' % crc32)
+        else:
+            try:
+                decomp_len = len(zlib.decompress(comp_data))
+            except zlib.error, e:
+                raise ChecksumMismatch('zlib stream', str(e))
+            if decomp_len != size:
+                raise ChecksumMismatch(str(size), str(decomp_len))
+        if type_num == OFS_DELTA:
+            j = bisect.bisect_left(offsets, offset - delta_base)
+            if offsets[j] != offset - delta_base:
+                raise AssertionError('Invalid delta base offset')
+            delta_base = shas[j]
+        unpacked = UnpackedObject(type_num, delta_base, size, crc32)
+        unpacked.offset = offset
+        unpacked.comp_chunks = [comp_data]
+        unpacked._sha = shas[i]
+        return unpacked
+
+    def get_raw_at(self, offset):
+        """Obtain the raw text for the object at a particular offset.
+
+        :param offset: Offset of the object in the pack
+        :return: tuple with numeric type and object contents.
+        """
         obj_type, obj = self.data.get_object_at(offset)
         type_num, chunks = self.data.resolve_object(offset, obj_type, obj)
         return type_num, ''.join(chunks)
 
+    def get_object_header_at(self, offset):
+        """Obtain the type and size of the object at a particular offset.
+
+        :param offset: Offset of the object in the pack
+        :return: tuple with numeric type and object size.
+        """
+        return self.data.get_object_header_at(offset)
+
     def __getitem__(self, sha1):
         """Retrieve the specified SHA1."""
         type, uncomp = self.get_raw(sha1)
@@ -1890,7 +3255,11 @@ class Pack(object):
         return keepfile_name
 
 
+# Hold on to the pure-python implementations for testing.
+_create_delta_py = create_delta
+_unpack_object_buffer_py = unpack_object_buffer
 try:
-    from dulwich._pack import apply_delta, bisect_find_sha
+    from dulwich._pack import apply_delta, bisect_find_sha, create_delta
+    from dulwich._pack import unpack_object_buffer
 except ImportError:
     pass
@@ -22,6 +22,7 @@
 from cStringIO import StringIO
 import socket
 
+from dulwich import __version__ as dulwich_version
 from dulwich.errors import (
     HangupException,
     GitProtocolError,
@@ -34,10 +35,18 @@ TCP_GIT_PORT = 9418
 
 ZERO_SHA = "0" * 40
 
+# Sent in the agent capability of protocol version 2
+AGENT = "dulwich/%d.%d.%d" % dulwich_version
+
 SINGLE_ACK = 0
 MULTI_ACK = 1
 MULTI_ACK_DETAILED = 2
 
+# Separates the sections of a protocol version 2 request or response. Read
+# as DELIM_PKT by read_pkt_line, and written by passing it to
+# write_pkt_line.
+DELIM_PKT = object()
+
 
 class ProtocolFile(object):
     """A dummy file for network ops that expect file-like objects."""
@@ -62,6 +71,8 @@ def pkt_line(data):
     """
     if data is None:
         return '0000'
+    if data is DELIM_PKT:
+        return '0001'
     return '%04x%s' % (len(data) + 4, data)
 
 
@@ -88,8 +99,8 @@ class Protocol(object):
 
         This method may read from the readahead buffer; see unread_pkt_line.
 
-        :return: The next string from the stream, without the length prefix, or
-            None for a flush-pkt ('0000').
+        :return: The next string from the stream, without the length prefix,
+            None for a flush-pkt ('0000') or DELIM_PKT for a delim-pkt ('0001').
         """
         if self._readahead is None:
             read = self.read
@@ -108,6 +119,8 @@ class Protocol(object):
                 return None
             if self.report_activity:
                 self.report_activity(size, 'read')
+            if size == 1:
+                return DELIM_PKT
             return read(size-4)
         except socket.error, e:
             raise GitProtocolError(e)
@@ -214,11 +227,7 @@ class Protocol(object):
 
         :return: A tuple of (command, [list of arguments]).
         """
-        line = self.read_pkt_line()
-        splice_at = line.find(" ")
-        cmd, args = line[:splice_at], line[splice_at+1:]
-        assert args[-1] == "\x00"
-        return cmd, args[:-1].split(chr(0))
+        return parse_cmd_pkt(self.read_pkt_line())
 
 
 _RBUFSIZE = 8192  # Default read buffer size.
@@ -327,6 +336,18 @@ class ReceivableProtocol(Protocol):
         return buf.read(size)
 
 
+def parse_cmd_pkt(line):
+    """Parse a command pkt-line, as sent by send_cmd.
+
+    :param line: The pkt-line, without length prefix
+    :return: A tuple of (command, [list of arguments]).
+    """
+    splice_at = line.find(" ")
+    cmd, args = line[:splice_at], line[splice_at+1:]
+    assert args[-1] == "\x00"
+    return cmd, args[:-1].split(chr(0))
+
+
 def extract_capabilities(text):
     """Extract a capabilities list from a string, if present.
 
@@ -356,6 +377,23 @@ def extract_want_line_capabilities(text):
     return (" ".join(split_text[:2]), split_text[2:])
 
 
+def parse_protocol_version(params):
+    """Determine the protocol version requested by a client.
+
+    :param params: Parameters sent by the client, e.g. the extra parameters
+        of a git:// request or the fields of a Git-Protocol HTTP header
+    :return: The highest version requested with a "version=" parameter, or 0
+    """
+    version = 0
+    for param in params:
+        if param.startswith("version="):
+            try:
+                version = max(version, int(param[len("version="):]))
+            except ValueError:
+                pass
+    return version
+
+
 def ack_type(capabilities):
     """Extract the ack type from a capabilities list."""
     if 'multi_ack_detailed' in capabilities:
@@ -428,6 +466,9 @@ class PktLineParser(object):
             if size == 0:
                 self.handle_pkt(None)
                 buf = buf[4:]
+            elif size == 1:
+                self.handle_pkt(DELIM_PKT)
+                buf = buf[4:]
             elif size <= len(buf):
                 self.handle_pkt(buf[4:size])
                 buf = buf[size:]
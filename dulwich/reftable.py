@@ -0,0 +1,635 @@
+# reftable.py -- Reading and writing git reftable files
+# Copyright (C) 2013 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing git reftable files.
+
+A reftable is an immutable file that stores refs sorted by name in
+fixed-size blocks. Within a block, each name is stored as a suffix of the
+previous one, except at restart points every few records, which hold the
+full name and are listed at the end of the block so that they can be
+binary searched.
+
+A repository keeps its refs in a stack of reftables, listed from oldest to
+newest in reftable/tables.list. Each update adds a new table to the top of
+the stack, and records in newer tables override those in older ones. Small
+tables at the top of the stack are merged together as they accumulate.
+
+Only ref blocks are read and written; tables written here have no index,
+object or log blocks.
+"""
+
+import errno
+import heapq
+import os
+import random
+import struct
+import zlib
+try:
+    from struct import unpack_from
+except ImportError:
+    from dulwich._compat import unpack_from
+
+from dulwich._compat import namedtuple
+from dulwich.file import GitFile
+from dulwich.objects import (
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import _load_file_contents
+
+
+REFTABLE_MAGIC = 'REFT'
+
+# Hash function identifier used in version 2 files
+REFTABLE_HASH_ID_SHA1 = 0x73686131
+
+BLOCK_TYPE_REF = 'r'
+
+# Value types of ref records
+REF_DELETION = 0x0
+REF_VAL1 = 0x1
+REF_VAL2 = 0x2
+REF_SYMREF = 0x3
+
+DEFAULT_BLOCK_SIZE = 4096
+
+# Number of records between restart points
+RESTART_INTERVAL = 16
+
+# Tables at the top of the stack are merged until each table is at least
+# this many times larger than all tables above it together.
+COMPACTION_FACTOR = 2
+
+TABLES_LIST = 'tables.list'
+
+_FOOTER_FIELDS_SIZE = 44
+
+
+class ReftableFormatError(Exception):
+    """A reftable file could not be parsed."""
+
+
+class RefRecord(namedtuple('RefRecord',
+        ['name', 'update_index', 'value_type', 'value', 'peeled'])):
+    """A ref record in a reftable.
+
+    The value is the hex SHA1 the ref points at, or the name of the target
+    ref for symbolic refs. Deletions have neither value nor peeled value.
+    """
+
+
+def _encode_varint(n):
+    ret = [chr(n & 0x7f)]
+    n >>= 7
+    while n:
+        n -= 1
+        ret.append(chr(0x80 | (n & 0x7f)))
+        n >>= 7
+    ret.reverse()
+    return ''.join(ret)
+
+
+def _decode_varint(data, pos):
+    c = ord(data[pos])
+    pos += 1
+    n = c & 0x7f
+    while c & 0x80:
+        c = ord(data[pos])
+        pos += 1
+        n = ((n + 1) << 7) | (c & 0x7f)
+    return n, pos
+
+
+def _encode_ref_record(record, prev_name, min_update_index):
+    name = record.name
+    prefix_len = 0
+    if prev_name is not None:
+        max_len = min(len(name), len(prev_name))
+        while (prefix_len < max_len and
+               name[prefix_len] == prev_name[prefix_len]):
+            prefix_len += 1
+    suffix = name[prefix_len:]
+    ret = [_encode_varint(prefix_len),
+           _encode_varint((len(suffix) << 3) | record.value_type),
+           suffix,
+           _encode_varint(record.update_index - min_update_index)]
+    if record.value_type == REF_VAL1:
+        ret.append(hex_to_sha(record.value))
+    elif record.value_type == REF_VAL2:
+        ret.append(hex_to_sha(record.value))
+        ret.append(hex_to_sha(record.peeled))
+    elif record.value_type == REF_SYMREF:
+        ret.append(_encode_varint(len(record.value)))
+        ret.append(record.value)
+    elif record.value_type != REF_DELETION:
+        raise ValueError('invalid value type %d' % record.value_type)
+    return ''.join(ret)
+
+
+def _header(version, block_size, min_update_index, max_update_index):
+    ret = REFTABLE_MAGIC + struct.pack('>I', (version << 24) | block_size)
+    ret += struct.pack('>QQ', min_update_index, max_update_index)
+    if version == 2:
+        ret += struct.pack('>I', REFTABLE_HASH_ID_SHA1)
+    return ret
+
+
+def write_reftable(f, records, min_update_index, max_update_index,
+                   block_size=DEFAULT_BLOCK_SIZE):
+    """Write a reftable file.
+
+    :param f: File-like object to write to
+    :param records: Iterable over RefRecords, sorted by name
+    :param min_update_index: Smallest update index of the records
+    :param max_update_index: Largest update index of the records
+    :param block_size: Size of the ref blocks
+    """
+    header = _header(1, block_size, min_update_index, max_update_index)
+    f.write(header)
+    # Space for the block type, block length and restart count
+    overhead = 6
+    block_start = len(header)
+    entries = []
+    restarts = []
+    used = 0
+    prev_name = None
+
+    def flush():
+        block_len = block_start + 4 + used + 3 * len(restarts) + 2
+        data = [BLOCK_TYPE_REF, struct.pack('>I', block_len)[1:]]
+        data.extend(entries)
+        for offset in restarts:
+            data.append(struct.pack('>I', offset)[1:])
+        data.append(struct.pack('>H', len(restarts)))
+        data.append('\0' * (block_size - block_len))
+        f.write(''.join(data))
+
+    for record in records:
+        if prev_name is not None and record.name <= prev_name:
+            raise ValueError('records not sorted by name: %s' % record.name)
+        restart = (len(entries) % RESTART_INTERVAL == 0)
+        entry = _encode_ref_record(record, None if restart else prev_name,
+                                   min_update_index)
+        if (entries and block_start + overhead + used + len(entry) +
+                3 * (len(restarts) + int(restart)) > block_size):
+            flush()
+            block_start = 0
+            entries = []
+            restarts = []
+            used = 0
+            entry = _encode_ref_record(record, None, min_update_index)
+            restart = True
+        if block_start + overhead + len(entry) + 3 > block_size:
+            raise ValueError('ref %s does not fit in a block' % record.name)
+        if restart:
+            # Restart offsets are relative to the start of the block, which
+            # for the first block is the start of the file.
+            restarts.append(block_start + 4 + used)
+        entries.append(entry)
+        used += len(entry)
+        prev_name = record.name
+    if entries:
+        flush()
+    footer = header
+    footer += struct.pack('>QQQQQ', 0, 0, 0, 0, 0)
+    footer += struct.pack('>I', zlib.crc32(footer) & 0xffffffff)
+    f.write(footer)
+
+
+def load_reftable(path):
+    """Load a reftable by path.
+
+    :param path: Path to the reftable
+    :return: A Reftable loaded from the given path
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return Reftable(path, file=f)
+    except:
+        f.close()
+        raise
+
+
+class Reftable(object):
+    """A single reftable file.
+
+    The file is memory-mapped where possible. Looking up a ref binary
+    searches the first names of the ref blocks and then the restart points
+    of a single block.
+    """
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            self._contents, self._size = (contents, size)
+        contents = self._contents
+        if contents[:4] != REFTABLE_MAGIC:
+            raise ReftableFormatError('Not a reftable file')
+        (version_and_size, self.min_update_index,
+            self.max_update_index) = unpack_from('>IQQ', contents, 4)
+        self.version = version_and_size >> 24
+        self.block_size = version_and_size & 0xffffff
+        if self.version == 1:
+            self._header_size = 24
+        elif self.version == 2:
+            self._header_size = 28
+            (hash_id,) = unpack_from('>I', contents, 24)
+            if hash_id != REFTABLE_HASH_ID_SHA1:
+                raise ReftableFormatError('Unsupported hash id %x' % hash_id)
+        else:
+            raise ReftableFormatError('Version was %d' % self.version)
+        footer_size = self._header_size + _FOOTER_FIELDS_SIZE
+        footer_start = self._size - footer_size
+        if (footer_start < self._header_size or
+                contents[footer_start:footer_start + self._header_size] !=
+                contents[:self._header_size]):
+            raise ReftableFormatError('Invalid reftable footer')
+        footer = contents[footer_start:self._size]
+        (crc,) = unpack_from('>I', footer, footer_size - 4)
+        if zlib.crc32(footer[:-4]) & 0xffffffff != crc:
+            raise ReftableFormatError('Reftable footer checksum mismatch')
+        sections = unpack_from('>QQQQ', footer, self._header_size)
+        ref_end = footer_start
+        for pos in (sections[0], sections[1] >> 5, sections[3]):
+            if pos:
+                ref_end = min(ref_end, pos)
+        self._blocks = self._find_blocks(ref_end)
+        self._first_names = [None] * len(self._blocks)
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, 'close', None) is not None:
+            self._contents.close()
+
+    def _find_blocks(self, ref_end):
+        contents = self._contents
+        blocks = []
+        start = 0
+        header_off = self._header_size
+        while start + header_off + 4 <= ref_end:
+            if contents[start + header_off] != BLOCK_TYPE_REF:
+                break
+            (block_len,) = unpack_from('>I', contents, start + header_off)
+            block_len &= 0xffffff
+            blocks.append(start)
+            if (block_len < self.block_size and start + block_len < ref_end
+                    and contents[start + block_len] != '\0'):
+                # Unpadded table
+                start += block_len
+            else:
+                start += self.block_size
+            header_off = 0
+        return blocks
+
+    def _block_restarts(self, i):
+        start = self._blocks[i]
+        header_off = self._header_size if start == 0 else 0
+        (block_len,) = unpack_from('>I', self._contents, start + header_off)
+        end = start + (block_len & 0xffffff)
+        (count,) = unpack_from('>H', self._contents, end - 2)
+        restarts_start = end - 2 - 3 * count
+        restarts = []
+        for j in range(count):
+            (offset,) = unpack_from('>I', self._contents,
+                                    restarts_start + 3 * j - 1)
+            restarts.append(start + (offset & 0xffffff))
+        return restarts, restarts_start
+
+    def _read_record(self, pos, prev_name):
+        contents = self._contents
+        prefix_len, pos = _decode_varint(contents, pos)
+        n, pos = _decode_varint(contents, pos)
+        suffix_len = n >> 3
+        value_type = n & 0x7
+        if prefix_len:
+            name = prev_name[:prefix_len] + contents[pos:pos + suffix_len]
+        else:
+            name = contents[pos:pos + suffix_len]
+        pos += suffix_len
+        delta, pos = _decode_varint(contents, pos)
+        value = peeled = None
+        if value_type == REF_VAL1:
+            value = sha_to_hex(contents[pos:pos + 20])
+            pos += 20
+        elif value_type == REF_VAL2:
+            value = sha_to_hex(contents[pos:pos + 20])
+            peeled = sha_to_hex(contents[pos + 20:pos + 40])
+            pos += 40
+        elif value_type == REF_SYMREF:
+            target_len, pos = _decode_varint(contents, pos)
+            value = contents[pos:pos + target_len]
+            pos += target_len
+        elif value_type != REF_DELETION:
+            raise ReftableFormatError('invalid value type %d' % value_type)
+        record = RefRecord(name, self.min_update_index + delta, value_type,
+                           value, peeled)
+        return record, pos
+
+    def _first_name(self, i):
+        name = self._first_names[i]
+        if name is None:
+            restarts, end = self._block_restarts(i)
+            name = self._read_record(restarts[0], None)[0].name
+            self._first_names[i] = name
+        return name
+
+    def _iter_block(self, i, name):
+        """Iterate over the records in a block, starting at name."""
+        restarts, end = self._block_restarts(i)
+        lo = 0
+        hi = len(restarts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._read_record(restarts[mid], None)[0].name <= name:
+                lo = mid + 1
+            else:
+                hi = mid
+        pos = restarts[max(lo - 1, 0)]
+        prev_name = None
+        while pos < end:
+            record, pos = self._read_record(pos, prev_name)
+            prev_name = record.name
+            if record.name >= name:
+                yield record
+
+    def iter_refs(self, start=''):
+        """Iterate over the records in this table.
+
+        :param start: Name to start at
+        :return: Iterator over RefRecords with names not less than start, in
+            order of name. Deletions are included.
+        """
+        lo = 0
+        hi = len(self._blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._first_name(mid) <= start:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(max(lo - 1, 0), len(self._blocks)):
+            for record in self._iter_block(i, start):
+                yield record
+
+    def get(self, name):
+        """Look up a ref record.
+
+        :param name: Name of the ref
+        :return: A RefRecord, which may be a deletion, or None if the table
+            has no record for the ref
+        """
+        for record in self.iter_refs(name):
+            if record.name == name:
+                return record
+            return None
+        return None
+
+
+def _merge_records(tables, start=''):
+    """Merge the records of a list of tables, oldest first.
+
+    :return: Iterator over RefRecords in order of name, taking each name from
+        the newest table that has a record for it. Deletions are included.
+    """
+    def keyed(records, i):
+        for record in records:
+            yield (record.name, -i, record)
+    iters = [keyed(t.iter_refs(start), i) for (i, t) in enumerate(tables)]
+    prev_name = None
+    for name, _, record in heapq.merge(*iters):
+        if name != prev_name:
+            yield record
+        prev_name = name
+
+
+def _table_name(min_update_index, max_update_index):
+    return '0x%012x-0x%012x-%08x.ref' % (
+        min_update_index, max_update_index, random.randint(0, 0xffffffff))
+
+
+class ReftableStack(object):
+    """The stack of reftables in a repository's reftable directory.
+
+    The list of tables is read again whenever tables.list changes. Updates
+    hold tables.list.lock while they write a new table, so they are atomic
+    with respect to each other.
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE,
+                 auto_compact=True):
+        self.path = path
+        self.block_size = block_size
+        self.auto_compact = auto_compact
+        self._stat = None
+        self._names = []
+        self._tables = {}
+
+    def _list_path(self):
+        return os.path.join(self.path, TABLES_LIST)
+
+    def _read_list(self):
+        try:
+            f = GitFile(self._list_path(), 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        try:
+            return [l.rstrip('\n') for l in f.readlines() if l.strip()]
+        finally:
+            f.close()
+
+    def refresh(self):
+        """Read tables.list again if it has changed on disk."""
+        while True:
+            try:
+                st = os.stat(self._list_path())
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                st = None
+            else:
+                st = (st.st_ino, st.st_size, st.st_mtime)
+            if self._stat is not None and st == self._stat:
+                return
+            names = self._read_list()
+            tables = {}
+            try:
+                for name in names:
+                    table = self._tables.get(name)
+                    if table is None:
+                        table = load_reftable(os.path.join(self.path, name))
+                    tables[name] = table
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # A table was removed by a concurrent compaction; the list
+                # has been replaced, so read it again.
+                for name, table in tables.iteritems():
+                    if name not in self._tables:
+                        table.close()
+                continue
+            for name, table in self._tables.iteritems():
+                if name not in tables:
+                    table.close()
+            self._names = names
+            self._tables = tables
+            self._stat = st
+            return
+
+    def tables(self):
+        """Return the tables in the stack, oldest first."""
+        self.refresh()
+        return [self._tables[name] for name in self._names]
+
+    def get(self, name):
+        """Look up a ref.
+
+        :param name: Name of the ref
+        :return: The RefRecord from the newest table that has a record for
+            the ref, or None if the ref does not exist or was deleted
+        """
+        for table in reversed(self.tables()):
+            record = table.get(name)
+            if record is not None:
+                if record.value_type == REF_DELETION:
+                    return None
+                return record
+        return None
+
+    def iter_refs(self, prefix=''):
+        """Iterate over the refs in the stack.
+
+        :param prefix: Only return refs with names that start with prefix
+        :return: Iterator over RefRecords in order of name, without deletions
+        """
+        for record in _merge_records(self.tables(), prefix):
+            if not record.name.startswith(prefix):
+                break
+            if record.value_type != REF_DELETION:
+                yield record
+
+    def _write_table(self, records, min_update_index, max_update_index):
+        name = _table_name(min_update_index, max_update_index)
+        f = GitFile(os.path.join(self.path, name), 'wb')
+        try:
+            write_reftable(f, records, min_update_index, max_update_index,
+                           self.block_size)
+        except:
+            f.abort()
+            raise
+        f.close()
+        return name
+
+    def _compact(self, names, start):
+        """Merge the tables from start upwards into a single table.
+
+        :return: Tuple with the new list of table names and the names of the
+            tables that were replaced
+        """
+        tables = [self._tables[name] for name in names[start:]]
+        records = _merge_records(tables)
+        if start == 0:
+            # Nothing below the merged tables can be shadowed by a deletion.
+            records = (r for r in records if r.value_type != REF_DELETION)
+        name = self._write_table(records, tables[0].min_update_index,
+                                 tables[-1].max_update_index)
+        return names[:start] + [name], names[start:]
+
+    def _auto_compact_start(self, names):
+        sizes = [len(self._tables[name]) for name in names]
+        start = len(sizes) - 1
+        total = sizes[start]
+        while start > 0 and sizes[start - 1] < COMPACTION_FACTOR * total:
+            start -= 1
+            total += sizes[start]
+        return start
+
+    def _replace(self, f, names, obsolete):
+        f.write(''.join('%s\n' % name for name in names))
+        f.close()
+        for name in obsolete:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def update(self, func):
+        """Atomically add a table to the top of the stack.
+
+        :param func: Function called while the stack is locked and up to
+            date. It returns a list of RefRecords to add (their update index
+            is ignored), or None to abort the update.
+        :return: True if the update was applied, False if it was aborted
+        """
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        f = GitFile(self._list_path(), 'wb')
+        try:
+            self._stat = None
+            tables = self.tables()
+            records = func()
+            if records is None:
+                return False
+            if not records:
+                return True
+            if tables:
+                update_index = tables[-1].max_update_index + 1
+            else:
+                update_index = 1
+            records = sorted(
+                RefRecord(r.name, update_index, r.value_type, r.value,
+                          r.peeled) for r in records)
+            for i in range(1, len(records)):
+                if records[i].name == records[i - 1].name:
+                    raise ValueError('duplicate ref %s' % records[i].name)
+            name = self._write_table(records, update_index, update_index)
+            names = self._names + [name]
+            obsolete = []
+            if self.auto_compact and len(names) > 1:
+                self._tables[name] = load_reftable(
+                    os.path.join(self.path, name))
+                start = self._auto_compact_start(names)
+                if start < len(names) - 1:
+                    names, obsolete = self._compact(names, start)
+            self._replace(f, names, obsolete)
+            return True
+        finally:
+            f.abort()
+
+    def compact(self):
+        """Merge all tables in the stack into a single table."""
+        f = GitFile(self._list_path(), 'wb')
+        try:
+            self._stat = None
+            if len(self.tables()) < 2:
+                return
+            names, obsolete = self._compact(self._names, 0)
+            self._replace(f, names, obsolete)
+        finally:
+            f.abort()
@@ -29,7 +29,14 @@ local disk (Repo).
 
 from cStringIO import StringIO
 import errno
+try:
+    import mmap
+except ImportError:
+    has_mmap = False
+else:
+    has_mmap = True
 import os
+import sys
 
 from dulwich.errors import (
     NoIndexPresent,
@@ -58,6 +65,15 @@ from dulwich.objects import (
     Tree,
     hex_to_sha,
     )
+from dulwich.reftable import (
+    DEFAULT_BLOCK_SIZE,
+    REF_DELETION,
+    REF_SYMREF,
+    REF_VAL1,
+    REF_VAL2,
+    RefRecord,
+    ReftableStack,
+    )
 import warnings
 
 
@@ -66,6 +82,7 @@ SYMREF = 'ref: '
 REFSDIR = 'refs'
 REFSDIR_TAGS = 'tags'
 REFSDIR_HEADS = 'heads'
+REFTABLEDIR = 'reftable'
 INDEX_FILENAME = "index"
 
 BASE_DIRECTORIES = [
@@ -433,14 +450,12 @@ class DiskRefsContainer(RefsContainer):
 
     def __init__(self, path):
         self.path = path
-        self._packed_refs = None
-        self._peeled_refs = None
+        self._packed_refs = PackedRefs(os.path.join(self.path, 'packed-refs'))
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.path)
 
-    def subkeys(self, base):
-        keys = set()
+    def _iter_loose_keys(self, base):
         path = self.refpath(base)
         for root, dirs, files in os.walk(path):
             dir = root[len(path):].strip(os.path.sep).replace(os.path.sep, "/")
@@ -449,10 +464,13 @@ class DiskRefsContainer(RefsContainer):
                 # check_ref_format requires at least one /, so we prepend the
                 # base before calling it.
                 if check_ref_format("%s/%s" % (base, refname)):
-                    keys.add(refname)
-        for key in self.get_packed_refs():
-            if key.startswith(base):
-                keys.add(key[len(base):].strip("/"))
+                    yield refname
+
+    def subkeys(self, base):
+        keys = set(self._iter_loose_keys(base))
+        prefix = base.rstrip("/") + "/"
+        for key, sha, peeled in self._packed_refs.iter_prefix(prefix):
+            keys.add(key[len(prefix):])
         return keys
 
     def allkeys(self):
@@ -469,6 +487,22 @@ class DiskRefsContainer(RefsContainer):
         keys.update(self.get_packed_refs())
         return keys
 
+    def as_dict(self, base=None):
+        if base is None:
+            return super(DiskRefsContainer, self).as_dict()
+        # Packed refs are read straight from the index; only loose refs (which
+        # may be symbolic or shadow a packed ref) need to be resolved.
+        ret = {}
+        prefix = base.rstrip("/") + "/"
+        for name, sha, peeled in self._packed_refs.iter_prefix(prefix):
+            ret[name[len(prefix):]] = sha
+        for key in self._iter_loose_keys(base):
+            try:
+                ret[key] = self[prefix + key]
+            except KeyError:
+                ret.pop(key, None)
+        return ret
+
     def refpath(self, name):
         """Return the disk path of a ref.
 
@@ -485,34 +519,19 @@ class DiskRefsContainer(RefsContainer):
         :note: Will return an empty dictionary when no packed-refs file is
             present.
         """
-        # TODO: invalidate the cache on repacking
-        if self._packed_refs is None:
-            # set both to empty because we want _peeled_refs to be
-            # None if and only if _packed_refs is also None.
-            self._packed_refs = {}
-            self._peeled_refs = {}
-            path = os.path.join(self.path, 'packed-refs')
-            try:
-                f = GitFile(path, 'rb')
-            except IOError, e:
-                if e.errno == errno.ENOENT:
-                    return {}
-                raise
-            try:
-                first_line = iter(f).next().rstrip()
-                if (first_line.startswith("# pack-refs") and " peeled" in
-                        first_line):
-                    for sha, name, peeled in read_packed_refs_with_peeled(f):
-                        self._packed_refs[name] = sha
-                        if peeled:
-                            self._peeled_refs[name] = peeled
-                else:
-                    f.seek(0)
-                    for sha, name in read_packed_refs(f):
-                        self._packed_refs[name] = sha
-            finally:
-                f.close()
-        return self._packed_refs
+        return self._packed_refs.as_dict()
+
+    def _read_packed_ref(self, name):
+        entry = self._packed_refs.get(name)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def read_ref(self, refname):
+        contents = self.read_loose_ref(refname)
+        if not contents:
+            contents = self._read_packed_ref(refname)
+        return contents
 
     def get_peeled(self, name):
         """Return the cached peeled value of a ref, if available.
@@ -522,12 +541,13 @@ class DiskRefsContainer(RefsContainer):
             tag, this will be the SHA the ref refers to. If the ref may point to
             a tag, but no cached information is available, None is returned.
         """
-        self.get_packed_refs()
-        if self._peeled_refs is None or name not in self._packed_refs:
-            # No cache: no peeled refs were read, or this ref is loose
+        entry = self._packed_refs.get(name)
+        if entry is None:
+            # No cache: this ref is loose or missing
             return None
-        if name in self._peeled_refs:
-            return self._peeled_refs[name]
+        sha, peeled = entry
+        if peeled is not None:
+            return peeled
         else:
             # Known not peelable
             return self[name]
@@ -562,22 +582,24 @@ class DiskRefsContainer(RefsContainer):
             raise
 
     def _remove_packed_ref(self, name):
-        if self._packed_refs is None:
-            return
         filename = os.path.join(self.path, 'packed-refs')
+        if not os.path.exists(filename):
+            return
         # reread cached refs from disk, while holding the lock
         f = GitFile(filename, 'wb')
         try:
-            self._packed_refs = None
-            self.get_packed_refs()
-
-            if name not in self._packed_refs:
+            self._packed_refs.refresh()
+            if self._packed_refs.get(name) is None:
                 return
-
-            del self._packed_refs[name]
-            if name in self._peeled_refs:
-                del self._peeled_refs[name]
-            write_packed_refs(f, self._packed_refs, self._peeled_refs)
+            packed_refs = {}
+            peeled_refs = {}
+            for key, sha, peeled in self._packed_refs.iter_prefix(""):
+                if key == name:
+                    continue
+                packed_refs[key] = sha
+                if peeled is not None:
+                    peeled_refs[key] = peeled
+            write_packed_refs(f, packed_refs, peeled_refs)
             f.close()
         finally:
             f.abort()
@@ -627,7 +649,7 @@ class DiskRefsContainer(RefsContainer):
                     # read again while holding the lock
                     orig_ref = self.read_loose_ref(realname)
                     if orig_ref is None:
-                        orig_ref = self.get_packed_refs().get(realname, None)
+                        orig_ref = self._read_packed_ref(realname)
                     if orig_ref != old_ref:
                         f.abort()
                         return False
@@ -664,7 +686,8 @@ class DiskRefsContainer(RefsContainer):
         ensure_dir_exists(os.path.dirname(filename))
         f = GitFile(filename, 'wb')
         try:
-            if os.path.exists(filename) or name in self.get_packed_refs():
+            if (os.path.exists(filename) or
+                    self._read_packed_ref(name) is not None):
                 f.abort()
                 return False
             try:
@@ -695,7 +718,7 @@ class DiskRefsContainer(RefsContainer):
             if old_ref is not None:
                 orig_ref = self.read_loose_ref(name)
                 if orig_ref is None:
-                    orig_ref = self.get_packed_refs().get(name, None)
+                    orig_ref = self._read_packed_ref(name)
                 if orig_ref != old_ref:
                     return False
             # may only be packed
@@ -711,6 +734,126 @@ class DiskRefsContainer(RefsContainer):
         return True
 
 
+class ReftableRefsContainer(RefsContainer):
+    """Refs container that stores refs in a stack of reftables.
+
+    Every update adds a table to the stack while holding its lock, so
+    updates to several refs can be applied atomically with update_refs().
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        self.path = path
+        self._stack = ReftableStack(os.path.join(path, REFTABLEDIR),
+                                    block_size=block_size)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    def allkeys(self):
+        return set(record.name for record in self._stack.iter_refs())
+
+    def subkeys(self, base):
+        prefix = base.rstrip("/") + "/"
+        return set(record.name[len(prefix):]
+                   for record in self._stack.iter_refs(prefix))
+
+    def get_packed_refs(self):
+        return {}
+
+    def read_loose_ref(self, name):
+        record = self._stack.get(name)
+        if record is None:
+            return None
+        if record.value_type == REF_SYMREF:
+            return SYMREF + record.value
+        return record.value
+
+    def read_ref(self, refname):
+        return self.read_loose_ref(refname)
+
+    def get_peeled(self, name):
+        record = self._stack.get(name)
+        if record is None or record.value_type != REF_VAL2:
+            return None
+        return record.peeled
+
+    def compact(self):
+        """Merge all reftables into a single table."""
+        self._stack.compact()
+
+    def set_symbolic_ref(self, name, other):
+        self._check_refname(name)
+        self._check_refname(other)
+        self._stack.update(
+            lambda: [RefRecord(name, None, REF_SYMREF, other, None)])
+
+    def set_if_equals(self, name, old_ref, new_ref):
+        self._check_refname(name)
+        def update():
+            try:
+                realname, _ = self._follow(name)
+            except KeyError:
+                realname = name
+            if old_ref is not None and self.read_ref(realname) != old_ref:
+                return None
+            return [RefRecord(realname, None, REF_VAL1, new_ref, None)]
+        return self._stack.update(update)
+
+    def add_if_new(self, name, ref):
+        def update():
+            try:
+                realname, contents = self._follow(name)
+                if contents is not None:
+                    return None
+            except KeyError:
+                realname = name
+            self._check_refname(realname)
+            if self.read_ref(realname) is not None:
+                return None
+            return [RefRecord(realname, None, REF_VAL1, ref, None)]
+        return self._stack.update(update)
+
+    def remove_if_equals(self, name, old_ref):
+        self._check_refname(name)
+        def update():
+            contents = self.read_ref(name)
+            if old_ref is not None and contents != old_ref:
+                return None
+            if contents is None:
+                return []
+            return [RefRecord(name, None, REF_DELETION, None, None)]
+        return self._stack.update(update)
+
+    def update_refs(self, updates):
+        """Update several refs atomically.
+
+        Either all refs are updated or none are. Symbolic references are not
+        followed.
+
+        :param updates: Iterable over tuples with a refname, the old sha the
+            refname must refer to (or None to update it unconditionally) and
+            the new sha (or None to delete the refname)
+        :return: True if the refs were updated, False otherwise.
+        """
+        updates = list(updates)
+        for name, old_ref, new_ref in updates:
+            self._check_refname(name)
+        def update():
+            records = []
+            for name, old_ref, new_ref in updates:
+                contents = self.read_ref(name)
+                if old_ref is not None and contents != old_ref:
+                    return None
+                if new_ref is not None:
+                    records.append(
+                        RefRecord(name, None, REF_VAL1, new_ref, None))
+                elif contents is not None:
+                    records.append(
+                        RefRecord(name, None, REF_DELETION, None, None))
+            return records
+        return self._stack.update(update)
+
+
 def _split_ref_line(line):
     """Split a single ref line into a tuple of SHA1 and name."""
     fields = line.rstrip("\n").split(" ")
@@ -775,6 +918,193 @@ def read_packed_refs_with_peeled(f):
         yield (sha, name, None)
 
 
+class PackedRefs(object):
+    """The contents of a packed-refs file, searchable by name.
+
+    Files that git has marked as sorted are memory-mapped and searched in
+    place, so opening them takes the same time however many refs they
+    contain. Other files are parsed and sorted when they are loaded. The file
+    is loaded again when its stat information changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+        self._data = ''
+        self._start = 0
+        self._end = 0
+        self._dict = None
+        self.has_peeled = False
+
+    def refresh(self):
+        """Load the file again if it has changed on disk."""
+        try:
+            st = os.stat(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            st = None
+        else:
+            st = (st.st_ino, st.st_size, st.st_mtime)
+        if self._stat is not None and st == self._stat:
+            return
+        self._close()
+        self._stat = st
+        if st is not None:
+            self._load()
+
+    def _close(self):
+        if not isinstance(self._data, str):
+            self._data.close()
+        self._data = ''
+        self._start = self._end = 0
+        self._dict = None
+        self.has_peeled = False
+
+    def _load(self):
+        try:
+            f = GitFile(self.path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            header = f.readline()
+            if not header.startswith("# pack-refs with:"):
+                header = ""
+            traits = header[len("# pack-refs with:"):].split()
+            self.has_peeled = "peeled" in traits
+            if "sorted" in traits:
+                size = os.fstat(f.fileno()).st_size
+                if size and has_mmap and sys.platform != 'win32':
+                    data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                else:
+                    f.seek(0)
+                    data = f.read()
+                start = len(header)
+            else:
+                f.seek(0)
+                refs = {}
+                peeled_refs = {}
+                if self.has_peeled:
+                    f.readline()
+                    for sha, name, peeled in read_packed_refs_with_peeled(f):
+                        refs[name] = sha
+                        if peeled:
+                            peeled_refs[name] = peeled
+                else:
+                    for sha, name in read_packed_refs(f):
+                        refs[name] = sha
+                out = StringIO()
+                write_packed_refs(out, refs, peeled_refs)
+                data = out.getvalue()
+                start = data.index("\n") + 1
+        finally:
+            f.close()
+        while data[start:start+1] == "#":
+            start = data.index("\n", start) + 1
+        self._data = data
+        self._start = start
+        self._end = len(data)
+
+    def _read_record(self, pos):
+        """Read the record that starts at a position.
+
+        :return: Tuple with name, SHA1, peeled SHA1 (or None) and the
+            position of the next record
+        """
+        data = self._data
+        eol = data.find("\n", pos, self._end)
+        if eol < 0:
+            eol = self._end
+        line = data[pos:eol].rstrip("\r")
+        if len(line) < 42 or line[40] != " ":
+            raise PackedRefsException("invalid ref line '%s'" % line)
+        pos = eol + 1
+        peeled = None
+        if data[pos:pos+1] == "^":
+            eol = data.find("\n", pos, self._end)
+            if eol < 0:
+                eol = self._end
+            peeled = data[pos+1:eol].rstrip("\r")
+            pos = eol + 1
+        return line[41:], line[:40], peeled, pos
+
+    def _record_start(self, pos):
+        """Find the start of the record that contains a position."""
+        data = self._data
+        start = data.rfind("\n", self._start, pos) + 1
+        if start == 0:
+            return self._start
+        if data[start:start+1] == "^":
+            start = data.rfind("\n", self._start, start - 1) + 1
+            if start == 0:
+                return self._start
+        return start
+
+    def _lower_bound(self, name):
+        """Find the first record with a name that is not less than name."""
+        lo = self._start
+        hi = self._end
+        while lo < hi:
+            pos = self._record_start((lo + hi) // 2)
+            if pos < lo:
+                pos = lo
+            record_name, sha, peeled, next_pos = self._read_record(pos)
+            if record_name < name:
+                lo = next_pos
+            else:
+                hi = pos
+        return lo
+
+    def get(self, name):
+        """Look up a ref.
+
+        :param name: Name of the ref
+        :return: Tuple with SHA1 and peeled SHA1 (or None), or None if the
+            ref is not in the file
+        """
+        self.refresh()
+        pos = self._lower_bound(name)
+        if pos >= self._end:
+            return None
+        record_name, sha, peeled, next_pos = self._read_record(pos)
+        if record_name != name:
+            return None
+        return sha, peeled
+
+    def iter_prefix(self, prefix):
+        """Iterate over the refs with names that start with a prefix.
+
+        :param prefix: Prefix of the ref names, e.g. "refs/heads/"
+        :return: Iterator over tuples with name, SHA1 and peeled SHA1 (or
+            None), in order of name
+        """
+        self.refresh()
+        data = self._data
+        pos = self._lower_bound(prefix)
+        while pos < self._end:
+            name, sha, peeled, pos = self._read_record(pos)
+            if not name.startswith(prefix):
+                break
+            yield name, sha, peeled
+            if self._data is not data:
+                raise RuntimeError("packed-refs changed during iteration")
+
+    def as_dict(self):
+        """Return a dictionary mapping ref names to SHA1s."""
+        self.refresh()
+        if self._dict is None:
+            self._dict = dict((name, sha) for (name, sha, peeled) in
+                              self.iter_prefix(""))
+        return self._dict
+
+    def peeled_dict(self):
+        """Return a dictionary mapping ref names to peeled SHA1s."""
+        return dict((name, peeled) for (name, sha, peeled) in
+                    self.iter_prefix("") if peeled is not None)
+
+
 def write_packed_refs(f, packed_refs, peeled_refs=None):
     """Write a packed refs file.
 
@@ -785,7 +1115,7 @@ def write_packed_refs(f, packed_refs, peeled_refs=None):
     if peeled_refs is None:
         peeled_refs = {}
     else:
-        f.write('# pack-refs with: peeled\n')
+        f.write('# pack-refs with: peeled sorted\n')
     for refname in sorted(packed_refs.iterkeys()):
         f.write('%s %s\n' % (packed_refs[refname], refname))
         if refname in peeled_refs:
@@ -847,6 +1177,13 @@ class BaseRepo(object):
         """
         raise NotImplementedError(self._put_named_file)
 
+    def _del_named_file(self, path):
+        """Delete a file in the control directory with the given name.
+
+        :param path: The path to the file, relative to the control dir.
+        """
+        raise NotImplementedError(self._del_named_file)
+
     def open_index(self):
         """Open the index for this repository.
 
@@ -871,7 +1208,8 @@ class BaseRepo(object):
         return self.get_refs()
 
     def fetch_objects(self, determine_wants, graph_walker, progress,
-                      get_tagged=None):
+                      get_tagged=None, get_object_filter=None,
+                      get_shallow=None, negotiation_done=None):
         """Fetch the missing objects required for a set of revisions.
 
         :param determine_wants: Function that takes a dictionary with heads
@@ -883,6 +1221,14 @@ class BaseRepo(object):
             updated progress strings.
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
+        :param get_object_filter: Function that returns the ObjectFilter to
+            apply, or None; called after determine_wants.
+        :param get_shallow: Function that returns a tuple with the set of
+            commits whose parents are not to be sent and the set of shallow
+            commits of the target; called after determine_wants.
+        :param negotiation_done: Function that returns whether the graph
+            walker finished the negotiation; if it returns False, for example
+            after a round of a stateless negotiation, None is returned.
         :return: iterator over objects, with __len__ implemented
         """
         wants = determine_wants(self.get_refs())
@@ -891,22 +1237,69 @@ class BaseRepo(object):
             # this interface.
             return None
         haves = self.object_store.find_common_revisions(graph_walker)
+        if negotiation_done is not None and not negotiation_done():
+            return None
+        object_filter = get_object_filter and get_object_filter() or None
+        shallow, client_shallow = get_shallow and get_shallow() or (None, None)
         return self.object_store.iter_shas(
           self.object_store.find_missing_objects(haves, wants, progress,
-                                                 get_tagged))
+              get_tagged, object_filter, shallow, client_shallow))
 
     def get_graph_walker(self, heads=None):
         """Retrieve a graph walker.
 
         A graph walker is used by a remote repository (or proxy)
-        to find out which objects are present in this repository.
+        to find out which objects are present in this repository. If
+        fetch.negotiationAlgorithm is set to "skipping", commits are skipped
+        over like git does with that setting.
 
         :param heads: Repository heads to use (optional)
         :return: A graph walker object
         """
         if heads is None:
             heads = self.refs.as_dict('refs/heads').values()
-        return self.object_store.get_graph_walker(heads)
+        return self.object_store.get_graph_walker(heads, self.get_shallow(),
+            self._get_negotiation_algorithm() == 'skipping')
+
+    def _get_negotiation_algorithm(self):
+        """Return the fetch.negotiationAlgorithm setting, if any."""
+        try:
+            return self.get_config_stack().get(
+                ("fetch", ), "negotiationalgorithm").lower()
+        except (KeyError, NotImplementedError):
+            return None
+
+    def get_shallow(self):
+        """Get the set of shallow commits.
+
+        The parents of shallow commits are not present in the repository.
+
+        :return: Set of shallow commits.
+        """
+        f = self.get_named_file('shallow')
+        if f is None:
+            return set()
+        try:
+            return set(line.strip() for line in f if line.strip())
+        finally:
+            f.close()
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        """Update the list of shallow commits.
+
+        :param new_shallow: Commits that became shallow
+        :param new_unshallow: Commits that are no longer shallow
+        """
+        if not new_shallow and not new_unshallow:
+            return
+        shallow = self.get_shallow()
+        shallow.update(new_shallow)
+        shallow.difference_update(new_unshallow)
+        if shallow:
+            self._put_named_file('shallow',
+                ''.join('%s\n' % sha for sha in sorted(shallow)))
+        else:
+            self._del_named_file('shallow')
 
     def ref(self, name):
         """Return the SHA1 a ref is pointing to.
@@ -1257,9 +1650,19 @@ class Repo(BaseRepo):
         self.path = root
         object_store = DiskObjectStore(os.path.join(self.controldir(),
                                                     OBJECTDIR))
-        refs = DiskRefsContainer(self.controldir())
+        if self._get_ref_storage() == 'reftable':
+            refs = ReftableRefsContainer(self.controldir())
+        else:
+            refs = DiskRefsContainer(self.controldir())
         BaseRepo.__init__(self, object_store, refs)
 
+    def _get_ref_storage(self):
+        config = self.get_config()
+        try:
+            return config.get(("extensions", ), "refstorage").lower()
+        except KeyError:
+            return "files"
+
     def controldir(self):
         """Return the path of the control directory."""
         return self._controldir
@@ -1277,6 +1680,18 @@ class Repo(BaseRepo):
         finally:
             f.close()
 
+    def _del_named_file(self, path):
+        """Delete a file in the control directory with the given name.
+
+        :param path: The path to the file, relative to the control dir.
+        """
+        path = path.lstrip(os.path.sep)
+        try:
+            os.unlink(os.path.join(self.controldir(), path))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def get_named_file(self, path):
         """Get a file from the control dir with a specific name.
 
@@ -1467,6 +1882,13 @@ class MemoryRepo(BaseRepo):
         """
         self._named_files[path] = contents
 
+    def _del_named_file(self, path):
+        """Delete a file in the control directory with the given name.
+
+        :param path: The path to the file, relative to the control dir.
+        """
+        self._named_files.pop(path, None)
+
     def get_named_file(self, path):
         """Get a file from the control dir with a specific name.
 
@@ -35,35 +35,57 @@ Currently supported capabilities:
  * no-progress
  * report-status
  * delete-refs
+ * filter (blob:none, blob:limit=<n> and tree:<depth>)
+ * shallow
+ * deepen-since
+
+Protocol version 2 is supported for upload-pack, with the ls-refs and fetch
+commands.
 
 Known capabilities that are not supported:
- * shallow (http://pad.lv/909524)
+ * deepen-not
+ * deepen-relative
 """
 
+from cStringIO import StringIO
+import asyncore
 import collections
+import errno
 import os
+import Queue
+import select
+import signal
 import socket
 import SocketServer
 import sys
+import threading
+import time
 import zlib
 
 from dulwich.errors import (
     ApplyDeltaError,
     ChecksumMismatch,
     GitProtocolError,
+    HangupException,
     NotGitRepository,
     UnexpectedCommandError,
     ObjectFormatException,
     )
 from dulwich import log_utils
 from dulwich.objects import (
+    Commit,
     hex_to_sha,
     )
+from dulwich.object_store import (
+    parse_object_filter,
+    )
 from dulwich.pack import (
-    write_pack_objects,
+    write_pack_data,
     )
 from dulwich.protocol import (
+    AGENT,
     BufferedPktLineWriter,
+    DELIM_PKT,
     MULTI_ACK,
     MULTI_ACK_DETAILED,
     Protocol,
@@ -72,12 +94,16 @@ from dulwich.protocol import (
     SINGLE_ACK,
     TCP_GIT_PORT,
     ZERO_SHA,
+    _RBUFSIZE,
     ack_type,
     extract_capabilities,
     extract_want_line_capabilities,
+    parse_cmd_pkt,
+    parse_protocol_version,
     )
 from dulwich.repo import (
     Repo,
+    SYMREF,
     )
 
 
@@ -155,16 +181,40 @@ class DictBackend(Backend):
 
 
 class FileSystemBackend(Backend):
-    """Simple backend that looks up Git repositories in the local file system."""
+    """Simple backend that looks up Git repositories in the local file system.
+
+    Each call to open_repository returns a new Repo, so connections that are
+    handled at the same time do not share any state.
+    """
+
+    def __init__(self, root=None):
+        """Create a new FileSystemBackend.
+
+        :param root: Optional directory that request paths are relative to;
+            paths outside of it are refused. Without a root, paths are
+            opened as given, relative to the working directory.
+        """
+        if root is not None:
+            root = os.path.join(os.path.abspath(root), '')
+        self.root = root
 
     def open_repository(self, path):
         logger.debug('opening repository at %s', path)
-        return Repo(path)
+        if self.root is None:
+            return Repo(path)
+        abspath = os.path.abspath(os.path.join(self.root, path.lstrip('/')))
+        if not os.path.join(abspath, '').startswith(self.root):
+            raise NotGitRepository(
+                "Path %(path)s is not inside %(root)s" %
+                dict(path=path, root=self.root))
+        return Repo(abspath)
 
 
 class Handler(object):
     """Smart protocol command handler base class."""
 
+    protocol_version = 0
+
     def __init__(self, backend, proto, http_req=None):
         self.backend = backend
         self.proto = proto
@@ -213,16 +263,26 @@ class UploadPackHandler(Handler):
     """Protocol handler for uploading a pack to the server."""
 
     def __init__(self, backend, args, proto, http_req=None,
-                 advertise_refs=False):
+                 advertise_refs=False, refs_advertised=False):
         Handler.__init__(self, backend, proto, http_req=http_req)
         self.repo = backend.open_repository(args[0])
         self._graph_walker = None
         self.advertise_refs = advertise_refs
+        self.refs_advertised = refs_advertised
+        if self.http_req is not None:
+            params = self.http_req.environ.get(
+                'HTTP_GIT_PROTOCOL', '').split(':')
+        else:
+            # Extra parameters of a git:// request follow the path and host.
+            params = args[1:]
+        if parse_protocol_version(params) >= 2:
+            self.protocol_version = 2
 
     @classmethod
     def capabilities(cls):
         return ("multi_ack_detailed", "multi_ack", "side-band-64k", "thin-pack",
-                "ofs-delta", "no-progress", "include-tag")
+                "ofs-delta", "no-progress", "include-tag", "filter", "shallow",
+                "deepen-since")
 
     @classmethod
     def required_capabilities(cls):
@@ -263,26 +323,370 @@ class UploadPackHandler(Handler):
         return tagged
 
     def handle(self):
-        write = lambda x: self.proto.write_sideband(1, x)
+        if self.protocol_version == 2:
+            return self._handle_v2()
 
         graph_walker = ProtocolGraphWalker(self, self.repo.object_store,
             self.repo.get_peeled)
         objects_iter = self.repo.fetch_objects(
           graph_walker.determine_wants, graph_walker, self.progress,
-          get_tagged=self.get_tagged)
+          get_tagged=self.get_tagged,
+          get_object_filter=lambda: graph_walker.object_filter,
+          get_shallow=lambda: (graph_walker.shallow,
+                               graph_walker.client_shallow),
+          # A stateless RPC request without 'done' is a single round of
+          # negotiation, which is answered with acknowledgments only.
+          negotiation_done=lambda: (not self.http_req or
+                                    graph_walker.done_received))
 
         # Did the process short-circuit (e.g. in a stateless RPC call)? Note
         # that the client still expects a 0-object pack in most cases.
         if objects_iter is None:
             return
 
-        self.progress("dul-daemon says what\n")
-        self.progress("counting objects: %d, done.\n" % len(objects_iter))
-        write_pack_objects(ProtocolFile(None, write), objects_iter)
-        self.progress("how was that, then?\n")
+        self._send_pack(objects_iter)
         # we are done
         self.proto.write("0000")
 
+    def _send_pack(self, objects_iter):
+        write = lambda x: self.proto.write_sideband(1, x)
+        self.progress("dul-daemon says what\n")
+        num_objects = len(objects_iter)
+        self.progress("counting objects: %d, done.\n" % num_objects)
+        # Read and deltify objects in another thread while the records that
+        # are ready are compressed and sent.
+        object_store = self.repo.object_store
+        records = _iter_prefetched(object_store.generate_pack_data(
+            objects_iter.itershas()), PREFETCH_RECORDS)
+        write_pack_data(ProtocolFile(None, write), num_objects, records,
+                        compression_level=object_store.pack_compression_level,
+                        threads=object_store.pack_threads)
+        self.progress("how was that, then?\n")
+
+    def _handle_v2(self):
+        if self.advertise_refs or not (self.http_req or self.refs_advertised):
+            for line in self.v2_capabilities():
+                self.proto.write_pkt_line("%s\n" % line)
+            self.proto.write_pkt_line(None)
+            if self.advertise_refs:
+                return
+        while True:
+            try:
+                request = _read_v2_request(self.proto)
+            except HangupException:
+                return
+            if request is None:
+                return
+            command, args = request
+            logger.info('Handling protocol v2 command %s', command)
+            if command == 'ls-refs':
+                self._ls_refs(args)
+            elif command == 'fetch':
+                self._fetch_v2(args)
+            else:
+                raise GitProtocolError('Unknown command %s' % command)
+            if self.http_req:
+                # Each HTTP request carries a single command.
+                return
+
+    @classmethod
+    def v2_capabilities(cls):
+        """Return the capability advertisement for protocol version 2."""
+        return ["version 2",
+                "agent=%s" % AGENT,
+                "ls-refs", "fetch=shallow filter", "object-format=sha1"]
+
+    def _get_refs_with_prefixes(self, prefixes):
+        """Get the refs with names that start with one of a list of prefixes.
+
+        Refs below a common directory are read with as_dict() on that
+        directory where the repository has a refs container, so that only
+        the matching part of a large set of refs is read.
+        """
+        refs_container = getattr(self.repo, 'refs', None)
+        if not prefixes or refs_container is None:
+            refs = self.repo.get_refs()
+            if not prefixes:
+                return refs
+            return dict((name, sha) for (name, sha) in refs.iteritems()
+                        if any(name.startswith(p) for p in prefixes))
+        refs = {}
+        bases = set()
+        for prefix in prefixes:
+            if '/' in prefix:
+                bases.add(prefix.rsplit('/', 1)[0])
+            elif 'refs/'.startswith(prefix):
+                bases.add('refs')
+            if 'HEAD'.startswith(prefix) and 'HEAD' in refs_container:
+                try:
+                    refs['HEAD'] = refs_container['HEAD']
+                except KeyError:
+                    pass
+        for base in bases:
+            if any(b != base and (base + '/').startswith(b + '/')
+                   for b in bases):
+                # Covered by a shorter base
+                continue
+            for name, sha in refs_container.as_dict(base).iteritems():
+                name = '%s/%s' % (base, name)
+                if any(name.startswith(p) for p in prefixes):
+                    refs[name] = sha
+        return refs
+
+    def _ls_refs(self, args):
+        peel = symrefs = False
+        prefixes = []
+        for arg in args:
+            if arg == 'peel':
+                peel = True
+            elif arg == 'symrefs':
+                symrefs = True
+            elif arg.startswith('ref-prefix '):
+                prefixes.append(arg[len('ref-prefix '):])
+            else:
+                raise GitProtocolError('Unexpected ls-refs argument %s' % arg)
+        refs = self._get_refs_with_prefixes(prefixes)
+        refs_container = getattr(self.repo, 'refs', None)
+        for name, sha in sorted(refs.iteritems()):
+            line = '%s %s' % (sha, name)
+            if symrefs and refs_container is not None:
+                contents = refs_container.read_ref(name)
+                if contents is not None and contents.startswith(SYMREF):
+                    target, _ = refs_container._follow(name)
+                    line += ' symref-target:%s' % target
+            if peel:
+                peeled_sha = self.repo.get_peeled(name)
+                if peeled_sha != sha:
+                    line += ' peeled:%s' % peeled_sha
+            self.proto.write_pkt_line(line + '\n')
+        self.proto.write_pkt_line(None)
+
+    def _fetch_v2(self, args):
+        store = self.repo.object_store
+        wants = []
+        haves = []
+        done = False
+        object_filter = None
+        client_shallow = set()
+        depth = since = None
+        capabilities = ['side-band-64k']
+        for arg in args:
+            if arg.startswith('want '):
+                sha = arg[len('want '):]
+                if sha not in store:
+                    raise GitProtocolError(
+                        'Client wants invalid object %s' % sha)
+                wants.append(sha)
+            elif arg.startswith('have '):
+                haves.append(arg[len('have '):])
+            elif arg == 'done':
+                done = True
+            elif arg.startswith('filter '):
+                object_filter = _parse_filter(arg[len('filter '):])
+            elif arg.split(' ', 1)[0] in ('shallow', 'deepen', 'deepen-since'):
+                command, value = _split_proto_line(arg, None)
+                if command == 'shallow':
+                    client_shallow.add(value)
+                elif command == 'deepen':
+                    depth = value
+                else:
+                    since = value
+            elif arg in self.innocuous_capabilities():
+                capabilities.append(arg)
+            else:
+                raise GitProtocolError('Unexpected fetch argument %s' % arg)
+        if not wants:
+            raise GitProtocolError('fetch request without wants')
+        self._client_capabilities = set(capabilities)
+        logger.info('Client capabilities: %s', capabilities)
+        common = [sha for sha in haves if sha in store]
+
+        if not done:
+            self.proto.write_pkt_line('acknowledgments\n')
+            for sha in common:
+                self.proto.write_pkt_line('ACK %s\n' % sha)
+            if not common:
+                self.proto.write_pkt_line('NAK\n')
+            graph_walker = ProtocolGraphWalker(self, store,
+                                               self.repo.get_peeled)
+            graph_walker.set_wants(wants)
+            if not common or not graph_walker.all_wants_satisfied(common):
+                # The client has to send more haves first.
+                self.proto.write_pkt_line(None)
+                return
+            self.proto.write_pkt_line('ready\n')
+            self.proto.write_pkt_line(DELIM_PKT)
+
+        shallow, new_shallow, unshallow = _shallow_update(
+            store, wants, client_shallow, depth, since)
+        if depth is not None or since is not None:
+            self.proto.write_pkt_line('shallow-info\n')
+            _write_shallow_update(self.proto, new_shallow, unshallow)
+            self.proto.write_pkt_line(DELIM_PKT)
+
+        tags = None
+        refs_container = getattr(self.repo, 'refs', None)
+        if refs_container is not None:
+            tags = dict(('refs/tags/%s' % name, sha) for (name, sha) in
+                        refs_container.as_dict('refs/tags').iteritems())
+        objects_iter = store.iter_shas(store.find_missing_objects(
+            common, wants, self.progress,
+            lambda: self.get_tagged(refs=tags), object_filter, shallow,
+            client_shallow))
+        self.proto.write_pkt_line('packfile\n')
+        self._send_pack(objects_iter)
+        self.proto.write_pkt_line(None)
+
+
+def _find_shallow(store, heads, depth=None, since=None):
+    """Find the commits at which a limited history is cut off.
+
+    :param store: Object store to read commits from
+    :param heads: Objects to start from; objects that do not peel to a commit
+        are ignored
+    :param depth: Optional number of commits to include from each head
+    :param since: Optional timestamp; the parents of a commit are only
+        included if none of them are older
+    :return: Tuple with the set of included commits whose parents are left
+        out, and the set of included commits whose parents are included
+    """
+    todo = collections.deque()
+    seen = set()
+    for head in heads:
+        obj = store.peel_sha(head)
+        if isinstance(obj, Commit) and obj.id not in seen:
+            seen.add(obj.id)
+            todo.append((obj.id, 1))
+    shallow = set()
+    not_shallow = set()
+    # Breadth-first, so that commits are reached at their smallest depth
+    while todo:
+        sha, cur_depth = todo.popleft()
+        parents = store.get_parents(sha)
+        if parents and ((depth is not None and cur_depth >= depth) or
+                        (since is not None and
+                         min(store.get_commit_time(p) for p in parents) < since)):
+            shallow.add(sha)
+            continue
+        not_shallow.add(sha)
+        for parent in parents:
+            if parent not in seen:
+                seen.add(parent)
+                todo.append((parent, cur_depth + 1))
+    return shallow, not_shallow
+
+
+def _shallow_update(store, wants, client_shallow, depth=None, since=None):
+    """Determine how a deepen request changes the shallow commits of a client.
+
+    :param store: Object store to read commits from
+    :param wants: Objects the client wants
+    :param client_shallow: Set of shallow commits of the client
+    :param depth: Optional depth requested with "deepen"
+    :param since: Optional timestamp requested with "deepen-since"
+    :return: Tuple with the set of commits whose parents are not to be sent,
+        the set of commits that become shallow for the client and the set of
+        shallow commits of the client whose parents are sent
+    """
+    if depth is None and since is None:
+        return set(client_shallow), set(), set()
+    shallow, not_shallow = _find_shallow(store, wants, depth, since)
+    unshallow = client_shallow & not_shallow
+    return (shallow | (client_shallow - not_shallow),
+            shallow - client_shallow, unshallow)
+
+
+def _write_shallow_update(proto, new_shallow, unshallow):
+    for sha in sorted(new_shallow):
+        proto.write_pkt_line('shallow %s\n' % sha)
+    for sha in sorted(unshallow):
+        proto.write_pkt_line('unshallow %s\n' % sha)
+
+
+def _parse_filter(spec):
+    try:
+        return parse_object_filter(spec)
+    except ValueError, e:
+        raise GitProtocolError(str(e))
+
+
+def _read_v2_request(proto):
+    """Read a protocol version 2 command request.
+
+    :param proto: Protocol to read from
+    :return: Tuple with the command and its arguments, or None if the client
+        sent a flush-pkt to end the session
+    """
+    pkt = proto.read_pkt_line()
+    if pkt is None:
+        return None
+    if pkt is DELIM_PKT or not pkt.startswith('command='):
+        raise GitProtocolError('Expected command, got %r' % pkt)
+    command = pkt[len('command='):].rstrip('\n')
+    # Capabilities of the client, such as its agent, up to the delim-pkt
+    pkt = proto.read_pkt_line()
+    while pkt is not None and pkt is not DELIM_PKT:
+        pkt = proto.read_pkt_line()
+    args = []
+    if pkt is DELIM_PKT:
+        pkt = proto.read_pkt_line()
+        while pkt is not None:
+            if pkt is DELIM_PKT:
+                raise GitProtocolError('Unexpected delim-pkt')
+            args.append(pkt.rstrip('\n'))
+            pkt = proto.read_pkt_line()
+    return command, args
+
+
+# Maximum number of pack records generated ahead of the one being sent
+PREFETCH_RECORDS = 64
+
+
+def _iter_prefetched(iterable, size):
+    """Iterate over an iterable, computing items in a separate thread.
+
+    :param iterable: The iterable to iterate over
+    :param size: Maximum number of items computed ahead of the caller
+    :return: Iterator over the items of iterable. Exceptions raised by the
+        iterable are raised by the iterator.
+    """
+    items = Queue.Queue(size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.isSet():
+            try:
+                items.put(item, True, 0.1)
+            except Queue.Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except:
+            put((False, sys.exc_info()))
+        else:
+            put((False, None))
+
+    producer = threading.Thread(target=produce)
+    producer.setDaemon(True)
+    producer.start()
+    try:
+        while True:
+            more, item = items.get()
+            if more:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item[0], item[1], item[2]
+    finally:
+        stopped.set()
+
 
 def _split_proto_line(line, allowed):
     """Split a line read from the wire.
@@ -295,6 +699,10 @@ def _split_proto_line(line, allowed):
     :return: a tuple having one of the following forms:
         ('want', obj_id)
         ('have', obj_id)
+        ('shallow', obj_id)
+        ('deepen', depth)
+        ('deepen-since', timestamp)
+        ('filter', filter_spec)
         ('done', None)
         (None, None)  (for a flush-pkt)
 
@@ -311,10 +719,16 @@ def _split_proto_line(line, allowed):
     try:
         if len(fields) == 1 and command in ('done', None):
             return (command, None)
-        elif len(fields) == 2 and command in ('want', 'have'):
+        elif len(fields) == 2 and command in ('want', 'have', 'shallow'):
             hex_to_sha(fields[1])
             return tuple(fields)
-    except (TypeError, AssertionError), e:
+        elif len(fields) == 2 and command == 'filter':
+            return tuple(fields)
+        elif len(fields) == 2 and command in ('deepen', 'deepen-since'):
+            value = int(fields[1])
+            if value > 0:
+                return (command, value)
+    except (TypeError, AssertionError, ValueError), e:
         raise GitProtocolError(e)
     raise GitProtocolError('Received invalid line from client: %s' % line)
 
@@ -339,11 +753,16 @@ class ProtocolGraphWalker(object):
         self.proto = handler.proto
         self.http_req = handler.http_req
         self.advertise_refs = handler.advertise_refs
+        self.refs_advertised = handler.refs_advertised
         self._wants = []
         self._cached = False
         self._cache = []
         self._cache_index = 0
         self._impl = None
+        self.object_filter = None
+        self.shallow = set()
+        self.client_shallow = set()
+        self.done_received = False
 
     def determine_wants(self, heads):
         """Determine the wants for a set of heads.
@@ -361,7 +780,7 @@ class ProtocolGraphWalker(object):
             self.proto.write_pkt_line(None)
             return None
         values = set(heads.itervalues())
-        if self.advertise_refs or not self.http_req:
+        if self.advertise_refs or not (self.http_req or self.refs_advertised):
             for i, (ref, sha) in enumerate(sorted(heads.iteritems())):
                 line = "%s %s" % (sha, ref)
                 if not i:
@@ -385,18 +804,38 @@ class ProtocolGraphWalker(object):
         line, caps = extract_want_line_capabilities(want)
         self.handler.set_client_capabilities(caps)
         self.set_ack_type(ack_type(caps))
-        allowed = ('want', None)
-        command, sha = _split_proto_line(line, allowed)
+        allowed = ['want', None]
+        if self.handler.has_capability('filter'):
+            allowed.append('filter')
+        # Clients deepen without echoing the shallow capability
+        if 'shallow' in self.handler.capabilities():
+            allowed.extend(['shallow', 'deepen', 'deepen-since'])
+        command, value = _split_proto_line(line, allowed)
 
         want_revs = []
+        depth = since = None
         while command != None:
-            if sha not in values:
+            if command == 'filter':
+                self.object_filter = _parse_filter(value)
+            elif command == 'shallow':
+                self.client_shallow.add(value)
+            elif command == 'deepen':
+                depth = value
+            elif command == 'deepen-since':
+                since = value
+            elif value not in values:
                 raise GitProtocolError(
-                  'Client wants invalid object %s' % sha)
-            want_revs.append(sha)
-            command, sha = self.read_proto_line(allowed)
+                  'Client wants invalid object %s' % value)
+            else:
+                want_revs.append(value)
+            command, value = self.read_proto_line(allowed)
 
         self.set_wants(want_revs)
+        self.shallow, new_shallow, unshallow = _shallow_update(
+            self.store, want_revs, self.client_shallow, depth, since)
+        if depth is not None or since is not None:
+            _write_shallow_update(self.proto, new_shallow, unshallow)
+            self.proto.write_pkt_line(None)
 
         if self.http_req and self.proto.eof():
             # The client may close the socket at this point, expecting a
@@ -443,7 +882,7 @@ class ProtocolGraphWalker(object):
     def set_wants(self, wants):
         self._wants = wants
 
-    def _is_satisfied(self, haves, want, earliest):
+    def _is_satisfied(self, haves, want, earliest, min_generation=None):
         """Check whether a want is satisfied by a set of haves.
 
         A want, typically a branch tip, is "satisfied" only if there exists a
@@ -454,21 +893,36 @@ class ProtocolGraphWalker(object):
         :param earliest: A timestamp beyond which the search for haves will be
             terminated, presumably because we're searching too far down the
             wrong branch.
+        :param min_generation: Optional lowest generation number of the haves
+            in the commit-graph; commits with a lower generation number can
+            not have any of the haves as ancestor and are not searched.
         """
-        o = self.store[want]
-        pending = collections.deque([o])
+        if want in haves:
+            return True
+        graph = self.store.get_commit_graph()
+        if (graph is None or want not in graph) and (
+                self.store[want].type_name != "commit"):
+            # non-commit wants are only satisfied if they are in haves
+            return False
+        pending = collections.deque([want])
+        seen = set(pending)
         while pending:
-            commit = pending.popleft()
-            if commit.id in haves:
+            commit_id = pending.popleft()
+            if commit_id in haves:
                 return True
-            if commit.type_name != "commit":
-                # non-commit wants are assumed to be satisfied
-                continue
-            for parent in commit.parents:
-                parent_obj = self.store[parent]
+            for parent in self.store.get_parents(commit_id):
+                if parent in seen:
+                    continue
+                seen.add(parent)
+                if min_generation is not None:
+                    try:
+                        if graph.get_generation(parent) < min_generation:
+                            continue
+                    except KeyError:
+                        pass
                 # TODO: handle parents with later commit times than children
-                if parent_obj.commit_time >= earliest:
-                    pending.append(parent_obj)
+                if self.store.get_commit_time(parent) >= earliest:
+                    pending.append(parent)
         return False
 
     def all_wants_satisfied(self, haves):
@@ -479,9 +933,16 @@ class ProtocolGraphWalker(object):
             in the current interface they are determined outside this class.
         """
         haves = set(haves)
-        earliest = min([self.store[h].commit_time for h in haves])
+        earliest = min([self.store.get_commit_time(h) for h in haves])
+        min_generation = None
+        graph = self.store.get_commit_graph()
+        if graph is not None:
+            try:
+                min_generation = min([graph.get_generation(h) for h in haves])
+            except KeyError:
+                pass
         for want in self._wants:
-            if not self._is_satisfied(haves, want, earliest):
+            if not self._is_satisfied(haves, want, earliest, min_generation):
                 return False
         return True
 
@@ -512,6 +973,7 @@ class SingleAckGraphWalkerImpl(object):
     def next(self):
         command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
         if command in (None, 'done'):
+            self.walker.done_received = (command == 'done')
             if not self._sent_ack:
                 self.walker.send_nak()
             return None
@@ -540,10 +1002,13 @@ class MultiAckGraphWalkerImpl(object):
             command, sha = self.walker.read_proto_line(_GRAPH_WALKER_COMMANDS)
             if command is None:
                 self.walker.send_nak()
+                if self.walker.http_req:
+                    return None
                 # in multi-ack mode, a flush-pkt indicates the client wants to
                 # flush but more have lines are still coming
                 continue
             elif command == 'done':
+                self.walker.done_received = True
                 # don't nak unless no common commits were found, even if not
                 # everything is satisfied
                 if self._common:
@@ -584,6 +1049,7 @@ class MultiAckDetailedGraphWalkerImpl(object):
                     return None
                 continue
             elif command == 'done':
+                self.walker.done_received = True
                 # don't nak unless no common commits were found, even if not
                 # everything is satisfied
                 if self._common:
@@ -603,10 +1069,11 @@ class ReceivePackHandler(Handler):
     """Protocol handler for downloading a pack from the client."""
 
     def __init__(self, backend, args, proto, http_req=None,
-                 advertise_refs=False):
+                 advertise_refs=False, refs_advertised=False):
         Handler.__init__(self, backend, proto, http_req=http_req)
         self.repo = backend.open_repository(args[0])
         self.advertise_refs = advertise_refs
+        self.refs_advertised = refs_advertised
 
     @classmethod
     def capabilities(cls):
@@ -676,7 +1143,7 @@ class ReceivePackHandler(Handler):
     def handle(self):
         refs = sorted(self.repo.get_refs().iteritems())
 
-        if self.advertise_refs or not self.http_req:
+        if self.advertise_refs or not (self.http_req or self.refs_advertised):
             if refs:
                 self.proto.write_pkt_line(
                   "%s %s\x00%s\n" % (refs[0][1], refs[0][0],
@@ -723,12 +1190,104 @@ DEFAULT_HANDLERS = {
   }
 
 
+# Default maximum number of connections handled at the same time by
+# ThreadingTCPGitServer and ForkingTCPGitServer
+DEFAULT_MAX_CONNECTIONS = 16
+
+
+def _wait_for(cond, predicate, timeout=None):
+    """Wait until a predicate is true.
+
+    :param cond: A threading.Condition that is notified when the outcome of
+        the predicate may have changed
+    :param predicate: Function that takes no arguments
+    :param timeout: Maximum number of seconds to wait, or None to wait forever
+    :return: Whether the predicate is true
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+    cond.acquire()
+    try:
+        while not predicate():
+            if timeout is None:
+                cond.wait(0.5)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                cond.wait(min(remaining, 0.5))
+        return True
+    finally:
+        cond.release()
+
+
+class _ThreadPool(object):
+    """A fixed number of daemon threads that run submitted functions."""
+
+    def __init__(self, size):
+        self._tasks = Queue.Queue()
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        self._size = size
+        for i in range(size):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            fn, args = task
+            try:
+                fn(*args)
+            except:
+                logger.exception('Exception in worker thread')
+            self._pending_cond.acquire()
+            try:
+                self._pending -= 1
+                self._pending_cond.notifyAll()
+            finally:
+                self._pending_cond.release()
+
+    def submit(self, fn, *args):
+        """Run a function in one of the threads, once one is available."""
+        self._pending_cond.acquire()
+        try:
+            self._pending += 1
+        finally:
+            self._pending_cond.release()
+        self._tasks.put((fn, args))
+
+    def wait(self, timeout=None):
+        """Wait for all submitted functions to finish.
+
+        :param timeout: Maximum number of seconds to wait, or None to wait
+            forever
+        :return: True if all functions have finished
+        """
+        return _wait_for(self._pending_cond, lambda: not self._pending,
+                         timeout)
+
+    def close(self):
+        """Stop the threads once the submitted functions have finished."""
+        for i in range(self._size):
+            self._tasks.put(None)
+
+
 class TCPGitRequestHandler(SocketServer.StreamRequestHandler):
 
     def __init__(self, handlers, *args, **kwargs):
         self.handlers = handlers
         SocketServer.StreamRequestHandler.__init__(self, *args, **kwargs)
 
+    def setup(self):
+        # Reads and writes that take longer than this raise socket.timeout,
+        # which disconnects clients that have stopped talking to us.
+        self.timeout = self.server.idle_timeout
+        SocketServer.StreamRequestHandler.setup(self)
+
     def handle(self):
         proto = ReceivableProtocol(self.connection.recv, self.wfile.write)
         command, args = proto.read_cmd()
@@ -742,6 +1301,11 @@ class TCPGitRequestHandler(SocketServer.StreamRequestHandler):
 
 
 class TCPGitServer(SocketServer.TCPServer):
+    """Git server that handles one connection at a time.
+
+    :ivar idle_timeout: Number of seconds after which a connection that has
+        not sent or received any data is closed, or None to wait forever.
+    """
 
     allow_reuse_address = True
     serve = SocketServer.TCPServer.serve_forever
@@ -749,11 +1313,13 @@ class TCPGitServer(SocketServer.TCPServer):
     def _make_handler(self, *args, **kwargs):
         return TCPGitRequestHandler(self.handlers, *args, **kwargs)
 
-    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None):
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 idle_timeout=None):
         self.handlers = dict(DEFAULT_HANDLERS)
         if handlers is not None:
             self.handlers.update(handlers)
         self.backend = backend
+        self.idle_timeout = idle_timeout
         logger.info('Listening for TCP connections on %s:%d', listen_addr, port)
         SocketServer.TCPServer.__init__(self, (listen_addr, port),
                                         self._make_handler)
@@ -766,18 +1332,513 @@ class TCPGitServer(SocketServer.TCPServer):
         logger.exception('Exception happened during processing of request '
                          'from %s', client_address)
 
+    def drain(self, timeout=None):
+        """Wait for the connections that are being handled to finish.
+
+        Call this after shutdown() to stop gracefully.
+
+        :param timeout: Maximum number of seconds to wait, or None to wait
+            until all connections have finished
+        :return: True if all connections have finished
+        """
+        # Connections are handled in serve_forever itself.
+        return True
+
+
+class ThreadingTCPGitServer(TCPGitServer):
+    """Git server that handles connections in a bounded pool of threads.
+
+    At most max_connections connections are handled at the same time. While
+    all threads are busy no further connections are accepted, so new clients
+    wait in the listen backlog until a thread becomes available.
+
+    Repositories are not safe to use from several threads at once, so the
+    backend should open a repository for each connection, like
+    FileSystemBackend does, rather than returning a shared one.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 idle_timeout=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+        TCPGitServer.__init__(self, backend, listen_addr, port=port,
+                              handlers=handlers, idle_timeout=idle_timeout)
+        self.max_connections = max_connections
+        self._active = 0
+        self._active_cond = threading.Condition()
+        self._stopping = False
+        self._pool = _ThreadPool(max_connections)
+
+    @property
+    def active_connections(self):
+        """The number of connections that are being handled."""
+        return self._active
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+    def get_request(self):
+        self._active_cond.acquire()
+        try:
+            while self._active >= self.max_connections:
+                if self._stopping:
+                    raise socket.error(errno.ECONNABORTED,
+                                       'Server is shutting down')
+                self._active_cond.wait(0.5)
+            self._active += 1
+        finally:
+            self._active_cond.release()
+        try:
+            return TCPGitServer.get_request(self)
+        except:
+            self._release_connection()
+            raise
+
+    def _release_connection(self):
+        self._active_cond.acquire()
+        try:
+            self._active -= 1
+            self._active_cond.notifyAll()
+        finally:
+            self._active_cond.release()
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process_request, request, client_address)
+
+    def shutdown_request(self, request):
+        try:
+            TCPGitServer.shutdown_request(self, request)
+        finally:
+            self._release_connection()
+
+    def shutdown(self):
+        self._stopping = True
+        TCPGitServer.shutdown(self)
+
+    def drain(self, timeout=None):
+        return _wait_for(self._active_cond, lambda: not self._active, timeout)
+
+    def server_close(self):
+        TCPGitServer.server_close(self)
+        self._pool.close()
+
+
+class ForkingTCPGitServer(SocketServer.ForkingMixIn, TCPGitServer):
+    """Git server that handles each connection in a child process.
+
+    At most max_connections child processes are running at the same time.
+    While that many are running, no further connections are accepted until
+    one of them exits.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 idle_timeout=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+        TCPGitServer.__init__(self, backend, listen_addr, port=port,
+                              handlers=handlers, idle_timeout=idle_timeout)
+        self.max_children = max_connections
+
+    def finish_request(self, request, client_address):
+        # Only the parent process drains connections on SIGTERM.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        TCPGitServer.finish_request(self, request, client_address)
+
+    def drain(self, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.active_children:
+            if timeout is None:
+                options = 0
+            elif time.time() >= deadline:
+                return False
+            else:
+                options = os.WNOHANG
+            try:
+                pid, _ = os.waitpid(-1, options)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    self.active_children.clear()
+                    break
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            if pid:
+                self.active_children.discard(pid)
+            else:
+                time.sleep(0.1)
+        return True
+
+
+class _AsyncGitConnection(asyncore.dispatcher):
+    """A connection accepted by AsyncTCPGitServer.
+
+    The connection goes through the following states:
+
+    * command: waiting for the client to send the command pkt-line
+    * advertising: a worker thread is generating the ref advertisement
+    * request: waiting for the client to send the first flush-pkt, which
+      ends the wants sent by fetch-pack or the ref updates sent by send-pack
+    * handed-off: the rest of the request is handled by a worker thread
+    """
+
+    def __init__(self, server, sock, client_address):
+        asyncore.dispatcher.__init__(self, sock, map=server._map)
+        self.server = server
+        self.client_address = client_address
+        self.state = 'command'
+        self.last_activity = time.time()
+        self._inbuf = ''
+        self._outbuf = ''
+        self._handler_cls = None
+        self._args = None
+
+    def readable(self):
+        return self.state in ('command', 'request')
+
+    def writable(self):
+        return bool(self._outbuf)
+
+    def handle_read(self):
+        data = self.recv(_RBUFSIZE)
+        if not data:
+            return
+        self.last_activity = time.time()
+        self._inbuf += data
+        try:
+            self._process_input()
+        except (GitProtocolError, AssertionError, ValueError):
+            self.server.handle_error(None, self.client_address)
+            self.close()
+
+    def handle_write(self):
+        sent = self.send(self._outbuf)
+        if sent:
+            self.last_activity = time.time()
+        self._outbuf = self._outbuf[sent:]
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.server.handle_error(None, self.client_address)
+        self.close()
+
+    def _read_pkt(self, offset):
+        """Find the pkt-line at a particular offset of the input buffer.
+
+        :return: Tuple with the pkt-line contents (None for a flush-pkt) and
+            the offset just past it, or None if it has not been received
+            completely yet
+        """
+        if len(self._inbuf) < offset + 4:
+            return None
+        size = int(self._inbuf[offset:offset+4], 16)
+        if size == 0:
+            return None, offset + 4
+        if size == 1:
+            return DELIM_PKT, offset + 4
+        if size < 4:
+            raise GitProtocolError('Invalid pkt-line length %d' % size)
+        if len(self._inbuf) < offset + size:
+            return None
+        return self._inbuf[offset+4:offset+size], offset + size
+
+    def _process_input(self):
+        if self.state == 'command':
+            result = self._read_pkt(0)
+            if result is None:
+                return
+            pkt, end = result
+            if pkt is None:
+                raise GitProtocolError('Expected command, got flush-pkt')
+            command, self._args = parse_cmd_pkt(pkt)
+            logger.info('Handling %s request, args=%s', command, self._args)
+            self._handler_cls = self.server.handlers.get(command, None)
+            if not callable(self._handler_cls):
+                raise GitProtocolError('Invalid service %s' % command)
+            self._inbuf = self._inbuf[end:]
+            self.state = 'advertising'
+            self.server._pool.submit(self._advertise)
+        elif self.state == 'request':
+            offset = 0
+            while True:
+                result = self._read_pkt(offset)
+                if result is None:
+                    return
+                pkt, offset = result
+                if pkt is None:
+                    break
+            if offset == 4:
+                # A lone flush-pkt: the client does not want anything.
+                self.close()
+                return
+            self.state = 'handed-off'
+            data, self._inbuf = self._inbuf, ''
+            sock = self.socket
+            self.del_channel()
+            self.server._pool.submit(self._handle_request, sock, data)
+
+    def _advertise(self):
+        # Runs in a worker thread.
+        try:
+            buf = StringIO()
+            handler = self._handler_cls(self.server.backend, self._args,
+                Protocol(None, buf.write), advertise_refs=True)
+            handler.handle()
+        except:
+            self.server.handle_error(None, self.client_address)
+            self.server._call_in_loop(self.close)
+        else:
+            self.server._call_in_loop(self._advertised, buf.getvalue())
+
+    def _advertised(self, data):
+        if self.state != 'advertising':
+            return
+        self._outbuf += data
+        self.state = 'request'
+        self.last_activity = time.time()
+        self._process_input()
+
+    def _handle_request(self, sock, data):
+        # Runs in a worker thread.
+        buffered = [data]
+        def recv(size):
+            if buffered:
+                data = buffered.pop()
+                if len(data) > size:
+                    buffered.append(data[size:])
+                    data = data[:size]
+                return data
+            return sock.recv(size)
+        try:
+            try:
+                sock.setblocking(1)
+                sock.settimeout(self.server.idle_timeout)
+                proto = ReceivableProtocol(recv, sock.sendall)
+                handler = self._handler_cls(self.server.backend, self._args,
+                    proto, refs_advertised=True)
+                handler.handle()
+            except:
+                self.server.handle_error(sock, self.client_address)
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            sock.close()
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Pipe used to wake up the event loop from other threads."""
+
+    def __init__(self, map):
+        self._read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._read_fd, map=map)
+        os.close(self._read_fd)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(_RBUFSIZE)
+        except (OSError, socket.error):
+            pass
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError:
+            pass
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+
+class AsyncTCPGitServer(asyncore.dispatcher):
+    """Git server that waits for clients in a single event loop.
+
+    Accepting connections, reading the service request and waiting for the
+    client's response to the ref advertisement happen in an asyncore event
+    loop, so a connection that is waiting for its client does not take up a
+    thread. Generating the ref advertisement, and the rest of the request
+    after the client has sent its wants or ref updates (negotiation and
+    sending or receiving the pack), run in a pool of max_connections worker
+    threads. Clients that only poll for changed refs never occupy a worker
+    thread for longer than it takes to read the refs.
+
+    The handlers have to accept the advertise_refs and refs_advertised
+    arguments, like UploadPackHandler and ReceivePackHandler. As the worker
+    threads handle several connections at once, the backend should open a
+    repository for each request, like FileSystemBackend does.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 idle_timeout=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.handlers = dict(DEFAULT_HANDLERS)
+        if handlers is not None:
+            self.handlers.update(handlers)
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self._pool = _ThreadPool(max_connections)
+        self._calls = Queue.Queue()
+        self._waker = _Waker(self._map)
+        self._serving = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+        logger.info('Listening for TCP connections on %s:%d', listen_addr, port)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((listen_addr, port))
+        self.listen(socket.SOMAXCONN)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, client_address = pair
+        logger.info('Handling request from %s', client_address)
+        _AsyncGitConnection(self, sock, client_address)
+
+    def handle_error(self, request=None, client_address=None):
+        logger.exception('Exception happened during processing of request '
+                         'from %s', client_address)
+
+    def _call_in_loop(self, fn, *args):
+        """Call a function from the event loop thread."""
+        self._calls.put((fn, args))
+        self._waker.wake()
+
+    def _connections(self):
+        return [c for c in self._map.values()
+                if isinstance(c, _AsyncGitConnection)]
+
+    def _close_idle_connections(self):
+        if self.idle_timeout is None:
+            return
+        cutoff = time.time() - self.idle_timeout
+        for conn in self._connections():
+            if conn.state != 'advertising' and conn.last_activity < cutoff:
+                logger.info('Closing idle connection from %s',
+                            conn.client_address)
+                conn.close()
+
+    def serve_forever(self, poll_interval=0.5):
+        """Handle connections until shutdown() is called.
+
+        :param poll_interval: Number of seconds between checks for idle
+            connections
+        """
+        self._serving = True
+        self._is_shut_down.clear()
+        use_poll = getattr(select, 'poll', None) is not None
+        try:
+            while self._serving:
+                asyncore.loop(timeout=poll_interval, use_poll=use_poll,
+                              map=self._map, count=1)
+                while True:
+                    try:
+                        fn, args = self._calls.get_nowait()
+                    except Queue.Empty:
+                        break
+                    fn(*args)
+                self._close_idle_connections()
+        finally:
+            self._is_shut_down.set()
+
+    serve = serve_forever
+
+    def shutdown(self):
+        """Stop serve_forever and wait for it to return."""
+        self._serving = False
+        self._waker.wake()
+        self._is_shut_down.wait()
+
+    def drain(self, timeout=None):
+        """Wait for the requests handled by worker threads to finish.
+
+        :param timeout: Maximum number of seconds to wait, or None to wait
+            until all requests have finished
+        :return: True if all requests have finished
+        """
+        return self._pool.wait(timeout)
+
+    def server_close(self):
+        """Close the listening socket and all connections."""
+        for conn in self._connections():
+            conn.close()
+        self._waker.close()
+        self.close()
+        self._pool.close()
+
 
 def main(argv=sys.argv):
     """Entry point for starting a TCP git server."""
-    if len(argv) > 1:
-        gitdir = argv[1]
+    import optparse
+    parser = optparse.OptionParser(usage="usage: %prog [options] [GITDIR]")
+    parser.add_option("-l", "--listen_address", dest="listen_address",
+                      default="localhost",
+                      help="Binding IP address.")
+    parser.add_option("-p", "--port", dest="port", type=int,
+                      default=TCP_GIT_PORT,
+                      help="Binding TCP port.")
+    parser.add_option("--mode", dest="mode", default="threading",
+                      choices=["serial", "threading", "forking", "async"],
+                      help="How to handle concurrent connections: serial, "
+                           "threading, forking or async. [default: %default]")
+    parser.add_option("--max-connections", dest="max_connections", type=int,
+                      default=DEFAULT_MAX_CONNECTIONS,
+                      help="Maximum number of connections handled at the "
+                           "same time. [default: %default]")
+    parser.add_option("--idle-timeout", dest="idle_timeout", type=float,
+                      help="Close connections that have been idle for this "
+                           "many seconds.")
+    parser.add_option("--drain-timeout", dest="drain_timeout", type=float,
+                      help="On SIGTERM, wait at most this many seconds for "
+                           "connections to finish.")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) > 0:
+        gitdir = args[0]
     else:
         gitdir = '.'
 
     log_utils.default_logging_config()
-    backend = DictBackend({'/': Repo(gitdir)})
-    server = TCPGitServer(backend, 'localhost')
-    server.serve_forever()
+    # Connections can be handled at the same time, so each of them opens the
+    # repository itself.
+    backend = FileSystemBackend(gitdir)
+    if options.mode == "serial":
+        server = TCPGitServer(backend, options.listen_address, options.port,
+                              idle_timeout=options.idle_timeout)
+    else:
+        if options.mode == "threading":
+            server_cls = ThreadingTCPGitServer
+        elif options.mode == "forking":
+            server_cls = ForkingTCPGitServer
+        else:
+            server_cls = AsyncTCPGitServer
+        server = server_cls(backend, options.listen_address, options.port,
+                            idle_timeout=options.idle_timeout,
+                            max_connections=options.max_connections)
+
+    def stop(signum, frame):
+        logger.info('Received signal %d, no longer accepting connections',
+                    signum)
+        # shutdown() waits for serve_forever() to return, so it can not be
+        # called from the thread that is running it.
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    if not server.drain(options.drain_timeout):
+        logger.warning('Connections still active after %.1f seconds',
+                       options.drain_timeout)
+    server.server_close()
 
 
 def serve_command(handler_cls, argv=sys.argv, backend=None, inf=sys.stdin,
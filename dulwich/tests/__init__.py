@@ -113,6 +113,7 @@ def self_test_suite():
     names = [
         'blackbox',
         'client',
+        'commit_graph',
         'config',
         'diff_tree',
         'fastexport',
@@ -125,6 +126,7 @@ def self_test_suite():
         'pack',
         'patch',
         'protocol',
+        'reftable',
         'repository',
         'server',
         'walk',
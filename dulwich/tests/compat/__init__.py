@@ -24,6 +24,7 @@ import unittest
 def test_suite():
     names = [
         'client',
+        'commit_graph',
         'pack',
         'repository',
         'server',
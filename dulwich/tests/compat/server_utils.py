@@ -26,12 +26,14 @@ import shutil
 import socket
 import tempfile
 import threading
+import time
 
 from dulwich.repo import Repo
 from dulwich.server import (
     ReceivePackHandler,
     )
 from dulwich.tests.utils import (
+    make_commit,
     tear_down_repo,
     )
 from dulwich.tests.compat.utils import (
@@ -92,6 +94,102 @@ class ServerTests(object):
         self._old_repo.object_store._pack_cache = None
         self.assertReposEqual(self._old_repo, self._new_repo)
 
+    def test_fetch_from_dulwich_many_haves(self):
+        self.import_repos()
+        port = self._start_server(self._new_repo)
+        # Many commits the server does not have make the negotiation take
+        # several rounds.
+        parent = self._old_repo.refs['refs/heads/master']
+        tree = self._old_repo[parent].tree
+        now = int(time.time())
+        for i in range(100):
+            commit = make_commit(parents=[parent], tree=tree,
+                                 commit_time=now + i, message='local %d' % i)
+            self._old_repo.object_store.add_object(commit)
+            parent = commit.id
+        self._old_repo.refs['refs/heads/local'] = parent
+
+        old_refs = self._old_repo.get_refs()
+        for version in ('0', '2'):
+            for ref in ('refs/heads/master', 'refs/heads/branch'):
+                self._old_repo.refs[ref] = old_refs[ref]
+            run_git_or_fail(['-c', 'protocol.version=%s' % version, 'fetch',
+                             self.url(port)] + self.branch_args(),
+                            cwd=self._old_repo.path)
+            for ref in ('refs/heads/master', 'refs/heads/branch'):
+                self.assertEqual(self._new_repo.refs[ref],
+                                 self._old_repo.refs[ref])
+        run_git_or_fail(['fsck'], cwd=self._old_repo.path)
+
+    def test_fetch_from_dulwich_v2(self):
+        self.import_repos()
+        self.assertReposNotEqual(self._old_repo, self._new_repo)
+        port = self._start_server(self._new_repo)
+
+        run_git_or_fail(['-c', 'protocol.version=2', 'fetch', self.url(port)]
+                        + self.branch_args(), cwd=self._old_repo.path)
+        # flush the pack cache so any new packs are picked up
+        self._old_repo.object_store._pack_cache = None
+        self.assertReposEqual(self._old_repo, self._new_repo)
+
+    def test_ls_remote_from_dulwich_v2(self):
+        self.import_repos()
+        port = self._start_server(self._new_repo)
+
+        output = run_git_or_fail(
+            ['-c', 'protocol.version=2', 'ls-remote', self.url(port),
+             'refs/heads/branch'], cwd=self._old_repo.path)
+        self.assertEqual(
+            '%s\trefs/heads/branch\n' % self._new_repo.refs['refs/heads/branch'],
+            output)
+
+    def test_clone_from_dulwich_filter(self):
+        self.import_repos()
+        port = self._start_server(self._new_repo)
+
+        new_repo_base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, new_repo_base_dir)
+        tree = self._new_repo['refs/heads/master'].tree
+        entries = list(self._new_repo[tree].iteritems())
+        for version in ('0', '2'):
+            new_repo_dir = os.path.join(new_repo_base_dir, version)
+            run_git_or_fail(['-c', 'protocol.version=%s' % version, 'clone',
+                             '--quiet', '--bare', '--filter=blob:none',
+                             self.url(port), new_repo_dir],
+                            cwd=new_repo_base_dir)
+            new_repo = Repo(new_repo_dir)
+            self.assertTrue(tree in new_repo.object_store)
+            for entry in entries:
+                self.assertFalse(entry.sha in new_repo.object_store)
+        # Blobs are fetched from the server when they are needed. This relies
+        # on protocol version 2, as version 0 only allows advertised wants.
+        entry = entries[0]
+        output = run_git_or_fail(['cat-file', 'blob', entry.sha],
+                                 cwd=new_repo_dir)
+        self.assertEqual(self._new_repo[entry.sha].data, output)
+
+    def test_clone_from_dulwich_shallow(self):
+        self.import_repos()
+        port = self._start_server(self._new_repo)
+
+        new_repo_base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, new_repo_base_dir)
+        master = self._new_repo.refs['refs/heads/master']
+        for version in ('0', '2'):
+            new_repo_dir = os.path.join(new_repo_base_dir, version)
+            run_git_or_fail(['-c', 'protocol.version=%s' % version, 'clone',
+                             '--quiet', '--bare', '--depth=1', self.url(port),
+                             new_repo_dir], cwd=new_repo_base_dir)
+            new_repo = Repo(new_repo_dir)
+            self.assertEqual(set([master]), new_repo.get_shallow())
+            self.assertEqual('1\n', run_git_or_fail(
+                ['rev-list', '--count', 'master'], cwd=new_repo_dir))
+            run_git_or_fail(['-c', 'protocol.version=%s' % version, 'fetch',
+                             '--quiet', '--unshallow', 'origin',
+                             'refs/heads/master'], cwd=new_repo_dir)
+            self.assertEqual(set(), new_repo.get_shallow())
+            run_git_or_fail(['fsck'], cwd=new_repo_dir)
+
     def test_clone_from_dulwich_empty(self):
         old_repo_dir = os.path.join(tempfile.mkdtemp(), 'empty_old')
         run_git_or_fail(['init', '--quiet', '--bare', old_repo_dir])
@@ -193,6 +193,62 @@ class DulwichClientTestBase(object):
         map(lambda r: dest.refs.set_if_equals(r[0], None, r[1]), refs.items())
         self.assertDestEqualsSrc()
 
+    def make_commits(self, r, parent, count):
+        tree = r[parent].tree
+        for i in range(count):
+            c = objects.Commit()
+            c.author = c.committer = 'Foo Bar <foo@example.com>'
+            c.author_time = c.commit_time = 2000000000 + i
+            c.author_timezone = c.commit_timezone = 0
+            c.message = 'commit %d in %s' % (i, r.path)
+            c.tree = tree
+            c.parents = [parent]
+            r.object_store.add_object(c)
+            parent = c.id
+        return parent
+
+    def _fetch_pack_many_haves(self):
+        self.test_fetch_pack()
+        # The client has many commits that the server does not have, so the
+        # negotiation takes several rounds over a stateless connection.
+        src = repo.Repo(os.path.join(self.gitroot, 'server_new.export'))
+        dest = repo.Repo(self.dest)
+        master = src.refs['refs/heads/master']
+        new_master = self.make_commits(src, master, 1)
+        src.refs['refs/heads/master'] = new_master
+        dest.refs['refs/heads/master'] = self.make_commits(dest, master, 100)
+        c = self._client()
+        refs = c.fetch(self._build_path('/server_new.export'), dest)
+        self.assertEqual(new_master, refs['refs/heads/master'])
+        self.assertTrue(new_master in dest.object_store)
+        run_git_or_fail(['fsck'], cwd=self.dest)
+
+    def test_fetch_pack_many_haves(self):
+        self._fetch_pack_many_haves()
+
+    def test_fetch_pack_skipping(self):
+        run_git_or_fail(['config', 'fetch.negotiationAlgorithm', 'skipping'],
+                        cwd=self.dest)
+        self._fetch_pack_many_haves()
+
+    def test_fetch_pack_depth(self):
+        c = self._client()
+        dest = repo.Repo(os.path.join(self.gitroot, 'dest'))
+        src = repo.Repo(os.path.join(self.gitroot, 'server_new.export'))
+        master = src.refs['refs/heads/master']
+        path = self._build_path('/server_new.export')
+        c.fetch(path, dest, lambda refs: [refs['refs/heads/master']], depth=1)
+        dest.refs['refs/heads/master'] = master
+        self.assertEqual(set([master]), dest.get_shallow())
+        self.assertEqual('1\n', run_git_or_fail(
+            ['rev-list', '--count', 'master'], cwd=self.dest))
+        # Deepen the clone until it is complete again
+        c = self._client()
+        c.fetch(path, dest, lambda refs: [refs['refs/heads/master']],
+                depth=2 ** 31 - 1)
+        self.assertEqual(set(), dest.get_shallow())
+        run_git_or_fail(['fsck'], cwd=self.dest)
+
     def test_fetch_pack_zero_sha(self):
         # zero sha1s are already present on the client, and should
         # be ignored
@@ -251,6 +307,43 @@ class DulwichTCPClientTest(CompatTestCase, DulwichClientTestBase):
     def _build_path(self, path):
         return path
 
+    def test_get_refs_many(self):
+        src = repo.Repo(os.path.join(self.gitroot, 'server_new.export'))
+        src_location = ('localhost', None, '/server_new.export')
+        missing_location = ('localhost', None, '/missing')
+        results = client.get_refs_many(
+            [src_location, ('localhost', None, '/dest'), missing_location],
+            timeout=30)
+        self.assertEqual(src.get_refs(), results[src_location])
+        self.assertEqual({}, results[('localhost', None, '/dest')])
+        self.assertTrue(isinstance(results[missing_location], Exception))
+
+
+class ProtocolV2ClientTestMixin(object):
+    """Tests for fetching with protocol version 2."""
+
+    # protocol version 2 was introduced in git 2.18
+    min_git_version = (2, 18, 0)
+
+    def test_fetch_pack_ref_prefix(self):
+        c = self._client()
+        dest = repo.Repo(os.path.join(self.gitroot, 'dest'))
+        refs = c.fetch(self._build_path('/server_new.export'), dest,
+                       ref_prefix=['refs/heads/bra'])
+        src = repo.Repo(os.path.join(self.gitroot, 'server_new.export'))
+        self.assertEqual({'refs/heads/branch': src.refs['refs/heads/branch']},
+                         refs)
+        self.assertTrue(src.refs['refs/heads/branch'] in dest.object_store)
+
+
+class DulwichTCPClientV2Test(ProtocolV2ClientTestMixin, DulwichTCPClientTest):
+
+    def _client(self):
+        return client.TCPGitClient('localhost', protocol_version=2)
+
+    def test_get_refs_many(self):
+        raise SkipTest("get_refs_many only speaks protocol version 0")
+
 
 class TestSSHVendor(object):
     @staticmethod
@@ -299,6 +392,14 @@ class DulwichSubprocessClientTest(CompatTestCase, DulwichClientTestBase):
         return self.gitroot + path
 
 
+class DulwichSubprocessClientV2Test(ProtocolV2ClientTestMixin,
+                                    DulwichSubprocessClientTest):
+
+    def _client(self):
+        return client.SubprocessGitClient(stderr=subprocess.PIPE,
+                                          protocol_version=2)
+
+
 class GitHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     """HTTP Request handler that calls out to 'git http-backend'."""
 
@@ -389,11 +490,15 @@ class GitHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         co = filter(None, self.headers.getheaders('cookie'))
         if co:
             env['HTTP_COOKIE'] = ', '.join(co)
+        git_protocol = self.headers.getheader('git-protocol')
+        if git_protocol:
+            env['HTTP_GIT_PROTOCOL'] = git_protocol
         # XXX Other HTTP_* headers
         # Since we're setting the env in the parent, provide empty
         # values to override previously set values
         for k in ('QUERY_STRING', 'REMOTE_HOST', 'CONTENT_LENGTH',
-                  'HTTP_USER_AGENT', 'HTTP_COOKIE', 'HTTP_REFERER'):
+                  'HTTP_USER_AGENT', 'HTTP_COOKIE', 'HTTP_REFERER',
+                  'HTTP_GIT_PROTOCOL'):
             env.setdefault(k, "")
 
         self.send_response(200, "Script output follows")
@@ -471,3 +576,9 @@ class DulwichHttpClientTest(CompatTestCase, DulwichClientTestBase):
 
     def test_archive(self):
         raise SkipTest("exporting archives not supported over http")
+
+
+class DulwichHttpClientV2Test(ProtocolV2ClientTestMixin, DulwichHttpClientTest):
+
+    def _client(self):
+        return client.HttpGitClient(self._httpd.get_url(), protocol_version=2)
@@ -0,0 +1,68 @@
+# test_commit_graph.py -- Compatibility tests for commit-graph files.
+# Copyright (C) 2013 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Compatibility tests for commit-graph files."""
+
+import shutil
+import tempfile
+
+from dulwich.repo import (
+    Repo,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
+from dulwich.tests.compat.utils import (
+    CompatTestCase,
+    run_git_or_fail,
+    )
+
+
+class CommitGraphTests(CompatTestCase):
+    """Compatibility tests for commit-graph files."""
+
+    min_git_version = (2, 18, 0)
+
+    def setUp(self):
+        super(CommitGraphTests, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._repo = Repo.init_bare(self._tempdir)
+        self.store = self._repo.object_store
+        self.commits = build_commit_graph(self.store,
+            [[1], [2, 1], [3, 1], [4, 2, 3], [5], [6, 4, 2, 5, 3]])
+        self._repo.refs['refs/heads/master'] = self.commits[-1].id
+
+    def test_verify(self):
+        graph = self.store.write_commit_graph([self.commits[-1].id])
+        self.addCleanup(graph.close)
+        run_git_or_fail(['commit-graph', 'verify'], cwd=self._tempdir)
+
+    def test_read(self):
+        run_git_or_fail(['commit-graph', 'write', '--reachable'],
+                        cwd=self._tempdir)
+        graph = self.store.get_commit_graph()
+        self.addCleanup(graph.close)
+        graph.check()
+        self.assertEqual(sorted(c.id for c in self.commits), list(graph))
+        for c in self.commits:
+            entry = graph.get_entry(c.id)
+            self.assertEqual(c.tree, entry.tree)
+            self.assertEqual(c.parents, entry.parents)
+            self.assertEqual(c.commit_time, entry.commit_time)
+        self.assertEqual(4, graph.get_generation(self.commits[-1].id))
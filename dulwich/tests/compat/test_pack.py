@@ -25,13 +25,28 @@ import os
 import shutil
 import tempfile
 
+from dulwich.object_store import (
+    MissingObjectFinder,
+    )
+from dulwich.objects import (
+    Blob,
+    hex_to_sha,
+    )
 from dulwich.pack import (
+    load_multi_pack_index,
     write_pack,
     )
+from dulwich.repo import (
+    Repo,
+    )
 from dulwich.tests.test_pack import (
     pack1_sha,
     PackTests,
     )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
 from dulwich.tests.compat.utils import (
     require_git_version,
     run_git_or_fail,
@@ -64,3 +79,103 @@ class TestPack(PackTests):
             pack_shas.add(sha)
         orig_shas = set(o.id for o in origpack.iterobjects())
         self.assertEqual(orig_shas, pack_shas)
+
+
+class MultiPackIndexTests(PackTests):
+    """Compatibility tests for multi-pack-index files."""
+
+    def setUp(self):
+        require_git_version((2, 21, 0))
+        super(MultiPackIndexTests, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._repo = Repo.init_bare(self._tempdir)
+        self.store = self._repo.object_store
+        self.blobs = [make_object(Blob, data='blob %d' % i) for i in range(4)]
+        self.store.add_objects([(b, None) for b in self.blobs[:3]])
+        self.store.add_objects([(b, None) for b in self.blobs[1:]])
+        self.addCleanup(self.close_packs)
+
+    def close_packs(self):
+        for p in self.store.packs:
+            p.close()
+
+    def test_verify(self):
+        midx = self.store.write_multi_pack_index()
+        self.addCleanup(midx.close)
+        run_git_or_fail(['multi-pack-index', 'verify'], cwd=self._tempdir)
+
+    def test_read(self):
+        run_git_or_fail(['multi-pack-index', 'write'], cwd=self._tempdir)
+        midx = load_multi_pack_index(os.path.join(
+            self.store.pack_dir, 'multi-pack-index'))
+        self.addCleanup(midx.close)
+        self.assertSucceeds(midx.check)
+        self.assertEqual(sorted(b.id for b in self.blobs), list(midx))
+        self.assertEqual(
+            sorted(os.path.basename(p._basename) + '.idx'
+                   for p in self.store.packs),
+            midx.pack_names)
+        for b in self.blobs:
+            self.assertEqual(b, self.store[b.id])
+
+
+class PackBitmapTests(PackTests):
+    """Compatibility tests for pack bitmap files."""
+
+    def setUp(self):
+        require_git_version((2, 0, 0))
+        super(PackBitmapTests, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._repo = Repo.init_bare(self._tempdir)
+        self.store = self._repo.object_store
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(3)]
+        trees = {
+            1: [('a', blobs[0]), ('d/b', blobs[1])],
+            2: [('a', blobs[0]), ('d/b', blobs[2])],
+            3: [('a', blobs[1]), ('d/b', blobs[1])],
+            4: [('a', blobs[2]), ('d/b', blobs[1])],
+            }
+        self.commits = [c.id for c in build_commit_graph(
+            self.store, [[1], [2, 1], [3, 1], [4, 2, 3]], trees)]
+        self._repo.refs['refs/heads/master'] = self.commits[-1]
+        self.addCleanup(self.close_packs)
+
+    def close_packs(self):
+        for p in self.store.packs:
+            p.close()
+
+    def test_write(self):
+        self.store.pack_loose_objects()
+        self.store.write_pack_bitmap(self.store.packs[0], [self.commits[-1]])
+        output = run_git_or_fail(['rev-list', '--test-bitmap', 'master'],
+                                 cwd=self._tempdir)
+        self.assertTrue('OK!' in output.splitlines(), output)
+
+    def test_repack(self):
+        self.store.add_objects(
+            [(make_object(Blob, data='unreachable'), None)])
+        self.store.repack(heads=[self.commits[-1]])
+        self.assertEqual(1, len(self.store.packs))
+        run_git_or_fail(['fsck', '--strict'], cwd=self._tempdir)
+        output = run_git_or_fail(['rev-list', '--test-bitmap', 'master'],
+                                 cwd=self._tempdir)
+        self.assertTrue('OK!' in output.splitlines(), output)
+        output = run_git_or_fail(['count-objects', '-v'], cwd=self._tempdir)
+        self.assertTrue('count: 0' in output.splitlines(), output)
+        self.assertTrue('in-pack: 13' in output.splitlines(), output)
+
+    def test_read(self):
+        run_git_or_fail(['repack', '-a', '-d', '-b', '-q'], cwd=self._tempdir)
+        pack = self.store.packs[0]
+        self.assertTrue(hex_to_sha(self.commits[-1]) in
+                        pack.bitmap.commit_bitmaps)
+        for haves, wants in [([], [self.commits[-1]]),
+                             ([self.commits[1]], [self.commits[-1]]),
+                             ([self.commits[2]], [self.commits[1]])]:
+            finder = MissingObjectFinder(self.store, haves, wants)
+            self.assertEqual(
+                sorted(sha for (sha, path) in iter(finder.next, None)),
+                sorted(sha for (sha, path) in
+                       self.store.find_missing_objects(haves, wants)))
@@ -24,11 +24,28 @@ Warning: these tests should be fairly stable, but when writing/debugging new
     Ctrl-C'ed. On POSIX systems, you can kill the tests with Ctrl-Z, "kill %".
 """
 
+import os
+import shutil
+import sys
+import tempfile
 import threading
 
+from dulwich.objects import (
+    Blob,
+    Tree,
+    )
+from dulwich.repo import Repo
 from dulwich.server import (
+    AsyncTCPGitServer,
     DictBackend,
+    FileSystemBackend,
+    ForkingTCPGitServer,
     TCPGitServer,
+    ThreadingTCPGitServer,
+    )
+from dulwich.tests.utils import (
+    make_commit,
+    make_object,
     )
 from dulwich.tests.compat.server_utils import (
     ServerTests,
@@ -37,6 +54,7 @@ from dulwich.tests.compat.server_utils import (
     )
 from dulwich.tests.compat.utils import (
     CompatTestCase,
+    run_git_or_fail,
     )
 
 
@@ -61,6 +79,7 @@ class GitServerTestCase(ServerTests, CompatTestCase):
     """
 
     protocol = 'git'
+    server_cls = TCPGitServer
 
     def _handlers(self):
         return {'git-receive-pack': NoSideBand64kReceivePackHandler}
@@ -72,8 +91,8 @@ class GitServerTestCase(ServerTests, CompatTestCase):
 
     def _start_server(self, repo):
         backend = DictBackend({'/': repo})
-        dul_server = TCPGitServer(backend, 'localhost', 0,
-                                  handlers=self._handlers())
+        dul_server = self.server_cls(backend, 'localhost', 0,
+                                     handlers=self._handlers())
         self._check_server(dul_server)
         self.addCleanup(dul_server.shutdown)
         threading.Thread(target=dul_server.serve).start()
@@ -95,3 +114,94 @@ class GitServerSideBand64kTestCase(GitServerTestCase):
         receive_pack_handler_cls = server.handlers['git-receive-pack']
         caps = receive_pack_handler_cls.capabilities()
         self.assertTrue('side-band-64k' in caps)
+
+
+class ThreadingGitServerTestCase(GitServerSideBand64kTestCase):
+    """Tests for client/server compatibility with a threading server."""
+
+    server_cls = ThreadingTCPGitServer
+
+    def _start_server(self, repo):
+        port = super(ThreadingGitServerTestCase, self)._start_server(repo)
+        self.addCleanup(self._stop_server, self._server)
+        return port
+
+    def _stop_server(self, server):
+        server.shutdown()
+        self.assertTrue(server.drain(10))
+        server.server_close()
+
+    def _make_delta_repo(self, num_commits=300):
+        """Create a repository with a long history of a single file."""
+        repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo_dir)
+        repo = Repo.init_bare(repo_dir)
+        lines = ['line %d\n' % i for i in range(1000)]
+        parents = []
+        for i in range(num_commits):
+            for j in range(20):
+                lines[(i * 37 + j * 101) % 1000] = 'change %d %d\n' % (i, j)
+            blob = make_object(Blob, data=''.join(lines))
+            tree = Tree()
+            tree.add('file', 0100644, blob.id)
+            commit = make_commit(tree=tree.id, parents=parents,
+                                 message='change %d' % i)
+            repo.object_store.add_objects(
+                [(blob, None), (tree, None), (commit, None)])
+            parents = [commit.id]
+        repo.refs['refs/heads/master'] = commit.id
+        # Reading the deltas of the pack goes through the pack's reader and
+        # delta base cache.
+        run_git_or_fail(['repack', '-adq'], cwd=repo_dir)
+        return repo
+
+    def test_concurrent_clones(self):
+        repo = self._make_delta_repo()
+        # Serve the repository like the git-daemon script does.
+        server = self.server_cls(FileSystemBackend(repo.path), 'localhost', 0)
+        threading.Thread(target=server.serve).start()
+        self.addCleanup(self._stop_server, server)
+        _, port = server.socket.getsockname()
+        # Switch threads as often as possible, to expose shared state.
+        self.addCleanup(sys.setcheckinterval, sys.getcheckinterval())
+        sys.setcheckinterval(1)
+        clones_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, clones_dir)
+        errors = []
+        def clone(i):
+            try:
+                run_git_or_fail(['clone', '--bare', self.url(port),
+                                 os.path.join(clones_dir, str(i))])
+            except AssertionError, e:
+                errors.append(e)
+        threads = [threading.Thread(target=clone, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        for i in range(8):
+            run_git_or_fail(['fsck'], cwd=os.path.join(clones_dir, str(i)))
+
+
+if getattr(os, 'fork', None) is not None:
+    class ForkingGitServerTestCase(GitServerSideBand64kTestCase):
+        """Tests for client/server compatibility with a forking server."""
+
+        server_cls = ForkingTCPGitServer
+
+        def _start_server(self, repo):
+            port = super(ForkingGitServerTestCase, self)._start_server(repo)
+            self.addCleanup(self._stop_server, self._server)
+            return port
+
+        def _stop_server(self, server):
+            server.shutdown()
+            self.assertTrue(server.drain(10))
+
+
+class AsyncGitServerTestCase(ThreadingGitServerTestCase):
+    """Tests for client/server compatibility with an asyncore server."""
+
+    server_cls = AsyncTCPGitServer
@@ -24,9 +24,14 @@ warning: these tests should be fairly stable, but when writing/debugging new
     Ctrl-C'ed. On POSIX systems, you can kill the tests with Ctrl-Z, "kill %".
 """
 
+import os
 import threading
 from wsgiref import simple_server
 
+from dulwich.objects import (
+    Blob,
+    Tree,
+    )
 from dulwich.server import (
     DictBackend,
     )
@@ -46,6 +51,11 @@ from dulwich.tests.compat.server_utils import (
     )
 from dulwich.tests.compat.utils import (
     CompatTestCase,
+    run_git_or_fail,
+    )
+from dulwich.tests.utils import (
+    make_commit,
+    make_object,
     )
 
 
@@ -110,6 +120,24 @@ class SmartWebTestCase(WebTests, CompatTestCase):
         self._check_app(to_check)
         return app
 
+    def test_push_to_dulwich_chunked(self):
+        # git streams request bodies larger than http.postBuffer in chunks
+        self.import_repos()
+        blob = make_object(Blob, data=os.urandom(128 * 1024))
+        tree = Tree()
+        tree.add('large', 0100644, blob.id)
+        commit = make_commit(tree=tree.id,
+                             parents=[self._new_repo.refs['refs/heads/master']])
+        for obj in (blob, tree, commit):
+            self._new_repo.object_store.add_object(obj)
+        self._new_repo.refs['refs/heads/master'] = commit.id
+        port = self._start_server(self._old_repo)
+
+        run_git_or_fail(['-c', 'http.postBuffer=65536', 'push',
+                         self.url(port)] + self.branch_args(),
+                        cwd=self._new_repo.path)
+        self.assertReposEqual(self._old_repo, self._new_repo)
+
 
 class SmartWebSideBand64kTestCase(SmartWebTestCase):
     """Test cases for smart HTTP server with side-band-64k support."""
@@ -135,3 +163,9 @@ class DumbWebTestCase(WebTests, CompatTestCase):
     def test_push_to_dulwich(self):
         # Note: remove this if dumb pushing is supported
         raise SkipTest('Dumb web pushing not supported.')
+
+    def test_clone_from_dulwich_filter(self):
+        raise SkipTest('Dumb web fetching can not be filtered.')
+
+    def test_clone_from_dulwich_shallow(self):
+        raise SkipTest('Dumb web fetching can not be shallow.')
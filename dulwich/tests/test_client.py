@@ -17,17 +17,32 @@
 # MA  02110-1301, USA.
 
 from cStringIO import StringIO
+import BaseHTTPServer
+import os
+import shutil
+import socket
+import struct
+import SocketServer
+import tempfile
+import threading
+from wsgiref import simple_server
 
 from dulwich.client import (
     TraditionalGitClient,
     TCPGitClient,
     SubprocessGitClient,
     SSHGitClient,
+    HTTPConnectionPool,
     HttpGitClient,
     ReportStatusParser,
     SendPackError,
     UpdateRefsError,
+    get_refs_many,
     get_transport_and_path,
+    _StatelessNegotiator,
+    )
+from dulwich.errors import (
+    GitProtocolError,
     )
 from dulwich.tests import (
     TestCase,
@@ -35,6 +50,25 @@ from dulwich.tests import (
 from dulwich.protocol import (
     TCP_GIT_PORT,
     Protocol,
+    pkt_line,
+    )
+from dulwich.objects import (
+    Blob,
+    )
+from dulwich.repo import (
+    MemoryRepo,
+    Repo,
+    )
+from dulwich.server import (
+    DictBackend,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
+from dulwich.web import (
+    HTTPGitRequestHandler,
+    make_wsgi_chain,
     )
 
 
@@ -85,6 +119,61 @@ class GitClientTests(TestCase):
         self.client.fetch_pack('bla', lambda heads: [], None, None, None)
         self.assertEqual(self.rout.getvalue(), '0000')
 
+    def test_fetch_pack_v2_none(self):
+        self.rin.write(''.join([
+            pkt_line('version 2\n'), pkt_line('ls-refs\n'),
+            pkt_line('fetch\n'), pkt_line(None),
+            pkt_line('%s refs/tags/v1 peeled:%s\n' % ('1' * 40, '2' * 40)),
+            pkt_line(None)]))
+        self.rin.seek(0)
+        refs = self.client.fetch_pack('bla', lambda heads: [], None, None,
+                                      None, ref_prefix=['refs/tags/'])
+        self.assertEqual({'refs/tags/v1': '1' * 40,
+                          'refs/tags/v1^{}': '2' * 40}, refs)
+        self.assertEqual(''.join([
+            pkt_line('command=ls-refs\n'), '0001', pkt_line('symrefs\n'),
+            pkt_line('peel\n'), pkt_line('ref-prefix refs/tags/\n'),
+            '0000', '0000']), self.rout.getvalue())
+
+    def test_fetch_pack_v2_unsupported_command(self):
+        self.rin.write(''.join([
+            pkt_line('version 2\n'), pkt_line('fetch\n'), pkt_line(None)]))
+        self.rin.seek(0)
+        self.assertRaises(GitProtocolError, self.client.fetch_pack, 'bla',
+                          lambda heads: [], None, None, None)
+
+    def test_fetch_pack_depth(self):
+        self.rin.write(''.join([
+            pkt_line('%s HEAD\x00side-band-64k shallow\n' % ('1' * 40)),
+            pkt_line(None), pkt_line('shallow %s\n' % ('1' * 40)),
+            pkt_line(None), pkt_line('NAK\n'), pkt_line('\x01PACK'),
+            pkt_line(None)]))
+        self.rin.seek(0)
+        graph_walker = MemoryRepo.init_bare([], {}).get_graph_walker()
+        data = []
+        self.client.fetch_pack('bla', lambda heads: heads.values(),
+                               graph_walker, data.append, None, depth=1)
+        self.assertEqual(['PACK'], data)
+        self.assertEqual(set(['1' * 40]), graph_walker.new_shallow)
+        self.assertEqual(''.join([
+            pkt_line('want %s side-band-64k shallow\n' % ('1' * 40)),
+            pkt_line('deepen 1\n'), '0000', pkt_line('done\n')]),
+            self.rout.getvalue())
+
+    def test_fetch_pack_depth_unsupported(self):
+        self.rin.write(''.join([
+            pkt_line('%s HEAD\x00side-band-64k\n' % ('1' * 40)),
+            pkt_line(None)]))
+        self.rin.seek(0)
+        graph_walker = MemoryRepo.init_bare([], {}).get_graph_walker()
+        self.assertRaises(GitProtocolError, self.client.fetch_pack, 'bla',
+                          lambda heads: heads.values(), graph_walker, None,
+                          None, depth=1)
+
+    def test_invalid_protocol_version(self):
+        self.assertRaises(ValueError, TCPGitClient, 'localhost',
+                          protocol_version=1)
+
     def test_get_transport_and_path_tcp(self):
         client, path = get_transport_and_path('git://foo.com/bar/baz')
         self.assertTrue(isinstance(client, TCPGitClient))
@@ -209,3 +298,328 @@ class ReportStatusParserTests(TestCase):
         parser.handle_packet("ok refs/foo/bar")
         parser.handle_packet(None)
         parser.check()
+
+
+class GetRefsManyTests(TestCase):
+
+    def serve(self, response):
+        """Start a server that sends a response to a single connection."""
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        requests = []
+        def serve():
+            conn, addr = listener.accept()
+            conn.settimeout(5)
+            requests.append(conn.recv(1024))
+            conn.sendall(response)
+            requests.append(conn.recv(1024))
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        self.addCleanup(thread.join)
+        return listener.getsockname(), requests
+
+    def test_refs(self):
+        (host, port), requests = self.serve(
+            pkt_line('%s HEAD\x00multi_ack thin-pack\n' % ('1' * 40)) +
+            pkt_line('%s refs/heads/master\n' % ('1' * 40)) +
+            pkt_line(None))
+        results = get_refs_many([(host, port, '/foo')], timeout=5)
+        self.assertEqual(
+            {(host, port, '/foo'):
+             {'HEAD': '1' * 40, 'refs/heads/master': '1' * 40}}, results)
+        self.assertEqual(
+            [pkt_line('git-upload-pack /foo\x00host=%s\x00' % host), '0000'],
+            requests)
+
+    def test_error(self):
+        (host, port), requests = self.serve(
+            pkt_line('ERR access denied') + pkt_line(None))
+        results = get_refs_many([(host, port, '/foo')], timeout=5)
+        self.assertTrue(
+            isinstance(results[(host, port, '/foo')], GitProtocolError))
+
+    def test_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        host, port = sock.getsockname()
+        sock.close()
+        results = get_refs_many([(host, port, '/foo')], timeout=5)
+        self.assertTrue(isinstance(results[(host, port, '/foo')], Exception))
+
+
+class HTTPConnectionPoolTests(TestCase):
+
+    def serve(self, protocol_version='HTTP/1.1', drop_reused=False):
+        """Start a server that advertises refs, recording its connections.
+
+        :param drop_reused: Whether to close connections when they are used
+            for a second request, without responding
+        """
+        connections = []
+        body = (pkt_line('# service=git-upload-pack\n') + pkt_line(None) +
+                pkt_line('%s HEAD\x00thin-pack\n' % ('1' * 40)) +
+                pkt_line(None))
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+                self.handled = 0
+
+            def do_GET(self):
+                if drop_reused and self.handled:
+                    self.close_connection = 1
+                    return
+                self.handled += 1
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'application/x-git-upload-pack-advertisement')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        Handler.protocol_version = protocol_version
+        server = SocketServer.ThreadingTCPServer(('localhost', 0), Handler)
+        server.daemon_threads = True
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        threading.Thread(target=server.serve_forever).start()
+        return 'http://localhost:%d/' % server.server_address[1], connections
+
+    def _get_refs(self, client):
+        return client.fetch_pack('/', lambda refs: [], None, None)
+
+    def test_reuse(self):
+        url, connections = self.serve()
+        client = HttpGitClient(url)
+        self.addCleanup(client.pool.close)
+        self.assertEqual({'HEAD': '1' * 40}, self._get_refs(client))
+        self.assertEqual({'HEAD': '1' * 40}, self._get_refs(client))
+        self.assertEqual(1, len(connections))
+
+    def test_shared(self):
+        url, connections = self.serve()
+        pool = HTTPConnectionPool()
+        self.addCleanup(pool.close)
+        self._get_refs(HttpGitClient(url, pool=pool))
+        self._get_refs(HttpGitClient(url, pool=pool))
+        self.assertEqual(1, len(connections))
+
+    def test_closed_by_server(self):
+        url, connections = self.serve('HTTP/1.0')
+        client = HttpGitClient(url)
+        self._get_refs(client)
+        self._get_refs(client)
+        self.assertEqual(2, len(connections))
+
+    def test_closed_when_reused(self):
+        url, connections = self.serve(drop_reused=True)
+        client = HttpGitClient(url)
+        self.addCleanup(client.pool.close)
+        self.assertEqual({'HEAD': '1' * 40}, self._get_refs(client))
+        self.assertEqual({'HEAD': '1' * 40}, self._get_refs(client))
+        self.assertEqual(2, len(connections))
+
+    def test_body_error(self):
+        url, connections = self.serve()
+        client = HttpGitClient(url, post_buffer=4)
+        self.addCleanup(client.pool.close)
+        conns = []
+        orig_get = client.pool.get
+        def get(key, connect):
+            conns.append(orig_get(key, connect))
+            return conns[-1]
+        client.pool.get = get
+        def write_body(write):
+            write('0000' * 4)
+            raise ValueError('broken body')
+        self.assertRaises(ValueError, client._smart_request,
+                          'git-upload-pack', url, write_body)
+        self.assertEqual(1, len(conns))
+        self.assertEqual(None, conns[0].sock)
+
+
+class HttpGitClientSendPackTests(TestCase):
+
+    def setUp(self):
+        super(HttpGitClientSendPackTests, self).setUp()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.target = Repo.init_bare(path)
+        self.requests = []
+        app = make_wsgi_chain(DictBackend({'/': self.target}))
+        def record(environ, start_response):
+            self.requests.append((environ['REQUEST_METHOD'],
+                environ.get('HTTP_TRANSFER_ENCODING'),
+                environ.get('HTTP_CONTENT_ENCODING')))
+            return app(environ, start_response)
+        server = simple_server.make_server('localhost', 0, record,
+            handler_class=HTTPGitRequestHandler)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        threading.Thread(target=server.serve_forever).start()
+        self.url = 'http://localhost:%d/' % server.server_address[1]
+        self.source = MemoryRepo.init_bare([], {})
+        # Random data does not compress, so the pack is larger than the blob
+        self.blob = make_object(Blob, data=os.urandom(8192))
+        self.commit, = build_commit_graph(self.source.object_store, [[1]],
+                                          trees={1: [('f', self.blob)]})
+
+    def _send_pack(self, client):
+        client.send_pack('/',
+            lambda refs: {'refs/heads/master': self.commit.id},
+            self.source.object_store.generate_pack_contents)
+        self.assertEqual(self.commit.id, self.target.refs['refs/heads/master'])
+        self.assertTrue(self.blob.id in self.target.object_store)
+
+    def test_send_pack(self):
+        self._send_pack(HttpGitClient(self.url))
+        self.assertEqual(('POST', None, None), self.requests[-1])
+
+    def test_send_pack_chunked(self):
+        self._send_pack(HttpGitClient(self.url, post_buffer=1024))
+        self.assertEqual(('POST', 'chunked', None), self.requests[-1])
+
+    def test_send_pack_gzip(self):
+        self._send_pack(HttpGitClient(self.url, post_buffer=1024,
+                                      gzip_requests=True))
+        self.assertEqual(('POST', 'chunked', 'gzip'), self.requests[-1])
+
+
+class ListGraphWalker(object):
+
+    def __init__(self, haves):
+        self.haves = list(haves)
+        self.acks = []
+
+    def next(self):
+        if self.haves:
+            return self.haves.pop(0)
+        return None
+
+    def ack(self, sha):
+        self.acks.append(sha)
+
+
+class StatelessNegotiatorTests(TestCase):
+
+    def setUp(self):
+        super(StatelessNegotiatorTests, self).setUp()
+        self.graph_walker = ListGraphWalker('%040d' % i for i in range(1000))
+        self.negotiator = _StatelessNegotiator(self.graph_walker)
+
+    def test_rounds(self):
+        self.assertEqual(32, len(self.negotiator.next_round()))
+        self.assertEqual(64, len(self.negotiator.next_round()))
+        self.assertEqual(128, len(self.negotiator.next_round()))
+        self.assertFalse(self.negotiator.done)
+
+    def test_exhausted(self):
+        negotiator = _StatelessNegotiator(ListGraphWalker(['1' * 40]))
+        self.assertEqual(['1' * 40], negotiator.next_round())
+        self.assertTrue(negotiator.done)
+
+    def test_single_round(self):
+        negotiator = _StatelessNegotiator(ListGraphWalker(['1' * 40] * 1000),
+                                          batch_size=None)
+        self.assertEqual(1000, len(negotiator.next_round()))
+        self.assertTrue(negotiator.done)
+
+    def test_ack(self):
+        haves = self.negotiator.next_round()
+        self.negotiator.ack(haves[3])
+        self.negotiator.ack(haves[3])
+        self.assertEqual([haves[3]], self.negotiator.common)
+        self.assertEqual([haves[3]], self.graph_walker.acks)
+
+    def test_ready(self):
+        haves = self.negotiator.next_round()
+        self.negotiator.ack(haves[3], ready=True)
+        self.assertEqual([], self.negotiator.next_round())
+        self.assertTrue(self.negotiator.done)
+
+    def test_in_vain(self):
+        self.negotiator.ack(self.negotiator.next_round()[0])
+        self.negotiator.next_round()
+        self.negotiator.next_round()
+        self.negotiator.next_round()
+        self.assertFalse(self.negotiator.done)
+        # More than MAX_IN_VAIN haves without a new common commit
+        self.assertEqual([], self.negotiator.next_round())
+        self.assertTrue(self.negotiator.done)
+
+
+class HttpGitClientFetchPackTests(TestCase):
+
+    def setUp(self):
+        super(HttpGitClientFetchPackTests, self).setUp()
+        # The remote repository has 300 commits; the local one has the first
+        # 200 of them, with 100 commits of its own on top.
+        store = MemoryRepo.init_bare([], {}).object_store
+        spec = [[1]] + [[i, i - 1] for i in range(2, 301)]
+        spec += [[301, 200]] + [[i, i - 1] for i in range(302, 401)]
+        commits = build_commit_graph(store, spec)
+        self.remote = MemoryRepo.init_bare([], {})
+        self.remote.refs['refs/heads/master'] = commits[299].id
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.local = Repo.init_bare(path)
+        self.local.refs['refs/heads/master'] = commits[-1].id
+        local_commits = commits[:200] + commits[300:]
+        for repo, repo_commits in [(self.remote, commits[:300]),
+                                   (self.local, local_commits)]:
+            for commit in repo_commits:
+                repo.object_store.add_object(commit)
+                repo.object_store.add_object(store[commit.tree])
+        self.head = commits[299].id
+        self.requests = []
+        app = make_wsgi_chain(DictBackend({'/': self.remote}))
+        def record(environ, start_response):
+            if environ['REQUEST_METHOD'] == 'POST':
+                self.requests.append(environ['PATH_INFO'])
+            return app(environ, start_response)
+        server = simple_server.make_server('localhost', 0, record,
+            handler_class=HTTPGitRequestHandler)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        threading.Thread(target=server.serve_forever).start()
+        self.client = HttpGitClient('http://localhost:%d/' %
+                                    server.server_address[1])
+        self.addCleanup(self.client.pool.close)
+
+    def _fetch(self, graph_walker):
+        data = []
+        self.client.fetch_pack('/', lambda refs: [self.head], graph_walker,
+                               data.append)
+        data = ''.join(data)
+        self.assertEqual('PACK', data[:4])
+        # Return the number of objects in the pack
+        return struct.unpack('>L', data[8:12])[0]
+
+    def test_rounds(self):
+        # The 100 missing commits and their tree
+        self.assertEqual(101, self._fetch(self.local.get_graph_walker()))
+        # 32 + 64 haves are in vain, the third round of 128 haves finds the
+        # common commit and the last request says done.
+        self.assertEqual(4, len(self.requests))
+
+    def test_skipping(self):
+        num_objects = self._fetch(self.local.object_store.get_graph_walker(
+            [self.local.head()], skipping=True))
+        # All haves fit in the first request
+        self.assertEqual(1, len(self.requests))
+        # Commits that were skipped over are sent again
+        self.assertTrue(101 < num_objects < 301, num_objects)
+
+    def test_single_ack(self):
+        self.client._fetch_capabilities.difference_update(
+            ['multi_ack', 'multi_ack_detailed'])
+        self.assertEqual(101, self._fetch(self.local.get_graph_walker()))
+        self.assertEqual(1, len(self.requests))
@@ -0,0 +1,123 @@
+# test_commit_graph.py -- Tests for reading and writing commit-graph files
+# Copyright (C) 2013 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for reading and writing commit-graph files."""
+
+from cStringIO import StringIO
+
+from dulwich.commit_graph import (
+    CommitGraph,
+    CommitGraphEntry,
+    write_commit_graph,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.object_store import (
+    MemoryObjectStore,
+    )
+from dulwich.tests import TestCase
+from utils import (
+    build_commit_graph,
+    )
+
+
+class CommitGraphTests(TestCase):
+
+    def setUp(self):
+        super(CommitGraphTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.commits = build_commit_graph(self.store,
+            [[1], [2, 1], [3, 1], [4, 2, 3], [5], [6, 4, 2, 5, 3]])
+
+    def make_graph(self, commits=None):
+        if commits is None:
+            commits = self.commits
+        f = StringIO()
+        write_commit_graph(f, [(c.id, c.tree, c.parents, c.commit_time)
+                               for c in commits])
+        return CommitGraph('commit-graph', file=StringIO(f.getvalue()))
+
+    def test_empty(self):
+        graph = self.make_graph([])
+        self.assertEqual(0, len(graph))
+        self.assertEqual([], list(graph.iterentries()))
+        graph.check()
+
+    def test_entries(self):
+        graph = self.make_graph()
+        self.assertEqual(6, len(graph))
+        self.assertEqual(sorted(c.id for c in self.commits), list(graph))
+        c1, c2, c3, c4, c5, c6 = self.commits
+        generations = {c1.id: 1, c2.id: 2, c3.id: 2, c4.id: 3, c5.id: 1,
+                       c6.id: 4}
+        for c in self.commits:
+            self.assertTrue(c.id in graph)
+            self.assertEqual(
+                CommitGraphEntry(c.id, c.tree, c.parents, generations[c.id],
+                                 c.commit_time),
+                graph.get_entry(c.id))
+        self.assertEqual(sorted(generations.iteritems()),
+            [(e.commit_id, e.generation) for e in graph.iterentries()])
+
+    def test_octopus(self):
+        graph = self.make_graph()
+        c6 = self.commits[5]
+        self.assertEqual(4, len(c6.parents))
+        self.assertEqual(c6.parents, graph.get_parents(c6.id))
+
+    def test_lookup_binary(self):
+        graph = self.make_graph()
+        c2 = self.commits[1]
+        self.assertEqual(c2.parents, graph.get_parents(c2.sha().digest()))
+        self.assertEqual(c2.commit_time,
+                         graph.get_commit_time(c2.sha().digest()))
+        self.assertEqual(2, graph.get_generation(c2.id))
+
+    def test_missing(self):
+        graph = self.make_graph(self.commits[:3])
+        c4 = self.commits[3]
+        self.assertFalse(c4.id in graph)
+        self.assertRaises(KeyError, graph.get_parents, c4.id)
+        self.assertRaises(KeyError, graph.get_commit_time, c4.id)
+
+    def test_missing_parent(self):
+        c = self.commits[1]
+        self.assertRaises(ValueError, write_commit_graph, StringIO(),
+                          [(c.id, c.tree, c.parents, c.commit_time)])
+
+    def test_large_commit_time(self):
+        c = self.commits[0]
+        f = StringIO()
+        write_commit_graph(f, [(c.id, c.tree, [], 0x2ffffffff)])
+        graph = CommitGraph('commit-graph', file=StringIO(f.getvalue()))
+        self.assertEqual(0x2ffffffff, graph.get_commit_time(c.id))
+
+    def test_check(self):
+        f = StringIO()
+        write_commit_graph(f, [(c.id, c.tree, c.parents, c.commit_time)
+                               for c in self.commits])
+        data = f.getvalue()
+        CommitGraph('commit-graph', file=StringIO(data)).check()
+        data = data[:-21] + chr(ord(data[-21]) ^ 1) + data[-20:]
+        graph = CommitGraph('commit-graph', file=StringIO(data))
+        self.assertRaises(ChecksumMismatch, graph.check)
+
+    def test_not_commit_graph(self):
+        self.assertRaises(AssertionError, CommitGraph, 'commit-graph',
+                          file=StringIO('PACK' + '\0' * 40))
@@ -17,7 +17,11 @@
 # MA  02110-1301, USA.
 
 from dulwich.object_store import (
+    BlobLimitFilter,
+    BlobNoneFilter,
     MemoryObjectStore,
+    TreeDepthFilter,
+    parse_object_filter,
     )
 from dulwich.objects import (
     Blob,
@@ -39,8 +43,10 @@ class MissingObjectFinderTest(TestCase):
     def cmt(self, n):
         return self.commits[n-1]
 
-    def assertMissingMatch(self, haves, wants, expected):
-        for sha, path in self.store.find_missing_objects(haves, wants):
+    def assertMissingMatch(self, haves, wants, expected, object_filter=None,
+                           shallow=None):
+        for sha, path in self.store.find_missing_objects(haves, wants,
+                object_filter=object_filter, shallow=shallow):
             self.assertTrue(sha in expected,
                 "(%s,%s) erroneously reported as missing" % (sha, path))
             expected.remove(sha)
@@ -58,6 +64,7 @@ class MOFLinearRepoTest(MissingObjectFinderTest):
         f2_2 = make_object(Blob, data='f2-changed')
         f2_3 = make_object(Blob, data='f2-changed-again')
         f3_2 = make_object(Blob, data='f3') # added in 2, left unmodified in 3
+        self.f1_1, self.f2_1, self.f2_2 = f1_1, f2_1, f2_2
 
         commit_spec = [[1], [2, 1], [3, 2]]
         trees = {1: [('f1', f1_1), ('f2', f2_1)],
@@ -75,6 +82,7 @@ class MOFLinearRepoTest(MissingObjectFinderTest):
             self.cmt(2).id, self.cmt(3).id,
             self.cmt(2).tree, self.cmt(3).tree,
             f2_2.id, f3_2.id, f2_3.id]
+        self.shallow_3 = [self.cmt(3).id, self.cmt(3).tree, f2_3.id, f3_2.id]
 
     def test_1_to_2(self):
         self.assertMissingMatch([self.cmt(1).id], [self.cmt(2).id],
@@ -107,6 +115,19 @@ class MOFLinearRepoTest(MissingObjectFinderTest):
     def test_no_changes(self):
         self.assertMissingMatch([self.cmt(3).id], [self.cmt(3).id], [])
 
+    def test_shallow(self):
+        self.assertMissingMatch([], [self.cmt(3).id], self.shallow_3,
+                                shallow=set([self.cmt(3).id]))
+
+    def test_unshallow(self):
+        # The receiving side only has the last commit and deepens it
+        missing = [self.cmt(1).id, self.cmt(2).id, self.cmt(1).tree,
+                   self.cmt(2).tree, self.f1_1.id, self.f2_1.id, self.f2_2.id]
+        self.assertEqual(sorted(missing), sorted(sha for sha, path in
+            self.store.find_missing_objects([self.cmt(3).id],
+                [self.cmt(3).id], shallow=set(),
+                client_shallow=set([self.cmt(3).id]))))
+
 
 class MOFMergeForkRepoTest(MissingObjectFinderTest):
     # 1 --- 2 --- 4 --- 6 --- 7
@@ -191,3 +212,86 @@ class MOFMergeForkRepoTest(MissingObjectFinderTest):
               self.cmt(7).id, self.cmt(6).id, self.cmt(4).id,
               self.cmt(7).tree, self.cmt(6).tree, self.cmt(4).tree,
               self.f1_4_id])
+
+
+class MOFFilterTest(MissingObjectFinderTest):
+    # commit 1: a, dir/bb, dir/sub/c
+    # commit 2: a, sub/c, where sub is the same tree as dir/sub in commit 1
+
+    def setUp(self):
+        super(MOFFilterTest, self).setUp()
+        self.a = make_object(Blob, data='a')
+        self.bb = make_object(Blob, data='bb')
+        self.c = make_object(Blob, data='c')
+        trees = {1: [('a', self.a), ('dir/bb', self.bb),
+                     ('dir/sub/c', self.c)],
+                 2: [('a', self.a), ('sub/c', self.c)]}
+        self.commits = build_commit_graph(self.store, [[1], [2, 1]], trees)
+        root1 = self.store[self.cmt(1).tree]
+        self.dir = root1['dir'][1]
+        self.sub = self.store[self.dir]['sub'][1]
+        self.assertEqual(self.sub, self.store[self.cmt(2).tree]['sub'][1])
+
+    def _base(self):
+        return [self.cmt(1).id, self.cmt(2).id]
+
+    def _trees(self):
+        return [self.cmt(1).tree, self.cmt(2).tree, self.dir, self.sub]
+
+    def test_blob_none(self):
+        self.assertMissingMatch([], [self.cmt(2).id],
+            self._base() + self._trees(), BlobNoneFilter())
+
+    def test_blob_limit(self):
+        self.assertMissingMatch([], [self.cmt(2).id],
+            self._base() + self._trees() + [self.a.id, self.c.id],
+            BlobLimitFilter(2))
+
+    def test_tree_0(self):
+        self.assertMissingMatch([], [self.cmt(2).id], self._base(),
+            TreeDepthFilter(0))
+
+    def test_tree_1(self):
+        self.assertMissingMatch([], [self.cmt(2).id],
+            self._base() + [self.cmt(1).tree, self.cmt(2).tree],
+            TreeDepthFilter(1))
+
+    def test_tree_smallest_depth(self):
+        # sub is reachable at depth 1 from commit 2, and c at depth 2
+        self.assertMissingMatch([], [self.cmt(2).id],
+            self._base() + self._trees() + [self.a.id],
+            TreeDepthFilter(2))
+        self.assertMissingMatch([], [self.cmt(2).id],
+            self._base() + self._trees() + [self.a.id, self.bb.id, self.c.id],
+            TreeDepthFilter(3))
+
+    def test_haves(self):
+        self.assertMissingMatch([self.cmt(1).id], [self.cmt(2).id],
+            [self.cmt(2).id, self.cmt(2).tree], BlobNoneFilter())
+
+    def test_want_blob(self):
+        # Objects asked for directly are sent regardless of the filter
+        self.assertMissingMatch([], [self.bb.id], [self.bb.id],
+            BlobNoneFilter())
+        self.assertMissingMatch([], [self.dir], [self.dir, self.sub],
+            BlobNoneFilter())
+
+
+class ParseObjectFilterTests(TestCase):
+
+    def test_blob_none(self):
+        self.assertTrue(isinstance(parse_object_filter('blob:none'),
+                                   BlobNoneFilter))
+
+    def test_blob_limit(self):
+        self.assertEqual(100, parse_object_filter('blob:limit=100').limit)
+        self.assertEqual(2048, parse_object_filter('blob:limit=2k').limit)
+        self.assertEqual(1024 ** 2, parse_object_filter('blob:limit=1m').limit)
+
+    def test_tree(self):
+        self.assertEqual(3, parse_object_filter('tree:3').depth)
+
+    def test_invalid(self):
+        for spec in ['blob:limit=', 'blob:limit=x', 'tree:-1', 'sparse:oid=x',
+                     'combine:blob:none+tree:0']:
+            self.assertRaises(ValueError, parse_object_filter, spec)
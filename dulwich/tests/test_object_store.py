@@ -23,6 +23,7 @@ from cStringIO import StringIO
 import os
 import shutil
 import tempfile
+import time
 
 from dulwich.index import (
     commit_tree,
@@ -31,9 +32,11 @@ from dulwich.errors import (
     NotTreeError,
     )
 from dulwich.objects import (
+    hex_to_sha,
     sha_to_hex,
     object_class,
     Blob,
+    Commit,
     Tag,
     Tree,
     TreeEntry,
@@ -41,11 +44,20 @@ from dulwich.objects import (
 from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
+    MissingObjectFinder,
     ObjectStoreGraphWalker,
+    ObjectStoreIterator,
+    SkippingGraphWalker,
+    _LOOSE,
+    _geometric_rollup,
     tree_lookup_path,
     )
 from dulwich.pack import (
+    OFS_DELTA,
+    Pack,
     REF_DELTA,
+    UnpackedObject,
+    write_pack_data,
     write_pack_objects,
     )
 from dulwich.tests import (
@@ -53,6 +65,7 @@ from dulwich.tests import (
     )
 from dulwich.tests.utils import (
     make_object,
+    build_commit_graph,
     build_pack,
     )
 
@@ -79,6 +92,23 @@ class ObjectStoreTests(object):
     def test_contains_nonexistant(self):
         self.assertFalse(("a" * 40) in self.store)
 
+    def test_contains_many(self):
+        self.store.add_object(testobject)
+        self.assertEqual(set([testobject.id]),
+            self.store.contains_many([testobject.id, "a" * 40]))
+        self.assertEqual(set(), self.store.contains_many([]))
+
+    def test_generate_pack_data_deltas(self):
+        blobs = [make_object(Blob, data="common line\n" * 20 + "%d\n" % i)
+                 for i in range(3)]
+        for blob in blobs:
+            self.store.add_object(blob)
+        records = list(self.store.generate_pack_data(
+            [(b.id, 'a') for b in blobs]))
+        self.assertEqual(sorted(b.sha().digest() for b in blobs),
+                         sorted(r[1] for r in records))
+        self.assertEqual(2, len([r for r in records if r[2] is not None]))
+
     def test_add_objects_empty(self):
         self.store.add_objects([])
 
@@ -188,6 +218,12 @@ class ObjectStoreTests(object):
         self.assertEqual((Blob.type_num, 'yummy data'),
                          self.store.get_raw(testobject.id))
 
+    def test_get_object_header(self):
+        self.store.add_object(testobject)
+        self.assertEqual((Blob.type_num, len('yummy data')),
+                         self.store.get_object_header(testobject.id))
+        self.assertRaises(KeyError, self.store.get_object_header, 'a' * 40)
+
 
 class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
 
@@ -215,6 +251,14 @@ class PackBasedObjectStoreTests(ObjectStoreTests):
         self.assertNotEquals([], self.store.packs)
         self.assertEqual(0, self.store.pack_loose_objects())
 
+    def test_contains_many_packed_and_loose(self):
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.store.add_object(b2)
+        self.assertEqual(set([b1.id, b2.id]),
+            self.store.contains_many([b1.id, b2.id, "a" * 40]))
+
 
 class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
 
@@ -240,6 +284,105 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         self.assertIn(b2.id, store)
         self.assertEqual(b2, store[b2.id])
 
+    def test_loose_objects(self):
+        blobs = [make_object(Blob, data="loose %d" % i) for i in range(300)]
+        for b in blobs[:-1]:
+            self.store.add_object(b)
+        missing = blobs[-1]
+        self.assertTrue(self.store.contains_loose(blobs[0].id))
+        self.assertFalse(self.store.contains_loose(missing.id))
+        # Enough objects for several to share a fan-out directory
+        self.assertEqual(set(b.id for b in blobs[:-1]),
+                         self.store.contains_many(b.id for b in blobs))
+        self.assertEqual(set(),
+                         self.store.contains_many(["ff" + "1" * 38]))
+        self.assertEqual((Blob.type_num, "loose 0"),
+                         self.store.get_raw(blobs[0].id))
+        self.assertEqual(blobs[0], self.store[blobs[0].id])
+        self.assertRaises(KeyError, self.store.get_raw, missing.id)
+
+    def test_missing_object_cache(self):
+        b1 = make_object(Blob, data="one")
+        b2 = make_object(Blob, data="two")
+        self.assertRaises(KeyError, self.store.get_raw, b1.id)
+        self.assertFalse(b2.id in self.store)
+        self.assertTrue(hex_to_sha(b1.id) in self.store._missing_objects)
+        # Loose objects are always checked
+        self.store.add_object(b1)
+        self.assertEqual(b1, self.store[b1.id])
+        # Packs added by another store are noticed through the pack
+        # directory.
+        other = DiskObjectStore(self.store_dir)
+        other.add_objects([(b2, None)])
+        self.addCleanup(self.close_packs, other)
+        os.utime(self.store.pack_dir, (0, time.time() + 10))
+        self.assertTrue(b2.id in self.store)
+        self.assertEqual(b2, self.store[b2.id])
+        self.addCleanup(self.close_packs, self.store)
+
+    def test_pack_loose_objects_inflates_once(self):
+        blobs = [make_object(Blob, data='common data\n' * 20 + str(i))
+                 for i in range(3)]
+        for b in blobs:
+            self.store.add_object(b)
+        reads = []
+        get_raw = self.store.get_raw
+        def counting_get_raw(sha):
+            reads.append(sha)
+            return get_raw(sha)
+        self.store.get_raw = counting_get_raw
+        self.assertEqual(3, self.store.pack_loose_objects())
+        self.assertEqual(sorted(b.id for b in blobs), sorted(reads))
+        for b in blobs:
+            self.assertEqual(b, self.store[b.id])
+
+    def test_get_object_header_without_inflating(self):
+        f, commit = self.store.add_pack()
+        entries = build_pack(f, [
+          (Blob.type_num, 'common data\n' * 20),
+          (OFS_DELTA, (0, 'common data\n' * 20 + 'more\n')),
+          ])
+        commit()
+        loose = make_object(Blob, data='loose data')
+        self.store.add_object(loose)
+        # Neither packed nor loose objects are inflated
+        self.addCleanup(setattr, Pack, 'get_raw_at', Pack.get_raw_at)
+        Pack.get_raw_at = None
+        self.store._get_loose_raw = None
+        for offset, type_num, data, sha, crc32 in entries:
+            self.assertEqual((Blob.type_num, len(data)),
+                             self.store.get_object_header(sha_to_hex(sha)))
+        self.assertEqual((Blob.type_num, len('loose data')),
+                         self.store.get_object_header(loose.id))
+
+    def test_object_location_cache(self):
+        b = make_object(Blob, data="moving")
+        self.store.add_object(b)
+        self.assertEqual(b, self.store[b.id])
+        self.assertEqual(_LOOSE,
+                         self.store._object_locations[hex_to_sha(b.id)])
+        # The object is packed without the store noticing
+        other = DiskObjectStore(self.store_dir)
+        other.pack_loose_objects()
+        self.addCleanup(self.close_packs, other)
+        self.assertEqual(b, self.store[b.id])
+        pack, offset = self.store._object_locations[hex_to_sha(b.id)]
+        self.addCleanup(pack.close)
+        self.assertEqual((Blob.type_num, "moving"), self.store.get_raw(b.id))
+
+    def test_pack_loose_objects_threads(self):
+        store = DiskObjectStore(self.store_dir, pack_compression_level=9,
+                                pack_threads=2)
+        blobs = [make_object(Blob, data=("blob %d\n" % i) * 2000)
+                 for i in range(5)]
+        for b in blobs:
+            store.add_object(b)
+        self.assertEqual(5, store.pack_loose_objects())
+        self.assertEqual(1, len(store.packs))
+        for b in blobs:
+            self.assertFalse(store.contains_loose(b.id))
+            self.assertEqual(b, store[b.id])
+
     def test_add_alternate_path(self):
         store = DiskObjectStore(self.store_dir)
         self.assertEqual([], store._read_alternate_paths())
@@ -286,6 +429,403 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
 
             pack.close()
 
+    def test_add_thin_pack_parallel(self):
+        o = DiskObjectStore(self.store_dir, index_processes=2)
+        blob = make_object(Blob, data='yummy data')
+        o.add_object(blob)
+
+        f = StringIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'other data'),
+          (OFS_DELTA, (0, 'other yummy data')),
+          (REF_DELTA, (blob.id, 'more yummy data')),
+          ], store=o)
+        pack = o.add_thin_pack(f.read, None)
+        try:
+            pack.check_length_and_checksum()
+            self.assertEqual(
+                sorted([blob.id] + [sha_to_hex(e[3]) for e in entries]),
+                list(pack))
+            self.assertEqual((Blob.type_num, 'more yummy data'),
+                             o.get_raw(entries[2][3]))
+        finally:
+            for p in o._pack_cache or []:
+                p.close()
+            pack.close()
+
+    def test_add_pack_parallel(self):
+        o = DiskObjectStore(self.store_dir, index_processes=2)
+        f, commit = o.add_pack()
+        blobs = [make_object(Blob, data="common data\n" * 10 + str(i))
+                 for i in range(5)]
+        write_pack_objects(f, [(b, None) for b in blobs])
+        pack = commit()
+        try:
+            self.assertEqual(sorted(b.id for b in blobs), list(pack))
+            for b in blobs:
+                self.assertEqual(b, o[b.id])
+        finally:
+            for p in o._pack_cache or []:
+                p.close()
+            pack.close()
+
+    def test_write_multi_pack_index(self):
+        o = DiskObjectStore(self.store_dir)
+        self.assertEqual(None, o.write_multi_pack_index())
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        b3 = make_object(Blob, data="even more yummy data")
+        o.add_objects([(b1, None)])
+        o.add_objects([(b1, None), (b2, None)])
+        midx = o.write_multi_pack_index()
+        self.addCleanup(midx.close)
+        self.assertEqual(2, len(midx.pack_names))
+        self.assertEqual(2, len(midx))
+        self.assertEqual([], o._unindexed_packs)
+        o.add_objects([(b3, None)])
+        self.assertEqual(1, len(o._unindexed_packs))
+        for b in (b1, b2, b3):
+            self.assertEqual(b, o[b.id])
+            self.assertTrue(o.contains_packed(b.id))
+        self.assertEqual(set([b1.id, b2.id, b3.id]),
+            o.contains_many([b1.id, b2.id, b3.id, "a" * 40]))
+        self.assertFalse(o.contains_packed("a" * 40))
+
+        reopened = DiskObjectStore(self.store_dir)
+        self.assertEqual(3, len(reopened.packs))
+        self.addCleanup(reopened._multi_pack_index.close)
+        self.assertEqual(2, len(reopened._multi_pack_index.pack_names))
+        self.assertEqual(b2, reopened[b2.id])
+        for p in reopened.packs:
+            p.close()
+
+    def test_multi_pack_index_missing_pack(self):
+        o = DiskObjectStore(self.store_dir)
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        o.add_objects([(b1, None)])
+        pack = o.add_objects([(b2, None)])
+        o.write_multi_pack_index().close()
+        pack.close()
+        os.remove(pack._data_path)
+        os.remove(pack._idx_path)
+        store = DiskObjectStore(self.store_dir)
+        self.assertEqual(1, len(store.packs))
+        self.assertEqual(None, store._multi_pack_index)
+        self.assertEqual(b1, store[b1.id])
+        self.assertRaises(KeyError, store.__getitem__, b2.id)
+        for p in store.packs:
+            p.close()
+
+
+    def test_generate_pack_data(self):
+        o = DiskObjectStore(self.store_dir)
+        f, commit = o.add_pack()
+        entries = build_pack(f, [
+          (Blob.type_num, 'common data\n' * 20),
+          (OFS_DELTA, (0, 'common data\n' * 20 + 'more\n')),
+          ])
+        pack = commit()
+        self.addCleanup(pack.close)
+        base, delta = [sha_to_hex(e[3]) for e in entries]
+        loose = make_object(Blob, data='loose data')
+        o.add_object(loose)
+
+        records = list(o.generate_pack_data(
+            [(base, None), (delta, None), (loose.id, 'a')]))
+        self.assertEqual([True, True, False],
+            [isinstance(r, UnpackedObject) for r in records])
+        self.assertEqual(OFS_DELTA, records[1].pack_type_num)
+        f = StringIO()
+        write_pack_data(f, len(records), records)
+        f.seek(0)
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        target = DiskObjectStore.init(target_dir)
+        self.addCleanup(target.add_thin_pack(f.read, None).close)
+        for sha in (base, delta, loose.id):
+            self.assertEqual(o[sha], target[sha])
+
+        # Deltas against objects that are not sent are not reused
+        records = list(o.generate_pack_data([(delta, None)]))
+        self.assertEqual(1, len(records))
+        self.assertFalse(isinstance(records[0], UnpackedObject))
+
+    def make_bitmapped_store(self):
+        o = DiskObjectStore(self.store_dir)
+        blobs = [make_object(Blob, data="blob %d" % i) for i in range(4)]
+        trees = {
+            1: [('a', blobs[0]), ('d/b', blobs[1])],
+            2: [('a', blobs[0]), ('d/b', blobs[2])],
+            3: [('a', blobs[3]), ('d/b', blobs[1])],
+            4: [('a', blobs[3]), ('d/b', blobs[2])],
+            }
+        commits = build_commit_graph(o, [[1], [2, 1], [3, 1], [4, 2, 3]],
+                                     trees)
+        tag = make_object(Tag, name="v1", message="v1", tag_time=0,
+                          tag_timezone=0, tagger="Foo <foo@example.com>",
+                          object=(Commit, commits[1].id))
+        o.add_object(tag)
+        o.pack_loose_objects()
+        self.addCleanup(self.close_packs, o)
+        return o, [c.id for c in commits], tag.id
+
+    def close_packs(self, store):
+        for p in store.packs:
+            p.close()
+
+    def assertMissingObjects(self, store, haves, wants, get_tagged=None):
+        expected = MissingObjectFinder(store, haves, wants, None, get_tagged)
+        self.assertEqual(
+            sorted(sha for (sha, path) in iter(expected.next, None)),
+            sorted(sha for (sha, path) in
+                   store.find_missing_objects(haves, wants, None, get_tagged)))
+
+    def test_write_pack_bitmap(self):
+        o, commits, tag = self.make_bitmapped_store()
+        pack = o.packs[0]
+        self.assertEqual(None, pack.bitmap)
+        bitmap = o.write_pack_bitmap(pack, [commits[3]], interval=2)
+        self.assertEqual(2, len(bitmap.commit_bitmaps))
+        self.assertTrue(hex_to_sha(commits[3]) in bitmap.commit_bitmaps)
+        self.assertEqual([4, 6, 4, 1],
+            [bin(bits).count('1') for bits in bitmap.type_bitmaps])
+        # Everything but the tag is reachable from the last commit
+        self.assertEqual(len(pack) - 1,
+            bin(bitmap.commit_bitmaps[hex_to_sha(commits[3])]).count('1'))
+        reopened = DiskObjectStore(self.store_dir)
+        self.addCleanup(self.close_packs, reopened)
+        self.assertEqual(bitmap.commit_bitmaps,
+                         reopened.packs[0].bitmap.commit_bitmaps)
+
+    def test_find_missing_objects_bitmap(self):
+        o, commits, tag = self.make_bitmapped_store()
+        o.write_pack_bitmap(o.packs[0], [commits[3]])
+        get_tagged = lambda: {commits[1]: tag}
+        self.assertMissingObjects(o, [], [commits[3]])
+        self.assertMissingObjects(o, [commits[0]], [commits[3]])
+        self.assertMissingObjects(o, [commits[1], "a" * 40], [commits[2]])
+        self.assertMissingObjects(o, [commits[2]], [commits[3]], get_tagged)
+        self.assertMissingObjects(o, [commits[0]], [commits[3]], get_tagged)
+        self.assertMissingObjects(o, [commits[3]], [commits[3]])
+        self.assertMissingObjects(o, [commits[0]], [tag])
+
+    def test_find_missing_objects_bitmap_loose(self):
+        o, commits, tag = self.make_bitmapped_store()
+        o.write_pack_bitmap(o.packs[0], [commits[3]])
+        blob = make_object(Blob, data="loose blob")
+        tree = Tree()
+        tree.add("a", 0100644, blob.id)
+        commit = make_object(Commit, tree=tree.id, parents=[commits[3]],
+                             author="Foo <foo@example.com>",
+                             committer="Foo <foo@example.com>",
+                             commit_time=0, commit_timezone=0,
+                             author_time=0, author_timezone=0,
+                             message="loose")
+        for obj in [blob, tree, commit]:
+            o.add_object(obj)
+        self.assertMissingObjects(o, [commits[2]], [commit.id])
+        self.assertMissingObjects(o, [commit.id], [commits[3]])
+
+    def test_write_commit_graph(self):
+        self.assertEqual(None, self.store.get_commit_graph())
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 1, 2]])
+        graph = self.store.write_commit_graph([c3.id])
+        self.addCleanup(graph.close)
+        self.assertEqual(sorted([c1.id, c2.id, c3.id]), list(graph))
+        self.assertEqual(3, graph.get_generation(c3.id))
+        graph.check()
+        # Parents and commit times no longer require the commits themselves
+        for c in [c1, c2, c3]:
+            os.remove(os.path.join(self.store.path, c.id[:2], c.id[2:]))
+        self.assertEqual([c1.id, c2.id], self.store.get_parents(c3.id))
+        self.assertEqual(c2.commit_time, self.store.get_commit_time(c2.id))
+        reopened = DiskObjectStore(self.store_dir)
+        self.addCleanup(reopened.get_commit_graph().close)
+        self.assertEqual([c1.id], reopened.get_parents(c2.id))
+        self.assertEqual(set([c1.id, c2.id, c3.id]),
+                         reopened._collect_ancestors([c3.id])[0])
+
+    def test_write_commit_graph_incremental(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        self.store.write_commit_graph([c2.id])
+        os.remove(os.path.join(self.store.path, c1.id[:2], c1.id[2:]))
+        c3, = build_commit_graph(self.store, [[3]])
+        c4 = make_object(Commit, tree=c3.tree, parents=[c2.id, c3.id],
+                         author="Foo <foo@example.com>",
+                         committer="Foo <foo@example.com>",
+                         commit_time=400, commit_timezone=0,
+                         author_time=400, author_timezone=0,
+                         message="merge")
+        self.store.add_object(c4)
+        graph = self.store.write_commit_graph([c4.id])
+        self.addCleanup(graph.close)
+        self.assertEqual(4, len(graph))
+        self.assertEqual(3, graph.get_generation(c4.id))
+        self.assertEqual(c1.commit_time, graph.get_commit_time(c1.id))
+
+    def add_blob_packs(self, store, *counts):
+        blobs = []
+        for count in counts:
+            new = [make_object(Blob, data="packed %d" % (len(blobs) + i))
+                   for i in range(count)]
+            store.add_objects([(b, None) for b in new])
+            blobs.extend(new)
+        return blobs
+
+    def test_repack(self):
+        blobs = self.add_blob_packs(self.store, 2, 3)
+        loose = make_object(Blob, data="loose")
+        self.store.add_object(loose)
+        # Duplicates are only written once
+        self.store.add_objects([(blobs[0], None)])
+        self.assertEqual(3, len(self.store.packs))
+        pack = self.store.repack()
+        self.addCleanup(self.close_packs, self.store)
+        self.assertEqual([pack._basename],
+                         [p._basename for p in self.store.packs])
+        self.assertEqual(6, len(pack))
+        self.assertFalse(self.store.contains_loose(loose.id))
+        for b in blobs + [loose]:
+            self.assertEqual(b, self.store[b.id])
+        self.assertEqual(None, self.store.repack())
+
+    def test_repack_heads(self):
+        o, commits, tag = self.make_bitmapped_store()
+        garbage = self.add_blob_packs(o, 2)
+        loose_garbage = make_object(Blob, data="loose garbage")
+        o.add_object(loose_garbage)
+        loose_commit, = build_commit_graph(o, [[5]])
+        pack = o.repack(heads=[commits[3], tag, loose_commit.id])
+        self.assertEqual(1, len(o.packs))
+        for b in garbage:
+            self.assertFalse(b.id in o)
+        # Unreachable loose objects are kept, as they may be about to be
+        # referenced.
+        self.assertTrue(o.contains_loose(loose_garbage.id))
+        self.assertFalse(o.contains_loose(loose_commit.id))
+        self.assertEqual(loose_commit, o[loose_commit.id])
+        self.assertTrue(hex_to_sha(commits[3]) in pack.bitmap.commit_bitmaps)
+
+    def test_repack_keep(self):
+        blobs = self.add_blob_packs(self.store, 1, 1, 1)
+        kept = self.store.packs[0]
+        kept.keep()
+        self.store.repack()
+        self.addCleanup(self.close_packs, self.store)
+        self.assertEqual(2, len(self.store.packs))
+        self.assertTrue(kept._basename in
+                        [p._basename for p in self.store.packs])
+        self.assertEqual([1, 2], sorted(len(p) for p in self.store.packs))
+        for b in blobs:
+            self.assertEqual(b, self.store[b.id])
+
+    def test_repack_geometric(self):
+        blobs = self.add_blob_packs(self.store, 1, 1, 20)
+        big = [p for p in self.store.packs if len(p) == 20][0]
+        self.store.repack(geometric=2)
+        self.addCleanup(self.close_packs, self.store)
+        self.assertEqual([2, 20], sorted(len(p) for p in self.store.packs))
+        self.assertTrue(big._basename in
+                        [p._basename for p in self.store.packs])
+        self.assertEqual(None, self.store.repack(geometric=2))
+        for b in blobs:
+            self.assertEqual(b, self.store[b.id])
+        self.assertRaises(ValueError, self.store.repack, heads=[],
+                          geometric=2)
+
+    def test_repack_multi_pack_index(self):
+        blobs = self.add_blob_packs(self.store, 1, 1)
+        self.store.write_multi_pack_index()
+        pack = self.store.repack()
+        self.addCleanup(self.close_packs, self.store)
+        self.assertEqual([os.path.basename(pack._basename) + ".idx"],
+                         self.store._multi_pack_index.pack_names)
+        for b in blobs:
+            self.assertEqual(b, self.store[b.id])
+
+    def test_repack_closes_packs(self):
+        blobs = self.add_blob_packs(self.store, 1, 1)
+        old_packs = list(self.store.packs)
+        for b in blobs:
+            self.assertEqual(b, self.store[b.id])
+        pack = self.store.repack()
+        self.addCleanup(self.close_packs, self.store)
+        for p in old_packs:
+            self.assertTrue(p.data._file.closed)
+            self.assertTrue(p.index._file.closed)
+        self.assertEqual([pack], self.store.packs)
+        self.assertTrue(pack is self.store.packs[0])
+
+    def test_prune_other_store(self):
+        blobs = self.add_blob_packs(self.store, 1, 1)
+        reader = DiskObjectStore(self.store_dir)
+        self.addCleanup(self.close_packs, reader)
+        for b in blobs:
+            self.assertEqual(b, reader[b.id])
+            self.assertTrue(b.id in reader)
+        # Drop all objects, as no heads are kept.
+        self.assertEqual(None, self.store.repack(heads=[]))
+        self.addCleanup(self.close_packs, self.store)
+        # Make sure the change of the pack directory is noticed.
+        mtime = os.stat(self.store.pack_dir).st_mtime + 10
+        os.utime(self.store.pack_dir, (mtime, mtime))
+        for b in blobs:
+            self.assertFalse(b.id in reader)
+            self.assertRaises(KeyError, reader.get_raw, b.id)
+
+    def test_repack_concurrent_reader(self):
+        blobs = self.add_blob_packs(self.store, 1, 1)
+        reader = DiskObjectStore(self.store_dir)
+        self.assertEqual(2, len(reader.packs))
+        # Pretend the removal of the old packs went unnoticed.
+        reader._pack_cache_stale = lambda: False
+        self.store.repack()
+        self.addCleanup(self.close_packs, self.store)
+        self.addCleanup(self.close_packs, reader)
+        for b in blobs:
+            self.assertTrue(b.id in reader)
+            self.assertEqual(b, reader[b.id])
+        self.assertEqual(1, len(reader.packs))
+
+
+class GeometricRollupTests(TestCase):
+
+    def rollup(self, counts, factor=2, extra=0):
+        return sorted(len(p) for p in _geometric_rollup(
+            [[None] * c for c in counts], factor, extra))
+
+    def test_progression(self):
+        self.assertEqual([], self.rollup([1, 2, 4, 8]))
+        self.assertEqual([], self.rollup([]))
+
+    def test_small_packs(self):
+        self.assertEqual([1, 1], self.rollup([1, 1, 8, 16]))
+        self.assertEqual([1, 1, 3], self.rollup([3, 1, 1, 16]))
+
+    def test_cascade(self):
+        # The combined pack is too big for the next pack
+        self.assertEqual([1, 1, 3, 5], self.rollup([1, 1, 3, 5, 40]))
+        self.assertEqual([], self.rollup([3, 8, 16], extra=1))
+        self.assertEqual([3, 8, 16], self.rollup([3, 8, 16], extra=2))
+
+
+class ObjectStoreIteratorTests(TestCase):
+
+    def test_len_then_iter(self):
+        consumed = []
+        def sha_iter():
+            for sha in ["1" * 40, "2" * 40]:
+                consumed.append(sha)
+                yield sha, None
+        it = ObjectStoreIterator(MemoryObjectStore(), sha_iter())
+        self.assertEqual(2, len(it))
+        self.assertEqual(2, len(it))
+        self.assertEqual([("1" * 40, None), ("2" * 40, None)],
+                         list(it.itershas()))
+        self.assertEqual(["1" * 40, "2" * 40], consumed)
+
+
 class TreeLookupPathTests(TestCase):
 
     def setUp(self):
@@ -383,3 +923,56 @@ class ObjectStoreGraphWalkerTests(TestCase):
         self.assertEqual("b", gw.next())
         self.assertEqual("d", gw.next())
         self.assertIs(None, gw.next())
+
+
+class SkippingGraphWalkerTests(TestCase):
+
+    def get_walker(self, heads, parent_map, shallow=None):
+        return SkippingGraphWalker(heads, parent_map.__getitem__,
+            lambda sha: int(sha[1:]), shallow)
+
+    def linear(self, n):
+        return dict(('c%02d' % i, i and ['c%02d' % (i - 1)] or [])
+                    for i in range(n))
+
+    def walk(self, gw):
+        ret = []
+        sha = gw.next()
+        while sha:
+            ret.append(sha)
+            sha = gw.next()
+        return ret
+
+    def test_empty(self):
+        gw = self.get_walker([], {})
+        self.assertIs(None, gw.next())
+        gw.ack("aa" * 20)
+        self.assertIs(None, gw.next())
+
+    def test_skips(self):
+        gw = self.get_walker(["c19"], self.linear(20))
+        # Roots are sent, regardless of the skip distance
+        self.assertEqual(["c19", "c17", "c14", "c09", "c01", "c00"],
+                         self.walk(gw))
+
+    def test_ack(self):
+        gw = self.get_walker(["c19"], self.linear(20))
+        self.assertEqual("c19", gw.next())
+        self.assertEqual("c17", gw.next())
+        self.assertEqual("c14", gw.next())
+        gw.ack("c14")
+        self.assertIs(None, gw.next())
+
+    def test_newest_first(self):
+        gw = self.get_walker(["c05", "c04"], {
+            "c05": ["c02"], "c04": ["c03"], "c03": ["c01"], "c02": ["c01"],
+            "c01": []})
+        self.assertEqual("c05", gw.next())
+        self.assertEqual("c04", gw.next())
+        gw.ack("c04")
+        # c03 is common and c02 is skipped
+        self.assertIs(None, gw.next())
+
+    def test_shallow(self):
+        gw = self.get_walker(["c19"], self.linear(20), shallow=["c15"])
+        self.assertEqual(["c19", "c17", "c15"], self.walk(gw))
@@ -27,6 +27,7 @@ import datetime
 import os
 import stat
 import warnings
+import zlib
 
 from dulwich.errors import (
     ObjectFormatException,
@@ -46,6 +47,8 @@ from dulwich.objects import (
     hex_to_filename,
     check_hexsha,
     check_identity,
+    parse_loose_object,
+    read_loose_object_header,
     parse_timezone,
     TreeEntry,
     parse_tree,
@@ -215,6 +218,75 @@ class BlobReadTests(TestCase):
         self.assertNotEqual(sha, c._make_sha())
 
 
+class ParseLooseObjectTests(TestCase):
+
+    def read_file(self, base, sha):
+        dir = os.path.join(os.path.dirname(__file__), 'data', base)
+        f = open(hex_to_filename(dir, sha), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_blobs(self):
+        for sha, text in [(a_sha, 'test 1\n'), (c_sha, 'test 3\n')]:
+            self.assertEqual((Blob.type_num, text),
+                             parse_loose_object(self.read_file('blobs', sha)))
+
+    def test_tree(self):
+        self.assertEqual(
+            (Tree.type_num,
+             Tree.from_path(hex_to_filename(
+                os.path.join(os.path.dirname(__file__), 'data', 'trees'),
+                tree_sha)).as_raw_string()),
+            parse_loose_object(self.read_file('trees', tree_sha)))
+
+    def test_legacy_object(self):
+        c = make_commit()
+        self.assertEqual((Commit.type_num, c.as_raw_string()),
+                         parse_loose_object(c.as_legacy_object()))
+
+    def test_invalid(self):
+        legacy = Blob.from_string('foo').as_legacy_object()
+        self.assertRaises(ObjectFormatException, parse_loose_object,
+                          legacy[:-4])
+        self.assertRaises(ObjectFormatException, parse_loose_object, '')
+        self.assertRaises(ObjectFormatException, parse_loose_object,
+                          zlib.compress('blob 4\0foo'))
+        self.assertRaises(ObjectFormatException, parse_loose_object,
+                          zlib.compress('blurb 3\0foo'))
+
+
+class ReadLooseObjectHeaderTests(TestCase):
+
+    def test_legacy_object(self):
+        c = make_commit()
+        self.assertEqual(
+            (Commit.type_num, len(c.as_raw_string())),
+            read_loose_object_header(StringIO(c.as_legacy_object())))
+        b = Blob.from_string(os.urandom(100000))
+        self.assertEqual(
+            (Blob.type_num, 100000),
+            read_loose_object_header(StringIO(b.as_legacy_object())))
+
+    def test_pack_header_object(self):
+        # Type 3 (blob) and 100000 in the size varint
+        self.assertEqual(
+            (Blob.type_num, 100000),
+            read_loose_object_header(StringIO('\xb0\xea\x30' +
+                                              zlib.compress('x' * 100000))))
+
+    def test_invalid(self):
+        self.assertRaises(ObjectFormatException, read_loose_object_header,
+                          StringIO(''))
+        self.assertRaises(ObjectFormatException, read_loose_object_header,
+                          StringIO(zlib.compress('blob 3')))
+        self.assertRaises(ObjectFormatException, read_loose_object_header,
+                          StringIO(zlib.compress('blurb 3\0foo')))
+        self.assertRaises(ObjectFormatException, read_loose_object_header,
+                          StringIO(zlib.compress('blob ' + 'x' * 100)))
+
+
 class ShaFileCheckTests(TestCase):
 
     def assertCheckFails(self, cls, data):
@@ -21,8 +21,10 @@
 
 
 from cStringIO import StringIO
+import mmap
 import os
 import shutil
+import sys
 import tempfile
 import zlib
 
@@ -35,6 +37,7 @@ from dulwich.errors import (
 from dulwich.file import (
     GitFile,
     )
+from dulwich import pack as pack_module
 from dulwich.object_store import (
     MemoryObjectStore,
     )
@@ -55,7 +58,15 @@ from dulwich.pack import (
     PackData,
     apply_delta,
     create_delta,
+    _create_delta_py,
+    _unpack_object_buffer_py,
     deltify_pack_objects,
+    deltify_sorted_objects,
+    BitmapIndex,
+    bitmap_from_positions,
+    iter_bitmap_positions,
+    load_multi_pack_index,
+    load_pack_bitmap,
     load_pack_index,
     UnpackedObject,
     read_zlib_chunks,
@@ -63,12 +74,21 @@ from dulwich.pack import (
     write_pack_index_v1,
     write_pack_index_v2,
     SHA1Writer,
+    read_ewah,
+    write_ewah,
+    write_multi_pack_index,
+    write_pack_bitmap,
+    write_pack_data,
     write_pack_object,
+    write_pack_objects,
     write_pack,
     unpack_object,
+    unpack_object_buffer,
+    pack_object_header,
     compute_file_sha,
     PackStreamReader,
     DeltaChainIterator,
+    PackIndexer,
     )
 from dulwich.tests import (
     TestCase,
@@ -76,6 +96,8 @@ from dulwich.tests import (
 from utils import (
     make_object,
     build_pack,
+    functest_builder,
+    ext_functest_builder,
     )
 
 pack1_sha = 'bc63ddad95e7321ee734ea11a7a62d314e0d7481'
@@ -125,6 +147,16 @@ class PackIndexTests(PackTests):
         self.assertEqual(p.object_index(tree_sha), 138)
         self.assertEqual(p.object_index(commit_sha), 12)
 
+    def test_object_index_many(self):
+        p = self.get_pack_index(pack1_sha)
+        self.assertEqual({a_sha: 178, tree_sha: 138, commit_sha: 12},
+            p.object_index_many([a_sha, pack1_sha, tree_sha, commit_sha]))
+        self.assertEqual({hex_to_sha(a_sha): 178},
+            p.object_index_many([hex_to_sha(a_sha), '\0' * 20, '\xff' * 20]))
+        self.assertEqual({a_sha: 178, hex_to_sha(a_sha): 178},
+            p.object_index_many([a_sha, hex_to_sha(a_sha)]))
+        self.assertEqual({}, p.object_index_many([]))
+
     def test_index_len(self):
         p = self.get_pack_index(pack1_sha)
         self.assertEqual(3, len(p))
@@ -181,9 +213,37 @@ class TestPackDeltas(TestCase):
         self._test_roundtrip(self.test_string_empty, self.test_string_big)
 
     def test_overflow_64k(self):
-        self.skipTest("big strings don't work yet")
         self._test_roundtrip(self.test_string_huge, self.test_string_huge)
 
+    def _do_test_create_delta(self, create_delta):
+        base = ''.join(chr(i % 251) for i in xrange(10000))
+        target = base[:3000] + 'inserted text' + base[3000:9000]
+        delta = create_delta(base, target)
+        self.assertEqual(target, ''.join(apply_delta(base, delta)))
+        # Two copies and one insert.
+        self.assertTrue(len(delta) < 40, len(delta))
+        self.assertEqual(create_delta(self.test_string1, self.test_string2),
+                         _create_delta_py(self.test_string1,
+                                          self.test_string2))
+        self.assertEqual(create_delta(base, target),
+                         _create_delta_py(base, target))
+
+    test_create_delta = functest_builder(_do_test_create_delta,
+                                         _create_delta_py)
+    test_create_delta_extension = ext_functest_builder(_do_test_create_delta,
+                                                       create_delta)
+
+    def _do_test_create_delta_large_copy(self, create_delta):
+        delta = create_delta(self.test_string_huge, self.test_string_huge)
+        self.assertEqual(self.test_string_huge,
+                         ''.join(apply_delta(self.test_string_huge, delta)))
+        self.assertTrue(len(delta) < 20, len(delta))
+
+    test_create_delta_large_copy = functest_builder(
+        _do_test_create_delta_large_copy, _create_delta_py)
+    test_create_delta_large_copy_extension = ext_functest_builder(
+        _do_test_create_delta_large_copy, create_delta)
+
 
 class TestPackData(PackTests):
     """Tests getting the data from the packfile."""
@@ -223,6 +283,44 @@ class TestPackData(PackTests):
           (178, 3, 'test 1\n', 1373561701L)
           ], actual)
 
+    def test_iterobjects_no_mmap(self):
+        p = self.get_pack_data(pack1_sha)
+        path = os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha)
+        p_nommap = PackData(path, use_mmap=False)
+        self.addCleanup(p_nommap.close)
+        self.assertEqual(None, p_nommap._contents)
+        self.assertNotEqual(None, p._contents)
+        self.assertEqual(list(p.iterobjects()), list(p_nommap.iterobjects()))
+
+    def test_get_object_at_no_mmap(self):
+        path = os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha)
+        p = PackData(path)
+        self.addCleanup(p.close)
+        p_nommap = PackData(path, use_mmap=False)
+        self.addCleanup(p_nommap.close)
+        for offset in (12, 138, 178):
+            self.assertEqual(p_nommap.get_object_at(offset),
+                             p.get_object_at(offset))
+        self.assertEqual(p_nommap.calculate_checksum(),
+                         p.calculate_checksum())
+        self.assertEqual(p_nommap.get_stored_checksum(),
+                         p.get_stored_checksum())
+
+    def test_mmap_failure(self):
+        class FailingMmap(object):
+            ACCESS_READ = mmap.ACCESS_READ
+            error = mmap.error
+            def mmap(self, *args, **kwargs):
+                raise mmap.error('mapping not supported')
+        self.addCleanup(setattr, pack_module, 'mmap', pack_module.mmap)
+        pack_module.mmap = FailingMmap()
+        path = os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha)
+        p = PackData(path)
+        self.addCleanup(p.close)
+        self.assertEqual(None, p._contents)
+        self.assertEqual((3, ['test 1\n']), p.get_object_at(178))
+        self.assertEqual(3, len(list(p.iterobjects())))
+
     def test_iterentries(self):
         p = self.get_pack_data(pack1_sha)
         entries = set((sha_to_hex(s), o, c) for s, o, c in p.iterentries())
@@ -263,6 +361,141 @@ class TestPackData(PackTests):
           compute_file_sha(f, start_ofs=4, end_ofs=-4).hexdigest())
 
 
+class DeltaBaseCacheTests(TestCase):
+
+    def resolve(self, data, offset):
+        type_num, obj = data.get_object_at(offset)
+        type_num, chunks = data.resolve_object(offset, type_num, obj)
+        return type_num, ''.join(chunks)
+
+    def test_shared_base(self):
+        f = StringIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          (OFS_DELTA, (0, 'blob2')),
+          ])
+        data = PackData('test.pack', file=f)
+        cache = data.delta_base_cache
+        self.assertEqual((Blob.type_num, 'blob1'),
+                         self.resolve(data, entries[1][0]))
+        self.assertEqual(1, len(cache))
+        hits = cache.hits
+        self.assertEqual((Blob.type_num, 'blob2'),
+                         self.resolve(data, entries[2][0]))
+        self.assertEqual(hits + 1, cache.hits)
+        self.assertEqual([entries[0][0]], cache.keys())
+
+    def test_chain_bases_cached(self):
+        f = StringIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          (OFS_DELTA, (1, 'blob2')),
+          ])
+        data = PackData('test.pack', file=f)
+        self.assertEqual((Blob.type_num, 'blob2'),
+                         self.resolve(data, entries[2][0]))
+        self.assertEqual(set([entries[0][0], entries[1][0]]),
+                         set(data.delta_base_cache.keys()))
+
+    def test_chain_deeper_than_recursion_limit(self):
+        n = sys.getrecursionlimit() + 10
+        objects_spec = [(Blob.type_num, 'blob')]
+        for i in xrange(n):
+            objects_spec.append((OFS_DELTA, (i, 'blob%i' % i)))
+        f = StringIO()
+        entries = build_pack(f, objects_spec)
+        data = PackData('test.pack', file=f)
+        self.assertEqual((Blob.type_num, 'blob%i' % (n - 1)),
+                         self.resolve(data, entries[-1][0]))
+
+    def test_size_limit(self):
+        f = StringIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob' * 100),
+          (OFS_DELTA, (0, 'blob' * 99)),
+          ])
+        data = PackData('test.pack', file=f, delta_base_cache_size=100)
+        self.assertEqual((Blob.type_num, 'blob' * 99),
+                         self.resolve(data, entries[1][0]))
+        self.assertEqual(0, len(data.delta_base_cache))
+
+
+class ParallelPackIndexerTests(PackTests):
+
+    def setUp(self):
+        super(ParallelPackIndexerTests, self).setUp()
+        self.store = MemoryObjectStore()
+
+    def build_pack_file(self, objects_spec):
+        path = os.path.join(self.tempdir, 'test.pack')
+        f = open(path, 'wb')
+        try:
+            entries = build_pack(f, objects_spec, store=self.store)
+        finally:
+            f.close()
+        return path, entries
+
+    def index_parallel(self, path, resolve_ext_ref=None):
+        data = PackData(path)
+        self.addCleanup(data.close)
+        indexer = PackIndexer.for_pack_data(
+            data, resolve_ext_ref=resolve_ext_ref)
+        return indexer, sorted(indexer.iter_parallel(path, processes=2))
+
+    def test_matches_serial(self):
+        objects_spec = [(Blob.type_num, 'blob'), (Blob.type_num, 'other')]
+        for i in xrange(20):
+            objects_spec.append((OFS_DELTA, (i, 'blob%i' % i)))
+            objects_spec.append((REF_DELTA, (1, 'other%i' % i)))
+        path, entries = self.build_pack_file(objects_spec)
+        data = PackData(path)
+        self.addCleanup(data.close)
+        _, parallel = self.index_parallel(path)
+        self.assertEqual(data.sorted_entries(), parallel)
+        self.assertEqual(sorted((e[3], e[0], e[4]) for e in entries),
+                         parallel)
+
+    def test_ext_ref(self):
+        blob = make_object(Blob, data='blob')
+        self.store.add_object(blob)
+        path, entries = self.build_pack_file([
+          (Blob.type_num, 'other'),
+          (REF_DELTA, (blob.id, 'blob1')),
+          (OFS_DELTA, (1, 'blob2')),
+          (OFS_DELTA, (0, 'other1')),
+          ])
+        indexer, parallel = self.index_parallel(
+            path, resolve_ext_ref=self.store.get_raw)
+        self.assertEqual(sorted((e[3], e[0], e[4]) for e in entries),
+                         parallel)
+        self.assertEqual([hex_to_sha(blob.id)], indexer.ext_refs())
+
+    def test_worker_closes_pack(self):
+        path, entries = self.build_pack_file([
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          ])
+        data = PackData(path)
+        self.addCleanup(data.close)
+        indexer = PackIndexer.for_pack_data(data)
+        closed = []
+        orig_close = PackData.close
+        def close(self):
+            closed.append(self)
+            orig_close(self)
+        self.addCleanup(setattr, PackData, 'close', orig_close)
+        PackData.close = close
+        self.addCleanup(setattr, pack_module, '_parallel_indexer_args', None)
+        pack_module._init_parallel_indexer(PackIndexer, path,
+            dict(indexer._pending_ofs), dict(indexer._pending_ref))
+        results = pack_module._index_delta_trees(indexer._full_ofs)
+        self.assertEqual(sorted((e[3], e[0], e[4]) for e in entries),
+                         sorted(results))
+        self.assertEqual(1, len(closed))
+
+
 class TestPack(PackTests):
 
     def test_len(self):
@@ -419,6 +652,95 @@ class TestPack(PackTests):
         self.assertTrue(isinstance(objs[tree_sha], Tree))
         self.assertTrue(isinstance(objs[commit_sha], Commit))
 
+    def _write_delta_pack(self, write_index=write_pack_index_v2):
+        basename = os.path.join(self.tempdir, 'deltas')
+        f = open(basename + '.pack', 'wb')
+        try:
+            entries = build_pack(f, [
+              (Blob.type_num, 'common data\n' * 20),
+              (OFS_DELTA, (0, 'common data\n' * 20 + 'more\n')),
+              (REF_DELTA, (1, 'common data\n' * 20 + 'even more\n')),
+              ])
+        finally:
+            f.close()
+        data = PackData(basename + '.pack')
+        try:
+            f = GitFile(basename + '.idx', 'wb')
+            try:
+                write_index(f, data.sorted_entries(), data.get_stored_checksum())
+            finally:
+                f.close()
+        finally:
+            data.close()
+        pack = Pack(basename)
+        self.addCleanup(pack.close)
+        return pack, entries
+
+    def test_get_compressed_entry(self):
+        pack, entries = self._write_delta_pack()
+        bases = [None, entries[0][3], entries[1][3]]
+        for (offset, type_num, data, sha, crc32), base in zip(entries, bases):
+            unpacked = pack.get_compressed_entry(offset)
+            self.assertEqual(offset, unpacked.offset)
+            self.assertEqual(sha, unpacked.sha())
+            self.assertEqual(crc32, unpacked.crc32)
+            self.assertEqual(base, unpacked.delta_base)
+        self.assertEqual(Blob.type_num,
+                         pack.get_compressed_entry(entries[0][0]).pack_type_num)
+        self.assertEqual(REF_DELTA,
+                         pack.get_compressed_entry(entries[2][0]).pack_type_num)
+        self.assertEqual(len(entries[0][2]),
+                         pack.get_compressed_entry(entries[0][0]).decomp_len)
+        self.assertRaises(KeyError, pack.get_compressed_entry, 13)
+
+    def test_get_object_header_at(self):
+        pack, entries = self._write_delta_pack()
+        for offset, type_num, data, sha, crc32 in entries:
+            self.assertEqual((Blob.type_num, len(data)),
+                             pack.get_object_header_at(offset))
+
+    def test_get_compressed_entry_corrupt(self):
+        for write_index in (write_pack_index_v1, write_pack_index_v2):
+            pack, entries = self._write_delta_pack(write_index)
+            pack.close()
+            f = open(pack._data_path, 'r+b')
+            try:
+                f.seek(entries[1][0] + 10)
+                f.write('\xff\xff')
+            finally:
+                f.close()
+            pack = Pack(pack._basename)
+            self.addCleanup(pack.close)
+            self.assertRaises(ChecksumMismatch, pack.get_compressed_entry,
+                              entries[1][0])
+            pack.get_compressed_entry(entries[0][0])
+
+    def test_write_compressed_entries(self):
+        pack, entries = self._write_delta_pack()
+        # Write the deltas before their bases, so they become REF_DELTAs
+        records = [pack.get_compressed_entry(e[0]) for e in entries[::-1]]
+        basename = os.path.join(self.tempdir, 'copy')
+        f = GitFile(basename + '.pack', 'wb')
+        try:
+            written, pack_checksum = write_pack_data(f, len(records), records)
+        finally:
+            f.close()
+        f = GitFile(basename + '.idx', 'wb')
+        try:
+            write_pack_index_v2(f, sorted((k, v[0], v[1])
+                                for (k, v) in written.iteritems()),
+                                pack_checksum)
+        finally:
+            f.close()
+        copy = Pack(basename)
+        self.addCleanup(copy.close)
+        copy.check()
+        for offset, type_num, data, sha, crc32 in entries:
+            self.assertEqual((type_num, data), copy.get_raw(sha))
+        self.assertEqual([REF_DELTA, REF_DELTA, Blob.type_num],
+            [copy.get_compressed_entry(written[e[3]][0]).pack_type_num
+             for e in entries[::-1]])
+
 
 class WritePackTests(TestCase):
 
@@ -535,6 +857,22 @@ class BaseTestFilePackIndexWriting(BaseTestPackIndexWriting):
         self.assertEqual(idx.version, self._expected_version)
         return idx
 
+    def test_object_index_many(self):
+        entries = sorted((make_sha(str(i)).digest(), i * 10, i)
+                         for i in range(500))
+        idx = self.index('many.idx', entries, pack_checksum)
+        shas = [e[0] for e in entries[::3]]
+        missing = [make_sha('missing%d' % i).digest() for i in range(50)]
+        self.assertEqual(dict((sha, idx.object_index(sha)) for sha in shas),
+                         idx.object_index_many(shas + missing))
+
+    def test_object_index_many_sparse(self):
+        # Search for each SHA rather than reading the names of its bucket
+        self.addCleanup(setattr, pack_module, '_NAME_TABLE_READ_FACTOR',
+                        pack_module._NAME_TABLE_READ_FACTOR)
+        pack_module._NAME_TABLE_READ_FACTOR = 0
+        self.test_object_index_many()
+
     def writeIndex(self, filename, entries, pack_checksum):
         # FIXME: Write to StringIO instead rather than hitting disk ?
         f = GitFile(filename, "wb")
@@ -588,6 +926,178 @@ class TestPackIndexWritingv2(TestCase, BaseTestFilePackIndexWriting):
         BaseTestFilePackIndexWriting.tearDown(self)
 
 
+class MultiPackIndexTests(TestCase):
+
+    def setUp(self):
+        super(MultiPackIndexTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def write_and_load(self, pack_indexes):
+        path = os.path.join(self.tempdir, 'multi-pack-index')
+        f = GitFile(path, 'wb')
+        try:
+            write_multi_pack_index(f, pack_indexes)
+        finally:
+            f.close()
+        midx = load_multi_pack_index(path)
+        self.addCleanup(midx.close)
+        return midx
+
+    def make_index(self, shas, offset_base):
+        entries = sorted((make_sha(sha).digest(), offset_base + i * 10, None)
+                         for (i, sha) in enumerate(shas))
+        return MemoryPackIndex(entries)
+
+    def test_empty(self):
+        midx = self.write_and_load([])
+        midx.check()
+        self.assertEqual([], midx.pack_names)
+        self.assertEqual(0, len(midx))
+
+    def test_lookup(self):
+        shas = ['a', 'b', 'c', 'd']
+        midx = self.write_and_load([
+            ('pack-2.idx', self.make_index(shas[:3], 100)),
+            ('pack-1.idx', self.make_index(shas[2:], 200)),
+            ])
+        midx.check()
+        self.assertEqual(['pack-1.idx', 'pack-2.idx'], midx.pack_names)
+        self.assertEqual(4, len(midx))
+        self.assertEqual((1, 100), midx.object_index(make_sha('a').digest()))
+        self.assertEqual((1, 120), midx.object_index(
+            make_sha('c').hexdigest()))
+        self.assertEqual((0, 210), midx.object_index(make_sha('d').digest()))
+        self.assertRaises(KeyError, midx.object_index, make_sha('e').digest())
+        self.assertEqual(sorted(make_sha(sha).hexdigest() for sha in shas),
+                         sorted(midx))
+        self.assertEqual(
+            {make_sha('b').hexdigest(): (1, 110)},
+            midx.object_index_many([make_sha('b').hexdigest(),
+                                    make_sha('e').hexdigest()]))
+
+    def test_large_offsets(self):
+        shas = [make_sha(str(i)).digest() for i in range(3)]
+        index = MemoryPackIndex(sorted([
+            (shas[0], 12, None),
+            (shas[1], 2**31 + 5, None),
+            (shas[2], 2**33 + 7, None)]))
+        midx = self.write_and_load([('pack-1.idx', index)])
+        midx.check()
+        self.assertEqual(sorted((sha, 0, offset)
+                                for (sha, offset, crc32) in index.iterentries()),
+                         list(midx.iterentries()))
+
+    def test_not_multi_pack_index(self):
+        path = os.path.join(self.tempdir, 'pack-1.idx')
+        f = GitFile(path, 'wb')
+        try:
+            write_pack_index_v2(f, [], pack_checksum)
+        finally:
+            f.close()
+        self.assertRaises(AssertionError, load_multi_pack_index, path)
+
+
+class EWAHTests(TestCase):
+
+    def roundtrip(self, bits):
+        f = StringIO()
+        write_ewah(f, bits)
+        data = f.getvalue()
+        self.assertEqual((bits, len(data)), read_ewah(data))
+        self.assertEqual((bits, len(data) + 4), read_ewah('abcd' + data, 4))
+        return data
+
+    def test_empty(self):
+        self.assertEqual('\0\0\0\0\0\0\0\1' + '\0' * 8 + '\0' * 4,
+                         self.roundtrip(0))
+
+    def test_literal(self):
+        self.assertEqual(
+            '\0\0\0\3\0\0\0\2' + '\0\0\0\2\0\0\0\0' +
+            '\0\0\0\0\0\0\0\5' + '\0' * 4,
+            self.roundtrip(5))
+
+    def test_runs(self):
+        data = self.roundtrip((2**640 - 1) << 64)
+        # One marker word for the run of zeroes and one for the run of ones
+        self.assertEqual(8 + 2 * 8 + 4, len(data))
+        self.roundtrip(((2**640 - 1) << 6400) | 3 << 64 | 1)
+        self.roundtrip(2**64 - 1)
+
+    def test_random(self):
+        self.roundtrip(long(make_sha('foo').hexdigest() * 20, 16) << 1000)
+
+    def test_positions(self):
+        self.assertEqual(0, bitmap_from_positions([]))
+        self.assertEqual(0b1000101, bitmap_from_positions([6, 0, 2]))
+        self.assertEqual([], list(iter_bitmap_positions(0)))
+        self.assertEqual([0, 2, 6, 100],
+            list(iter_bitmap_positions(0b1000101 | 2**100)))
+
+
+class PackBitmapTests(PackTests):
+
+    def write_and_load(self, index, entries):
+        path = os.path.join(self.tempdir, 'pack.bitmap')
+        type_bitmaps = (0b1, 0b10, 0b100, 0)
+        f = GitFile(path, 'wb')
+        try:
+            write_pack_bitmap(f, index.get_pack_checksum(), type_bitmaps,
+                              entries)
+        finally:
+            f.close()
+        bitmap = load_pack_bitmap(path)
+        self.addCleanup(bitmap.close)
+        return bitmap
+
+    def test_roundtrip(self):
+        index = self.get_pack_index(pack1_sha)
+        bitmap = self.write_and_load(index, [(2, 0b111)])
+        self.assertSucceeds(bitmap.check)
+        self.assertEqual(1, len(bitmap))
+        self.assertEqual(index.get_pack_checksum(),
+                         bitmap.get_pack_checksum())
+        self.assertEqual([(2, 0b111)], list(bitmap.iterentries()))
+        self.assertEqual((0b1, 0b10, 0b100, 0),
+            (bitmap.commits, bitmap.trees, bitmap.blobs, bitmap.tags))
+
+    def test_bitmap_index(self):
+        index = self.get_pack_index(pack1_sha)
+        bitmap = BitmapIndex(index, self.write_and_load(index, [(2, 0b111)]))
+        # Objects are ordered by offset
+        self.assertEqual(0, bitmap.position(hex_to_sha(commit_sha)))
+        self.assertEqual(1, bitmap.position(hex_to_sha(tree_sha)))
+        self.assertEqual(2, bitmap.position(hex_to_sha(a_sha)))
+        self.assertEqual(2, bitmap.index_position(hex_to_sha(commit_sha)))
+        self.assertRaises(KeyError, bitmap.position, hex_to_sha(pack1_sha))
+        self.assertEqual({hex_to_sha(commit_sha): 0b111},
+                         bitmap.commit_bitmaps)
+        self.assertEqual([hex_to_sha(commit_sha), hex_to_sha(a_sha)],
+                         list(bitmap.iter_names(0b101)))
+
+    def test_pack_bitmap(self):
+        shutil.copy(os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha),
+                    self.tempdir)
+        shutil.copy(os.path.join(self.datadir, 'pack-%s.idx' % pack1_sha),
+                    self.tempdir)
+        pack = Pack(os.path.join(self.tempdir, 'pack-%s' % pack1_sha))
+        self.addCleanup(pack.close)
+        self.assertEqual(None, pack.bitmap)
+        f = GitFile(pack._bitmap_path, 'wb')
+        try:
+            write_pack_bitmap(f, pack.index.get_pack_checksum(),
+                              (0b1, 0b10, 0b100, 0), [(2, 0b111)])
+        finally:
+            f.close()
+        # The earlier miss is remembered.
+        self.assertEqual(None, pack.bitmap)
+        reopened = Pack(os.path.join(self.tempdir, 'pack-%s' % pack1_sha))
+        self.addCleanup(reopened.close)
+        self.assertEqual({hex_to_sha(commit_sha): 0b111},
+                         reopened.bitmap.commit_bitmaps)
+
+
 class ReadZlibTests(TestCase):
 
     decomp = (
@@ -669,6 +1179,75 @@ class ReadZlibTests(TestCase):
         self.assertEqual(self.comp, ''.join(self.unpacked.comp_chunks))
 
 
+class UnpackObjectBufferTests(TestCase):
+
+    extra = 'nextobject'
+
+    def entries(self):
+        data = 'some data\n' * 100
+        comp = zlib.compress(data)
+        for type_num, delta_base in [(Blob.type_num, None),
+                                     (OFS_DELTA, 1234567),
+                                     (REF_DELTA, '\xab' * 20)]:
+            header = pack_object_header(type_num, delta_base, len(data))
+            yield (header + comp,
+                   (type_num, delta_base, len(data), data, comp,
+                    zlib.crc32(header + comp) & 0xffffffff,
+                    len(header) + len(comp)))
+
+    def _do_test_complete(self, unpack_object_buffer):
+        for entry, expected in self.entries():
+            self.assertEqual(expected,
+                             unpack_object_buffer(entry + self.extra, True,
+                                                  True))
+            self.assertEqual(expected[:4] + (None, None, expected[6]),
+                             unpack_object_buffer(entry + self.extra))
+
+    test_complete = functest_builder(_do_test_complete,
+                                     _unpack_object_buffer_py)
+    test_complete_extension = ext_functest_builder(_do_test_complete,
+                                                   unpack_object_buffer)
+
+    def _do_test_incomplete(self, unpack_object_buffer):
+        for entry, expected in self.entries():
+            # The end of the object must be followed by more data.
+            for i in range(len(entry) + 1):
+                self.assertEqual(None, unpack_object_buffer(entry[:i]))
+
+    test_incomplete = functest_builder(_do_test_incomplete,
+                                       _unpack_object_buffer_py)
+    test_incomplete_extension = ext_functest_builder(_do_test_incomplete,
+                                                     unpack_object_buffer)
+
+    def _do_test_errors(self, unpack_object_buffer):
+        comp = zlib.compress('foo')
+        for size in (2, 4):
+            self.assertRaises(zlib.error, unpack_object_buffer,
+                pack_object_header(Blob.type_num, None, size) + comp + 'x')
+        self.assertRaises(zlib.error, unpack_object_buffer,
+            pack_object_header(Blob.type_num, None, 3) + 'garbage' * 10)
+
+    test_errors = functest_builder(_do_test_errors, _unpack_object_buffer_py)
+    test_errors_extension = ext_functest_builder(_do_test_errors,
+                                                 unpack_object_buffer)
+
+    def test_unpack_object_small_buffer(self):
+        for entry, expected in self.entries():
+            for bufsize in (1, 5, 30, 4096):
+                f = StringIO(entry + self.extra)
+                unpacked, unused = unpack_object(
+                    f.read, compute_crc32=True, include_comp=True,
+                    zlib_bufsize=bufsize)
+                self.assertEqual(self.extra, unused + f.read())
+                self.assertEqual(expected[:3],
+                                 (unpacked.pack_type_num,
+                                  unpacked.delta_base, unpacked.decomp_len))
+                self.assertEqual(expected[3],
+                                 ''.join(unpacked.decomp_chunks))
+                self.assertEqual(expected[4], ''.join(unpacked.comp_chunks))
+                self.assertEqual(expected[5], unpacked.crc32)
+
+
 class DeltifyTests(TestCase):
 
     def test_empty(self):
@@ -690,6 +1269,89 @@ class DeltifyTests(TestCase):
             ],
             list(deltify_pack_objects([(b1, ""), (b2, "")])))
 
+    def test_depth(self):
+        blobs = [Blob.from_string("a" * (200 - i)) for i in range(5)]
+        result = list(deltify_pack_objects([(b, "") for b in blobs],
+                                           depth=2))
+        bases = dict((sha, base) for (_, sha, base, _) in result)
+        def chain_depth(sha):
+            depth = 0
+            while bases[sha] is not None:
+                sha = bases[sha]
+                depth += 1
+            return depth
+        self.assertEqual(2, max(chain_depth(sha) for sha in bases))
+
+    def test_sorted_lazy(self):
+        blobs = [Blob.from_string("a" * (200 - i)) for i in range(3)]
+        consumed = []
+        def iter_objects():
+            for b in blobs:
+                consumed.append(b.id)
+                yield b.type_num, b.sha().digest(), b.as_raw_string()
+        result = deltify_sorted_objects(iter_objects(), window=1)
+        self.assertEqual(blobs[0].sha().digest(), result.next()[1])
+        self.assertEqual([blobs[0].id], consumed)
+        self.assertEqual(blobs[0].sha().digest(), result.next()[2])
+        self.assertEqual(blobs[1].sha().digest(), result.next()[2])
+
+
+class WritePackObjectsTests(PackTests):
+
+    def test_deltified_roundtrip(self):
+        blobs = [Blob.from_string("common line\n" * 100 + "line %d\n" % i)
+                 for i in range(10)]
+        basename = os.path.join(self.tempdir, 'deltified')
+        write_pack(basename, [(b, None) for b in blobs])
+        p = Pack(basename)
+        self.addCleanup(p.close)
+        self.assertSucceeds(p.check)
+        types = set(t for (_, t, _, _) in p.data.iterobjects())
+        self.assertTrue(OFS_DELTA in types)
+        for b in blobs:
+            self.assertEqual(b, p[b.id])
+
+    def test_no_window(self):
+        blobs = [Blob.from_string("a" * (100 + i)) for i in range(3)]
+        f = StringIO()
+        entries, sha = write_pack_objects(f, [(b, None) for b in blobs],
+                                          window=0)
+        f.seek(0)
+        data = PackData('test.pack', file=f)
+        self.assertEqual(set([Blob.type_num]),
+            set(t for (_, t, _, _) in data.iterobjects()))
+
+    def _write(self, objects, **kwargs):
+        f = StringIO()
+        entries, sha = write_pack_objects(f, objects, **kwargs)
+        return f.getvalue(), entries, sha
+
+    def test_threads(self):
+        # Large enough to be handed to the compression threads, and with a
+        # few deltas for the offsets to depend on the preceding entries.
+        objects = [(Blob.from_string(os.urandom(1024) * 8 + str(i)), None)
+                   for i in range(20)]
+        objects += [(Blob.from_string("small %d" % i), None)
+                    for i in range(20)]
+        expected = self._write(objects)
+        self.assertEqual(expected, self._write(objects, threads=3))
+        self.assertEqual(expected, self._write(objects, threads=None))
+        data = PackData('test.pack', file=StringIO(expected[0]))
+        self.assertSucceeds(data.check)
+
+    def test_compression_level(self):
+        objects = [(Blob.from_string("line %d\n" % i * 100), None)
+                   for i in range(5)]
+        stored, entries, sha = self._write(objects, window=0,
+                                           compression_level=0)
+        default = self._write(objects, window=0)[0]
+        self.assertTrue(len(stored) > len(default))
+        data = PackData('test.pack', file=StringIO(stored))
+        self.assertEqual(
+            sorted(o.as_raw_string() for (o, path) in objects),
+            sorted(''.join(chunks) for (_, _, chunks, _) in
+                   data.iterobjects()))
+
 
 class TestPackStreamReader(TestCase):
 
@@ -874,6 +1536,15 @@ class DeltaChainIteratorTests(TestCase):
         entries = build_pack(f, objects_spec)
         self.assertEntriesMatch(xrange(n + 1), entries, self.make_pack_iter(f))
 
+    def test_chain_deeper_than_recursion_limit(self):
+        n = sys.getrecursionlimit() + 10
+        objects_spec = [(Blob.type_num, 'blob')]
+        for i in xrange(n):
+            objects_spec.append((OFS_DELTA, (i, 'blob%i' % i)))
+        f = StringIO()
+        entries = build_pack(f, objects_spec)
+        self.assertEntriesMatch(xrange(n + 1), entries, self.make_pack_iter(f))
+
     def test_branchy_chain(self):
         n = 100
         objects_spec = [(Blob.type_num, 'blob')]
@@ -25,12 +25,14 @@ from dulwich.errors import (
     HangupException,
     )
 from dulwich.protocol import (
+    DELIM_PKT,
     PktLineParser,
     Protocol,
     ReceivableProtocol,
     extract_capabilities,
     extract_want_line_capabilities,
     ack_type,
+    parse_protocol_version,
     SINGLE_ACK,
     MULTI_ACK,
     MULTI_ACK_DETAILED,
@@ -82,6 +84,15 @@ class BaseProtocolTests(object):
         self.rin.seek(0)
         self.assertEqual(None, self.proto.read_pkt_line())
 
+    def test_delim_pkt(self):
+        self.proto.write_pkt_line(DELIM_PKT)
+        self.assertEqual('0001', self.rout.getvalue())
+        self.rin.write('00010005a0000')
+        self.rin.seek(0)
+        self.assertEqual(DELIM_PKT, self.proto.read_pkt_line())
+        self.assertEqual('a', self.proto.read_pkt_line())
+        self.assertEqual(None, self.proto.read_pkt_line())
+
     def test_write_sideband(self):
         self.proto.write_sideband(3, 'bloe')
         self.assertEqual(self.rout.getvalue(), '0009\x03bloe')
@@ -228,6 +239,20 @@ class CapabilitiesTestCase(TestCase):
                                     'multi_ack_detailed']))
 
 
+class ParseProtocolVersionTests(TestCase):
+
+    def test_none(self):
+        self.assertEqual(0, parse_protocol_version([]))
+        self.assertEqual(0, parse_protocol_version(['host=example.com', '']))
+
+    def test_version(self):
+        self.assertEqual(2, parse_protocol_version(['', 'version=2']))
+
+    def test_highest(self):
+        self.assertEqual(2, parse_protocol_version(
+            ['version=1', 'version=2', 'version=bogus']))
+
+
 class BufferedPktLineWriterTests(TestCase):
 
     def setUp(self):
@@ -307,3 +332,9 @@ class PktLineParserTests(TestCase):
         parser.parse("0005z0006aba")
         self.assertEqual(pktlines, ["z", "ab"])
         self.assertEqual("a", parser.get_tail())
+
+    def test_delim(self):
+        pktlines = []
+        parser = PktLineParser(pktlines.append)
+        parser.parse("00010005z0000")
+        self.assertEqual(pktlines, [DELIM_PKT, "z", None])
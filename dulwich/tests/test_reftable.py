@@ -0,0 +1,189 @@
+# test_reftable.py -- Tests for reading and writing reftables
+# Copyright (C) 2013 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for reading and writing reftables."""
+
+from cStringIO import StringIO
+import os
+import shutil
+import tempfile
+
+from dulwich.reftable import (
+    REF_DELETION,
+    REF_SYMREF,
+    REF_VAL1,
+    REF_VAL2,
+    RefRecord,
+    Reftable,
+    ReftableFormatError,
+    ReftableStack,
+    TABLES_LIST,
+    _decode_varint,
+    _encode_varint,
+    write_reftable,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+
+ONES = '1' * 40
+TWOS = '2' * 40
+
+
+def _write(records, min_update_index=1, max_update_index=1, block_size=256):
+    f = StringIO()
+    write_reftable(f, records, min_update_index, max_update_index,
+                   block_size=block_size)
+    data = f.getvalue()
+    return Reftable('test.ref', file=f, contents=data, size=len(data))
+
+
+class VarintTests(TestCase):
+
+    def test_roundtrip(self):
+        for n in (0, 1, 127, 128, 255, 16511, 16512, 2 ** 40):
+            encoded = _encode_varint(n)
+            self.assertEqual((n, len(encoded)), _decode_varint(encoded, 0))
+
+    def test_encoding(self):
+        self.assertEqual('\x7f', _encode_varint(127))
+        self.assertEqual('\x80\x00', _encode_varint(128))
+
+
+class ReftableTests(TestCase):
+
+    def test_empty(self):
+        table = _write([])
+        self.assertEqual([], list(table.iter_refs()))
+        self.assertEqual(None, table.get('refs/heads/master'))
+
+    def test_values(self):
+        table = _write([
+            RefRecord('HEAD', 1, REF_SYMREF, 'refs/heads/master', None),
+            RefRecord('refs/heads/gone', 2, REF_DELETION, None, None),
+            RefRecord('refs/heads/master', 1, REF_VAL1, ONES, None),
+            RefRecord('refs/tags/v1', 2, REF_VAL2, ONES, TWOS),
+            ], 1, 2)
+        self.assertEqual(1, table.min_update_index)
+        self.assertEqual(2, table.max_update_index)
+        self.assertEqual(
+            RefRecord('HEAD', 1, REF_SYMREF, 'refs/heads/master', None),
+            table.get('HEAD'))
+        self.assertEqual(
+            RefRecord('refs/heads/gone', 2, REF_DELETION, None, None),
+            table.get('refs/heads/gone'))
+        self.assertEqual(
+            RefRecord('refs/tags/v1', 2, REF_VAL2, ONES, TWOS),
+            table.get('refs/tags/v1'))
+        self.assertEqual(None, table.get('refs/heads/other'))
+
+    def test_many_blocks(self):
+        names = ['refs/heads/branch-%04d' % i for i in range(1000)]
+        table = _write([RefRecord(name, 1, REF_VAL1, ONES, None)
+                        for name in names])
+        self.assertTrue(len(table) > 30 * 256)
+        self.assertEqual(names, [r.name for r in table.iter_refs()])
+        for name in names[::37]:
+            self.assertEqual(name, table.get(name).name)
+        self.assertEqual(None, table.get('refs/heads/branch-0500a'))
+        self.assertEqual(None, table.get('refs/heads/a'))
+        self.assertEqual(None, table.get('refs/tags/z'))
+        self.assertEqual(names[500:510], [r.name for r in
+            table.iter_refs('refs/heads/branch-05')][:10])
+
+    def test_unsorted(self):
+        self.assertRaises(ValueError, _write, [
+            RefRecord('refs/heads/b', 1, REF_VAL1, ONES, None),
+            RefRecord('refs/heads/a', 1, REF_VAL1, ONES, None)])
+
+    def test_corrupt_footer(self):
+        f = StringIO()
+        write_reftable(f, [RefRecord('refs/heads/a', 1, REF_VAL1, ONES, None)],
+                       1, 1)
+        data = f.getvalue()
+        data = data[:-10] + 'x' + data[-9:]
+        self.assertRaises(ReftableFormatError, Reftable, 'test.ref', file=f,
+                          contents=data, size=len(data))
+
+
+class ReftableStackTests(TestCase):
+
+    def setUp(self):
+        super(ReftableStackTests, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._path = os.path.join(self._tempdir, 'reftable')
+
+    def _set(self, stack, name, sha):
+        return stack.update(
+            lambda: [RefRecord(name, None, REF_VAL1, sha, None)])
+
+    def _tables_list(self):
+        f = open(os.path.join(self._path, TABLES_LIST), 'rb')
+        try:
+            return f.read().splitlines()
+        finally:
+            f.close()
+
+    def test_update(self):
+        stack = ReftableStack(self._path, auto_compact=False)
+        self.assertEqual(None, stack.get('refs/heads/master'))
+        self.assertTrue(self._set(stack, 'refs/heads/master', ONES))
+        self.assertTrue(self._set(stack, 'refs/heads/master', TWOS))
+        self.assertEqual(2, len(stack.tables()))
+        record = stack.get('refs/heads/master')
+        self.assertEqual((TWOS, 2), (record.value, record.update_index))
+        self.assertFalse(stack.update(lambda: None))
+        self.assertEqual(2, len(stack.tables()))
+
+    def test_deletion(self):
+        stack = ReftableStack(self._path, auto_compact=False)
+        self._set(stack, 'refs/heads/a', ONES)
+        self._set(stack, 'refs/heads/b', ONES)
+        stack.update(
+            lambda: [RefRecord('refs/heads/a', None, REF_DELETION, None, None)])
+        self.assertEqual(None, stack.get('refs/heads/a'))
+        self.assertEqual(['refs/heads/b'],
+                         [r.name for r in stack.iter_refs('refs/heads/')])
+        stack.compact()
+        self.assertEqual(1, len(stack.tables()))
+        self.assertEqual(['refs/heads/b'],
+                         [r.name for r in stack.tables()[0].iter_refs()])
+        self.assertEqual(1, len(self._tables_list()))
+        self.assertEqual(sorted(self._tables_list() + [TABLES_LIST]),
+                         sorted(os.listdir(self._path)))
+
+    def test_auto_compact(self):
+        stack = ReftableStack(self._path)
+        for i in range(64):
+            self._set(stack, 'refs/heads/branch-%d' % i, ONES)
+        tables = stack.tables()
+        self.assertTrue(len(tables) <= 7, len(tables))
+        for newer, older in zip(tables[1:], tables):
+            self.assertTrue(len(older) >= 2 * len(newer))
+        self.assertEqual(64, len(list(stack.iter_refs())))
+        self.assertEqual(64, tables[-1].max_update_index)
+
+    def test_reload(self):
+        stack = ReftableStack(self._path)
+        other = ReftableStack(self._path)
+        self.assertEqual(None, other.get('refs/heads/master'))
+        self._set(stack, 'refs/heads/master', ONES)
+        self.assertEqual(ONES, other.get('refs/heads/master').value)
+        self._set(other, 'refs/heads/master', TWOS)
+        self.assertEqual(TWOS, stack.get('refs/heads/master').value)
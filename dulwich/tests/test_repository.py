@@ -30,6 +30,7 @@ from dulwich.file import (
     GitFile,
     )
 from dulwich.object_store import (
+    SkippingGraphWalker,
     tree_lookup_path,
     )
 from dulwich import objects
@@ -40,6 +41,8 @@ from dulwich.repo import (
     InfoRefsContainer,
     Repo,
     MemoryRepo,
+    PackedRefs,
+    ReftableRefsContainer,
     read_packed_refs,
     read_packed_refs_with_peeled,
     write_packed_refs,
@@ -353,6 +356,25 @@ class RepositoryTests(TestCase):
         r = self._repo = open_repo('ooo_merge.git')
         self.assertIsInstance(r.get_config_stack(), Config)
 
+    def test_shallow(self):
+        r = self._repo = open_repo('a.git')
+        self.assertEqual(set(), r.get_shallow())
+        r.update_shallow([missing_sha], [])
+        self.assertEqual(set([missing_sha]), r.get_shallow())
+        self.assertEqual(set([missing_sha]), r.get_graph_walker().shallow)
+        r.update_shallow([], [missing_sha])
+        self.assertEqual(set(), r.get_shallow())
+        self.assertFalse(os.path.exists(os.path.join(r.controldir(),
+                                                     'shallow')))
+
+    def test_graph_walker_skipping(self):
+        r = self._repo = open_repo('a.git')
+        self.assertNotIsInstance(r.get_graph_walker(), SkippingGraphWalker)
+        c = r.get_config()
+        c.set(('fetch', ), 'negotiationAlgorithm', 'skipping')
+        c.write_to_path()
+        self.assertIsInstance(r.get_graph_walker(), SkippingGraphWalker)
+
     def test_submodule(self):
         temp_dir = tempfile.mkdtemp()
         repo_dir = os.path.join(os.path.dirname(__file__), 'data', 'repos')
@@ -658,7 +680,7 @@ class PackedRefsFileTests(TestCase):
         write_packed_refs(f, {'ref/1': ONES, 'ref/2': TWOS},
                           {'ref/1': THREES})
         self.assertEqual(
-          "# pack-refs with: peeled\n%s ref/1\n^%s\n%s ref/2\n" % (
+          "# pack-refs with: peeled sorted\n%s ref/1\n^%s\n%s ref/2\n" % (
           ONES, THREES, TWOS), f.getvalue())
 
     def test_write_without_peeled(self):
@@ -667,6 +689,96 @@ class PackedRefsFileTests(TestCase):
         self.assertEqual("%s ref/1\n%s ref/2\n" % (ONES, TWOS), f.getvalue())
 
 
+class PackedRefsTests(TestCase):
+
+    def setUp(self):
+        super(PackedRefsTests, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._path = os.path.join(self._tempdir, 'packed-refs')
+
+    def _write(self, contents):
+        f = open(self._path, 'wb')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+
+    def test_missing(self):
+        refs = PackedRefs(self._path)
+        self.assertEqual(None, refs.get('refs/heads/master'))
+        self.assertEqual([], list(refs.iter_prefix('')))
+        self.assertEqual({}, refs.as_dict())
+
+    def test_sorted(self):
+        self._write('# pack-refs with: peeled fully-peeled sorted \n'
+                    '%s refs/heads/a\n%s refs/heads/b\n%s refs/tags/c\n^%s\n'
+                    '%s refs/tags/d\n' % (ONES, TWOS, THREES, FOURS, ONES))
+        refs = PackedRefs(self._path)
+        self.assertEqual((ONES, None), refs.get('refs/heads/a'))
+        self.assertEqual((TWOS, None), refs.get('refs/heads/b'))
+        self.assertEqual((THREES, FOURS), refs.get('refs/tags/c'))
+        self.assertEqual((ONES, None), refs.get('refs/tags/d'))
+        self.assertEqual(None, refs.get('refs/heads/c'))
+        self.assertEqual(None, refs.get('refs/tags/e'))
+        self.assertEqual(None, refs.get('refs'))
+        self.assertTrue(refs.has_peeled)
+
+    def test_unsorted(self):
+        self._write('# pack-refs with: peeled \n'
+                    '%s refs/tags/c\n^%s\n%s refs/heads/b\n%s refs/heads/a\n'
+                    % (THREES, FOURS, TWOS, ONES))
+        refs = PackedRefs(self._path)
+        self.assertEqual((ONES, None), refs.get('refs/heads/a'))
+        self.assertEqual((THREES, FOURS), refs.get('refs/tags/c'))
+        self.assertEqual([('refs/heads/a', ONES, None),
+                          ('refs/heads/b', TWOS, None)],
+                         list(refs.iter_prefix('refs/heads/')))
+
+    def test_without_header(self):
+        self._write('%s refs/heads/b\n%s refs/heads/a\n' % (TWOS, ONES))
+        refs = PackedRefs(self._path)
+        self.assertFalse(refs.has_peeled)
+        self.assertEqual({'refs/heads/a': ONES, 'refs/heads/b': TWOS},
+                         refs.as_dict())
+
+    def test_iter_prefix(self):
+        names = ['refs/heads/%03d' % i for i in range(100)]
+        names.append('refs/tags/v1')
+        f = open(self._path, 'wb')
+        try:
+            write_packed_refs(f, dict((name, ONES) for name in names), {})
+        finally:
+            f.close()
+        refs = PackedRefs(self._path)
+        self.assertEqual(['refs/heads/050', 'refs/heads/051'],
+                         [name for (name, sha, peeled) in
+                          refs.iter_prefix('refs/heads/05')][:2])
+        self.assertEqual(['refs/tags/v1'],
+                         [name for (name, sha, peeled) in
+                          refs.iter_prefix('refs/tags/')])
+        self.assertEqual(101, len(list(refs.iter_prefix('refs/'))))
+        self.assertEqual([], list(refs.iter_prefix('refs/remotes/')))
+
+    def test_reload(self):
+        self._write('# pack-refs with: peeled sorted\n%s refs/heads/a\n' % ONES)
+        refs = PackedRefs(self._path)
+        self.assertEqual({'refs/heads/a': ONES}, refs.as_dict())
+        os.remove(self._path)
+        self._write('# pack-refs with: peeled sorted\n%s refs/heads/a\n'
+                    '%s refs/heads/b\n' % (TWOS, THREES))
+        self.assertEqual((TWOS, None), refs.get('refs/heads/a'))
+        self.assertEqual({'refs/heads/a': TWOS, 'refs/heads/b': THREES},
+                         refs.as_dict())
+        os.remove(self._path)
+        self.assertEqual(None, refs.get('refs/heads/a'))
+
+    def test_invalid(self):
+        self._write('# pack-refs with: peeled sorted\nbogus\n')
+        refs = PackedRefs(self._path)
+        self.assertRaises(errors.PackedRefsException, refs.get, 'refs/heads/a')
+
+
 # Dict of refs that we expect all RefsContainerTests subclasses to define.
 _TEST_REFS = {
   'HEAD': '42d06bd4b77fed026b154d16493e5deab78f02ec',
@@ -805,6 +917,29 @@ class DiskRefsContainerTests(RefsContainerTests, TestCase):
           'refs/tags/refs-0.1': 'df6800012397fb85c56e7418dd4eb9405dee075c',
           }, self._refs.get_packed_refs())
 
+    def test_get_packed_refs_reload(self):
+        refs_file = os.path.join(self._repo.path, 'packed-refs')
+        self.assertTrue('refs/heads/packed' in self._refs.get_packed_refs())
+        os.remove(refs_file)
+        f = GitFile(refs_file, 'wb')
+        try:
+            write_packed_refs(f, {'refs/heads/other': ONES}, {})
+        finally:
+            f.close()
+        self.assertEqual({'refs/heads/other': ONES},
+                         self._refs.get_packed_refs())
+        self.assertEqual(ONES, self._refs['refs/heads/other'])
+        self.assertRaises(KeyError, lambda: self._refs['refs/heads/packed'])
+
+    def test_as_dict_base(self):
+        self.assertEqual({
+          'refs-0.1': 'df6800012397fb85c56e7418dd4eb9405dee075c',
+          'refs-0.2': '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8',
+          }, self._refs.as_dict('refs/tags'))
+        self._refs['refs/heads/packed'] = ONES
+        self.assertEqual(ONES, self._refs.as_dict('refs/heads')['packed'])
+        self.assertFalse('loop' in self._refs.as_dict('refs/heads'))
+
     def test_get_peeled_not_packed(self):
         # not packed
         self.assertEqual(None, self._refs.get_peeled('refs/tags/refs-0.2'))
@@ -951,6 +1086,58 @@ class DiskRefsContainerTests(RefsContainerTests, TestCase):
             self._refs.read_ref("nonexistant"))
 
 
+class ReftableRefsContainerTests(RefsContainerTests, TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._refs = ReftableRefsContainer(self._tempdir)
+        self._refs.set_symbolic_ref('HEAD', 'refs/heads/master')
+        self._refs.set_symbolic_ref('refs/heads/loop', 'refs/heads/loop')
+        self.assertTrue(self._refs.update_refs(
+            (name, None, sha) for (name, sha) in _TEST_REFS.iteritems()
+            if name != 'HEAD'))
+
+    def test_update_refs(self):
+        nines = '9' * 40
+        self.assertFalse(self._refs.update_refs([
+            ('refs/heads/master', '42d06bd4b77fed026b154d16493e5deab78f02ec',
+             nines),
+            ('refs/tags/refs-0.1', 'c0ffee', None)]))
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         self._refs['refs/heads/master'])
+        self.assertTrue(self._refs.update_refs([
+            ('refs/heads/master', '42d06bd4b77fed026b154d16493e5deab78f02ec',
+             nines),
+            ('refs/tags/refs-0.1', 'df6800012397fb85c56e7418dd4eb9405dee075c',
+             None)]))
+        self.assertEqual(nines, self._refs['refs/heads/master'])
+        self.assertFalse('refs/tags/refs-0.1' in self._refs)
+        self.assertRaises(errors.RefFormatError, self._refs.update_refs,
+                          [('notrefs/foo', None, nines)])
+
+    def test_get_peeled(self):
+        self.assertEqual(None, self._refs.get_peeled('refs/tags/refs-0.1'))
+        self.assertEqual(None, self._refs.get_peeled('refs/tags/missing'))
+
+    def test_compact(self):
+        self._refs.compact()
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
+        self.assertEqual(1, len(self._refs._stack.tables()))
+
+    def test_repo(self):
+        repo = Repo.init_bare(self._tempdir)
+        config = repo.get_config()
+        config.set(("core", ), "repositoryformatversion", "1")
+        config.set(("extensions", ), "refStorage", "reftable")
+        config.write_to_path()
+        repo = Repo(self._tempdir)
+        self.assertTrue(isinstance(repo.refs, ReftableRefsContainer))
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         repo.refs['refs/heads/master'])
+
+
 _TEST_REFS_SERIALIZED = (
 '42d06bd4b77fed026b154d16493e5deab78f02ec\trefs/heads/master\n'
 '42d06bd4b77fed026b154d16493e5deab78f02ec\trefs/heads/packed\n'
@@ -20,18 +20,35 @@
 
 from cStringIO import StringIO
 import os
+import shutil
+import socket
 import tempfile
+import threading
+import time
 
+from dulwich.client import (
+    get_refs_many,
+    )
+from dulwich.commit_graph import (
+    CommitGraph,
+    write_commit_graph,
+    )
 from dulwich.errors import (
     GitProtocolError,
     NotGitRepository,
     UnexpectedCommandError,
     )
+from dulwich.protocol import (
+    DELIM_PKT,
+    Protocol,
+    pkt_line,
+    )
 from dulwich.repo import (
     MemoryRepo,
     Repo,
     )
 from dulwich.server import (
+    AsyncTCPGitServer,
     Backend,
     DictBackend,
     FileSystemBackend,
@@ -43,11 +60,15 @@ from dulwich.server import (
     ProtocolGraphWalker,
     ReceivePackHandler,
     SingleAckGraphWalkerImpl,
+    ThreadingTCPGitServer,
     UploadPackHandler,
+    _iter_prefetched,
     update_server_info,
     )
 from dulwich.tests import TestCase
+from dulwich.web import HTTPGitRequest
 from dulwich.tests.utils import (
+    build_commit_graph,
     make_commit,
     )
 
@@ -195,12 +216,204 @@ class UploadPackHandlerTestCase(TestCase):
         self.assertEqual({}, self._handler.get_tagged(refs, repo=self._repo))
 
 
+class UploadPackHandlerV2TestCase(TestCase):
+
+    def setUp(self):
+        super(UploadPackHandlerV2TestCase, self).setUp()
+        self._repo = MemoryRepo.init_bare([], {})
+        self._c1, self._c2 = build_commit_graph(self._repo.object_store,
+                                                [[1], [2, 1]])
+        self._repo.refs['refs/heads/master'] = self._c2.id
+        self._repo.refs['refs/heads/other'] = self._c1.id
+        self._repo.refs.set_symbolic_ref('HEAD', 'refs/heads/master')
+        self._backend = DictBackend({'/': self._repo})
+
+    def _handle(self, command, args,
+                handler_args=('/', 'host=lolcathost', '', 'version=2')):
+        request = [pkt_line('command=%s\n' % command), pkt_line(DELIM_PKT)]
+        request.extend(pkt_line('%s\n' % arg) for arg in args)
+        request.append(pkt_line(None))
+        output = StringIO()
+        proto = Protocol(StringIO(''.join(request)).read, output.write)
+        handler = UploadPackHandler(self._backend, list(handler_args), proto)
+        self.assertEqual(2, handler.protocol_version)
+        handler.handle()
+        output.seek(0)
+        proto = Protocol(output.read, None)
+        pkts = []
+        while not proto.eof():
+            pkt = proto.read_pkt_line()
+            if pkt not in (None, DELIM_PKT) and pkt[0] in '\x01\x02':
+                # Sideband data of the pack and progress messages
+                pkt = pkt[0]
+            pkts.append(pkt)
+        return pkts
+
+    def test_version_0(self):
+        handler = UploadPackHandler(self._backend, ['/', 'host=lolcathost'],
+                                    TestProto())
+        self.assertEqual(0, handler.protocol_version)
+
+    def test_capabilities(self):
+        pkts = self._handle('ls-refs', [])
+        self.assertEqual(['version 2\n'], pkts[:1])
+        self.assertTrue('ls-refs\n' in pkts[:pkts.index(None)])
+        self.assertTrue('fetch=shallow filter\n' in pkts[:pkts.index(None)])
+
+    def test_ls_refs(self):
+        pkts = self._handle('ls-refs', ['symrefs'])
+        pkts = pkts[pkts.index(None) + 1:]
+        self.assertEqual([
+            '%s HEAD symref-target:refs/heads/master\n' % self._c2.id,
+            '%s refs/heads/master\n' % self._c2.id,
+            '%s refs/heads/other\n' % self._c1.id,
+            None], pkts)
+
+    def test_ls_refs_prefix(self):
+        pkts = self._handle('ls-refs', ['ref-prefix refs/heads/o'])
+        pkts = pkts[pkts.index(None) + 1:]
+        self.assertEqual(['%s refs/heads/other\n' % self._c1.id, None], pkts)
+
+    def test_fetch_done(self):
+        pkts = self._handle('fetch', ['want %s' % self._c2.id, 'done'])
+        pkts = pkts[pkts.index(None) + 1:]
+        self.assertEqual('packfile\n', pkts[0])
+        self.assertTrue('\x01' in pkts)
+        self.assertEqual(None, pkts[-1])
+
+    def test_fetch_ready(self):
+        pkts = self._handle('fetch', ['want %s' % self._c2.id,
+                                      'have %s' % self._c1.id])
+        pkts = pkts[pkts.index(None) + 1:]
+        self.assertEqual(['acknowledgments\n', 'ACK %s\n' % self._c1.id,
+                          'ready\n', DELIM_PKT, 'packfile\n'], pkts[:5])
+
+    def test_fetch_not_ready(self):
+        pkts = self._handle('fetch', ['want %s' % self._c2.id,
+                                      'have %s' % FOUR])
+        pkts = pkts[pkts.index(None) + 1:]
+        self.assertEqual(['acknowledgments\n', 'NAK\n', None], pkts)
+
+    def test_fetch_filter(self):
+        pkts = self._handle('fetch', ['want %s' % self._c2.id,
+                                      'filter tree:0', 'done'])
+        pkts = pkts[pkts.index(None) + 1:]
+        self.assertEqual('packfile\n', pkts[0])
+        self.assertRaises(GitProtocolError, self._handle, 'fetch',
+                          ['want %s' % self._c2.id, 'filter bogus', 'done'])
+
+    def test_fetch_invalid_want(self):
+        self.assertRaises(GitProtocolError, self._handle, 'fetch',
+                          ['want %s' % FOUR, 'done'])
+
+    def test_fetch_deepen(self):
+        pkts = self._handle('fetch', ['want %s' % self._c2.id, 'deepen 1',
+                                      'done'])
+        pkts = pkts[pkts.index(None) + 1:]
+        self.assertEqual(['shallow-info\n', 'shallow %s\n' % self._c2.id,
+                          DELIM_PKT, 'packfile\n'], pkts[:4])
+
+    def test_fetch_unshallow(self):
+        pkts = self._handle('fetch', ['want %s' % self._c2.id,
+                                      'shallow %s' % self._c2.id,
+                                      'deepen 2', 'have %s' % self._c2.id,
+                                      'done'])
+        pkts = pkts[pkts.index(None) + 1:]
+        self.assertEqual(['shallow-info\n', 'unshallow %s\n' % self._c2.id,
+                          DELIM_PKT, 'packfile\n'], pkts[:4])
+
+
+class UploadPackHandlerStatelessTestCase(TestCase):
+
+    def setUp(self):
+        super(UploadPackHandlerStatelessTestCase, self).setUp()
+        self._repo = MemoryRepo.init_bare([], {})
+        self._c1, self._c2 = build_commit_graph(self._repo.object_store,
+                                                [[1], [2, 1]])
+        self._repo.refs['refs/heads/master'] = self._c2.id
+        self._backend = DictBackend({'/': self._repo})
+
+    def _handle(self, haves, done, caps='multi_ack_detailed'):
+        caps = ' '.join(
+            [caps] + list(UploadPackHandler.required_capabilities()))
+        request = [pkt_line('want %s %s\n' % (self._c2.id, caps)),
+                   pkt_line(None)]
+        request.extend(pkt_line('have %s\n' % have) for have in haves)
+        request.append(pkt_line(done and 'done\n' or None))
+        output = StringIO()
+        proto = Protocol(StringIO(''.join(request)).read, output.write)
+        handler = UploadPackHandler(self._backend, ['/', 'host=lolcathost'],
+                                    proto, http_req=HTTPGitRequest({}, None))
+        handler.handle()
+        output.seek(0)
+        proto = Protocol(output.read, None)
+        pkts = []
+        while not proto.eof():
+            pkt = proto.read_pkt_line()
+            if pkt is not None and pkt[0] in '\x01\x02':
+                pkt = pkt[0]
+            pkts.append(pkt)
+        return pkts
+
+    def test_round(self):
+        self.assertEqual(['NAK\n'], self._handle([FOUR], False))
+
+    def test_round_ready(self):
+        self.assertEqual(['ACK %s common\n' % self._c1.id,
+                          'ACK %s ready\n' % self._c1.id, 'NAK\n'],
+                         self._handle([FOUR, self._c1.id], False))
+
+    def test_round_multi_ack(self):
+        self.assertEqual(['ACK %s continue\n' % self._c1.id, 'NAK\n'],
+                         self._handle([self._c1.id], False,
+                                      'multi_ack'))
+
+    def test_done(self):
+        pkts = self._handle([self._c1.id], True)
+        self.assertEqual(['ACK %s common\n' % self._c1.id,
+                          'ACK %s ready\n' % self._c1.id,
+                          'ACK %s\n' % self._c1.id], pkts[:3])
+        self.assertTrue('\x01' in pkts)
+        self.assertEqual(None, pkts[-1])
+
+
 class TestUploadPackHandler(UploadPackHandler):
     @classmethod
     def required_capabilities(self):
         return ()
 
 
+class IterPrefetchedTests(TestCase):
+
+    def test_items(self):
+        self.assertEqual(range(100), list(_iter_prefetched(xrange(100), 5)))
+
+    def test_empty(self):
+        self.assertEqual([], list(_iter_prefetched([], 5)))
+
+    def test_exception(self):
+        def fail():
+            yield 1
+            raise ValueError('broken')
+        it = _iter_prefetched(fail(), 5)
+        self.assertEqual(1, it.next())
+        self.assertRaises(ValueError, it.next)
+
+    def test_close(self):
+        finished = threading.Event()
+        def produce():
+            try:
+                for i in xrange(100):
+                    yield i
+            finally:
+                finished.set()
+        it = _iter_prefetched(produce(), 2)
+        self.assertEqual(0, it.next())
+        it.close()
+        finished.wait(5)
+        self.assertTrue(finished.isSet())
+
+
 class ProtocolGraphWalkerTestCase(TestCase):
 
     def setUp(self):
@@ -247,6 +460,24 @@ class ProtocolGraphWalkerTestCase(TestCase):
         self.assertFalse(self._walker.all_wants_satisfied([THREE]))
         self.assertTrue(self._walker.all_wants_satisfied([TWO, THREE]))
 
+    def test_all_wants_satisfied_commit_graph(self):
+        store = self._repo.object_store
+        f = StringIO()
+        write_commit_graph(f, [(c.id, c.tree, c.parents, c.commit_time)
+                               for c in [store[sha] for sha in store]])
+        graph = CommitGraph('commit-graph', file=StringIO(f.getvalue()))
+        store.get_commit_graph = lambda: graph
+        # The commits themselves are no longer needed
+        for sha in [ONE, TWO, THREE, FOUR, FIVE]:
+            del store[sha]
+        self._walker.set_wants([FOUR, FIVE])
+        self.assertTrue(self._walker.all_wants_satisfied([FOUR, FIVE]))
+        self.assertTrue(self._walker.all_wants_satisfied([ONE]))
+        self.assertFalse(self._walker.all_wants_satisfied([TWO]))
+        self.assertFalse(self._walker.all_wants_satisfied([THREE]))
+        self.assertTrue(self._walker.all_wants_satisfied([TWO, THREE]))
+        self.assertFalse(self._walker._is_satisfied([TWO], FIVE, 0, 2))
+
     def test_split_proto_line(self):
         allowed = ('want', 'done', None)
         self.assertEqual(('want', ONE),
@@ -263,6 +494,20 @@ class ProtocolGraphWalkerTestCase(TestCase):
         self.assertEqual(('done', None), _split_proto_line('done\n', allowed))
         self.assertEqual((None, None), _split_proto_line('', allowed))
 
+    def test_split_proto_line_deepen(self):
+        allowed = ('shallow', 'deepen', 'deepen-since')
+        self.assertEqual(('shallow', ONE),
+                         _split_proto_line('shallow %s\n' % ONE, allowed))
+        self.assertEqual(('deepen', 3),
+                         _split_proto_line('deepen 3\n', allowed))
+        self.assertEqual(('deepen-since', 1234567890),
+                         _split_proto_line('deepen-since 1234567890\n',
+                                           allowed))
+        self.assertRaises(GitProtocolError, _split_proto_line,
+                          'deepen 0\n', allowed)
+        self.assertRaises(GitProtocolError, _split_proto_line,
+                          'deepen x\n', allowed)
+
     def test_determine_wants(self):
         self.assertEqual(None, self._walker.determine_wants({}))
         self.assertEqual(None, self._walker.proto.get_received_line())
@@ -291,6 +536,64 @@ class ProtocolGraphWalkerTestCase(TestCase):
         self._walker.proto.set_output(['want %s multi_ack' % FOUR])
         self.assertRaises(GitProtocolError, self._walker.determine_wants, heads)
 
+    def test_determine_wants_filter(self):
+        heads = {'refs/heads/ref1': ONE}
+        self._repo.refs._update(heads)
+        self._walker.proto.set_output(['want %s filter' % ONE,
+                                       'filter tree:1'])
+        self.assertEqual([ONE], self._walker.determine_wants(heads))
+        self.assertEqual(1, self._walker.object_filter.depth)
+
+        # The filter capability has to be negotiated first
+        self._walker.proto.set_output(['want %s' % ONE, 'filter tree:1'])
+        self.assertRaises(UnexpectedCommandError,
+                          self._walker.determine_wants, heads)
+
+        self._walker.proto.set_output(['want %s filter' % ONE,
+                                       'filter sparse:oid=%s' % TWO])
+        self.assertRaises(GitProtocolError, self._walker.determine_wants,
+                          heads)
+
+    def _skip_advertisement(self):
+        while self._walker.proto.get_received_line() is not None:
+            pass
+
+    def test_determine_wants_deepen(self):
+        heads = {'refs/heads/ref4': FOUR, 'refs/heads/ref5': FIVE}
+        self._repo.refs._update(heads)
+        self._walker.proto.set_output(['want %s shallow' % FOUR, 'deepen 2'])
+        self.assertEqual([FOUR], self._walker.determine_wants(heads))
+        self._skip_advertisement()
+        self.assertEqual('shallow %s\n' % TWO,
+                         self._walker.proto.get_received_line())
+        self.assertEqual(None, self._walker.proto.get_received_line())
+        self.assertEqual(set([TWO]), self._walker.shallow)
+
+        # Deepening a shallow clone
+        self._walker.proto.set_output(['want %s shallow' % FOUR,
+                                       'shallow %s' % TWO, 'deepen 3'])
+        self.assertEqual([FOUR], self._walker.determine_wants(heads))
+        self._skip_advertisement()
+        self.assertEqual('unshallow %s\n' % TWO,
+                         self._walker.proto.get_received_line())
+        self.assertEqual(None, self._walker.proto.get_received_line())
+        self.assertEqual(set(), self._walker.shallow)
+
+        # Clients do not have to echo the shallow capability
+        self._walker.proto.set_output(['want %s' % FOUR, 'deepen 2'])
+        self.assertEqual([FOUR], self._walker.determine_wants(heads))
+        self.assertEqual(set([TWO]), self._walker.shallow)
+
+    def test_determine_wants_deepen_since(self):
+        heads = {'refs/heads/ref5': FIVE}
+        self._repo.refs._update(heads)
+        self._walker.proto.set_output(['want %s' % FIVE, 'deepen-since 400'])
+        self.assertEqual([FIVE], self._walker.determine_wants(heads))
+        self._skip_advertisement()
+        self.assertEqual('shallow %s\n' % FIVE,
+                         self._walker.proto.get_received_line())
+        self.assertEqual(set([FIVE]), self._walker.shallow)
+
     def test_determine_wants_advertisement(self):
         self._walker.proto.set_output([])
         # advertise branch tips plus tag
@@ -334,6 +637,7 @@ class TestProtocolGraphWalker(object):
         self.acks = []
         self.lines = []
         self.done = False
+        self.done_received = False
         self.http_req = None
         self.advertise_refs = False
 
@@ -530,6 +834,21 @@ class MultiAckGraphWalkerImplTestCase(AckGraphWalkerImplTestCase):
 
         self.assertNextEquals(None)
         self.assertNak()
+        self.assertTrue(self._walker.done_received)
+
+    def test_multi_ack_stateless(self):
+        # transmission ends with a flush-pkt
+        self._walker.lines[-1] = (None, None)
+        self._walker.http_req = True
+
+        self.assertNextEquals(TWO)
+        self.assertNextEquals(ONE)
+        self.assertNextEquals(THREE)
+        self.assertNoAck()
+
+        self.assertNextEquals(None)
+        self.assertNak()
+        self.assertFalse(self._walker.done_received)
 
 
 class MultiAckDetailedGraphWalkerImplTestCase(AckGraphWalkerImplTestCase):
@@ -643,6 +962,7 @@ class MultiAckDetailedGraphWalkerImplTestCase(AckGraphWalkerImplTestCase):
 
         self.assertNextEquals(None)
         self.assertNak()
+        self.assertFalse(self._walker.done_received)
 
 
 class FileSystemBackendTests(TestCase):
@@ -666,6 +986,18 @@ class FileSystemBackendTests(TestCase):
         self.assertRaises(NotGitRepository,
             self.backend.open_repository, os.path.join(self.path, "foo"))
 
+    def test_root(self):
+        backend = FileSystemBackend(self.path)
+        repo = backend.open_repository('/')
+        self.assertEqual(repo.path, self.repo.path)
+        self.assertFalse(repo is backend.open_repository('/'))
+
+    def test_outside_root(self):
+        backend = FileSystemBackend(os.path.join(self.path, '.git'))
+        self.assertRaises(NotGitRepository, backend.open_repository, '/..')
+        self.assertRaises(NotGitRepository, backend.open_repository,
+                          '/../../%s' % os.path.basename(self.path))
+
     def test_bad_repo_path(self):
         repo = MemoryRepo.init_bare([], {})
         backend = DictBackend({'/': repo})
@@ -698,6 +1030,159 @@ class ServeCommandTests(TestCase):
         self.assertEqual("0000", outlines[-1])
         self.assertEqual(0, exitcode)
 
+    def test_relative_path(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        Repo.init(os.path.join(path, 'r'), mkdir=True)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(path)
+        outf = StringIO()
+        exitcode = serve_command(ReceivePackHandler, ["test", "r"],
+                                 inf=StringIO("0000"), outf=outf)
+        self.assertEqual(0, exitcode)
+        # The empty repository advertises its capabilities only.
+        self.assertTrue(outf.getvalue().startswith(
+            "0064%s capabilities^{}\x00" % ("0" * 40)))
+
+
+class BlockingHandler(object):
+    """Handler that waits until it is released."""
+
+    def __init__(self, backend, args, proto):
+        self.backend = backend
+        self.proto = proto
+
+    def handle(self):
+        self.backend.release.wait()
+        self.proto.write_pkt_line('done')
+
+
+class ThreadingTCPGitServerTests(TestCase):
+    """Tests for ThreadingTCPGitServer."""
+
+    def setUp(self):
+        super(ThreadingTCPGitServerTests, self).setUp()
+        self.backend = DictBackend({})
+        self.backend.release = threading.Event()
+        self.server = ThreadingTCPGitServer(self.backend, 'localhost', 0,
+            handlers={'git-upload-pack': BlockingHandler},
+            idle_timeout=5, max_connections=2)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.backend.release.set)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def connect(self, command=True):
+        sock = socket.create_connection(self.server.socket.getsockname())
+        self.addCleanup(sock.close)
+        sock.settimeout(5)
+        if command:
+            sock.sendall(pkt_line('git-upload-pack /\x00host=localhost\x00'))
+        return sock
+
+    def wait_for_connections(self, n):
+        for i in range(100):
+            if self.server.active_connections == n:
+                return
+            time.sleep(0.05)
+        self.assertEqual(n, self.server.active_connections)
+
+    def test_max_connections(self):
+        socks = [self.connect() for i in range(3)]
+        self.wait_for_connections(2)
+        # The third connection waits in the listen backlog
+        time.sleep(0.2)
+        self.assertEqual(2, self.server.active_connections)
+        self.assertFalse(self.server.drain(0.1))
+        self.backend.release.set()
+        for sock in socks:
+            self.assertEqual(pkt_line('done'), sock.recv(100))
+        self.assertTrue(self.server.drain(5))
+        self.assertEqual(0, self.server.active_connections)
+
+    def test_idle_timeout(self):
+        self.server.idle_timeout = 0.1
+        sock = self.connect(command=False)
+        self.wait_for_connections(1)
+        self.assertEqual('', sock.recv(100))
+        self.assertTrue(self.server.drain(5))
+
+    def test_shutdown_while_saturated(self):
+        self.connect()
+        self.connect()
+        self.wait_for_connections(2)
+        self.connect()
+        time.sleep(0.1)
+        self.server.shutdown()
+        self.assertFalse(self.server.drain(0.1))
+        self.backend.release.set()
+        self.assertTrue(self.server.drain(5))
+
+
+class AsyncTCPGitServerTests(TestCase):
+    """Tests for AsyncTCPGitServer."""
+
+    def setUp(self):
+        super(AsyncTCPGitServerTests, self).setUp()
+        commit = make_commit(id=ONE, parents=[], commit_time=111)
+        self.repo = MemoryRepo.init_bare(
+            [commit], {'refs/heads/master': commit.id})
+        self.backend = DictBackend({'/': self.repo})
+        self.server = AsyncTCPGitServer(self.backend, 'localhost', 0,
+                                        max_connections=1)
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+        self.address = self.server.socket.getsockname()
+
+    def connect(self):
+        sock = socket.create_connection(self.address)
+        self.addCleanup(sock.close)
+        sock.settimeout(5)
+        return sock
+
+    def read_advertisement(self, sock):
+        data = ''
+        while not data.endswith('0000'):
+            data += sock.recv(1024)
+        return data
+
+    def test_get_refs(self):
+        location = self.address + ('/', )
+        self.assertEqual({location: {'refs/heads/master': ONE}},
+                         get_refs_many([location], timeout=5))
+
+    def test_idle_connections(self):
+        # Connections waiting for their client do not take up the only
+        # worker thread.
+        socks = [self.connect() for i in range(5)]
+        for sock in socks:
+            sock.sendall(pkt_line('git-upload-pack /\x00host=localhost\x00'))
+        for sock in socks:
+            self.assertTrue(ONE in self.read_advertisement(sock))
+        location = self.address + ('/', )
+        self.assertEqual({'refs/heads/master': ONE},
+                         get_refs_many([location], timeout=5)[location])
+        for sock in socks:
+            sock.sendall(pkt_line(None))
+            self.assertEqual('', sock.recv(100))
+
+    def test_idle_timeout(self):
+        self.server.idle_timeout = 0.1
+        sock = self.connect()
+        self.assertEqual('', sock.recv(100))
+
+    def test_invalid_service(self):
+        sock = self.connect()
+        sock.sendall(pkt_line('git-foo /\x00host=localhost\x00'))
+        self.assertEqual('', sock.recv(100))
+
 
 class UpdateServerInfoTests(TestCase):
     """Tests for update_server_info."""
@@ -18,9 +18,15 @@
 
 """Tests for commit walking functionality."""
 
+from cStringIO import StringIO
+
 from dulwich._compat import (
     permutations,
     )
+from dulwich.commit_graph import (
+    CommitGraph,
+    write_commit_graph,
+    )
 from dulwich.diff_tree import (
     CHANGE_ADD,
     CHANGE_MODIFY,
@@ -125,6 +131,19 @@ class WalkerTest(TestCase):
             self.assertWalkYields(cs[:i], [cs[0].id], max_entries=i)
         self.assertRaises(MissingCommitError, Walker, self.store, [cs[-1].id])
 
+    def test_commit_graph(self):
+        c1, x2, x3, y4, y5 = self.make_commits(
+            [[1], [2, 1], [3, 2], [4, 1], [5, 4]], times=[1, 2, 3, 4, 5])
+        f = StringIO()
+        write_commit_graph(f, [(c.id, c.tree, c.parents, c.commit_time)
+                               for c in [c1, x2, x3, y4, y5]])
+        graph = CommitGraph('commit-graph', file=StringIO(f.getvalue()))
+        self.store.get_commit_graph = lambda: graph
+        # Excluded commits are only looked up in the commit-graph
+        for c in [c1, x2, x3]:
+            del self.store[c.id]
+        self.assertWalkYields([y5, y4], [y5.id], exclude=[x3.id])
+
     def test_branch(self):
         c1, x2, x3, y4 = self.make_commits([[1], [2, 1], [3, 2], [4, 1]])
         self.assertWalkYields([x3, x2, c1], [x3.id])
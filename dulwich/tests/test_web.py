@@ -46,6 +46,7 @@ from dulwich.web import (
     HTTP_FORBIDDEN,
     HTTP_ERROR,
     GunzipFilter,
+    LimitedInputFilter,
     send_file,
     get_text_file,
     get_loose_object,
@@ -54,6 +55,8 @@ from dulwich.web import (
     get_info_refs,
     get_info_packs,
     handle_service_request,
+    _ChunkedFile,
+    _GunzipFile,
     _LengthLimitedFile,
     HTTPGitRequest,
     HTTPGitApplication,
@@ -291,6 +294,11 @@ class SmartHandlersTestCase(WebTestCase):
             self.proto = proto
             self.http_req = http_req
             self.advertise_refs = advertise_refs
+            environ = getattr(http_req, 'environ', {})
+            if 'version=2' in environ.get('HTTP_GIT_PROTOCOL', ''):
+                self.protocol_version = 2
+            else:
+                self.protocol_version = 0
 
         def handle(self):
             self.proto.write('handled input: %s' % self.proto.recv(1024))
@@ -356,6 +364,16 @@ class SmartHandlersTestCase(WebTestCase):
         self.assertTrue(self._handler.http_req)
         self.assertFalse(self._req.cached)
 
+    def test_get_info_refs_v2(self):
+        self._environ['wsgi.input'] = StringIO('foo')
+        self._environ['QUERY_STRING'] = 'service=git-upload-pack'
+        self._environ['HTTP_GIT_PROTOCOL'] = 'version=2'
+
+        mat = re.search('.*', '/git-upload-pack')
+        list(get_info_refs(self._req, 'backend', mat))
+        # There is no service line in protocol version 2
+        self.assertEqual('handled input: ', self._output.getvalue())
+
 
 class LengthLimitedFileTestCase(TestCase):
     def test_no_cutoff(self):
@@ -374,6 +392,44 @@ class LengthLimitedFileTestCase(TestCase):
         self.assertEqual('', f.read())
 
 
+class ChunkedFileTestCase(TestCase):
+
+    def test_read(self):
+        f = _ChunkedFile(StringIO('3\r\nfoo\r\n3;ext=1\r\nbar\r\n0\r\n'
+                                  'Trailer: x\r\n\r\nnext request'))
+        self.assertEqual('foobar', f.read())
+        self.assertEqual('', f.read())
+
+    def test_multiple_reads(self):
+        f = _ChunkedFile(StringIO('3\r\nfoo\r\na\r\nbarbazquux\r\n'
+                                  '0\r\n\r\n'))
+        self.assertEqual('fo', f.read(2))
+        self.assertEqual('obarb', f.read(5))
+        self.assertEqual('azquux', f.read(100))
+        self.assertEqual('', f.read(100))
+
+    def test_truncated(self):
+        f = _ChunkedFile(StringIO('6\r\nfoo'))
+        self.assertRaises(IOError, f.read)
+        f = _ChunkedFile(StringIO('foo\r\n'))
+        self.assertRaises(IOError, f.read)
+
+
+class GunzipFileTestCase(TestCase):
+
+    def test_read(self):
+        data = ''.join(str(i) for i in range(10000))
+        zstream = StringIO()
+        zfile = gzip.GzipFile(fileobj=zstream, mode='w')
+        zfile.write(data)
+        zfile.close()
+        f = _GunzipFile(_LengthLimitedFile(StringIO(zstream.getvalue()),
+                                           len(zstream.getvalue())))
+        self.assertEqual(data[:5], f.read(5))
+        self.assertEqual(data[5:], f.read())
+        self.assertEqual('', f.read(5))
+
+
 class HTTPGitRequestTestCase(WebTestCase):
 
     # This class tests the contents of the actual cache headers
@@ -482,7 +538,52 @@ class GunzipTestCase(HTTPGitApplicationTestCase):
         app_output = self._app(self._environ, None)
         buf = self._environ['wsgi.input']
         self.assertIsNot(buf, zstream)
-        buf.seek(0)
         self.assertEqual(orig, buf.read())
         self.assertIs(None, self._environ.get('CONTENT_LENGTH'))
         self.assertNotIn('HTTP_CONTENT_ENCODING', self._environ)
+
+
+class LimitedInputFilterTestCase(TestCase):
+
+    def setUp(self):
+        super(LimitedInputFilterTestCase, self).setUp()
+        self._app = LimitedInputFilter(
+            lambda environ, start_response: environ['wsgi.input'].read())
+        self._environ = {'REQUEST_METHOD': 'POST'}
+
+    def test_content_length(self):
+        self._environ['CONTENT_LENGTH'] = '3'
+        self._environ['wsgi.input'] = StringIO('foobar')
+        self.assertEqual('foo', self._app(self._environ, None))
+
+    def test_chunked(self):
+        self._environ['SERVER_SOFTWARE'] = 'WSGIServer/0.1 Python/2.7'
+        self._environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        self._environ['wsgi.input'] = StringIO('3\r\nfoo\r\n0\r\n\r\nbar')
+        self.assertEqual('foo', self._app(self._environ, None))
+        self.assertNotIn('HTTP_TRANSFER_ENCODING', self._environ)
+
+    def test_chunked_decoded_by_server(self):
+        self._environ['SERVER_SOFTWARE'] = 'gunicorn/19.9.0'
+        self._environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        self._environ['wsgi.input'] = StringIO('foo')
+        self.assertEqual('foo', self._app(self._environ, None))
+
+    def test_chunked_input_terminated(self):
+        self._environ['SERVER_SOFTWARE'] = 'WSGIServer/0.1 Python/2.7'
+        self._environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        self._environ['wsgi.input_terminated'] = True
+        self._environ['wsgi.input'] = StringIO('foo')
+        self.assertEqual('foo', self._app(self._environ, None))
+
+    def test_dechunk(self):
+        app = LimitedInputFilter(
+            lambda environ, start_response: environ['wsgi.input'].read(),
+            dechunk=True)
+        self._environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        self._environ['wsgi.input'] = StringIO('3\r\nfoo\r\n0\r\n\r\n')
+        self.assertEqual('foo', app(self._environ, None))
+        app.dechunk = False
+        self._environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        self._environ['wsgi.input'] = StringIO('3\r\nfoo\r\n0\r\n\r\n')
+        self.assertEqual('3\r\nfoo\r\n0\r\n\r\n', app(self._environ, None))
@@ -100,7 +100,7 @@ class _CommitTimeQueue(object):
         self._seen = set()
         self._done = set()
         self._min_time = walker.since
-        self._last = None
+        self._last_time = None
         self._extra_commits_left = _MAX_EXTRA_COMMITS
         self._is_finished = False
 
@@ -108,52 +108,51 @@ class _CommitTimeQueue(object):
             self._push(commit_id)
 
     def _push(self, commit_id):
+        if commit_id in self._pq_set or commit_id in self._done:
+            return
         try:
-            commit = self._store[commit_id]
+            commit_time = self._store.get_commit_time(commit_id)
         except KeyError:
             raise MissingCommitError(commit_id)
-        if commit_id not in self._pq_set and commit_id not in self._done:
-            heapq.heappush(self._pq, (-commit.commit_time, commit))
-            self._pq_set.add(commit_id)
-            self._seen.add(commit_id)
+        heapq.heappush(self._pq, (-commit_time, commit_id))
+        self._pq_set.add(commit_id)
+        self._seen.add(commit_id)
 
-    def _exclude_parents(self, commit):
+    def _exclude_parents(self, commit_id):
         excluded = self._excluded
         seen = self._seen
-        todo = [commit]
+        get_parents = self._store.get_parents
+        todo = [commit_id]
         while todo:
-            commit = todo.pop()
-            for parent in commit.parents:
+            commit_id = todo.pop()
+            for parent in get_parents(commit_id):
                 if parent not in excluded and parent in seen:
-                    # TODO: This is inefficient unless the object store does
-                    # some caching (which DiskObjectStore currently does not).
-                    # We could either add caching in this class or pass around
-                    # parsed queue entry objects instead of commits.
-                    todo.append(self._store[parent])
+                    todo.append(parent)
                 excluded.add(parent)
 
     def next(self):
         if self._is_finished:
             return None
         while self._pq:
-            _, commit = heapq.heappop(self._pq)
-            sha = commit.id
+            neg_time, sha = heapq.heappop(self._pq)
+            commit_time = -neg_time
             self._pq_set.remove(sha)
             if sha in self._done:
                 continue
-            self._done.add(commit.id)
+            self._done.add(sha)
 
-            for parent_id in commit.parents:
+            for parent_id in self._store.get_parents(sha):
                 self._push(parent_id)
 
             reset_extra_commits = True
             is_excluded = sha in self._excluded
             if is_excluded:
-                self._exclude_parents(commit)
-                if self._pq and all(c.id in self._excluded
+                self._exclude_parents(sha)
+                if self._pq and all(c in self._excluded
                                     for _, c in self._pq):
-                    _, n = self._pq[0]
-                    if self._last and n.commit_time >= self._last.commit_time:
+                    next_time = -self._pq[0][0]
+                    if (self._last_time is not None and
+                        next_time >= self._last_time):
                         # If the next commit is newer than the last one, we need
                         # to keep walking in case its parents (which we may not
                         # have seen yet) are excluded. This gives the excluded
@@ -164,7 +163,7 @@ class _CommitTimeQueue(object):
                         reset_extra_commits = False
 
             if (self._min_time is not None and
-                commit.commit_time < self._min_time):
+                commit_time < self._min_time):
                 # We want to stop walking at min_time, but commits at the
                 # boundary may be out of order with respect to their parents. So
                 # we walk _MAX_EXTRA_COMMITS more commits once we hit this
@@ -180,8 +179,8 @@ class _CommitTimeQueue(object):
                     break
 
             if not is_excluded:
-                self._last = commit
-                return WalkEntry(self._walker, commit)
+                self._last_time = commit_time
+                return WalkEntry(self._walker, self._store[sha])
         self._is_finished = True
         return None
 
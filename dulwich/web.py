@@ -19,11 +19,11 @@
 """HTTP server for dulwich that implements the git smart HTTP protocol."""
 
 from cStringIO import StringIO
-import gzip
 import os
 import re
 import sys
 import time
+import zlib
 
 try:
     from urlparse import parse_qs
@@ -53,6 +53,9 @@ HTTP_NOT_FOUND = '404 Not Found'
 HTTP_FORBIDDEN = '403 Forbidden'
 HTTP_ERROR = '500 Internal Server Error'
 
+# Number of bytes of compressed request body to decompress at once
+GUNZIP_READ_SIZE = 64 * 1024
+
 
 def date_time_string(timestamp=None):
     # From BaseHTTPRequestHandler.date_time_string in BaseHTTPServer.py in the
@@ -173,8 +176,9 @@ def get_info_refs(req, backend, mat):
         proto = ReceivableProtocol(StringIO().read, write)
         handler = handler_cls(backend, [url_prefix(mat)], proto,
                               http_req=req, advertise_refs=True)
-        handler.proto.write_pkt_line('# service=%s\n' % service)
-        handler.proto.write_pkt_line(None)
+        if handler.protocol_version < 2:
+            handler.proto.write_pkt_line('# service=%s\n' % service)
+            handler.proto.write_pkt_line(None)
         handler.handle()
     else:
         # non-smart fallback
@@ -217,6 +221,79 @@ class _LengthLimitedFile(object):
     # TODO: support more methods as necessary
 
 
+class _ChunkedFile(object):
+    """Wrapper class to decode a body sent with chunked transfer encoding.
+
+    wsgiref passes the body of HTTP/1.1 requests without a Content-Length on
+    as it was received, so the chunk sizes have to be stripped here.
+    """
+
+    def __init__(self, input):
+        self._input = input
+        self._chunk_left = 0
+        self._eof = False
+
+    def _next_chunk(self):
+        line = self._input.readline()
+        try:
+            self._chunk_left = int(line.split(';', 1)[0], 16)
+        except ValueError:
+            raise IOError('invalid chunk size line %r' % line)
+        if self._chunk_left == 0:
+            # Skip the trailer
+            while self._input.readline().strip():
+                pass
+            self._eof = True
+
+    def read(self, size=-1):
+        ret = []
+        while not self._eof and size != 0:
+            if self._chunk_left == 0:
+                self._next_chunk()
+                continue
+            if size < 0 or size > self._chunk_left:
+                data = self._input.read(self._chunk_left)
+            else:
+                data = self._input.read(size)
+            if not data:
+                raise IOError('unexpected end of chunked request body')
+            ret.append(data)
+            self._chunk_left -= len(data)
+            if size > 0:
+                size -= len(data)
+            if self._chunk_left == 0:
+                # Each chunk is followed by a line break
+                self._input.readline()
+        return ''.join(ret)
+
+
+class _GunzipFile(object):
+    """Wrapper class to decompress gzip data read from a file-like object.
+
+    Unlike gzip.GzipFile, this never seeks in the underlying file, which is
+    not possible for the input of a request.
+    """
+
+    def __init__(self, input):
+        self._input = input
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buf = ''
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            data = self._input.read(GUNZIP_READ_SIZE)
+            if data:
+                self._buf += self._decompressor.decompress(data)
+            else:
+                self._buf += self._decompressor.flush()
+                self._eof = True
+        if size < 0:
+            size = len(self._buf)
+        ret, self._buf = self._buf[:size], self._buf[size:]
+        return ret
+
+
 def handle_service_request(req, backend, mat):
     service = mat.group().lstrip('/')
     logger.info('Handling service request for %s', service)
@@ -363,26 +440,50 @@ class GunzipFilter(object):
             environ.pop('HTTP_CONTENT_ENCODING')
             if 'CONTENT_LENGTH' in environ:
                 del environ['CONTENT_LENGTH']
-            environ['wsgi.input'] = gzip.GzipFile(filename=None,
-                fileobj=environ['wsgi.input'], mode='r')
+            environ['wsgi.input'] = _GunzipFile(environ['wsgi.input'])
         return self.app(environ, start_response)
 
 
+def _server_dechunks(environ):
+    """Check whether the WSGI server decodes chunked request bodies itself.
+
+    Servers such as gunicorn and mod_wsgi do, and some of them say so with
+    wsgi.input_terminated. wsgiref passes the body on as it was received.
+    """
+    if environ.get('wsgi.input_terminated'):
+        return True
+    return not environ.get('SERVER_SOFTWARE', '').startswith('WSGIServer/')
+
+
 class LimitedInputFilter(object):
     """WSGI middleware that limits the input length of a request to that
-    specified in Content-Length.
+    specified in Content-Length, or to the chunks of a chunked request.
     """
 
-    def __init__(self, application):
+    def __init__(self, application, dechunk=None):
+        """Create a new LimitedInputFilter.
+
+        :param application: The WSGI application to wrap
+        :param dechunk: Whether to decode chunked request bodies: True if the
+            WSGI server does not, False if it does, or None to only decode
+            them when running under wsgiref
+        """
         self.app = application
+        self.dechunk = dechunk
 
     def __call__(self, environ, start_response):
         # This is not necessary if this app is run from a conforming WSGI
         # server. Unfortunately, there's no way to tell that at this point.
-        # TODO: git may used HTTP/1.1 chunked encoding instead of specifying
-        # content-length
         content_length = environ.get('CONTENT_LENGTH', '')
-        if content_length:
+        transfer_encoding = environ.get('HTTP_TRANSFER_ENCODING', '')
+        if transfer_encoding.lower() == 'chunked':
+            dechunk = self.dechunk
+            if dechunk is None:
+                dechunk = not _server_dechunks(environ)
+            if dechunk:
+                environ.pop('HTTP_TRANSFER_ENCODING')
+                environ['wsgi.input'] = _ChunkedFile(environ['wsgi.input'])
+        elif content_length:
             environ['wsgi.input'] = _LengthLimitedFile(
                 environ['wsgi.input'], int(content_length))
         return self.app(environ, start_response)
@@ -391,9 +492,13 @@ class LimitedInputFilter(object):
 def make_wsgi_chain(*args, **kwargs):
     """Factory function to create an instance of HTTPGitApplication,
     correctly wrapped with needed middleware.
+
+    The dechunk keyword argument is passed on to LimitedInputFilter.
     """
+    dechunk = kwargs.pop('dechunk', None)
     app = HTTPGitApplication(*args, **kwargs)
-    wrapped_app = GunzipFilter(LimitedInputFilter(app))
+    # The input has to be limited before it can be decompressed
+    wrapped_app = LimitedInputFilter(GunzipFilter(app), dechunk=dechunk)
     return wrapped_app
 
 